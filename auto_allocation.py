@@ -0,0 +1,280 @@
+# auto_allocation.py
+"""
+Bulk auto-allocation of high-confidence M-Pesa receipts.
+
+Receipts in ``unallocated_payments`` whose tenant was matched with high
+confidence (house number on PayBill, or phone and name) are allocated
+first-in-first-out: the oldest receipt pays the oldest outstanding bills of
+its tenant's house. The whole run is planned in memory from two queries and
+committed with one ``bulk_write`` per collection inside a transaction, so a
+run either applies completely or not at all. Each tenant then gets one SMS
+summarising everything allocated for them, and every run is recorded in
+``allocation_runs`` with its throughput.
+
+Run ``python auto_allocation.py <admin_id> [--dry-run]``.
+"""
+import logging
+import sys
+import time
+from collections import defaultdict, deque
+from datetime import datetime
+
+from bson import ObjectId
+from pymongo import ASCENDING, UpdateOne
+
+import balances
+import rollups
+from sms_outbox import build_outbox_message, enqueue_sms_many
+
+logger = logging.getLogger(__name__)
+
+ALLOCATION_METHOD = 'mpesa_auto_allocated'
+OPEN_RECEIPT_STATUSES = ('pending', 'partial')
+OUTSTANDING_STATUSES = ('unpaid', 'partial')
+# Bills or receipts changed by someone else while a run was being committed are re-planned this many times
+MAX_PLAN_ATTEMPTS = 3
+
+
+def _remaining(amount):
+    """Round away float noise; anything under PRECISION counts as nothing left"""
+    amount = round(amount, 2)
+    return amount if amount > balances.PRECISION else 0.0
+
+
+def plan_allocations(db, admin_id):
+    """Plan FIFO allocations of the admin's open high-confidence receipts; returns a list of receipt plans"""
+    receipts = list(db.unallocated_payments.find(
+        {
+            'admin_id': admin_id,
+            'allocation_status': {'$in': list(OPEN_RECEIPT_STATUSES)},
+            'matching_confidence': 'high',
+            'house_id': {'$ne': None},
+            'amount_remaining': {'$gt': balances.PRECISION}
+        },
+        {'house_id': 1, 'house_number': 1, 'tenant_id': 1, 'tenant_name': 1, 'amount_remaining': 1,
+         'mpesa_trans_id': 1, 'payment_date': 1}
+    ).sort([('payment_date', ASCENDING), ('_id', ASCENDING)]))
+    if not receipts:
+        return []
+
+    # Oldest bill first for every (house, tenant), so a receipt never pays another occupant's bills
+    queues = defaultdict(deque)
+    for bill in db.payments.find(
+        {
+            'admin_id': admin_id,
+            'house_id': {'$in': list({receipt['house_id'] for receipt in receipts})},
+            'payment_status': {'$in': list(OUTSTANDING_STATUSES)}
+        },
+        {'house_id': 1, 'tenant_id': 1, 'bill_type': 1, 'month_year': 1, 'bill_amount': 1, 'amount_paid': 1, 'due_date': 1}
+    ).sort([('due_date', ASCENDING), ('_id', ASCENDING)]):
+        bill['outstanding'] = _remaining(float(bill.get('bill_amount') or 0) - float(bill.get('amount_paid') or 0))
+        if bill['outstanding']:
+            queues[(bill['house_id'], bill.get('tenant_id'))].append(bill)
+
+    plan = []
+    for receipt in receipts:
+        queue = queues.get((receipt['house_id'], receipt.get('tenant_id')))
+        available = _remaining(float(receipt['amount_remaining']))
+        allocations = []
+        while queue and available:
+            bill = queue[0]
+            amount = min(available, bill['outstanding'])
+            allocations.append({
+                'bill_id': bill['_id'],
+                'bill_type': bill.get('bill_type', 'unknown'),
+                'month_year': bill.get('month_year', 'unknown'),
+                'amount': amount
+            })
+            available = _remaining(available - amount)
+            bill['outstanding'] = _remaining(bill['outstanding'] - amount)
+            if not bill['outstanding']:
+                queue.popleft()
+
+        if allocations:
+            plan.append({
+                'receipt_id': receipt['_id'],
+                'tenant_id': receipt.get('tenant_id'),
+                'tenant_name': receipt.get('tenant_name'),
+                'house_number': receipt.get('house_number'),
+                'mpesa_trans_id': receipt.get('mpesa_trans_id'),
+                'receipt_remaining': float(receipt['amount_remaining']),
+                'allocations': allocations,
+                'amount': round(sum(allocation['amount'] for allocation in allocations), 2)
+            })
+    return plan
+
+
+def _receipt_operations(plan, now):
+    """One guarded pipeline update per receipt moving the planned amount from remaining to allocated"""
+    operations = []
+    for receipt in plan:
+        total = receipt['amount']
+        new_allocated = {'$add': ['$amount_allocated', total]}
+        new_remaining = {'$subtract': ['$amount_remaining', total]}
+        entries = [dict(allocation, allocated_at=now, method=ALLOCATION_METHOD) for allocation in receipt['allocations']]
+        operations.append(UpdateOne(
+            # Still holding what was planned against, or the run is re-planned
+            {'_id': receipt['receipt_id'], 'amount_remaining': receipt['receipt_remaining']},
+            [{'$set': {
+                'amount_allocated': new_allocated,
+                'amount_remaining': new_remaining,
+                'allocation_status': {'$switch': {
+                    'branches': [
+                        {'case': {'$lte': [new_remaining, balances.PRECISION]}, 'then': 'complete'},
+                        {'case': {'$gt': [new_allocated, 0]}, 'then': 'partial'}
+                    ],
+                    'default': 'pending'
+                }},
+                'allocations': {'$concatArrays': [{'$ifNull': ['$allocations', []]}, [{'$literal': entry} for entry in entries]]},
+                'updated_at': now
+            }}]
+        ))
+    return operations
+
+
+def _bill_applications(plan, now):
+    """Combine the plan into one application per bill, with a payment_history entry per receipt"""
+    amounts = defaultdict(float)
+    histories = defaultdict(list)
+    for receipt in plan:
+        for allocation in receipt['allocations']:
+            amounts[allocation['bill_id']] += allocation['amount']
+            histories[allocation['bill_id']].append({
+                'amount': allocation['amount'],
+                'method': ALLOCATION_METHOD,
+                'date': now,
+                'mpesa_trans_id': receipt['mpesa_trans_id'],
+                'unallocated_payment_id': receipt['receipt_id'],
+                'notes': f"Auto-allocated from M-Pesa payment {receipt['mpesa_trans_id']}"
+            })
+    fields = {'last_payment_method': ALLOCATION_METHOD, 'last_payment_date': now, 'updated_at': now}
+    return [(bill_id, round(amount, 2), fields, histories[bill_id]) for bill_id, amount in amounts.items()]
+
+
+def commit_plan(db, admin_id, plan):
+    """Apply a plan in one transaction; returns the post-image of every bill paid"""
+    now = datetime.now()
+    receipt_operations = _receipt_operations(plan, now)
+    applications = _bill_applications(plan, now)
+
+    def write(session):
+        result = db.unallocated_payments.bulk_write(receipt_operations, ordered=False, session=session)
+        if result.matched_count != len(receipt_operations):
+            raise balances.PaymentConflict(f"{len(receipt_operations) - result.matched_count} receipts changed while being allocated")
+        return balances.apply_payments(db, admin_id, applications, session=session, guard=True)
+
+    with db.client.start_session() as session:
+        return session.with_transaction(write)
+
+
+def _confirmation_messages(db, plan, run_id):
+    """One outbox SMS per tenant summarising all of their receipts allocated in this run"""
+    by_tenant = defaultdict(list)
+    for receipt in plan:
+        if receipt.get('tenant_id'):
+            by_tenant[receipt['tenant_id']].append(receipt)
+    if not by_tenant:
+        return []
+
+    phones = {
+        tenant['_id']: tenant.get('phone')
+        for tenant in db.tenants.find({'_id': {'$in': list(by_tenant)}}, {'phone': 1})
+    }
+
+    messages = []
+    for tenant_id, receipts in by_tenant.items():
+        if not phones.get(tenant_id):
+            continue
+        totals = defaultdict(float)
+        for receipt in receipts:
+            for allocation in receipt['allocations']:
+                totals[allocation['bill_type']] += allocation['amount']
+        details = ', '.join(f"{bill_type} KES {amount:.2f}" for bill_type, amount in totals.items())
+        refs = ', '.join(receipt['mpesa_trans_id'] for receipt in receipts if receipt.get('mpesa_trans_id'))
+        message = f"Payment allocated: {details}. House {receipts[0]['house_number']}. Ref: {refs}. Thank you!"
+        messages.append(build_outbox_message(
+            phones[tenant_id], message,
+            context={'type': 'auto_allocation', 'run_id': run_id, 'tenant_id': tenant_id}
+        ))
+    return messages
+
+
+def _summary(plan):
+    return {
+        'receipts_allocated': len(plan),
+        'bills_paid': len({allocation['bill_id'] for receipt in plan for allocation in receipt['allocations']}),
+        'amount_allocated': round(sum(receipt['amount'] for receipt in plan), 2)
+    }
+
+
+def run_auto_allocation(db, admin_id, dry_run=False):
+    """Plan and (unless dry_run) commit auto-allocations for one admin; returns the recorded run"""
+    started = time.monotonic()
+    run = {
+        '_id': ObjectId(),
+        'admin_id': admin_id,
+        'dry_run': dry_run,
+        'status': 'running',
+        'started_at': datetime.now()
+    }
+
+    try:
+        if not dry_run and not balances.supports_transactions(db):
+            raise RuntimeError("Auto-allocation needs MongoDB transactions (a replica set); use dry run to preview")
+
+        for attempt in range(1, MAX_PLAN_ATTEMPTS + 1):
+            plan = plan_allocations(db, admin_id)
+            planned_at = time.monotonic()
+            if dry_run or not plan:
+                paid_bills = {}
+                break
+            try:
+                paid_bills = commit_plan(db, admin_id, plan)
+                break
+            except balances.PaymentConflict as e:
+                if attempt == MAX_PLAN_ATTEMPTS:
+                    raise
+                logger.info(f"Auto-allocation for admin {admin_id} re-planning: {e}")
+
+        run.update(_summary(plan), status='planned' if dry_run else 'completed', attempts=attempt)
+
+        if paid_bills:
+            for receipt in plan:
+                for allocation in receipt['allocations']:
+                    rollups.record_collection(db, paid_bills[allocation['bill_id']], allocation['amount'])
+            messages = _confirmation_messages(db, plan, run['_id'])
+            enqueue_sms_many(db, messages)
+            run['sms_queued'] = len(messages)
+
+    except Exception as e:
+        logger.error(f"Auto-allocation failed for admin {admin_id}: {e}")
+        plan = []
+        planned_at = time.monotonic()
+        run.update(status='failed', error=str(e))
+
+    finished = time.monotonic()
+    run.update(
+        finished_at=datetime.now(),
+        plan_ms=round((planned_at - started) * 1000, 1),
+        duration_ms=round((finished - started) * 1000, 1),
+        receipts_per_second=round(run.get('receipts_allocated', 0) / max(finished - started, 1e-6), 1)
+    )
+    db.allocation_runs.insert_one(run)
+    if dry_run:
+        run['plan'] = plan
+    return run
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    from home import mongo
+
+    if len(sys.argv) < 2:
+        sys.exit("usage: python auto_allocation.py <admin_id> [--dry-run]")
+    result = run_auto_allocation(mongo.db, ObjectId(sys.argv[1]), dry_run='--dry-run' in sys.argv)
+    for receipt in result.get('plan', []):
+        parts = ', '.join(f"{a['bill_type']} {a['month_year']} KES {a['amount']:.2f}" for a in receipt['allocations'])
+        print(f"{receipt['mpesa_trans_id']} ({receipt['tenant_name']}, house {receipt['house_number']}): {parts}")
+    print(f"{result['status']}: {result.get('receipts_allocated', 0)} receipts, {result.get('bills_paid', 0)} bills, "
+          f"KES {result.get('amount_allocated', 0):.2f} in {result['duration_ms']} ms")
+    sys.exit(0 if result['status'] != 'failed' else 1)
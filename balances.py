@@ -0,0 +1,375 @@
+# balances.py
+"""
+Running per-tenant balance ledger.
+
+``tenant_balances`` holds the outstanding amount per (admin_id, tenant_id,
+bill_type, month_year). Every bill insert and payment against a bill applies
+the change in outstanding amount with ``$inc`` inside the same transaction as
+the bill write, so a tenant's arrears are one indexed read instead of loading
+and summing every unpaid bill.
+
+Payments are applied with ``apply_payment`` / ``apply_payments``: an
+aggregation-pipeline update adds to ``amount_paid`` and derives
+``payment_status`` on the server, so concurrent payments against one bill
+never lose an update and need no prior read.
+
+A bill counts towards arrears exactly as ``calculate_total_arrears`` always
+counted it: while it is unpaid or partial and more than 0.01 is outstanding.
+
+Run ``python balances.py [admin_id] [--fix]`` to verify the ledger against
+the raw payments (and rewrite any entries that disagree).
+"""
+import logging
+import sys
+from collections import defaultdict
+from datetime import datetime
+
+from bson import ObjectId
+from pymongo import ReturnDocument, UpdateOne
+from pymongo.errors import OperationFailure
+
+import db_indexes
+import search_keys
+import tenant_statements
+
+logger = logging.getLogger(__name__)
+
+OUTSTANDING_STATUSES = ('unpaid', 'partial')
+# Outstanding amounts at or below this are treated as settled
+PRECISION = 0.01
+# Bill fields derived from what is outstanding, dropped whenever a payment changes it
+STALE_ON_PAYMENT = ('late_fine', 'fine_computed_at')
+# MongoDB error codes meaning the deployment cannot run transactions
+NO_TRANSACTION_CODES = {20, 263}
+
+_transactions_supported = None
+
+
+class PaymentConflict(Exception):
+    """A guarded payment no longer fits the bill it was planned against"""
+
+
+def outstanding(bill):
+    """How much a bill contributes to its tenant's arrears"""
+    if not bill or bill.get('payment_status') not in OUTSTANDING_STATUSES:
+        return 0.0
+    amount = float(bill.get('bill_amount') or 0) - float(bill.get('amount_paid') or 0)
+    return amount if amount > PRECISION else 0.0
+
+
+def _key(bill):
+    return (bill.get('admin_id'), bill.get('tenant_id'), bill.get('bill_type'), bill.get('month_year'))
+
+
+def _apply(db, increments, session=None):
+    """Upsert {key: delta} outstanding increments in one bulk write"""
+    operations = []
+    now = datetime.now()
+    for (admin_id, tenant_id, bill_type, month_year), delta in increments.items():
+        if not delta or not admin_id or not tenant_id:
+            continue
+        operations.append(UpdateOne(
+            {'admin_id': admin_id, 'tenant_id': tenant_id, 'bill_type': bill_type, 'month_year': month_year},
+            {'$inc': {'outstanding': delta}, '$set': {'updated_at': now}},
+            upsert=True
+        ))
+    if operations:
+        db.tenant_balances.bulk_write(operations, ordered=False, session=session)
+
+
+def ensure_balance_indexes(db):
+    """Create the unique ledger key index"""
+    db_indexes.ensure_indexes(db, ['tenant_balances'])
+
+
+def run_in_transaction(db, callback):
+    """Run callback(session) in a transaction, or with no session on a standalone server"""
+    global _transactions_supported
+    if _transactions_supported is not False:
+        try:
+            with db.client.start_session() as session:
+                result = session.with_transaction(callback)
+                _transactions_supported = True
+                return result
+        except OperationFailure as e:
+            if e.code not in NO_TRANSACTION_CODES:
+                raise
+            logger.warning("MongoDB transactions are not supported here; ledger writes run without them")
+            _transactions_supported = False
+    return callback(None)
+
+
+def supports_transactions(db):
+    """Whether the deployment is a replica set or sharded cluster, where multi-document transactions work"""
+    hello = db.client.admin.command('hello')
+    return bool(hello.get('setName')) or hello.get('msg') == 'isdbgrid'
+
+
+def record_bills(db, bills, session=None):
+    """Add newly created bills to the ledger"""
+    increments = defaultdict(float)
+    for bill in bills:
+        increments[_key(bill)] += outstanding(bill)
+    _apply(db, increments, session)
+
+
+def record_change(db, before, after, session=None):
+    """Apply the change in a bill's outstanding amount between two states"""
+    delta = outstanding(after) - outstanding(before)
+    if delta:
+        _apply(db, {_key(before): delta}, session)
+
+
+def insert_bills(db, bills, session=None):
+    """Insert bill documents and their ledger entries together; pass session to join the caller's transaction"""
+    if not bills:
+        return
+    search_keys.annotate_bills(db, bills)
+
+    def write(session):
+        db.payments.insert_many(bills, ordered=False, session=session)
+        record_bills(db, bills, session)
+
+    if session is not None:
+        write(session)
+    else:
+        run_in_transaction(db, write)
+    tenant_statements.bump(bill.get('tenant_id') for bill in bills)
+
+
+def payment_status_expr(amount_paid, bill_amount='$bill_amount'):
+    """Aggregation expression for a bill's status once amount_paid has been paid against it"""
+    return {'$switch': {
+        'branches': [
+            {'case': {'$gte': [amount_paid, bill_amount]}, 'then': 'paid'},
+            {'case': {'$gt': [amount_paid, 0]}, 'then': 'partial'}
+        ],
+        'default': 'unpaid'
+    }}
+
+
+def settle(bill, amount, cap=False):
+    """amount_paid and payment_status of a bill after paying amount, as payment_pipeline derives them"""
+    amount_paid = (bill.get('amount_paid') or 0) + amount
+    bill_amount = bill.get('bill_amount') or 0
+    if cap:
+        amount_paid = round(min(amount_paid, bill_amount), 2)
+    if amount_paid >= bill_amount:
+        status = 'paid'
+    elif amount_paid > 0:
+        status = 'partial'
+    else:
+        status = 'unpaid'
+    return {'amount_paid': amount_paid, 'payment_status': status}
+
+
+def payment_pipeline(amount, fields=None, history=None, cap=False):
+    """Pipeline update adding amount to a bill, deriving its status and appending payment_history entries.
+
+    With cap, amount_paid is rounded to cents and never stored above bill_amount.
+    The bill's materialized late fine no longer matches what is outstanding, so
+    it is unset for late_fines to compute again.
+    """
+    amount_paid = {'$add': [{'$ifNull': ['$amount_paid', 0]}, amount]}
+    if cap:
+        amount_paid = {'$round': [{'$min': [amount_paid, '$bill_amount']}, 2]}
+    added = {'amount_paid': amount_paid}
+    # Values are wrapped in $literal so user text such as notes starting with '$' is never read as a field path
+    for field, value in (fields or {}).items():
+        added[field] = {'$literal': value}
+    if history:
+        entries = history if isinstance(history, list) else [history]
+        added['payment_history'] = {'$concatArrays': [{'$ifNull': ['$payment_history', []]}, [{'$literal': entry} for entry in entries]]}
+        added['payment_count'] = {'$add': [{'$ifNull': ['$payment_count', 0]}, len(entries)]}
+    return [
+        {'$set': added},
+        {'$set': {'payment_status': payment_status_expr('$amount_paid')}},
+        {'$unset': list(STALE_ON_PAYMENT)}
+    ]
+
+
+def _after(before, amount, fields=None, cap=False):
+    """Post-image of a bill that payment_pipeline updated, from its pre-image"""
+    after = dict(before, **(fields or {}), **settle(before, amount, cap))
+    for field in STALE_ON_PAYMENT:
+        after.pop(field, None)
+    return after
+
+
+def apply_payment(db, query, amount, fields=None, history=None, allow_overpayment=True):
+    """Pay amount against the bill matching query in one round trip; returns its post-image or None.
+
+    Without allow_overpayment the bill only matches while the payment fits in
+    what is outstanding, and amount_paid is rounded and capped at bill_amount
+    so a payment within the rounding tolerance settles it exactly. The server returns the pre-image, which is what the
+    ledger needs; the post-image follows from it deterministically.
+    """
+    if not allow_overpayment:
+        query = dict(query, **{'$expr': {'$lte': [
+            {'$add': [{'$ifNull': ['$amount_paid', 0]}, amount]},
+            {'$add': ['$bill_amount', PRECISION / 2]}
+        ]}})
+
+    def write(session):
+        before = db.payments.find_one_and_update(
+            query, payment_pipeline(amount, fields, history, cap=not allow_overpayment),
+            return_document=ReturnDocument.BEFORE, session=session
+        )
+        if before is None:
+            return None
+        after = _after(before, amount, fields, cap=not allow_overpayment)
+        record_change(db, before, after, session)
+        return after
+
+    after = run_in_transaction(db, write)
+    if after is not None:
+        tenant_statements.bump([after.get('tenant_id')])
+    return after
+
+
+def apply_payments(db, admin_id, applications, session=None, guard=False):
+    """Apply several payments in one bulk write, e.g. one receipt split across bills.
+
+    applications is [(bill_id, amount, fields, history)] with one entry per
+    bill. Returns {bill_id: post-image} for the bills found. Inside a
+    transaction the pre-images read here are exact; on a standalone server a
+    racing write can skew the ledger (never amount_paid) until reconcile runs.
+    Pass session to join the caller's transaction. With guard, a bill that
+    changed since it was read or would be overpaid raises PaymentConflict.
+    """
+    def write(session):
+        bill_ids = [bill_id for bill_id, _, _, _ in applications]
+        befores = {
+            bill['_id']: bill
+            for bill in db.payments.find({'_id': {'$in': bill_ids}, 'admin_id': admin_id}, session=session)
+        }
+
+        operations = []
+        afters = {}
+        increments = defaultdict(float)
+        for bill_id, amount, fields, history in applications:
+            before = befores.get(bill_id)
+            if before is None:
+                if guard:
+                    raise PaymentConflict(f"Bill {bill_id} no longer exists")
+                continue
+            query = {'_id': bill_id, 'admin_id': admin_id}
+            if guard:
+                query['amount_paid'] = before.get('amount_paid')
+                query['$expr'] = {'$lte': [
+                    {'$add': [{'$ifNull': ['$amount_paid', 0]}, amount]},
+                    {'$add': ['$bill_amount', PRECISION / 2]}
+                ]}
+            operations.append(UpdateOne(query, payment_pipeline(amount, fields, history)))
+            afters[bill_id] = _after(before, amount, fields)
+            increments[_key(before)] += outstanding(afters[bill_id]) - outstanding(before)
+
+        if operations:
+            result = db.payments.bulk_write(operations, ordered=False, session=session)
+            if guard and result.matched_count != len(operations):
+                raise PaymentConflict(f"{len(operations) - result.matched_count} bills changed while being paid")
+            _apply(db, increments, session)
+        return afters
+
+    if session is not None:
+        # The caller's transaction commits later; a view rebuilt before then lasts until the next bump or its TTL
+        afters = write(session)
+    else:
+        afters = run_in_transaction(db, write)
+    tenant_statements.bump(after.get('tenant_id') for after in afters.values())
+    return afters
+
+
+def _arrears_match(admin_id, tenant_ids, bill_type=None, exclude_month=None):
+    match = {'admin_id': admin_id, 'tenant_id': {'$in': list(tenant_ids)}, 'outstanding': {'$gt': PRECISION / 2}}
+    if bill_type:
+        match['bill_type'] = bill_type
+    if exclude_month:
+        if isinstance(exclude_month, datetime):
+            exclude_month = exclude_month.strftime('%Y-%m')
+        match['month_year'] = {'$ne': exclude_month}
+    return match
+
+
+def arrears(db, admin_id, tenant_id, bill_type=None, exclude_month=None):
+    """A tenant's total outstanding, optionally for one bill type and excluding one month"""
+    total = sum(
+        entry['outstanding']
+        for entry in db.tenant_balances.find(_arrears_match(admin_id, [tenant_id], bill_type, exclude_month), {'outstanding': 1})
+    )
+    return round(total, 2)
+
+
+def arrears_many(db, admin_id, tenant_ids, bill_type=None, exclude_month=None):
+    """arrears() for many tenants in one query, keyed by tenant_id (tenants with none are omitted)"""
+    totals = defaultdict(float)
+    for entry in db.tenant_balances.find(
+        _arrears_match(admin_id, tenant_ids, bill_type, exclude_month), {'tenant_id': 1, 'outstanding': 1}
+    ):
+        totals[entry['tenant_id']] += entry['outstanding']
+    return {tenant_id: round(total, 2) for tenant_id, total in totals.items() if round(total, 2) > 0}
+
+
+def _expected_balances(db, scope):
+    """Outstanding per ledger key computed from the raw payments"""
+    expected = defaultdict(float)
+    for bill in db.payments.find(
+        dict(scope, payment_status={'$in': list(OUTSTANDING_STATUSES)}),
+        {'admin_id': 1, 'tenant_id': 1, 'bill_type': 1, 'month_year': 1, 'bill_amount': 1, 'amount_paid': 1, 'payment_status': 1}
+    ):
+        amount = outstanding(bill)
+        if amount:
+            expected[_key(bill)] += amount
+    return expected
+
+
+def reconcile(db, admin_id=None, fix=False):
+    """Compare the ledger with the payments; returns [(key, ledger, expected)] and rewrites them when fix"""
+    scope = {'admin_id': admin_id} if admin_id else {}
+    expected = _expected_balances(db, scope)
+
+    actual = {}
+    for entry in db.tenant_balances.find(scope):
+        actual[_key(entry)] = entry.get('outstanding', 0)
+
+    mismatches = []
+    for key in set(expected) | set(actual):
+        if abs(expected.get(key, 0) - actual.get(key, 0)) > PRECISION / 2:
+            mismatches.append((key, round(actual.get(key, 0), 2), round(expected.get(key, 0), 2)))
+
+    if fix and mismatches:
+        operations = []
+        for (entry_admin, tenant_id, bill_type, month_year), _, amount in mismatches:
+            operations.append(UpdateOne(
+                {'admin_id': entry_admin, 'tenant_id': tenant_id, 'bill_type': bill_type, 'month_year': month_year},
+                {'$set': {'outstanding': expected.get((entry_admin, tenant_id, bill_type, month_year), 0), 'updated_at': datetime.now()}},
+                upsert=True
+            ))
+        db.tenant_balances.bulk_write(operations, ordered=False)
+        logger.info(f"Rewrote {len(operations)} tenant balance entries")
+
+    return mismatches
+
+
+def backfill_if_empty(db):
+    """Build the ledger from the payments the first time it is used"""
+    try:
+        if db.tenant_balances.find_one({}, {'_id': 1}) is None and db.payments.find_one({}, {'_id': 1}):
+            mismatches = reconcile(db, fix=True)
+            logger.info(f"Built tenant balance ledger with {len(mismatches)} entries")
+    except Exception as e:
+        logger.error(f"Error backfilling tenant balances: {e}")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    from home import mongo
+
+    args = [arg for arg in sys.argv[1:] if arg != '--fix']
+    target = ObjectId(args[0]) if args else None
+    ensure_balance_indexes(mongo.db)
+    found = reconcile(mongo.db, target, fix='--fix' in sys.argv)
+    for (entry_admin, tenant_id, bill_type, month_year), ledger, expected in found:
+        print(f"MISMATCH admin={entry_admin} tenant={tenant_id} {bill_type} {month_year}: ledger {ledger}, payments {expected}")
+    print(f"{len(found)} mismatched ledger entries{' fixed' if found and '--fix' in sys.argv else ''}")
+    sys.exit(1 if found and '--fix' not in sys.argv else 0)
@@ -0,0 +1,297 @@
+# db_indexes.py
+"""
+Declarative MongoDB index manager.
+
+``INDEXES`` lists every index the application's queries rely on. At startup
+``ensure_indexes`` creates whichever are missing; the CLI also reports
+indexes that are unused or redundant and runs ``explain()`` on each hot query
+shape from ``hot_queries()``, failing if any of them scans a whole collection.
+
+    python db_indexes.py ensure    # create missing indexes
+    python db_indexes.py report    # unused, redundant and undeclared indexes
+    python db_indexes.py explain   # exit 1 if a hot query does a COLLSCAN
+"""
+import logging
+import sys
+from datetime import datetime
+
+from bson import ObjectId
+from pymongo import ASCENDING, DESCENDING
+
+logger = logging.getLogger(__name__)
+
+# collection -> [{'name', 'keys', optional create_index options}]
+INDEXES = {
+    'tenants': [
+        {'name': 'admin_property_name_id_idx', 'keys': [('admin_id', ASCENDING), ('property_id', ASCENDING), ('name', ASCENDING), ('_id', ASCENDING)]},
+        {'name': 'admin_name_id_idx', 'keys': [('admin_id', ASCENDING), ('name', ASCENDING), ('_id', ASCENDING)]},
+        {'name': 'admin_house_idx', 'keys': [('admin_id', ASCENDING), ('house_number', ASCENDING)]},
+        {'name': 'admin_phone_idx', 'keys': [('admin_id', ASCENDING), ('phone', ASCENDING)]},
+        {'name': 'admin_property_search_idx', 'keys': [('admin_id', ASCENDING), ('property_id', ASCENDING), ('search_keys', ASCENDING)]},
+        {'name': 'admin_updated_idx', 'keys': [('admin_id', ASCENDING), ('updated_at', DESCENDING)]},
+    ],
+    'houses': [
+        {'name': 'admin_property_house_id_idx', 'keys': [('admin_id', ASCENDING), ('property_id', ASCENDING), ('house_number', ASCENDING), ('_id', ASCENDING)]},
+        {'name': 'admin_house_idx', 'keys': [('admin_id', ASCENDING), ('house_number', ASCENDING)]},
+    ],
+    'payments': [
+        {'name': 'admin_tenant_status_month_idx', 'keys': [('admin_id', ASCENDING), ('tenant_id', ASCENDING), ('payment_status', ASCENDING), ('month_year', ASCENDING)]},
+        {'name': 'status_due_date_idx', 'keys': [('payment_status', ASCENDING), ('due_date', ASCENDING)]},
+        {'name': 'mpesa_trans_id_idx', 'keys': [('mpesa_trans_id', ASCENDING)], 'sparse': True},
+        {'name': 'reading_id_idx', 'keys': [('reading_id', ASCENDING)], 'sparse': True},
+        {'name': 'house_status_due_idx', 'keys': [('house_id', ASCENDING), ('payment_status', ASCENDING), ('due_date', ASCENDING)]},
+        {'name': 'admin_search_due_idx', 'keys': [('admin_id', ASCENDING), ('search_keys', ASCENDING), ('due_date', ASCENDING)]},
+        {'name': 'admin_property_status_due_id_idx', 'keys': [('admin_id', ASCENDING), ('property_id', ASCENDING), ('payment_status', ASCENDING), ('due_date', ASCENDING), ('_id', ASCENDING)]},
+        {'name': 'tenant_admin_month_type_idx', 'keys': [('tenant_id', ASCENDING), ('admin_id', ASCENDING), ('month_year', ASCENDING), ('bill_type', ASCENDING)]},
+        {'name': 'fined_status_idx', 'keys': [('payment_status', ASCENDING), ('late_fine', ASCENDING)], 'partialFilterExpression': {'late_fine': {'$gt': 0}}},
+    ],
+    'meter_readings': [
+        {'name': 'tenant_admin_date_id_idx', 'keys': [('tenant_id', ASCENDING), ('admin_id', ASCENDING), ('date_recorded', DESCENDING), ('_id', DESCENDING)]},
+        {'name': 'house_admin_date_idx', 'keys': [('house_number', ASCENDING), ('admin_id', ASCENDING), ('date_recorded', DESCENDING)]},
+        {'name': 'house_id_date_idx', 'keys': [('house_id', ASCENDING), ('date_recorded', DESCENDING)]},
+        {'name': 'admin_type_date_idx', 'keys': [('admin_id', ASCENDING), ('reading_type', ASCENDING), ('date_recorded', DESCENDING)]},
+        {'name': 'admin_property_date_idx', 'keys': [('admin_id', ASCENDING), ('property_id', ASCENDING), ('date_recorded', DESCENDING)]},
+        {'name': 'admin_id_idx', 'keys': [('admin_id', ASCENDING), ('_id', DESCENDING)]},
+    ],
+    'unallocated_payments': [
+        {'name': 'admin_status_date_id_idx', 'keys': [('admin_id', ASCENDING), ('allocation_status', ASCENDING), ('payment_date', DESCENDING), ('_id', DESCENDING)]},
+        {'name': 'mpesa_trans_id_idx', 'keys': [('mpesa_trans_id', ASCENDING)], 'sparse': True},
+    ],
+    'maintenance_requests': [
+        {'name': 'admin_created_id_idx', 'keys': [('admin_id', ASCENDING), ('created_at', DESCENDING), ('_id', DESCENDING)]},
+    ],
+    'short_urls': [
+        {'name': 'short_code_idx', 'keys': [('short_code', ASCENDING)], 'unique': True},
+    ],
+    # Portal tokens are no longer stored; the TTL index drains the rows written before
+    'tenant_access_tokens': [
+        {'name': 'expires_at_ttl_idx', 'keys': [('expires_at', ASCENDING)], 'expireAfterSeconds': 0},
+    ],
+    'portal_revocations': [
+        {'name': 'key_idx', 'keys': [('key', ASCENDING)], 'unique': True},
+        {'name': 'expires_at_ttl_idx', 'keys': [('expires_at', ASCENDING)], 'expireAfterSeconds': 0},
+    ],
+    'admins': [
+        {'name': 'business_number_idx', 'keys': [('business_number', ASCENDING)], 'sparse': True},
+        {'name': 'till_idx', 'keys': [('till', ASCENDING)], 'sparse': True},
+    ],
+    'properties': [
+        {'name': 'admin_id_1', 'keys': [('admin_id', ASCENDING)]},
+        {'name': 'name_1_admin_id_1', 'keys': [('name', ASCENDING), ('admin_id', ASCENDING)]},
+    ],
+    'sms_config': [
+        {'name': 'admin_id_idx', 'keys': [('admin_id', ASCENDING)]},
+    ],
+    'subscription_payments': [
+        {'name': 'admin_id_1_created_at_-1', 'keys': [('admin_id', ASCENDING), ('created_at', DESCENDING)]},
+        {'name': 'checkout_request_id_1', 'keys': [('checkout_request_id', ASCENDING)], 'unique': True, 'sparse': True},
+        {'name': 'reference_idx', 'keys': [('reference', ASCENDING)], 'sparse': True},
+    ],
+    'billing_runs': [
+        {'name': 'active_key_idx', 'keys': [('active_key', ASCENDING)], 'unique': True, 'sparse': True},
+        {'name': 'admin_created_idx', 'keys': [('admin_id', ASCENDING), ('created_at', DESCENDING)]},
+    ],
+    'report_jobs': [
+        {'name': 'active_key_idx', 'keys': [('active_key', ASCENDING)], 'unique': True, 'sparse': True},
+        {'name': 'admin_created_idx', 'keys': [('admin_id', ASCENDING), ('created_at', DESCENDING)]},
+        {'name': 'expires_at_ttl_idx', 'keys': [('expires_at', ASCENDING)], 'expireAfterSeconds': 0},
+    ],
+    'tenant_balances': [
+        {'name': 'balance_key_idx', 'keys': [('admin_id', ASCENDING), ('tenant_id', ASCENDING), ('bill_type', ASCENDING), ('month_year', ASCENDING)], 'unique': True},
+    ],
+    'monthly_rollups': [
+        {'name': 'rollup_key_idx', 'keys': [('admin_id', ASCENDING), ('property_id', ASCENDING), ('month', ASCENDING), ('bill_type', ASCENDING)], 'unique': True},
+        {'name': 'admin_updated_idx', 'keys': [('admin_id', ASCENDING), ('updated_at', DESCENDING)]},
+    ],
+    'sms_outbox': [
+        {'name': 'status_next_attempt_idx', 'keys': [('status', ASCENDING), ('next_attempt_at', ASCENDING)]},
+        {'name': 'status_claimed_idx', 'keys': [('status', ASCENDING), ('claimed_at', ASCENDING)]},
+    ],
+    'allocation_runs': [
+        {'name': 'admin_started_idx', 'keys': [('admin_id', ASCENDING), ('started_at', DESCENDING)]},
+    ],
+    'payment_inbox': [
+        {'name': 'provider_transaction_idx', 'keys': [('provider', ASCENDING), ('transaction_id', ASCENDING)], 'unique': True},
+        {'name': 'status_next_attempt_idx', 'keys': [('status', ASCENDING), ('next_attempt_at', ASCENDING)]},
+        {'name': 'status_claimed_idx', 'keys': [('status', ASCENDING), ('claimed_at', ASCENDING)]},
+        {'name': 'admin_status_received_idx', 'keys': [('admin_id', ASCENDING), ('status', ASCENDING), ('received_at', ASCENDING)]},
+    ],
+}
+
+
+def hot_queries():
+    """Representative (collection, filter, sort) shapes of the application's frequent queries"""
+    some_id = ObjectId()
+    now = datetime.now()
+    return [
+        ('tenants', {'admin_id': some_id, 'property_id': some_id}, [('name', ASCENDING), ('_id', ASCENDING)]),
+        ('tenants', {'admin_id': some_id}, [('name', ASCENDING), ('_id', ASCENDING)]),
+        ('houses', {'admin_id': some_id, 'property_id': some_id}, [('house_number', ASCENDING), ('_id', ASCENDING)]),
+        ('tenants', {'house_number': 'A1', 'admin_id': some_id}, None),
+        ('tenants', {'admin_id': some_id, 'phone': '+254700000000'}, None),
+        ('houses', {'house_number': 'A1', 'admin_id': some_id, 'property_id': some_id}, None),
+        ('houses', {'house_number': 'A1', 'admin_id': some_id}, None),
+        ('payments', {
+            'admin_id': some_id, 'tenant_id': some_id,
+            'payment_status': {'$in': ['unpaid', 'partial']}, 'month_year': {'$ne': now.strftime('%Y-%m')}
+        }, None),
+        ('payments', {'payment_status': {'$in': ['unpaid', 'partial']}, 'due_date': {'$lt': now}, 'reminder_sent': {'$ne': True}}, None),
+        ('payments', {'mpesa_trans_id': 'QWE123RTY', 'admin_id': some_id}, None),
+        ('meter_readings', {'house_number': 'A1', 'admin_id': some_id, 'property_id': some_id}, [('date_recorded', DESCENDING)]),
+        ('meter_readings', {'tenant_id': some_id, 'admin_id': some_id}, [('date_recorded', DESCENDING), ('_id', DESCENDING)]),
+        ('meter_readings', {'tenant_id': some_id, 'admin_id': some_id, 'property_id': some_id}, [('date_recorded', DESCENDING)]),
+        ('payments', {'tenant_id': some_id, 'admin_id': some_id, 'month_year': now.strftime('%Y-%m'), 'property_id': some_id}, None),
+        ('payments', {'tenant_id': some_id, 'admin_id': some_id, 'bill_type': {'$in': ['water', None]}, 'month_year': now.strftime('%Y-%m')}, None),
+        ('unallocated_payments', {'admin_id': some_id, 'allocation_status': {'$in': ['pending', 'partial']}}, [('payment_date', DESCENDING), ('_id', DESCENDING)]),
+        ('payments', {'house_id': some_id, 'admin_id': some_id, 'payment_status': {'$in': ['unpaid', 'partial']}}, [('due_date', ASCENDING)]),
+        ('payments', {'payment_status': 'paid', 'late_fine': {'$gt': 0}}, None),
+        ('tenants', {'admin_id': some_id, 'property_id': some_id, 'search_keys': 'n:jan'}, None),
+        ('payments', {'admin_id': some_id, 'property_id': some_id, 'bill_type': 'water', 'payment_status': {'$in': ['unpaid', 'partial']},
+                      '$or': [{'search_keys': 'n:jan'}, {'search_keys': 'h:a1'}]}, [('due_date', ASCENDING)]),
+        ('payments', {'admin_id': some_id, 'property_id': some_id, 'bill_type': 'water', 'payment_status': {'$in': ['unpaid', 'partial']}},
+         [('due_date', ASCENDING), ('_id', ASCENDING)]),
+        ('maintenance_requests', {'admin_id': some_id, 'status': 'pending'}, [('created_at', DESCENDING), ('_id', DESCENDING)]),
+        ('short_urls', {'short_code': 'abc123'}, None),
+        ('portal_revocations', {'key': {'$in': ['token:abc', f'tenant:{some_id}']}}, None),
+        ('portal_revocations', {'expires_at': {'$gt': now}}, None),
+        ('admins', {'$or': [{'business_number': '174379'}, {'till': '174379'}]}, None),
+        ('tenant_balances', {'admin_id': some_id, 'tenant_id': {'$in': [some_id]}, 'bill_type': 'water', 'month_year': {'$ne': now.strftime('%Y-%m')}}, None),
+        ('monthly_rollups', {'admin_id': some_id, 'month': {'$gte': now.strftime('%Y-%m')}}, None),
+        ('monthly_rollups', {'admin_id': some_id}, [('updated_at', DESCENDING)]),
+        ('tenants', {'admin_id': some_id}, [('updated_at', DESCENDING)]),
+        ('meter_readings', {'admin_id': some_id}, [('_id', DESCENDING)]),
+        ('report_jobs', {'active_key': 'abc'}, None),
+        ('sms_outbox', {'status': 'queued', 'next_attempt_at': {'$lte': now}}, [('next_attempt_at', ASCENDING)]),
+        ('payment_inbox', {'status': 'pending', 'next_attempt_at': {'$lte': now}}, [('next_attempt_at', ASCENDING)]),
+        ('payment_inbox', {'admin_id': some_id, 'status': {'$in': ['pending', 'processing']}}, [('received_at', ASCENDING)]),
+    ]
+
+
+def _key(keys):
+    # 1 and 1.0 compare and hash equal, so server-reported keys match declared ones
+    return tuple((field, direction) for field, direction in keys)
+
+
+def ensure_indexes(db, collections=None):
+    """Create any declared index that is missing; returns {'created': [...], 'errors': [...]}"""
+    report = {'created': [], 'errors': []}
+    for collection, specs in INDEXES.items():
+        if collections and collection not in collections:
+            continue
+        try:
+            existing = {_key(info['key']) for info in db[collection].index_information().values()}
+        except Exception as e:
+            report['errors'].append(f"{collection}: {e}")
+            logger.error(f"Error reading {collection} indexes: {e}")
+            continue
+
+        for spec in specs:
+            # An index on the same keys under an older name already serves the queries
+            if _key(spec['keys']) in existing:
+                continue
+            options = {option: value for option, value in spec.items() if option != 'keys'}
+            try:
+                db[collection].create_index(spec['keys'], **options)
+                report['created'].append(f"{collection}.{spec['name']}")
+            except Exception as e:
+                report['errors'].append(f"{collection}.{spec['name']}: {e}")
+                logger.error(f"Error creating index {collection}.{spec['name']}: {e}")
+
+    if report['created']:
+        logger.info(f"Created indexes: {', '.join(report['created'])}")
+    return report
+
+
+def index_usage_report(db):
+    """Find unused, redundant and undeclared indexes on the declared collections.
+
+    Usage counters come from $indexStats and reset when mongod restarts.
+    """
+    report = {'unused': [], 'redundant': [], 'undeclared': []}
+    for collection, specs in INDEXES.items():
+        try:
+            information = db[collection].index_information()
+            indexes = {name: _key(info['key']) for name, info in information.items()}
+            unique = {name for name, info in information.items() if info.get('unique')}
+            usage = {stat['name']: stat['accesses']['ops'] for stat in db[collection].aggregate([{'$indexStats': {}}])}
+        except Exception as e:
+            logger.error(f"Error reading {collection} index stats: {e}")
+            continue
+
+        declared = {_key(spec['keys']) for spec in specs}
+        for name, key in indexes.items():
+            if name == '_id_':
+                continue
+            label = f"{collection}.{name}"
+            if usage.get(name, 0) == 0:
+                report['unused'].append(label)
+            if key not in declared:
+                report['undeclared'].append(label)
+            # A non-unique index whose keys prefix another index adds write cost and no reads
+            covering = [other for other, other_key in indexes.items()
+                        if other != name and len(other_key) > len(key) and other_key[:len(key)] == key]
+            if covering and name not in unique:
+                report['redundant'].append(f"{label} (covered by {covering[0]})")
+
+    return report
+
+
+def _plan_stages(plan):
+    """Every stage name in an explain() plan tree"""
+    if isinstance(plan, dict):
+        stages = [plan['stage']] if 'stage' in plan else []
+        for value in plan.values():
+            stages.extend(_plan_stages(value))
+        return stages
+    if isinstance(plan, list):
+        return [stage for item in plan for stage in _plan_stages(item)]
+    return []
+
+
+def check_query_plans(db):
+    """explain() each hot query shape; returns a description of every one that does a COLLSCAN"""
+    failures = []
+    for collection, query, sort in hot_queries():
+        cursor = db[collection].find(query)
+        if sort:
+            cursor = cursor.sort(sort)
+        try:
+            winning_plan = cursor.explain()['queryPlanner']['winningPlan']
+        except Exception as e:
+            failures.append(f"{collection} {sorted(query)}: explain failed: {e}")
+            continue
+        if 'COLLSCAN' in _plan_stages(winning_plan):
+            failures.append(f"{collection} {sorted(query)}{' sort ' + str(sort) if sort else ''}: COLLSCAN")
+    return failures
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    from home import mongo
+
+    command = sys.argv[1] if len(sys.argv) > 1 else 'ensure'
+
+    if command == 'ensure':
+        result = ensure_indexes(mongo.db)
+        print(f"Created {len(result['created'])} indexes")
+        for error in result['errors']:
+            print(f"ERROR {error}")
+        sys.exit(1 if result['errors'] else 0)
+
+    elif command == 'report':
+        result = index_usage_report(mongo.db)
+        for section in ('unused', 'redundant', 'undeclared'):
+            print(f"{section.capitalize()} indexes:")
+            for label in result[section] or ['(none)']:
+                print(f"  {label}")
+
+    elif command == 'explain':
+        failures = check_query_plans(mongo.db)
+        for failure in failures:
+            print(f"FAIL {failure}")
+        print(f"{len(hot_queries()) - len(failures)}/{len(hot_queries())} hot queries use an index")
+        sys.exit(1 if failures else 0)
+
+    else:
+        print(f"Unknown command {command}; use ensure, report or explain")
+        sys.exit(2)
@@ -0,0 +1,144 @@
+# exports.py
+"""
+Streaming Excel and CSV exports with bounded memory.
+
+Exports used to load every row into a list or DataFrame, build the workbook
+in a ``BytesIO`` and then walk every cell again to size the columns, so a
+landlord with a long history could push a worker's memory up by the size of
+the whole file several times over.
+
+Rows are now consumed from an iterator, typically a sorted Mongo cursor
+read ``EXPORT_BATCH_SIZE`` documents at a time:
+
+- ``write_xlsx`` writes with xlsxwriter in ``constant_memory`` mode, which
+  flushes each row to a temporary file as soon as the next one starts, and
+  ``xlsx_export`` sends the finished file from disk.
+- ``csv_chunks`` encodes the rows as CSV one batch at a time, for a
+  chunked response or ``write_csv``.
+
+Column widths are estimated from the first ``EXPORT_WIDTH_SAMPLE_ROWS`` rows
+rather than measured over the whole sheet. Peak memory is one batch of rows
+plus xlsxwriter's per-row buffer, whatever the length of the history; see
+test_exports.py for the benchmark.
+"""
+import csv
+import io
+import itertools
+import logging
+import os
+import tempfile
+from datetime import date, datetime
+
+import xlsxwriter
+from flask import send_file
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = int(os.getenv('EXPORT_BATCH_SIZE', 500))
+WIDTH_SAMPLE_ROWS = int(os.getenv('EXPORT_WIDTH_SAMPLE_ROWS', 200))
+MIN_WIDTH = 8
+MAX_WIDTH = 50
+DATE_FORMAT = 'yyyy-mm-dd'
+XLSX_MIMETYPE = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+
+
+def _text(value):
+    if value is None:
+        return ''
+    if isinstance(value, datetime):
+        return value.strftime('%Y-%m-%d %H:%M:%S') if value.time() != datetime.min.time() else value.strftime('%Y-%m-%d')
+    if isinstance(value, date):
+        return value.strftime('%Y-%m-%d')
+    if isinstance(value, float):
+        return f"{value:.2f}".rstrip('0').rstrip('.')
+    return str(value)
+
+
+def estimate_widths(headers, sample, minimum=MIN_WIDTH, maximum=MAX_WIDTH):
+    """Column widths fitting the headers and a sample of rows"""
+    widths = [len(str(header)) for header in headers]
+    for row in sample:
+        for col, value in enumerate(row):
+            if col >= len(widths):
+                widths.append(0)
+            widths[col] = max(widths[col], len(_text(value)))
+    return [min(max(width + 2, minimum), maximum) for width in widths]
+
+
+def write_table(worksheet, first_row, headers, rows, header_format=None, formats=None):
+    """Write a header row and then rows from an iterator, in order; returns how many rows were written.
+
+    The worksheet may be in constant_memory mode, so nothing is written above
+    first_row afterwards. formats gives a cell format per column.
+    """
+    rows = iter(rows)
+    sample = list(itertools.islice(rows, WIDTH_SAMPLE_ROWS))
+    for col, width in enumerate(estimate_widths(headers, sample)):
+        worksheet.set_column(col, col, width)
+
+    for col, header in enumerate(headers):
+        worksheet.write(first_row, col, header, header_format)
+    formats = formats or []
+    written = 0
+    for written, row in enumerate(itertools.chain(sample, rows), 1):
+        for col, value in enumerate(row):
+            cell_format = formats[col] if col < len(formats) else None
+            if value is None:
+                if cell_format is not None:
+                    worksheet.write_blank(first_row + written, col, None, cell_format)
+            else:
+                worksheet.write(first_row + written, col, value, cell_format)
+    return written
+
+
+def write_xlsx(path, build):
+    """Create a constant_memory workbook at path, fill it with build(workbook) and close it"""
+    workbook = xlsxwriter.Workbook(path, {'constant_memory': True, 'default_date_format': DATE_FORMAT})
+    try:
+        build(workbook)
+    finally:
+        workbook.close()
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError as e:
+        logger.warning(f"Could not remove export file {path}: {e}")
+
+
+def xlsx_export(filename, build):
+    """Download response for a workbook filled by build(workbook), sent from a temporary file"""
+    handle, path = tempfile.mkstemp(prefix='export_', suffix='.xlsx')
+    os.close(handle)
+    try:
+        write_xlsx(path, build)
+        response = send_file(path, mimetype=XLSX_MIMETYPE, as_attachment=True, download_name=filename)
+    except Exception:
+        _remove(path)
+        raise
+    response.call_on_close(lambda: _remove(path))
+    return response
+
+
+def csv_chunks(headers, rows):
+    """Encoded CSV for headers and rows, one chunk per BATCH_SIZE rows"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    # The byte order mark makes Excel read the file as UTF-8 (units such as m³)
+    buffer.write('\ufeff')
+    writer.writerow(headers)
+    for count, row in enumerate(rows, 1):
+        writer.writerow([_text(value) for value in row])
+        if count % BATCH_SIZE == 0:
+            yield buffer.getvalue().encode('utf-8')
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue().encode('utf-8')
+
+
+def write_csv(path, headers, rows):
+    """Write rows from an iterator to a CSV file at path, a batch at a time"""
+    with open(path, 'wb') as output:
+        for chunk in csv_chunks(headers, rows):
+            output.write(chunk)
@@ -2,12 +2,35 @@ import os
 import logging
 import urllib.parse
 import re
-import requests
+import http_client
+import rollups
+import db_indexes
+import last_readings
+import property_backfill
+import balances
+import matching_index
+import payment_inbox
+import auto_allocation
+import late_fines
+import request_context
+import subscription_state
+import search_keys
+import paging
+import portal_tokens
+import short_urls
+import tenant_statements
+import exports
+import reports
+import report_jobs
+import multiprocessing
 import dns.resolver
-from mpesa_integration import MpesaAPI
+from mpesa_integration import MpesaAPI, invalidate_access_token
+from lru import LRUCache
 from subscription_config import SUBSCRIPTION_TIERS, MPESA_CONFIG
 from crypto_utils import encrypt_mpesa_credentials, decrypt_mpesa_credentials
 from paystack_integration import PaystackAPI
+from sms_outbox import (enqueue_sms, enqueue_sms_many, build_outbox_message, sms_writeback,
+                        start_background_dispatcher)
 from flask import Flask, render_template, request, redirect, url_for, flash, session, jsonify, send_from_directory
 from flask_sqlalchemy import SQLAlchemy
 from flask_migrate import Migrate
@@ -19,25 +42,28 @@ from functools import wraps
 from flask_wtf.csrf import CSRFProtect, CSRFError
 from sqlalchemy import create_engine
 from sqlalchemy.engine import URL
-from itsdangerous import URLSafeTimedSerializer, SignatureExpired, BadSignature
+from itsdangerous import SignatureExpired, BadSignature
 import secrets
 from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
 from flask_talisman import Talisman
 # from flask_pymongo import PyMongo  # Comment out as we'll use direct MongoClient
 from bson.objectid import ObjectId
+from bson.errors import InvalidId
 import pandas as pd
+import numpy as np
 from werkzeug.utils import secure_filename
 from io import BytesIO
 from flask import send_file
 from bson import ObjectId
-import xlsxwriter
 import pymongo
 from pymongo.mongo_client import MongoClient
 from pymongo.server_api import ServerApi
 from flask_caching import Cache
-import hashlib
 import base64
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pymongo.errors import DuplicateKeyError
 
 
     
@@ -85,6 +111,18 @@ if not DATABASE_NAME:
 BITLY_ACCESS_TOKEN = os.getenv("BITLY_ACCESS_TOKEN")
 ENABLE_URL_SHORTENING = os.getenv("ENABLE_URL_SHORTENING", "true").lower() == "true"
 
+# SMS outbox dispatch: 'thread' runs a dispatcher inside each web process,
+# 'external' leaves delivery to a separate `python sms_outbox.py` worker
+SMS_OUTBOX_WORKER = os.getenv("SMS_OUTBOX_WORKER", "thread").lower()
+# Payment callback processing: 'thread' or a separate `python payment_inbox.py` worker
+PAYMENT_INBOX_WORKER = os.getenv("PAYMENT_INBOX_WORKER", "thread").lower()
+BILLING_RUN_THREADS = int(os.getenv("BILLING_RUN_THREADS", 2))
+# Adds X-Context-Lookups-Saved/-Loaded headers reporting the request-scoped lookup cache (always on in debug mode)
+CONTEXT_CACHE_DEBUG = os.getenv("CONTEXT_CACHE_DEBUG", "false").lower() == "true"
+BILLING_RUN_STALE_MINUTES = 30
+# Report worker processes import this module when the app runs as a script; they must not start background workers
+IN_WORKER_PROCESS = multiprocessing.parent_process() is not None
+
 # Create Flask app
 app = Flask(__name__)
 app.config['SECRET_KEY'] = SECRET_KEY
@@ -226,14 +264,7 @@ def initialize_subscription_records():
         if 'subscription_payments' not in mongo.db.list_collection_names():
             mongo.db.create_collection('subscription_payments')
             
-        mongo.db.subscription_payments.create_index([
-            ('admin_id', 1),
-            ('created_at', -1)
-        ])
-        
-        mongo.db.subscription_payments.create_index([
-            ('checkout_request_id', 1)
-        ], unique=True, sparse=True)
+        db_indexes.ensure_indexes(mongo.db, ['subscription_payments'])
         
         # Update admin schema for subscriptions
         mongo.db.admins.update_many(
@@ -264,7 +295,7 @@ def check_subscription_limit(resource_type='tenant'):
         def decorated_function(*args, **kwargs):
             try:
                 admin_id = get_admin_id()
-                admin = mongo.db.admins.find_one({"_id": admin_id})
+                admin = get_current_admin(admin_id)
                 
                 if not admin:
                     flash('Admin account not found', 'danger')
@@ -291,6 +322,8 @@ def check_subscription_limit(resource_type='tenant'):
                                 "subscription_status": "expired"
                             }}
                         )
+                        request_context.invalidate('admin', admin_id)
+                        subscription_state.invalidate(admin_id)
                         flash('Your subscription has expired. Please renew to continue.', 'warning')
                         return redirect(url_for('subscription'))
                 
@@ -347,84 +380,20 @@ def enforce_subscription_payment(exclude_routes=None):
                     return f(*args, **kwargs)
 
                 admin_id = get_admin_id()
-                admin = mongo.db.admins.find_one({"_id": admin_id})
+                snapshot = subscription_state.get_snapshot(mongo.db, admin_id)
 
-                if not admin:
+                if not snapshot:
                     flash('Admin account not found', 'danger')
                     return redirect(url_for('login'))
 
-                # Get subscription details
-                tier = admin.get('subscription_tier', 'starter')
-                subscription_status = admin.get('subscription_status', 'active')
-                subscription_type = admin.get('subscription_type', 'monthly')
-                subscription_end_date = admin.get('subscription_end_date')
-                last_payment_date = admin.get('last_payment_date')
-                auto_renew = admin.get('auto_renew', False)
-
-                # CRITICAL: Check if subscription has expired
-                subscription_expired = False
-                grace_period_expired = False
-
-                if subscription_end_date and subscription_end_date < datetime.now():
-                    subscription_expired = True
-
-                    # Check grace period (7 days after expiry)
-                    grace_period_end = subscription_end_date + timedelta(days=7)
-                    if datetime.now() > grace_period_end:
-                        grace_period_expired = True
-
-                # CRITICAL: Check payment overdue (more than 30 days since last payment)
-                payment_overdue = False
-                if last_payment_date:
-                    days_since_payment = (datetime.now() - last_payment_date).days
-                    if days_since_payment > 30:  # 30 days payment overdue
-                        payment_overdue = True
-                else:  # No payment record for any tier
-                    payment_overdue = True
-
-                # ENFORCEMENT RULES - COMPLETE HALT CONDITIONS
-                halt_reasons = []
-
-                # 1. Subscription status is not active
-                if subscription_status != 'active':
-                    halt_reasons.append(f"Your {tier} subscription is {subscription_status}")
-
-                # 2. Grace period has expired
-                if grace_period_expired:
-                    halt_reasons.append("Your subscription grace period has expired")
-
-                # 3. Payment is severely overdue
-                if payment_overdue:
-                    halt_reasons.append("Your subscription payment is overdue")
-
-                # 4. No payment record for subscription
-                if not last_payment_date:
-                    halt_reasons.append("No payment record found for your subscription")
+                halt_reasons, warning_messages = subscription_state.evaluate(snapshot)
 
                 # COMPLETE HALT - Block ALL operations
                 if halt_reasons:
-                    # Suspend account (no free tier to downgrade to)
-                    mongo.db.admins.update_one(
-                        {"_id": admin_id},
-                        {"$set": {
-                            "subscription_status": "suspended",
-                            "suspended_at": datetime.now(),
-                            "suspension_reason": "; ".join(halt_reasons)
-                        }}
-                    )
-
-                    # Log the suspension
-                    app.logger.critical(f"SUBSCRIPTION SUSPENDED - Admin {admin_id}: {'; '.join(halt_reasons)}")
-
-                    # Create suspension record
-                    mongo.db.subscription_suspensions.insert_one({
-                        "admin_id": admin_id,
-                        "suspended_at": datetime.now(),
-                        "reasons": halt_reasons,
-                        "tier_at_suspension": tier,
-                        "last_payment_date": last_payment_date,
-                        "subscription_end_date": subscription_end_date
-                    })
+                    # Suspend account (no free tier to downgrade to); an already suspended admin costs no writes
+                    if snapshot.get('subscription_status') != 'suspended':
+                        if subscription_state.suspend(mongo.db, admin_id, halt_reasons):
+                            request_context.invalidate('admin', admin_id)
 
                     # Block access with detailed message
                     halt_message = "🚫 ALL OPERATIONS SUSPENDED - " + "; ".join(halt_reasons)
@@ -433,26 +402,8 @@ def enforce_subscription_payment(exclude_routes=None):
 
                     return render_template('subscription_suspended.html',
                                         reasons=halt_reasons,
-                                        admin=admin,
-                                        suspension_date=datetime.now())
-
-                # WARNING CHECKS - Allow operations but show warnings
-                warning_messages = []
-
-                # 1. Subscription expires within 3 days
-                if subscription_end_date and not subscription_expired:
-                    days_until_expiry = (subscription_end_date - datetime.now()).days
-                    if days_until_expiry <= 3:
-                        warning_messages.append(f"⚠️ Your subscription expires in {days_until_expiry} days")
-
-                # 2. Currently in grace period
-                if subscription_expired and not grace_period_expired:
-                    days_in_grace = (datetime.now() - subscription_end_date).days
-                    warning_messages.append(f"⚠️ Subscription expired {days_in_grace} days ago - Grace period ends soon")
-
-                # 3. Auto-renewal failed (if applicable)
-                if auto_renew and subscription_expired:
-                    warning_messages.append("⚠️ Auto-renewal failed - Please update payment method")
+                                        admin=snapshot,
+                                        suspension_date=snapshot.get('suspended_at') or datetime.now())
 
                 # Show warnings but allow operations
                 for warning in warning_messages:
@@ -472,7 +423,7 @@ def check_subscription_status_only():
     """Helper function to check subscription status without enforcement"""
     try:
         admin_id = get_admin_id()
-        admin = mongo.db.admins.find_one({"_id": admin_id})
+        admin = get_current_admin(admin_id)
 
         if not admin:
             return {'valid': False, 'reason': 'Admin not found'}
@@ -564,8 +515,7 @@ def initialize_properties_collection():
             mongo.db.create_collection('properties')
 
         # Create indexes for properties
-        mongo.db.properties.create_index([('admin_id', 1)])
-        mongo.db.properties.create_index([('name', 1), ('admin_id', 1)])
+        db_indexes.ensure_indexes(mongo.db, ['properties'])
 
         # Create default property for existing admins who don't have one
         admins_without_properties = mongo.db.admins.find({})
@@ -740,7 +690,8 @@ def migrate_existing_readings_to_payments():
                     'updated_at': datetime.now()
                 }
                 
-                mongo.db.payments.insert_one(payment_data)
+                balances.insert_bills(mongo.db, [payment_data])
+                rollups.record_bills(mongo.db, [payment_data])
                 app.logger.info(f"Migrated payment record for reading {reading['_id']}")
         
         app.logger.info("Migration completed successfully")
@@ -759,29 +710,7 @@ def migrate_to_meter_readings():
             mongo.db.create_collection('meter_readings')
             
         # Create indexes for optimal performance
-        mongo.db.meter_readings.create_index([
-            ('tenant_id', 1),
-            ('admin_id', 1),
-            ('date_recorded', -1)
-        ], name='tenant_admin_date_idx')
-        
-        mongo.db.meter_readings.create_index([
-            ('house_number', 1),
-            ('admin_id', 1),
-            ('date_recorded', -1)
-        ], name='house_admin_date_idx')
-        
-        mongo.db.meter_readings.create_index([
-            ('house_id', 1),
-            ('date_recorded', -1)
-        ], name='house_id_date_idx')
-        
-        # Add compound index for payment queries
-        mongo.db.meter_readings.create_index([
-            ('admin_id', 1),
-            ('reading_type', 1),
-            ('date_recorded', -1)
-        ], name='admin_type_date_idx')
+        db_indexes.ensure_indexes(mongo.db, ['meter_readings'])
         
         # Migrate water_readings data
         water_readings = list(mongo.db.water_readings.find({}))
@@ -810,6 +739,9 @@ def migrate_to_meter_readings():
                     unique_readings.append(reading)
             
             mongo.db.meter_readings.insert_many(unique_readings)
+            rollups.record_readings(mongo.db, unique_readings)
+            tenant_statements.bump(reading.get('tenant_id') for reading in unique_readings)
+            last_readings.rebuild_last_readings(mongo.db)
             
         app.logger.info(f"Migrated {len(all_readings)} readings to meter_readings collection")
         return True
@@ -957,7 +889,7 @@ def subscription():
     """Enhanced subscription management page"""
     try:
         admin_id = get_admin_id()
-        admin = mongo.db.admins.find_one({"_id": admin_id})
+        admin = get_current_admin(admin_id)
         
         # Get current usage
         tenant_count = mongo.db.tenants.count_documents({"admin_id": admin_id})
@@ -1025,6 +957,8 @@ def upgrade_subscription():
                 "subscription_end_date": datetime.now() + relativedelta(months=1)
             }}
         )
+        request_context.invalidate('admin', admin_id)
+        subscription_state.invalidate(admin_id)
         
         flash(f'Successfully upgraded to {SUBSCRIPTION_TIERS[new_tier]["name"]} plan!', 'success')
         
@@ -1040,7 +974,7 @@ def fix_subscription_dates():
     """Fix missing subscription dates for existing admins"""
     try:
         admin_id = get_admin_id()
-        admin = mongo.db.admins.find_one({"_id": admin_id})
+        admin = get_current_admin(admin_id)
 
         if not admin:
             flash('Admin not found', 'danger')
@@ -1070,6 +1004,8 @@ def fix_subscription_dates():
                     "auto_renew": admin.get('auto_renew', True)
                 }}
             )
+            request_context.invalidate('admin', admin_id)
+            subscription_state.invalidate(admin_id)
 
             flash(f'Subscription dates have been set! Your {subscription_type} subscription expires on {end_date.strftime("%B %d, %Y")}', 'success')
         else:
@@ -1088,7 +1024,7 @@ def initiate_subscription_payment():
     """Initiate M-Pesa payment for subscription"""
     try:
         admin_id = get_admin_id()
-        admin = mongo.db.admins.find_one({"_id": admin_id})
+        admin = get_current_admin(admin_id)
         
         # Get form data
         tier = request.form.get('tier')
@@ -1124,6 +1060,8 @@ def initiate_subscription_payment():
                     "auto_renew": True  # Both monthly and annual can have auto-renewal
                 }}
             )
+            request_context.invalidate('admin', admin_id)
+            subscription_state.invalidate(admin_id)
             return jsonify({'success': True, 'message': 'Free tier activated'})
             
         # Generate unique reference
@@ -1167,95 +1105,111 @@ def initiate_subscription_payment():
         app.logger.error(f"Payment initiation error: {e}")
         return jsonify({'error': 'Failed to initiate payment'}), 500
 
-@app.route('/mpesa/signup-callback', methods=['POST'])
-@csrf.exempt  # M-Pesa callbacks can't send CSRF tokens
-def mpesa_signup_callback():
-    """Handle M-Pesa payment callbacks for new signups"""
+def stk_checkout_request_id(data):
+    """CheckoutRequestID of an STK Push callback, or None when the payload is malformed"""
     try:
-        # Get callback data
-        data = request.get_json()
+        return data['Body']['stkCallback']['CheckoutRequestID']
+    except (KeyError, TypeError):
+        return None
 
-        # Extract relevant information
-        result_code = data['Body']['stkCallback']['ResultCode']
-        checkout_request_id = data['Body']['stkCallback']['CheckoutRequestID']
+def record_stk_callback(kind):
+    """Persist an STK Push callback to the payment inbox and acknowledge it straight away"""
+    data = request.get_json(silent=True)
+    checkout_request_id = stk_checkout_request_id(data)
+    if not checkout_request_id:
+        app.logger.error(f"Malformed {kind} callback: {data}")
+        return jsonify({'ResultCode': 1, 'ResultDesc': 'Invalid callback'})
 
-        # Find signup payment record
-        payment = mongo.db.signup_payments.find_one({
-            'checkout_request_id': checkout_request_id
-        })
+    try:
+        payment_inbox.record(mongo.db, 'mpesa_stk', kind, checkout_request_id, data)
+    except Exception as e:
+        app.logger.error(f"Error recording {kind} callback {checkout_request_id}: {e}")
+        return jsonify({'ResultCode': 1, 'ResultDesc': 'Internal error'})
 
-        if not payment:
-            app.logger.error(f"Signup payment record not found for {checkout_request_id}")
-            return jsonify({'ResultCode': 1, 'ResultDesc': 'Payment not found'})
+    return jsonify({'ResultCode': 0, 'ResultDesc': 'Success'})
 
-        admin_id = payment['admin_id']
+@app.route('/mpesa/signup-callback', methods=['POST'])
+@csrf.exempt  # M-Pesa callbacks can't send CSRF tokens
+def mpesa_signup_callback():
+    """Handle M-Pesa payment callbacks for new signups"""
+    return record_stk_callback('signup')
 
-        if result_code == 0:  # Success
-            # Extract payment details
-            callback_metadata = data['Body']['stkCallback']['CallbackMetadata']['Item']
+def process_signup_callback(entry):
+    """Apply a signup STK callback from the payment inbox: activate the account or flag the failure"""
+    data = entry['payload']
+    result_code = data['Body']['stkCallback']['ResultCode']
+    checkout_request_id = entry['transaction_id']
 
-            amount = next(item['Value'] for item in callback_metadata if item['Name'] == 'Amount')
-            receipt_number = next(item['Value'] for item in callback_metadata if item['Name'] == 'MpesaReceiptNumber')
+    payment = mongo.db.signup_payments.find_one({'checkout_request_id': checkout_request_id})
+    if not payment:
+        # The callback can overtake the insert made once the STK request returns, so retry later
+        raise LookupError(f"Signup payment record not found for {checkout_request_id}")
 
-            # Update payment record
-            mongo.db.signup_payments.update_one(
-                {'_id': payment['_id']},
-                {'$set': {
-                    'status': 'completed',
-                    'receipt_number': receipt_number,
-                    'completed_at': datetime.now()
-                }}
-            )
+    if payment.get('status') == 'completed':
+        return 'already completed'
 
-            # ACTIVATE THE ACCOUNT
-            tier = payment['tier']
-            payment_type = payment['payment_type']
+    admin_id = payment['admin_id']
 
-            # Calculate subscription dates
-            start_date = datetime.now()
-            if payment_type == 'annual':
-                end_date = start_date + relativedelta(years=1)
-            else:  # monthly
-                end_date = start_date + relativedelta(months=1)
+    if result_code == 0:  # Success
+        # Extract payment details
+        callback_metadata = data['Body']['stkCallback']['CallbackMetadata']['Item']
+        receipt_number = next(item['Value'] for item in callback_metadata if item['Name'] == 'MpesaReceiptNumber')
 
-            # Activate admin account
-            mongo.db.admins.update_one(
-                {"_id": admin_id},
-                {"$set": {
-                    "subscription_status": "active",
-                    "subscription_start_date": start_date,
-                    "subscription_end_date": end_date,
-                    "last_payment_date": start_date
-                }}
-            )
+        # ACTIVATE THE ACCOUNT
+        tier = payment['tier']
+        payment_type = payment['payment_type']
 
-            app.logger.info(f"Signup payment successful for admin {admin_id}, subscription activated")
+        # Calculate subscription dates
+        start_date = datetime.now()
+        if payment_type == 'annual':
+            end_date = start_date + relativedelta(years=1)
+        else:  # monthly
+            end_date = start_date + relativedelta(months=1)
 
-        else:  # Payment failed
-            # Update payment status
-            mongo.db.signup_payments.update_one(
-                {'_id': payment['_id']},
-                {'$set': {
-                    'status': 'failed',
-                    'failed_at': datetime.now()
-                }}
-            )
+        # Activation only sets fields, so it runs before the payment is marked and a retry repeats it safely
+        mongo.db.admins.update_one(
+            {"_id": admin_id},
+            {"$set": {
+                "subscription_status": "active",
+                "subscription_start_date": start_date,
+                "subscription_end_date": end_date,
+                "last_payment_date": start_date
+            }}
+        )
+        subscription_state.invalidate(admin_id)
+
+        mongo.db.signup_payments.update_one(
+            {'_id': payment['_id']},
+            {'$set': {
+                'status': 'completed',
+                'receipt_number': receipt_number,
+                'completed_at': datetime.now()
+            }}
+        )
 
-            # Mark admin account as payment failed (can retry)
-            mongo.db.admins.update_one(
-                {"_id": admin_id},
-                {"$set": {
-                    "subscription_status": "payment_failed"
-                }}
-            )
+        app.logger.info(f"Signup payment successful for admin {admin_id}, subscription activated")
+        return 'activated'
 
-            app.logger.error(f"Signup payment failed for admin {admin_id}")
+    # Payment failed
+    mongo.db.signup_payments.update_one(
+        {'_id': payment['_id']},
+        {'$set': {
+            'status': 'failed',
+            'failed_at': datetime.now()
+        }}
+    )
 
-        return jsonify({'ResultCode': 0, 'ResultDesc': 'Success'})
+    # Mark admin account as payment failed (can retry)
+    mongo.db.admins.update_one(
+        {"_id": admin_id},
+        {"$set": {
+            "subscription_status": "payment_failed"
+        }}
+    )
+    subscription_state.invalidate(admin_id)
 
-    except Exception as e:
-        app.logger.error(f"Signup callback error: {e}")
-        return jsonify({'ResultCode': 1, 'ResultDesc': 'Internal error'})
+    app.logger.error(f"Signup payment failed for admin {admin_id}")
+    return 'failed'
 
 # ==================== PAYSTACK PAYMENT ROUTES ====================
 
@@ -1279,7 +1233,7 @@ def paystack_initiate_subscription_payment():
 
         admin_id = get_admin_id()
         print(f"Admin ID: {admin_id}")
-        admin = mongo.db.admins.find_one({"_id": admin_id})
+        admin = get_current_admin(admin_id)
 
         if not admin:
             print("ERROR: Admin not found!")
@@ -1407,55 +1361,37 @@ def paystack_subscription_callback():
             flash('Payment record not found', 'danger')
             return redirect(url_for('subscription'))
 
-        admin_id = payment['admin_id']
-        tier = payment['tier']
-        payment_type = payment['payment_type']
-        amount = payment['amount']
-
-        # Check if payment succeeded
         if result['status'] == 'success':
             # Verify amount
-            if result['amount'] != amount:
-                app.logger.warning(f"Amount mismatch: Expected {amount}, got {result['amount']}")
-
-            # Update payment record
-            mongo.db.subscription_payments.update_one(
-                {'reference': reference},
-                {'$set': {
-                    'status': 'completed',
-                    'completed_at': datetime.now(),
-                    'channel': result.get('channel'),
-                    'fees': result.get('fees', 0)
-                }}
-            )
+            if result['amount'] != payment['amount']:
+                app.logger.warning(f"Amount mismatch: Expected {payment['amount']}, got {result['amount']}")
+            event = 'charge.success'
+        elif result['status'] == 'failed':
+            event = 'charge.failed'
+        else:
+            flash('Payment was not completed. Please try again.', 'warning')
+            return redirect(url_for('subscription'))
 
-            # Calculate dates
-            start_date = datetime.now()
-            end_date = start_date + (relativedelta(years=1) if payment_type == 'annual' else relativedelta(months=1))
+        # Shares the webhook's inbox key, so whichever arrives first applies the charge
+        entry_id, _ = payment_inbox.record(mongo.db, 'paystack', 'paystack_charge', f"{event}:{reference}", {
+            'event': event,
+            'source': 'redirect',
+            'data': {'reference': reference, 'channel': result.get('channel'), 'fees': result.get('fees', 0)}
+        })
 
-            # Update admin subscription
-            mongo.db.admins.update_one(
-                {"_id": admin_id},
-                {"$set": {
-                    "subscription_tier": tier,
-                    "subscription_type": payment_type,
-                    "subscription_status": "active",
-                    "subscription_start_date": start_date,
-                    "subscription_end_date": end_date,
-                    "last_payment_date": start_date
-                }}
-            )
+        # The payer is waiting on this page, so apply it now unless a worker already holds it
+        if entry_id is not None:
+            entry = payment_inbox.claim_entry(mongo.db, f"request:{os.getpid()}", entry_id)
+            if entry:
+                payment_inbox.process_entry(mongo.db, PAYMENT_INBOX_HANDLERS, entry)
 
-            app.logger.info(f"Subscription activated: {admin_id} - {tier}")
-            flash(f'Payment successful! Your {tier.title()} subscription is now active.', 'success')
-        elif result['status'] == 'failed':
-            mongo.db.subscription_payments.update_one(
-                {'reference': reference},
-                {'$set': {'status': 'failed', 'failed_at': datetime.now()}}
-            )
+        payment = mongo.db.subscription_payments.find_one({'reference': reference})
+        if event == 'charge.failed':
             flash('Payment failed. Please try again.', 'danger')
+        elif payment.get('status') == 'completed':
+            flash(f'Payment successful! Your {payment["tier"].title()} subscription is now active.', 'success')
         else:
-            flash('Payment was not completed. Please try again.', 'warning')
+            flash('Payment received. Your subscription will be activated shortly.', 'info')
 
         return redirect(url_for('subscription'))
 
@@ -1484,38 +1420,12 @@ def paystack_webhook():
         # Parse data
         data = request.get_json()
         event = data.get('event')
-        event_data = data.get('data', {})
 
         app.logger.info(f"Paystack webhook: {event}")
 
-        if event == 'charge.success':
-            reference = event_data.get('reference')
-            channel = event_data.get('channel')
-
-            payment = mongo.db.subscription_payments.find_one({'reference': reference})
-
-            if payment and payment.get('status') == 'pending':
-                mongo.db.subscription_payments.update_one(
-                    {'reference': reference},
-                    {'$set': {
-                        'status': 'completed',
-                        'completed_at': datetime.now(),
-                        'channel': channel,
-                        'webhook_received': True
-                    }}
-                )
-                app.logger.info(f"Payment confirmed via webhook: {reference}")
-
-        elif event == 'charge.failed':
-            reference = event_data.get('reference')
-            mongo.db.subscription_payments.update_one(
-                {'reference': reference},
-                {'$set': {
-                    'status': 'failed',
-                    'failed_at': datetime.now(),
-                    'webhook_received': True
-                }}
-            )
+        if event in ('charge.success', 'charge.failed'):
+            reference = data.get('data', {}).get('reference')
+            payment_inbox.record(mongo.db, 'paystack', 'paystack_charge', f"{event}:{reference}", dict(data, source='webhook'))
 
         return jsonify({'status': 'success'}), 200
 
@@ -1523,92 +1433,147 @@ def paystack_webhook():
         app.logger.error(f"Paystack webhook error: {str(e)}")
         return jsonify({'status': 'error', 'message': str(e)}), 500
 
+def process_paystack_charge(entry):
+    """Apply a Paystack charge event from the payment inbox to its subscription payment"""
+    data = entry['payload']
+    event = data.get('event')
+    event_data = data.get('data', {})
+    reference = event_data.get('reference')
+    confirmation = {'webhook_received': True} if data.get('source') == 'webhook' else {}
+
+    payment = mongo.db.subscription_payments.find_one({'reference': reference})
+    if not payment:
+        return 'ignored: no subscription payment for reference'
+
+    if event == 'charge.failed':
+        mongo.db.subscription_payments.update_one(
+            {'reference': reference, 'status': {'$ne': 'completed'}},
+            {'$set': dict(confirmation, status='failed', failed_at=datetime.now())}
+        )
+        return 'failed'
+
+    if payment.get('status') == 'completed':
+        return 'already completed'
+
+    admin_id = payment['admin_id']
+    tier = payment['tier']
+    payment_type = payment['payment_type']
+
+    # Calculate dates
+    start_date = datetime.now()
+    end_date = start_date + (relativedelta(years=1) if payment_type == 'annual' else relativedelta(months=1))
+
+    # Activation only sets fields, so it runs before the payment is marked and a retry repeats it safely
+    mongo.db.admins.update_one(
+        {"_id": admin_id},
+        {"$set": {
+            "subscription_tier": tier,
+            "subscription_type": payment_type,
+            "subscription_status": "active",
+            "subscription_start_date": start_date,
+            "subscription_end_date": end_date,
+            "last_payment_date": start_date
+        }}
+    )
+    subscription_state.invalidate(admin_id)
+
+    mongo.db.subscription_payments.update_one(
+        {'reference': reference},
+        {'$set': dict(
+            confirmation,
+            status='completed',
+            completed_at=datetime.now(),
+            channel=event_data.get('channel'),
+            fees=event_data.get('fees', 0)
+        )}
+    )
+
+    app.logger.info(f"Subscription activated: {admin_id} - {tier}")
+    return 'activated'
+
 # ==================== END PAYSTACK ROUTES ====================
 
 @app.route('/mpesa/callback', methods=['POST'])
 @csrf.exempt  # M-Pesa callbacks can't send CSRF tokens
 def mpesa_callback():
     """Handle M-Pesa payment callbacks"""
-    try:
-        # Get callback data
-        data = request.get_json()
-        
-        # Extract relevant information
-        result_code = data['Body']['stkCallback']['ResultCode']
-        checkout_request_id = data['Body']['stkCallback']['CheckoutRequestID']
-        
-        # Find payment record
-        payment = mongo.db.subscription_payments.find_one({
-            'checkout_request_id': checkout_request_id
-        })
-        
-        if not payment:
-            app.logger.error(f"Payment record not found for {checkout_request_id}")
-            return jsonify({'ResultCode': 1, 'ResultDesc': 'Payment not found'})
-            
-        if result_code == 0:  # Success
-            # Extract payment details
-            callback_metadata = data['Body']['stkCallback']['CallbackMetadata']['Item']
-            
-            amount = next(item['Value'] for item in callback_metadata if item['Name'] == 'Amount')
-            receipt_number = next(item['Value'] for item in callback_metadata if item['Name'] == 'MpesaReceiptNumber')
-            
-            # Update payment record
-            mongo.db.subscription_payments.update_one(
-                {'_id': payment['_id']},
-                {'$set': {
-                    'status': 'completed',
-                    'receipt_number': receipt_number,
-                    'completed_at': datetime.now()
-                }}
-            )
-            
-            # AUTOMATIC REACTIVATION: Use new reactivation system
-            admin_id = payment['admin_id']
-            tier = payment['tier']
-            payment_type = payment['payment_type']
+    return record_stk_callback('subscription')
 
-            # Use enhanced reactivation function (handles suspended accounts)
-            reactivation_success = reactivate_subscription_on_payment(admin_id, tier, payment_type)
+def process_subscription_callback(entry):
+    """Apply a subscription STK callback from the payment inbox"""
+    data = entry['payload']
+    result_code = data['Body']['stkCallback']['ResultCode']
+    checkout_request_id = entry['transaction_id']
 
-            if not reactivation_success:
-                app.logger.error(f"Failed to reactivate subscription for admin {admin_id}")
-                # Fallback to manual activation
-                mongo.db.admins.update_one(
-                    {"_id": admin_id},
-                    {"$set": {
-                        "subscription_tier": tier,
-                        "subscription_type": payment_type,
-                        "subscription_status": "active",
-                        "subscription_start_date": datetime.now(),
-                        "last_payment_date": datetime.now()
-                    }}
-                )
-            
-            # Send confirmation SMS
-            admin = mongo.db.admins.find_one({"_id": admin_id})
-            if admin and admin.get('phone'):
-                tier_name = SUBSCRIPTION_TIERS[tier]['name']
-                message = f"Payment confirmed! Your {tier_name} {payment_type} subscription is now active. Thank you for choosing Water Billing System."
-                send_message(admin['phone'], message)
-                
-        else:  # Failed
-            result_desc = data['Body']['stkCallback']['ResultDesc']
-            
-            mongo.db.subscription_payments.update_one(
-                {'_id': payment['_id']},
-                {'$set': {
-                    'status': 'failed',
-                    'error_message': result_desc,
-                    'failed_at': datetime.now()
+    # Find payment record
+    payment = mongo.db.subscription_payments.find_one({
+        'checkout_request_id': checkout_request_id
+    })
+
+    if not payment:
+        # The callback can overtake the insert made once the STK request returns, so retry later
+        raise LookupError(f"Payment record not found for {checkout_request_id}")
+
+    if result_code != 0:  # Failed
+        result_desc = data['Body']['stkCallback']['ResultDesc']
+
+        mongo.db.subscription_payments.update_one(
+            {'_id': payment['_id'], 'status': {'$ne': 'completed'}},
+            {'$set': {
+                'status': 'failed',
+                'error_message': result_desc,
+                'failed_at': datetime.now()
+            }}
+        )
+        return 'failed'
+
+    admin_id = payment['admin_id']
+    tier = payment['tier']
+    payment_type = payment['payment_type']
+
+    if payment.get('status') != 'completed':
+        # Extract payment details
+        callback_metadata = data['Body']['stkCallback']['CallbackMetadata']['Item']
+        receipt_number = next(item['Value'] for item in callback_metadata if item['Name'] == 'MpesaReceiptNumber')
+
+        # AUTOMATIC REACTIVATION: Use new reactivation system
+        # Activation only sets fields, so it runs before the payment is marked and a retry repeats it safely
+        reactivation_success = reactivate_subscription_on_payment(admin_id, tier, payment_type)
+
+        if not reactivation_success:
+            app.logger.error(f"Failed to reactivate subscription for admin {admin_id}")
+            # Fallback to manual activation
+            mongo.db.admins.update_one(
+                {"_id": admin_id},
+                {"$set": {
+                    "subscription_tier": tier,
+                    "subscription_type": payment_type,
+                    "subscription_status": "active",
+                    "subscription_start_date": datetime.now(),
+                    "last_payment_date": datetime.now()
                 }}
             )
-            
-        return jsonify({'ResultCode': 0, 'ResultDesc': 'Success'})
+            subscription_state.invalidate(admin_id)
+
+        # Update payment record
+        mongo.db.subscription_payments.update_one(
+            {'_id': payment['_id']},
+            {'$set': {
+                'status': 'completed',
+                'receipt_number': receipt_number,
+                'completed_at': datetime.now()
+            }}
+        )
 
-    except Exception as e:
-        app.logger.error(f"M-Pesa callback error: {e}")
-        return jsonify({'ResultCode': 1, 'ResultDesc': 'Internal error'})
+    # Send confirmation SMS
+    if payment_inbox.claim_effect(mongo.db, 'subscription_payments', payment['_id'], 'confirmation_sms'):
+        admin = mongo.db.admins.find_one({"_id": admin_id}, {'phone': 1})
+        if admin and admin.get('phone'):
+            tier_name = SUBSCRIPTION_TIERS[tier]['name']
+            message = f"Payment confirmed! Your {tier_name} {payment_type} subscription is now active. Thank you for choosing Water Billing System."
+            queue_message(admin['phone'], message)
+
+    return 'activated'
 
 @app.route('/mpesa/till_callback', methods=['POST'])
 @csrf.exempt  # M-Pesa callbacks can't send CSRF tokens
@@ -1623,115 +1588,19 @@ def find_tenant_with_multi_reference(admin_id, payment_method, bill_ref_number,
     Returns: (tenant, house, matching_method)
     """
     try:
-        # Strategy 1: PayBill - House number as account reference (most reliable)
-        if payment_method == 'paybill' and bill_ref_number:
-            # Check if admin has enabled house number feature
-            config = mongo.db.sms_config.find_one({"admin_id": admin_id})
-            if config and config.get('use_house_number_as_account'):
-                # Find house by house number
-                house = mongo.db.houses.find_one({
-                    "house_number": bill_ref_number,
-                    "admin_id": admin_id
-                })
-
-                if house:
-                    # Find tenant in that house
-                    tenant = mongo.db.tenants.find_one({
-                        "house_number": bill_ref_number,
-                        "admin_id": admin_id
-                    })
-
-                    if tenant:
-                        return tenant, house, "house_number_paybill"
-                    else:
-                        # House exists but no tenant found - still return house for manual allocation
-                        return None, house, "house_found_no_tenant"
-
-        # Strategy 2: Phone number + name matching (works for both PayBill and Till)
-        if customer_phone and customer_name:
-            # Normalize name for comparison (remove extra spaces, convert to lowercase)
-            normalized_customer_name = ' '.join(customer_name.lower().split())
-
-            # Find tenant by phone and name match
-            tenants = list(mongo.db.tenants.find({
-                "admin_id": admin_id,
-                "phone": customer_phone
-            }))
-
-            for tenant in tenants:
-                tenant_name = tenant.get('name', '').lower()
-                normalized_tenant_name = ' '.join(tenant_name.split())
-
-                # Check if names match (exact or partial)
-                if (normalized_customer_name in normalized_tenant_name or
-                    normalized_tenant_name in normalized_customer_name):
-
-                    # Find the house for this tenant
-                    house = mongo.db.houses.find_one({
-                        "house_number": tenant.get('house_number'),
-                        "admin_id": admin_id
-                    })
-
-                    return tenant, house, "phone_and_name_match"
-
-        # Strategy 3: Phone number only (less reliable)
-        if customer_phone:
-            tenant = mongo.db.tenants.find_one({
-                "admin_id": admin_id,
-                "phone": customer_phone
-            })
-
-            if tenant:
-                house = mongo.db.houses.find_one({
-                    "house_number": tenant.get('house_number'),
-                    "admin_id": admin_id
-                })
-
-                return tenant, house, "phone_only_match"
-
-        # Strategy 4: Till users - House number as tenant reference (if available)
-        if payment_method == 'till' and bill_ref_number:
-            # For Till users, sometimes bill_ref_number might be house number
-            house = mongo.db.houses.find_one({
-                "house_number": bill_ref_number,
-                "admin_id": admin_id
-            })
-
-            if house:
-                tenant = mongo.db.tenants.find_one({
-                    "house_number": bill_ref_number,
-                    "admin_id": admin_id
-                })
-
-                return tenant, house, "house_number_till"
-
-        # Strategy 5: Name matching only (least reliable)
-        if customer_name and len(customer_name.strip()) > 3:
-            normalized_customer_name = ' '.join(customer_name.lower().split())
-
-            # Find tenants with similar names
-            tenants = list(mongo.db.tenants.find({"admin_id": admin_id}))
-
-            for tenant in tenants:
-                tenant_name = tenant.get('name', '').lower()
-                normalized_tenant_name = ' '.join(tenant_name.split())
-
-                # More strict name matching for this fallback
-                if normalized_customer_name == normalized_tenant_name:
-                    house = mongo.db.houses.find_one({
-                        "house_number": tenant.get('house_number'),
-                        "admin_id": admin_id
-                    })
-
-                    return tenant, house, "name_only_exact_match"
-
-        # No match found
-        return None, None, "no_match_found"
+        index = matching_index.get_index(mongo.db, admin_id)
+        return matching_index.match_payment(index, payment_method, bill_ref_number, customer_phone, customer_name)
 
     except Exception as e:
         app.logger.error(f"Error in tenant matching: {str(e)}")
         return None, None, "matching_error"
 
+def invalidate_matching_index(admin_id):
+    """Forget an admin's cached payment matching index and listing counts after tenants, houses or settings change"""
+    matching_index.invalidate(admin_id)
+    paging.invalidate_counts('tenants', admin_id)
+    paging.invalidate_counts('houses', admin_id)
+
 def get_matching_confidence(matching_method):
     """Return confidence level for different matching methods"""
     confidence_map = {
@@ -1749,27 +1618,15 @@ def get_matching_confidence(matching_method):
 @app.route('/mpesa/paybill_callback', methods=['POST'])
 @csrf.exempt  # M-Pesa callbacks can't send CSRF tokens
 def mpesa_payment_callback():
-    """Handle automatic M-Pesa PayBill/Till payments with multi-reference tenant matching"""
+    """Handle automatic M-Pesa PayBill/Till payments: persist them to the payment inbox and acknowledge"""
     try:
         # Log the incoming request
         data = request.get_json()
         app.logger.info(f"PayBill callback received: {data}")
 
-        # Extract payment information from PayBill callback
-        # PayBill format is different from STK Push
-        trans_type = data.get('TransactionType')
         trans_id = data.get('TransID')
-        trans_time = data.get('TransTime')
         trans_amount = data.get('TransAmount')
         business_short_code = data.get('BusinessShortCode')
-        bill_ref_number = data.get('BillRefNumber', '').strip()  # This is the account name/house number
-        invoice_number = data.get('InvoiceNumber')
-        org_account_balance = data.get('OrgAccountBalance')
-        third_party_trans_id = data.get('ThirdPartyTransID')
-        msisdn = data.get('MSISDN')  # Customer phone number
-        first_name = data.get('FirstName', '')
-        middle_name = data.get('MiddleName', '')
-        last_name = data.get('LastName', '')
 
         # Validate required fields (trans_amount and trans_id are always required)
         if not all([trans_id, trans_amount]):
@@ -1780,12 +1637,7 @@ def mpesa_payment_callback():
             })
 
         # Find admin by business short code (supports both PayBill and Till)
-        admin = mongo.db.admins.find_one({
-            '$or': [
-                {'business_number': str(business_short_code)},
-                {'till': str(business_short_code)}
-            ]
-        })
+        admin = matching_index.find_admin_by_shortcode(mongo.db, business_short_code)
 
         if not admin:
             app.logger.error(f"Admin not found for business code: {business_short_code}")
@@ -1794,105 +1646,16 @@ def mpesa_payment_callback():
                 'ResultDesc': 'Business not found'
             })
 
-        admin_id = admin['_id']
-        payment_method = admin.get('payment_method', 'till')  # Default to till for older accounts
-
-        # Clean phone number (remove country code if present)
-        customer_phone = msisdn
-        if customer_phone and customer_phone.startswith('254'):
-            customer_phone = '0' + customer_phone[3:]
-
-        # Build customer name from M-Pesa data
-        customer_name = f"{first_name} {middle_name} {last_name}".strip()
-
-        # Enhanced tenant matching with multiple strategies
-        tenant, house, matching_method = find_tenant_with_multi_reference(
-            admin_id=admin_id,
-            payment_method=payment_method,
-            bill_ref_number=bill_ref_number,
-            customer_phone=customer_phone,
-            customer_name=customer_name
-        )
-
-        # Create automatic payment record
-        current_month = datetime.now().strftime('%Y-%m')
-
-        # Check if payment already exists for this transaction
-        existing_payment = mongo.db.payments.find_one({
-            'mpesa_trans_id': trans_id,
-            'admin_id': admin_id
-        })
+        # Matching, recording and SMS happen in the inbox workers so Safaricom is answered at once
+        _, is_new = payment_inbox.record(mongo.db, 'mpesa_c2b', 'c2b_payment', trans_id, data, admin['_id'])
 
-        if existing_payment:
+        if not is_new:
             app.logger.info(f"Payment already recorded for transaction: {trans_id}")
             return jsonify({
                 'ResultCode': '00000000',
                 'ResultDesc': 'Success - payment already recorded'
             })
 
-        # Create unallocated payment record (to be manually allocated by admin)
-        unallocated_payment = {
-            'admin_id': admin_id,
-            'house_id': house['_id'] if house else None,
-            'house_number': house.get('house_number') if house else bill_ref_number,
-            'tenant_id': tenant['_id'] if tenant else None,
-            'tenant_name': tenant['name'] if tenant else customer_name,
-            'amount_received': float(trans_amount),
-            'amount_allocated': 0.0,
-            'amount_remaining': float(trans_amount),
-            'payment_method': f'mpesa_{payment_method}',  # mpesa_paybill or mpesa_till
-            'payment_status': 'unallocated',
-            'allocation_status': 'pending',  # pending/partial/complete
-            'payment_date': datetime.now(),
-            'month_year': current_month,
-            'mpesa_trans_id': trans_id,
-            'mpesa_phone': msisdn,
-            'customer_phone': customer_phone,
-            'customer_name': customer_name,
-            'bill_ref_number': bill_ref_number,
-            'matching_method': matching_method,
-            'matching_confidence': get_matching_confidence(matching_method),
-            'allocations': [],  # Array to track bill allocations
-            'created_at': datetime.now(),
-            'updated_at': datetime.now(),
-            'notes': f'Auto M-Pesa payment via {payment_method.upper()} - {matching_method}. Ref: {bill_ref_number or "N/A"}'
-        }
-
-        # Insert unallocated payment record
-        result = mongo.db.unallocated_payments.insert_one(unallocated_payment)
-        app.logger.info(f"Unallocated payment recorded: {result.inserted_id}")
-
-        # Send confirmation SMS to tenant if phone number available
-        if tenant and tenant.get('phone'):
-            try:
-                house_info = house.get('house_number', 'N/A') if house else 'N/A'
-                confidence = get_matching_confidence(matching_method)
-                message = f"Payment received! Amount: KES {trans_amount}, House: {house_info}, Ref: {trans_id}. Your payment is being processed. Thank you!"
-                send_message(tenant['phone'], message)
-            except Exception as sms_error:
-                app.logger.error(f"SMS sending failed: {sms_error}")
-
-        # Send notification to admin about unallocated payment with matching details
-        if admin.get('phone'):
-            try:
-                tenant_name = tenant['name'] if tenant else customer_name or 'Unknown'
-                house_info = house.get('house_number') if house else bill_ref_number or 'Unknown'
-                confidence = get_matching_confidence(matching_method)
-
-                # Create detailed message based on matching confidence
-                if confidence == "high":
-                    message = f"NEW PAYMENT (High Match): {tenant_name}, House {house_info}, KES {trans_amount}. Tenant matched via {payment_method.upper()}. Ref: {trans_id}"
-                elif confidence == "medium":
-                    message = f"NEW PAYMENT (Medium Match): {tenant_name}, House {house_info}, KES {trans_amount}. Please verify and allocate. Ref: {trans_id}"
-                elif confidence == "low":
-                    message = f"NEW PAYMENT (Low Match): {tenant_name}, House {house_info}, KES {trans_amount}. Uncertain match - please verify. Ref: {trans_id}"
-                else:
-                    message = f"NEW PAYMENT (No Match): {customer_name}, KES {trans_amount}. Could not match tenant. Please allocate manually. Ref: {trans_id}"
-
-                send_message(admin['phone'], message)
-            except Exception as sms_error:
-                app.logger.error(f"Admin SMS sending failed: {sms_error}")
-
         return jsonify({
             'ResultCode': '00000000',
             'ResultDesc': 'Success'
@@ -1905,6 +1668,116 @@ def mpesa_payment_callback():
             'ResultDesc': 'Internal server error'
         })
 
+def process_c2b_payment(entry):
+    """Match a PayBill/Till payment from the payment inbox to a tenant and record it for allocation"""
+    data = entry['payload']
+
+    # Extract payment information from PayBill callback
+    # PayBill format is different from STK Push
+    trans_id = data.get('TransID')
+    trans_amount = data.get('TransAmount')
+    business_short_code = data.get('BusinessShortCode')
+    bill_ref_number = (data.get('BillRefNumber') or '').strip()  # This is the account name/house number
+    msisdn = data.get('MSISDN')  # Customer phone number
+    first_name = data.get('FirstName', '')
+    middle_name = data.get('MiddleName', '')
+    last_name = data.get('LastName', '')
+
+    admin = matching_index.find_admin_by_shortcode(mongo.db, business_short_code)
+    if not admin:
+        return f"ignored: business {business_short_code} not found"
+
+    admin_id = admin['_id']
+    payment_method = admin.get('payment_method', 'till')  # Default to till for older accounts
+
+    # Clean phone number (remove country code if present)
+    customer_phone = msisdn
+    if customer_phone and customer_phone.startswith('254'):
+        customer_phone = '0' + customer_phone[3:]
+
+    # Build customer name from M-Pesa data
+    customer_name = f"{first_name} {middle_name} {last_name}".strip()
+
+    # Check if payment already exists for this transaction
+    if mongo.db.payments.find_one({'mpesa_trans_id': trans_id, 'admin_id': admin_id}, {'_id': 1}):
+        return 'already recorded'
+
+    # Enhanced tenant matching with multiple strategies
+    tenant, house, matching_method = find_tenant_with_multi_reference(
+        admin_id=admin_id,
+        payment_method=payment_method,
+        bill_ref_number=bill_ref_number,
+        customer_phone=customer_phone,
+        customer_name=customer_name
+    )
+    if matching_method == 'matching_error':
+        raise RuntimeError(f"Tenant matching failed for transaction {trans_id}")
+
+    # Dated when the callback arrived, not when a worker got to it
+    received_at = entry['received_at']
+
+    # Create unallocated payment record (to be manually allocated by admin)
+    unallocated_payment = {
+        'house_id': house['_id'] if house else None,
+        'house_number': house.get('house_number') if house else bill_ref_number,
+        'tenant_id': tenant['_id'] if tenant else None,
+        'tenant_name': tenant['name'] if tenant else customer_name,
+        'amount_received': float(trans_amount),
+        'amount_allocated': 0.0,
+        'amount_remaining': float(trans_amount),
+        'payment_method': f'mpesa_{payment_method}',  # mpesa_paybill or mpesa_till
+        'payment_status': 'unallocated',
+        'allocation_status': 'pending',  # pending/partial/complete
+        'payment_date': received_at,
+        'month_year': received_at.strftime('%Y-%m'),
+        'mpesa_phone': msisdn,
+        'customer_phone': customer_phone,
+        'customer_name': customer_name,
+        'bill_ref_number': bill_ref_number,
+        'matching_method': matching_method,
+        'matching_confidence': get_matching_confidence(matching_method),
+        'allocations': [],  # Array to track bill allocations
+        'created_at': received_at,
+        'updated_at': datetime.now(),
+        'notes': f'Auto M-Pesa payment via {payment_method.upper()} - {matching_method}. Ref: {bill_ref_number or "N/A"}'
+    }
+
+    # Keyed on the transaction, so a retried entry finds the record an earlier attempt wrote
+    payment = mongo.db.unallocated_payments.find_one_and_update(
+        {'admin_id': admin_id, 'mpesa_trans_id': trans_id},
+        {'$setOnInsert': unallocated_payment},
+        upsert=True,
+        projection={'_id': 1},
+        return_document=pymongo.ReturnDocument.AFTER
+    )
+    app.logger.info(f"Unallocated payment recorded: {payment['_id']}")
+
+    # Send confirmation SMS to tenant if phone number available
+    if tenant and tenant.get('phone') and payment_inbox.claim_effect(mongo.db, 'unallocated_payments', payment['_id'], 'tenant_sms'):
+        house_info = house.get('house_number', 'N/A') if house else 'N/A'
+        message = f"Payment received! Amount: KES {trans_amount}, House: {house_info}, Ref: {trans_id}. Your payment is being processed. Thank you!"
+        queue_message(tenant['phone'], message)
+
+    # Send notification to admin about unallocated payment with matching details
+    if admin.get('phone') and payment_inbox.claim_effect(mongo.db, 'unallocated_payments', payment['_id'], 'admin_sms'):
+        tenant_name = tenant['name'] if tenant else customer_name or 'Unknown'
+        house_info = house.get('house_number') if house else bill_ref_number or 'Unknown'
+        confidence = get_matching_confidence(matching_method)
+
+        # Create detailed message based on matching confidence
+        if confidence == "high":
+            message = f"NEW PAYMENT (High Match): {tenant_name}, House {house_info}, KES {trans_amount}. Tenant matched via {payment_method.upper()}. Ref: {trans_id}"
+        elif confidence == "medium":
+            message = f"NEW PAYMENT (Medium Match): {tenant_name}, House {house_info}, KES {trans_amount}. Please verify and allocate. Ref: {trans_id}"
+        elif confidence == "low":
+            message = f"NEW PAYMENT (Low Match): {tenant_name}, House {house_info}, KES {trans_amount}. Uncertain match - please verify. Ref: {trans_id}"
+        else:
+            message = f"NEW PAYMENT (No Match): {customer_name}, KES {trans_amount}. Could not match tenant. Please allocate manually. Ref: {trans_id}"
+
+        queue_message(admin['phone'], message)
+
+    return matching_method
+
 
 @app.route('/mpesa/validation', methods=['POST'])
 @csrf.exempt
@@ -1929,66 +1802,51 @@ def mpesa_validation():
         })
 
 
+# Decrypted M-Pesa credentials and ready MpesaAPI clients, keyed by (admin_id, scope)
+# The TTL bounds staleness in other worker processes that did not see the save
+mpesa_client_cache = LRUCache(maxsize=512, ttl=600)
+
+def invalidate_mpesa_cache(admin_id):
+    """Forget cached M-Pesa credentials and clients for an admin after their config changes"""
+    mpesa_client_cache.discard_where(lambda key: key[0] == admin_id)
+
 def get_mpesa_credentials(admin_id):
     """Get decrypted M-Pesa credentials for an admin"""
     try:
+        cache_key = (admin_id, 'credentials')
+        credentials = mpesa_client_cache.get(cache_key)
+        if credentials is not None:
+            return credentials
+
         encrypted_config = mongo.db.mpesa_config.find_one({"admin_id": admin_id})
         if not encrypted_config:
             return None
 
-        return decrypt_mpesa_credentials(encrypted_config)
+        credentials = decrypt_mpesa_credentials(encrypted_config)
+        mpesa_client_cache.set(cache_key, credentials)
+        return credentials
     except Exception as e:
         app.logger.error(f"Error getting M-Pesa credentials: {e}")
         return None
 
 
 def generate_tenant_access_token(tenant_id, admin_id, expires_in_hours=24):
-    """Generate a secure access token for tenant portal"""
-    token_data = {
-        'tenant_id': str(tenant_id),
-        'admin_id': str(admin_id),
-        'timestamp': datetime.now().isoformat(),
-        'expires': (datetime.now() + timedelta(hours=expires_in_hours)).isoformat()
-    }
+    """Generate a signed, self-verifying access token for tenant portal; nothing is stored"""
+    return portal_tokens.issue(SECRET_KEY, tenant_id, admin_id, expires_in_hours)
 
-    serializer = URLSafeTimedSerializer(SECRET_KEY)
-    token = serializer.dumps(token_data)
 
-    # Store token in database for tracking
-    mongo.db.tenant_access_tokens.insert_one({
-        'token': token,
-        'tenant_id': ObjectId(tenant_id),
-        'admin_id': ObjectId(admin_id),
-        'created_at': datetime.now(),
-        'expires_at': datetime.now() + timedelta(hours=expires_in_hours),
-        'used': False
-    })
+def verify_tenant_access_token(token, use=None):
+    """Verify and decode tenant access token: signature and expiry, then the revocation filter"""
+    try:
+        claims = portal_tokens.decode(SECRET_KEY, token)
 
-    return token
-
-
-def verify_tenant_access_token(token):
-    """Verify and decode tenant access token"""
-    try:
-        serializer = URLSafeTimedSerializer(SECRET_KEY)
-        token_data = serializer.loads(token, max_age=24*3600)  # 24 hours
-
-        # Check if token exists in database and is not used
-        token_record = mongo.db.tenant_access_tokens.find_one({
-            'token': token,
-            'used': False,
-            'expires_at': {'$gt': datetime.now()}
-        })
-
-        if not token_record:
-            app.logger.warning(f"Token not found in database or expired: {token[:20]}...")
-            # If token not in DB but signature is valid, still allow access for backward compatibility
-            # but add logging to track this
-            app.logger.info(f"Allowing access with signature-only verification for token: {token[:20]}...")
+        if portal_tokens.is_revoked(mongo.db, claims, use):
+            app.logger.warning(f"Revoked or used token: {token[:20]}...")
+            return None
 
         return {
-            'tenant_id': ObjectId(token_data['tenant_id']),
-            'admin_id': ObjectId(token_data['admin_id'])
+            'tenant_id': claims['tenant_id'],
+            'admin_id': claims['admin_id']
         }
 
     except SignatureExpired:
@@ -2002,12 +1860,12 @@ def verify_tenant_access_token(token):
         return None
 
 
-def mark_token_as_used(token):
-    """Mark a token as used to prevent reuse"""
-    mongo.db.tenant_access_tokens.update_one(
-        {'token': token},
-        {'$set': {'used': True, 'used_at': datetime.now()}}
-    )
+def mark_token_as_used(token, use=None):
+    """Mark a token as used to prevent reuse, for everything or only for one use such as 'download'"""
+    try:
+        portal_tokens.revoke(mongo.db, portal_tokens.decode(SECRET_KEY, token), reason='used', use=use)
+    except (SignatureExpired, BadSignature):
+        pass  # An invalid token is already refused
 
 
 @app.route('/check_payment_status/<checkout_request_id>')
@@ -2039,7 +1897,7 @@ def manual_subscription_check():
     """Manually trigger aggressive subscription enforcement (Admin only)"""
     try:
         admin_id = get_admin_id()
-        admin = mongo.db.admins.find_one({"_id": admin_id})
+        admin = get_current_admin(admin_id)
 
         # Only allow super admins to trigger this
         if not admin or admin.get('role') != 'super_admin':
@@ -2098,6 +1956,8 @@ def reactivate_subscription_on_payment(admin_id, tier, payment_type):
             {"_id": admin_id},
             {"$set": reactivation_data}
         )
+        request_context.invalidate('admin', admin_id)
+        subscription_state.invalidate(admin_id)
 
         # Log reactivation
         if was_suspended:
@@ -2116,7 +1976,7 @@ def reactivate_subscription_on_payment(admin_id, tier, payment_type):
             if admin.get('phone'):
                 tier_name = SUBSCRIPTION_TIERS[tier]['name']
                 message = f"🎉 ACCOUNT REACTIVATED! Your {tier_name} subscription is now active. All operations restored. Welcome back!"
-                send_message(admin['phone'], message)
+                queue_message(admin['phone'], message)
 
         return True
 
@@ -2130,7 +1990,7 @@ def toggle_auto_renew():
     """Toggle auto-renewal for monthly and annual subscriptions"""
     try:
         admin_id = get_admin_id()
-        admin = mongo.db.admins.find_one({"_id": admin_id})
+        admin = get_current_admin(admin_id)
 
         subscription_type = admin.get('subscription_type')
         if subscription_type not in ['monthly', 'annual']:
@@ -2142,6 +2002,8 @@ def toggle_auto_renew():
             {"_id": admin_id},
             {"$set": {"auto_renew": new_status}}
         )
+        request_context.invalidate('admin', admin_id)
+        subscription_state.invalidate(admin_id)
         
         return jsonify({
             'success': True,
@@ -2159,7 +2021,7 @@ def test_subscription_enforcement():
     """Test subscription enforcement by simulating different scenarios"""
     try:
         admin_id = get_admin_id()
-        admin = mongo.db.admins.find_one({"_id": admin_id})
+        admin = get_current_admin(admin_id)
 
         if request.method == 'POST':
             test_scenario = request.form.get('scenario')
@@ -2174,6 +2036,8 @@ def test_subscription_enforcement():
                         "suspension_reason": "Test suspension"
                     }}
                 )
+                request_context.invalidate('admin', admin_id)
+                subscription_state.invalidate(admin_id)
                 flash('Account suspended for testing - try accessing dashboard', 'warning')
 
             elif test_scenario == 'expire':
@@ -2185,6 +2049,8 @@ def test_subscription_enforcement():
                         "subscription_status": "expired"
                     }}
                 )
+                request_context.invalidate('admin', admin_id)
+                subscription_state.invalidate(admin_id)
                 flash('Subscription expired for testing - try accessing dashboard', 'warning')
 
             elif test_scenario == 'overdue':
@@ -2196,6 +2062,8 @@ def test_subscription_enforcement():
                         "subscription_tier": "business"
                     }}
                 )
+                request_context.invalidate('admin', admin_id)
+                subscription_state.invalidate(admin_id)
                 flash('Payment overdue for testing - try accessing dashboard', 'warning')
 
             elif test_scenario == 'restore':
@@ -2211,6 +2079,8 @@ def test_subscription_enforcement():
                         "suspension_reason": None
                     }}
                 )
+                request_context.invalidate('admin', admin_id)
+                subscription_state.invalidate(admin_id)
                 flash('Account restored to active status', 'success')
 
             return redirect(url_for('test_subscription_enforcement'))
@@ -2254,32 +2124,18 @@ def check_subscription_expiry():
             # IMMEDIATE SUSPENSION - NO GRACE PERIOD
             suspension_reason = "Payment overdue for 30+ days"
 
-            mongo.db.admins.update_one(
-                {"_id": admin['_id']},
-                {"$set": {
-                    "subscription_tier": "starter",
-                    "subscription_status": "suspended",
-                    "suspended_at": datetime.now(),
-                    "suspension_reason": suspension_reason
-                }}
-            )
-
-            # Create suspension record
-            mongo.db.subscription_suspensions.insert_one({
-                "admin_id": admin['_id'],
-                "suspended_at": datetime.now(),
-                "reasons": [suspension_reason],
-                "tier_at_suspension": admin.get('subscription_tier', 'unknown'),
-                "last_payment_date": admin.get('last_payment_date'),
-                "auto_suspended": True
-            })
+            # Compare-and-set, so an overlapping run neither re-suspends nor records a second event
+            if not subscription_state.suspend(mongo.db, admin['_id'], [suspension_reason],
+                                              fields={"subscription_tier": "starter"},
+                                              event={"auto_suspended": True}):
+                continue
 
             app.logger.critical(f"AUTO-SUSPENDED: Admin {admin['_id']} - Payment overdue 30+ days")
 
             # Send critical suspension SMS
             if admin.get('phone'):
                 message = f"🚫 ACCOUNT SUSPENDED: Payment overdue 30+ days. ALL operations halted. Pay immediately to restore access."
-                send_message(admin['phone'], message)
+                queue_message(admin['phone'], message)
 
         # PHASE 2: GRACE PERIOD EXPIRY - Suspend accounts past 7-day grace
         seven_days_ago = datetime.now() - timedelta(days=7)
@@ -2293,21 +2149,16 @@ def check_subscription_expiry():
         for admin in grace_expired:
             suspension_reason = "Grace period expired (7 days past subscription end)"
 
-            mongo.db.admins.update_one(
-                {"_id": admin['_id']},
-                {"$set": {
-                    "subscription_tier": "starter",
-                    "subscription_status": "suspended",
-                    "suspended_at": datetime.now(),
-                    "suspension_reason": suspension_reason
-                }}
-            )
+            if not subscription_state.suspend(mongo.db, admin['_id'], [suspension_reason],
+                                              fields={"subscription_tier": "starter"},
+                                              event={"auto_suspended": True}):
+                continue
 
             app.logger.warning(f"GRACE EXPIRED: Admin {admin['_id']} suspended after grace period")
 
             if admin.get('phone'):
                 message = f"🚫 ACCOUNT SUSPENDED: Grace period expired. ALL operations halted until payment."
-                send_message(admin['phone'], message)
+                queue_message(admin['phone'], message)
 
         # PHASE 3: EXPIRY WARNINGS (Standard behavior)
         # Find subscriptions expiring in 3 days
@@ -2326,7 +2177,7 @@ def check_subscription_expiry():
 
                 days_remaining = (admin['subscription_end_date'] - datetime.now()).days
                 message = f"⚠️ URGENT: {SUBSCRIPTION_TIERS[admin['subscription_tier']]['name']} subscription expires in {days_remaining} days. Renew: {short_subscription_url}"
-                send_message(admin['phone'], message)
+                queue_message(admin['phone'], message)
 
         # PHASE 4: DOWNGRADE EXPIRED (but still within grace period)
         recently_expired = mongo.db.admins.find({
@@ -2343,12 +2194,13 @@ def check_subscription_expiry():
                     "grace_period_start": datetime.now()
                 }}
             )
+            subscription_state.invalidate(admin['_id'])
 
             app.logger.info(f"EXPIRED: Admin {admin['_id']} moved to grace period")
 
             if admin.get('phone'):
                 message = f"⚠️ Subscription expired! 7-day grace period started. Renew immediately to avoid suspension."
-                send_message(admin['phone'], message)
+                queue_message(admin['phone'], message)
 
         # PHASE 5: DAILY PAYMENT REMINDERS for overdue accounts
         overdue_admins = mongo.db.admins.find({
@@ -2359,7 +2211,7 @@ def check_subscription_expiry():
         for admin in overdue_admins:
             if admin.get('phone'):
                 message = f"🚨 PAYMENT REQUIRED: Your account access is restricted. Pay now to restore full service."
-                send_message(admin['phone'], message)
+                queue_message(admin['phone'], message)
 
         app.logger.info("Aggressive subscription enforcement check completed")
 
@@ -2379,6 +2231,7 @@ def send_payment_reminders():
         }))
 
         reminder_count = 0
+        late_fines.attach_fines(mongo.db, overdue_bills)
 
         for bill in overdue_bills:
             try:
@@ -2401,9 +2254,7 @@ def send_payment_reminders():
                 outstanding_amount = bill['bill_amount'] - bill.get('amount_paid', 0)
                 days_overdue = (datetime.now() - bill['due_date']).days
 
-                # Calculate late payment fine
-                property_settings = get_property_billing_settings(bill.get('property_id'), bill['admin_id'])
-                fine_amount = calculate_late_payment_fine(bill, property_settings)
+                fine_amount = bill['late_payment_fine']
                 total_due = outstanding_amount + fine_amount
 
                 # Generate short tenant portal link
@@ -2429,27 +2280,18 @@ def send_payment_reminders():
                         f"Contact: {admin.get('phone', 'N/A')}"
                     )
 
-                # Send SMS
-                response = send_message(tenant['phone'], message)
+                # Queue SMS; the reminder is marked as sent once it is delivered (with admin validation)
+                response = queue_message(tenant['phone'], message, writeback=sms_writeback(
+                    'payments',
+                    {'_id': bill['_id'], 'admin_id': bill['admin_id']},
+                    on_sent={'reminder_sent': True, 'reminder_sent_date': datetime.now()}
+                ))
 
                 if "error" not in response:
-                    # Mark reminder as sent (with admin validation)
-                    mongo.db.payments.update_one(
-                        {
-                            '_id': bill['_id'],
-                            'admin_id': bill['admin_id']  # Validate admin ownership
-                        },
-                        {
-                            '$set': {
-                                'reminder_sent': True,
-                                'reminder_sent_date': datetime.now()
-                            }
-                        }
-                    )
                     reminder_count += 1
-                    app.logger.info(f"Payment reminder sent to {tenant['name']} for bill {bill['_id']}")
+                    app.logger.info(f"Payment reminder queued for {tenant['name']} for bill {bill['_id']}")
                 else:
-                    app.logger.error(f"Failed to send reminder to {tenant['name']}: {response.get('error', 'Unknown error')}")
+                    app.logger.error(f"Failed to queue reminder to {tenant['name']}: {response.get('error', 'Unknown error')}")
 
             except Exception as tenant_error:
                 app.logger.error(f"Error sending reminder for bill {bill['_id']}: {str(tenant_error)}")
@@ -2464,10 +2306,15 @@ def send_payment_reminders():
 
 def get_property_payment_info(admin, property_id=None):
     """Get property-specific payment information for SMS"""
+    return request_context.memoize(
+        'payment_info', (admin.get('_id'), property_id), lambda: _property_payment_info(admin, property_id)
+    )
+
+def _property_payment_info(admin, property_id=None):
     try:
         # Get property-specific payment config if available
         if property_id:
-            property_doc = mongo.db.properties.find_one({'_id': property_id})
+            property_doc = get_property_doc(property_id)
             if property_doc and property_doc.get('payment_methods', {}).get('mpesa', {}).get('enabled'):
                 mpesa_config = property_doc['payment_methods']['mpesa']
                 if mpesa_config.get('shortcode'):
@@ -2494,7 +2341,7 @@ def manual_payment_reminders():
     """Manual trigger for payment reminders (admin only)"""
     try:
         admin_id = get_admin_id()
-        admin = mongo.db.admins.find_one({'_id': admin_id})
+        admin = get_current_admin(admin_id)
 
         if not admin:
             flash('Admin not found', 'danger')
@@ -2510,6 +2357,7 @@ def manual_payment_reminders():
         }))
 
         reminder_count = 0
+        late_fines.attach_fines(mongo.db, overdue_bills)
 
         for bill in overdue_bills:
             try:
@@ -2528,9 +2376,7 @@ def manual_payment_reminders():
                 outstanding_amount = bill['bill_amount'] - bill.get('amount_paid', 0)
                 days_overdue = (datetime.now() - bill['due_date']).days
 
-                # Calculate late payment fine
-                property_settings = get_property_billing_settings(property_id, admin_id)
-                fine_amount = calculate_late_payment_fine(bill, property_settings)
+                fine_amount = bill['late_payment_fine']
                 total_due = outstanding_amount + fine_amount
 
                 # Generate short tenant portal link
@@ -2555,28 +2401,20 @@ def manual_payment_reminders():
                         f"Contact: {admin.get('phone', 'N/A')}"
                     )
 
-                response = send_message(tenant['phone'], message)
+                response = queue_message(tenant['phone'], message, writeback=sms_writeback(
+                    'payments',
+                    {'_id': bill['_id'], 'admin_id': admin_id},  # Validate admin ownership
+                    on_sent={'manual_reminder_sent': True, 'manual_reminder_sent_date': datetime.now()}
+                ))
 
                 if "error" not in response:
-                    mongo.db.payments.update_one(
-                        {
-                            '_id': bill['_id'],
-                            'admin_id': admin_id  # Validate admin ownership
-                        },
-                        {
-                            '$set': {
-                                'manual_reminder_sent': True,
-                                'manual_reminder_sent_date': datetime.now()
-                            }
-                        }
-                    )
                     reminder_count += 1
 
             except Exception as tenant_error:
                 app.logger.error(f"Error sending manual reminder for bill {bill['_id']}: {str(tenant_error)}")
                 continue
 
-        flash(f'Sent {reminder_count} payment reminders successfully', 'success')
+        flash(f'Queued {reminder_count} payment reminders for delivery', 'success')
         return redirect(url_for('payments_dashboard'))
 
     except Exception as e:
@@ -2588,6 +2426,10 @@ def manual_payment_reminders():
 # Call this function when the app starts
 if mongo:
     with app.app_context():
+        db_indexes.ensure_indexes(mongo.db)
+        # Derived collections are built before migrations add to them incrementally
+        rollups.backfill_if_empty(mongo.db)
+        balances.backfill_if_empty(mongo.db)
         initialize_houses_collection()
         migrate_existing_data()
         migrate_existing_readings_to_payments()
@@ -2604,6 +2446,20 @@ def get_admin_id():
     except (KeyError, TypeError):
         raise ValueError("Invalid admin session")
 
+def get_current_admin(admin_id=None):
+    """Get the admin document, fetched once per request."""
+    admin_id = admin_id or get_admin_id()
+    return request_context.memoize('admin', admin_id, lambda: mongo.db.admins.find_one({"_id": admin_id}))
+
+def get_property_doc(property_id):
+    """Get a property document by id, fetched once per request."""
+    property_id = ObjectId(property_id)
+    return request_context.memoize('property', property_id, lambda: mongo.db.properties.find_one({"_id": property_id}))
+
+def get_sms_config(admin_id):
+    """Get the admin's SMS config, fetched once per request."""
+    return request_context.memoize('sms_config', admin_id, lambda: mongo.db.sms_config.find_one({"admin_id": admin_id}))
+
 def get_current_property_id():
     """Get current property ID from session or return default property."""
     try:
@@ -2741,12 +2597,9 @@ def get_property_settings(property_id=None):
             property_id = get_current_property_id()
 
         admin_id = get_admin_id()
-        property_doc = mongo.db.properties.find_one({
-            "_id": ObjectId(property_id),
-            "admin_id": admin_id
-        })
+        property_doc = get_property_doc(property_id)
 
-        if property_doc and 'settings' in property_doc:
+        if property_doc and property_doc.get('admin_id') == admin_id and 'settings' in property_doc:
             return property_doc['settings']
 
         # Return default settings if none found
@@ -2792,12 +2645,7 @@ def get_property_mpesa_config(property_id=None):
                 return mpesa_config
 
         # Fall back to admin-level M-Pesa config
-        admin_id = get_admin_id()
-        admin_mpesa = mongo.db.mpesa_config.find_one({"admin_id": admin_id})
-        if admin_mpesa:
-            return decrypt_mpesa_credentials(admin_mpesa)
-
-        return None
+        return get_mpesa_credentials(get_admin_id())
     except Exception as e:
         app.logger.error(f"Error getting property M-Pesa config: {e}")
         return None
@@ -2805,15 +2653,25 @@ def get_property_mpesa_config(property_id=None):
 def get_property_mpesa_api(property_id=None):
     """Get property-specific M-Pesa API instance."""
     try:
+        if not property_id:
+            property_id = get_current_property_id()
+
+        cache_key = (get_admin_id(), 'api', str(property_id))
+        client = mpesa_client_cache.get(cache_key)
+        if client is not None:
+            return client
+
         config = get_property_mpesa_config(property_id)
         if config and config.get('consumer_key') and config.get('consumer_secret'):
-            return MpesaAPI(
+            client = MpesaAPI(
                 consumer_key=config.get('consumer_key'),
                 consumer_secret=config.get('consumer_secret'),
                 shortcode=config.get('shortcode'),
                 passkey=config.get('passkey'),
                 env=config.get('environment', 'sandbox')
             )
+            mpesa_client_cache.set(cache_key, client)
+            return client
 
         # Fall back to default M-Pesa API
         return mpesa
@@ -2828,8 +2686,6 @@ def shorten_url_bitly(long_url):
         if not BITLY_ACCESS_TOKEN:
             return None
 
-        import requests
-
         headers = {
             'Authorization': f'Bearer {BITLY_ACCESS_TOKEN}',
             'Content-Type': 'application/json',
@@ -2840,8 +2696,8 @@ def shorten_url_bitly(long_url):
             'domain': 'bit.ly'  # You can use custom domains if you have them
         }
 
-        response = requests.post('https://api-ssl.bitly.com/v4/shorten',
-                               json=data, headers=headers)
+        response = http_client.post('https://api-ssl.bitly.com/v4/shorten',
+                                    json=data, headers=headers)
 
         if response.status_code == 200 or response.status_code == 201:
             result = response.json()
@@ -2854,39 +2710,17 @@ def shorten_url_bitly(long_url):
         app.logger.error(f"Error shortening URL with Bitly: {e}")
         return None
 
-def create_custom_short_url(long_url, identifier=None):
-    """Create a custom short URL using our own database."""
+def create_custom_short_url(long_url, identifier=None, base_url=None):
+    """Create a custom short URL using our own database; base_url defaults to the current request's root."""
     try:
-        # Generate short code
-        if identifier:
-            # Use provided identifier for consistent URLs
-            short_code = hashlib.md5(identifier.encode()).hexdigest()[:8]
-        else:
-            # Generate random short code
-            short_code = hashlib.md5(long_url.encode()).hexdigest()[:8]
-
-        # Check if short URL already exists
-        existing = mongo.db.short_urls.find_one({"short_code": short_code})
-        if existing:
-            return f"{request.url_root}s/{short_code}"
-
-        # Store in database
-        short_url_doc = {
-            "short_code": short_code,
-            "long_url": long_url,
-            "created_at": datetime.now(),
-            "click_count": 0,
-            "identifier": identifier
-        }
-
-        mongo.db.short_urls.insert_one(short_url_doc)
-        return f"{request.url_root}s/{short_code}"
+        short_code = short_urls.mint(mongo.db, long_url, identifier)
+        return f"{base_url or request.url_root}s/{short_code}"
 
     except Exception as e:
         app.logger.error(f"Error creating custom short URL: {e}")
         return long_url  # Return original URL as fallback
 
-def shorten_url(long_url, identifier=None):
+def shorten_url(long_url, identifier=None, base_url=None):
     """Shorten URL using preferred method."""
     try:
         if not ENABLE_URL_SHORTENING:
@@ -2899,12 +2733,32 @@ def shorten_url(long_url, identifier=None):
                 return short_url
 
         # Fallback to custom shortener
-        return create_custom_short_url(long_url, identifier)
+        return create_custom_short_url(long_url, identifier, base_url)
 
     except Exception as e:
         app.logger.error(f"Error in URL shortening: {e}")
         return long_url  # Return original URL as fallback
 
+def shorten_urls(links, base_url=None):
+    """Shorten [(long_url, identifier), ...] for a whole batch of messages; our own codes are stored in one write.
+
+    Pass base_url (the app's root URL) when there is no request, e.g. in a background job.
+    """
+    if not ENABLE_URL_SHORTENING:
+        return [long_url for long_url, _ in links]
+
+    # Bitly has no batch endpoint, so when configured it is still asked per link
+    if BITLY_ACCESS_TOKEN:
+        return [shorten_url(long_url, identifier, base_url) for long_url, identifier in links]
+
+    try:
+        codes = short_urls.mint_many(mongo.db, links)
+        root = base_url or request.url_root
+        return [f"{root}s/{code}" for code in codes]
+    except Exception as e:
+        app.logger.error(f"Error creating short URLs in bulk: {e}")
+        return [long_url for long_url, _ in links]  # Return original URLs as fallback
+
 
 
 # Property Management Routes
@@ -3094,6 +2948,7 @@ def edit_property(property_id):
                 "updated_at": datetime.now()
             }}
         )
+        request_context.invalidate()
 
         flash(f'Property "{name}" updated successfully!', 'success')
         return redirect(url_for('properties'))
@@ -3231,6 +3086,12 @@ def update_property_settings(property_id):
                 "updated_at": datetime.now()
             }}
         )
+        request_context.invalidate()
+        invalidate_mpesa_cache(admin_id)
+        if mpesa_consumer_key:
+            invalidate_access_token(mpesa_consumer_key)
+        # Stored late fines were computed with the old grace period and rate
+        late_fines.clear_fines(mongo.db, dict(property_backfill.property_filter(mongo.db, property_id_obj), admin_id=admin_id))
 
         flash('Property billing settings updated successfully!', 'success')
         return redirect(url_for('property_settings', property_id=property_id))
@@ -3251,21 +3112,18 @@ def update_property_settings(property_id):
 def redirect_short_url(short_code):
     """Handle short URL redirects."""
     try:
-        # Find the short URL in database
-        short_url_doc = mongo.db.short_urls.find_one({"short_code": short_code})
+        # Served from the in-process cache, falling back to the short_code index
+        long_url = short_urls.resolve(mongo.db, short_code)
 
-        if not short_url_doc:
+        if not long_url:
             flash('Link not found or expired.', 'danger')
             return redirect(url_for('login'))
 
-        # Increment click count
-        mongo.db.short_urls.update_one(
-            {"short_code": short_code},
-            {"$inc": {"click_count": 1}, "$set": {"last_accessed": datetime.now()}}
-        )
+        # Counted in memory and flushed to the database in batches
+        short_urls.record_click(mongo.db, short_code)
 
         # Redirect to the original URL
-        return redirect(short_url_doc['long_url'])
+        return redirect(long_url)
 
     except Exception as e:
         app.logger.error(f"Error handling short URL redirect: {e}")
@@ -3368,7 +3226,7 @@ def send_message(recipient, message, sender=None, retries=3):
             app.logger.info(f"Request payload: {payload}")
             
             # Send request with proper headers
-            response = requests.post(url, json=payload, headers=headers)
+            response = http_client.post(url, json=payload, headers=headers)
             
             # Log the response
             app.logger.info(f"Response status: {response.status_code}")
@@ -3396,6 +3254,38 @@ def send_message(recipient, message, sender=None, retries=3):
     
     return {"error": str(last_error)}
 
+def queue_message(recipient, message, sender=None, writeback=None, context=None):
+    """Queue an SMS in the durable outbox; returns a send_message-style dict."""
+    try:
+        outbox_id = enqueue_sms(mongo.db, recipient, message, sender, writeback, context)
+        return {"status": "queued", "outbox_id": outbox_id}
+    except Exception as e:
+        app.logger.error(f"Error queueing SMS to {recipient}: {e}")
+        return {"error": str(e)}
+
+# Payment inbox entry kinds and the functions that apply them
+PAYMENT_INBOX_HANDLERS = {
+    'signup': process_signup_callback,
+    'subscription': process_subscription_callback,
+    'paystack_charge': process_paystack_charge,
+    'c2b_payment': process_c2b_payment,
+}
+
+def start_background_workers():
+    """Start the in-process background queues; called by the web entry points only (wsgi.py, app.run).
+
+    Importing this module starts nothing, so one-off commands and tests never
+    claim queued work they might abandon when they exit.
+    """
+    if not mongo or IN_WORKER_PROCESS:
+        return
+    # Deliver queued SMS in the background unless a dedicated worker does it
+    if SMS_OUTBOX_WORKER == 'thread':
+        start_background_dispatcher(mongo.db, send_message)
+    # Process received payment callbacks in the background unless a dedicated worker does it
+    if PAYMENT_INBOX_WORKER == 'thread':
+        payment_inbox.start_background_processor(mongo.db, PAYMENT_INBOX_HANDLERS)
+
 # Enhanced phone number formatter with regex validation
 def format_phone_number(phone):
     """Format and validate phone number."""
@@ -3418,6 +3308,9 @@ def format_phone_number(phone):
 
 def get_rate_per_unit(admin_id, property_id=None):
     """Get rate per unit for admin with property-specific override."""
+    return request_context.memoize('rate', (admin_id, property_id), lambda: _rate_per_unit(admin_id, property_id))
+
+def _rate_per_unit(admin_id, property_id=None):
     # First check if property-specific rate is available
     if property_id:
         try:
@@ -3428,17 +3321,17 @@ def get_rate_per_unit(admin_id, property_id=None):
             app.logger.error(f"Error getting property rate: {e}")
 
     # Fall back to SMS config rate
-    sms_config = mongo.db.sms_config.find_one({"admin_id": admin_id})
+    sms_config = get_sms_config(admin_id)
     if sms_config:
         return sms_config.get('rate_per_unit', RATE_PER_UNIT)
 
     # Finally fall back to admin default rate
-    admin = mongo.db.admins.find_one({"_id": admin_id})
+    admin = get_current_admin(admin_id)
     return admin.get('rate_per_unit', RATE_PER_UNIT) if admin else RATE_PER_UNIT
 
 
 def calculate_dashboard_analytics(admin_id, property_id=None):
-    """Calculate analytics data for dashboard."""
+    """Calculate analytics data for dashboard from the monthly rollups."""
     try:
         current_month = datetime.now().replace(day=1)
 
@@ -3446,90 +3339,23 @@ def calculate_dashboard_analytics(admin_id, property_id=None):
         if not property_id:
             property_id = get_current_property_id()
 
-        # Monthly consumption for current month
-        # Add property filtering for data isolation - handle old readings without property_id
-        if property_id:
-            monthly_match = {
-                "$and": [
-                    {"admin_id": admin_id},
-                    {"date_recorded": {"$gte": current_month}},
-                    {
-                        "$or": [
-                            {"property_id": property_id},
-                            {"property_id": {"$exists": False}}
-                        ]
-                    }
-                ]
-            }
-        else:
-            monthly_match = {
-                "admin_id": admin_id,
-                "date_recorded": {"$gte": current_month}
-            }
-
-        monthly_pipeline = [
-            {"$match": monthly_match},
-            {
-                "$group": {
-                    "_id": None,
-                    "total_usage": {"$sum": "$usage"},
-                    "total_revenue": {"$sum": "$bill_amount"},
-                    "count": {"$sum": 1}
-                }
-            }
-        ]
-
-        monthly_result = list(mongo.db.meter_readings.aggregate(monthly_pipeline))
-        monthly_consumption = monthly_result[0]['total_usage'] if monthly_result else 0
-        monthly_revenue = monthly_result[0]['total_revenue'] if monthly_result else 0
-        reading_count = monthly_result[0]['count'] if monthly_result else 0
-
-        # Total revenue (all time) - Combined water + rent
-        # Water revenue
-        # Add property filtering for data isolation - handle old readings without property_id
-        if property_id:
-            water_revenue_match = {
-                "$and": [
-                    {"admin_id": admin_id},
-                    {
-                        "$or": [
-                            {"property_id": property_id},
-                            {"property_id": {"$exists": False}}
-                        ]
-                    }
-                ]
-            }
-        else:
-            water_revenue_match = {"admin_id": admin_id}
-
-        water_revenue_pipeline = [
-            {"$match": water_revenue_match},
-            {
-                "$group": {
-                    "_id": None,
-                    "total_revenue": {"$sum": "$bill_amount"}
-                }
-            }
-        ]
-
-        water_revenue_result = list(mongo.db.meter_readings.aggregate(water_revenue_pipeline))
-        water_revenue = water_revenue_result[0]['total_revenue'] if water_revenue_result else 0
-
-        # Rent revenue
-        rent_revenue_pipeline = [
-            {
-                "$match": {"admin_id": admin_id}
-            },
-            {
-                "$group": {
-                    "_id": None,
-                    "total_revenue": {"$sum": "$amount_paid"}
-                }
-            }
-        ]
+        # Water rollups; legacy payments without a bill_type were water bills
+        water_types = ['water', None]
+        include_legacy = not property_backfill.is_backfill_complete(mongo.db)
 
-        rent_revenue_result = list(mongo.db.payment_collections.aggregate(rent_revenue_pipeline))
-        rent_revenue = rent_revenue_result[0]['total_revenue'] if rent_revenue_result else 0
+        # Monthly consumption for current month
+        current_totals = rollups.sum_rollups(mongo.db, rollups.rollup_query(
+            admin_id, property_id, since_month=current_month, bill_types=water_types, include_legacy=include_legacy
+        ))
+        monthly_consumption = current_totals['usage']
+
+        # Total revenue (all time) - Combined water billed + rent collected
+        water_revenue = rollups.sum_rollups(mongo.db, rollups.rollup_query(
+            admin_id, property_id, bill_types=water_types, include_legacy=include_legacy
+        ))['billed']
+        rent_revenue = rollups.sum_rollups(mongo.db, rollups.rollup_query(
+            admin_id, property_id, bill_types=['rent'], include_legacy=include_legacy
+        ))['collected']
 
         # Combined total revenue
         total_revenue = water_revenue + rent_revenue
@@ -3545,65 +3371,26 @@ def calculate_dashboard_analytics(admin_id, property_id=None):
         # Monthly breakdown for charts (last 12 months)
         twelve_months_ago = datetime.now() - timedelta(days=365)
 
-        # Monthly water revenue
-        # Add property filtering for data isolation - handle old readings without property_id
-        if property_id:
-            monthly_water_match = {
-                "$and": [
-                    {"admin_id": admin_id},
-                    {"date_recorded": {"$gte": twelve_months_ago}},
-                    {
-                        "$or": [
-                            {"property_id": property_id},
-                            {"property_id": {"$exists": False}}
-                        ]
-                    }
-                ]
-            }
-        else:
-            monthly_water_match = {
-                "admin_id": admin_id,
-                "date_recorded": {"$gte": twelve_months_ago}
-            }
-
-        monthly_water_pipeline = [
-            {"$match": monthly_water_match},
-            {
-                "$group": {
-                    "_id": {
-                        "year": {"$year": "$date_recorded"},
-                        "month": {"$month": "$date_recorded"}
-                    },
-                    "revenue": {"$sum": "$bill_amount"},
-                    "consumption": {"$sum": "$usage"}
-                }
-            },
-            {"$sort": {"_id.year": 1, "_id.month": 1}}
-        ]
-
-        monthly_water_data = list(mongo.db.meter_readings.aggregate(monthly_water_pipeline))
-
-        # Monthly rent revenue
-        monthly_rent_pipeline = [
-            {
-                "$match": {
-                    "admin_id": admin_id,
-                    "collection_date": {"$gte": twelve_months_ago}
-                }
-            },
-            {
-                "$group": {
-                    "_id": {
-                        "year": {"$year": "$collection_date"},
-                        "month": {"$month": "$collection_date"}
-                    },
-                    "revenue": {"$sum": "$amount_paid"}
-                }
-            },
-            {"$sort": {"_id.year": 1, "_id.month": 1}}
-        ]
+        monthly_water_data = []
+        for month, totals in rollups.monthly_totals(mongo.db, rollups.rollup_query(
+            admin_id, property_id, since_month=twelve_months_ago, bill_types=water_types, include_legacy=include_legacy
+        )):
+            year, month_number = month.split('-')
+            monthly_water_data.append({
+                '_id': {'year': int(year), 'month': int(month_number)},
+                'revenue': totals['billed'],
+                'consumption': totals['usage']
+            })
 
-        monthly_rent_data = list(mongo.db.payment_collections.aggregate(monthly_rent_pipeline))
+        monthly_rent_data = []
+        for month, totals in rollups.monthly_totals(mongo.db, rollups.rollup_query(
+            admin_id, property_id, since_month=twelve_months_ago, bill_types=['rent'], include_legacy=include_legacy
+        )):
+            year, month_number = month.split('-')
+            monthly_rent_data.append({
+                '_id': {'year': int(year), 'month': int(month_number)},
+                'revenue': totals['collected']
+            })
 
         return {
             'monthly_consumption': round(monthly_consumption, 1),
@@ -3629,36 +3416,43 @@ def calculate_dashboard_analytics(admin_id, property_id=None):
 
 
 
+def build_payment_record(admin_id, tenant_id, house_id, bill_amount, reading_id=None, month_year=None, bill_type=None, property_id=None):
+    """Build a new unpaid payment document without writing it"""
+    current_time = datetime.now()  # Full timestamp
+
+    payment_data = {
+        'admin_id': ObjectId(admin_id),
+        'tenant_id': ObjectId(tenant_id),
+        'house_id': ObjectId(house_id),
+        'bill_amount': float(bill_amount),
+        'amount_paid': 0.0,
+        'payment_status': 'unpaid',
+        'due_date': datetime.now() + timedelta(days=30),  # 30 days to pay
+        'month_year': month_year,
+        'reading_id': ObjectId(reading_id) if reading_id else None,
+        'bill_type': bill_type,
+        'last_payment_date': None,
+        'last_payment_method': None,
+        'notes': '',
+        'created_at': current_time,
+        'updated_at': current_time
+    }
+
+    # Add property_id for data isolation
+    if property_id:
+        payment_data['property_id'] = ObjectId(property_id) if isinstance(property_id, str) else property_id
+
+    return payment_data
+
 def create_payment_record(admin_id, tenant_id, house_id, bill_amount, reading_id=None, month_year=None, bill_type=None, property_id=None):
     """Create a new payment record when a water reading is recorded"""
     try:
-        current_time = datetime.now()  # Full timestamp
-
-        payment_data = {
-            'admin_id': ObjectId(admin_id),
-            'tenant_id': ObjectId(tenant_id),
-            'house_id': ObjectId(house_id),
-            'bill_amount': float(bill_amount),
-            'amount_paid': 0.0,
-            'payment_status': 'unpaid',
-            'due_date': datetime.now() + timedelta(days=30),  # 30 days to pay
-            'month_year': month_year,
-            'reading_id': ObjectId(reading_id) if reading_id else None,
-            'bill_type': bill_type,
-            'last_payment_date': None,
-            'last_payment_method': None,
-            'notes': '',
-            'created_at': current_time,
-            'updated_at': current_time
-        }
-
-        # Add property_id for data isolation
-        if property_id:
-            payment_data['property_id'] = ObjectId(property_id) if isinstance(property_id, str) else property_id
+        payment_data = build_payment_record(admin_id, tenant_id, house_id, bill_amount, reading_id, month_year, bill_type, property_id)
 
-        result = mongo.db.payments.insert_one(payment_data)
+        balances.insert_bills(mongo.db, [payment_data])
+        rollups.record_bills(mongo.db, [payment_data])
         cache.delete_memoized(get_billing_summary, admin_id)
-        return result.inserted_id
+        return payment_data['_id']
     except Exception as e:
         app.logger.error(f"Error creating payment record: {str(e)}")
         return None
@@ -3691,8 +3485,22 @@ def get_unpaid_bills(admin_id, tenant_id=None, bill_type=None, property_id=None)
     except Exception as e:
         app.logger.error(f"Error fetching unpaid bills: {str(e)}")
         return []
-def get_unpaid_bills_paginated(admin_id, page=1, per_page=10, filter_status=None, search_term=None, bill_type=None, property_id=None):
-    """Get paginated unpaid bills with optional filtering and bill_type"""
+
+# Listing orders for keyset pagination; each ends with _id so positions are unique
+TENANT_PAGE_SORT = [("name", 1), ("_id", 1)]
+HOUSE_PAGE_SORT = [("house_number", 1), ("_id", 1)]
+READING_PAGE_SORT = [("date_recorded", -1), ("_id", -1)]
+BILL_PAGE_SORT = [("due_date", 1), ("_id", 1)]
+MAINTENANCE_PAGE_SORT = [("created_at", -1), ("_id", -1)]
+
+@app.template_global()
+def page_url(endpoint, pagination, target, **args):
+    """Link to the 'prev' or 'next' page, or page number target, of a listing; by cursor when the page has one"""
+    return url_for(endpoint, **paging.page_args(pagination, target), **args)
+
+def get_unpaid_bills_paginated(admin_id, page=1, per_page=10, filter_status=None, search_term=None, bill_type=None, property_id=None,
+                               after=None, before=None):
+    """Get paginated unpaid bills with optional filtering and bill_type; after/before are page tokens"""
     try:
         # Start with basic query
         query = {'admin_id': ObjectId(admin_id)}
@@ -3722,92 +3530,23 @@ def get_unpaid_bills_paginated(admin_id, page=1, per_page=10, filter_status=None
         else:  # Default to showing unpaid and partial
             query['payment_status'] = {'$in': ['unpaid', 'partial']}
         
-        # Add search term if provided
+        # Add search term if provided; tenant name and house number are denormalized onto each bill
         if search_term:
-            # Create regex pattern for case-insensitive search
-            escaped_query = re.escape(search_term.strip())
-            regex_pattern = {"$regex": escaped_query, "$options": "i"}
-            
-            # Use aggregation pipeline for search across related collections
-            pipeline = [
-                {'$match': query},
-                {'$lookup': {
-                    'from': 'tenants',
-                    'localField': 'tenant_id',
-                    'foreignField': '_id',
-                    'as': 'tenant_info'
-                }},
-                {'$lookup': {
-                    'from': 'houses',
-                    'localField': 'house_id',
-                    'foreignField': '_id',
-                    'as': 'house_info'
-                }},
-                {'$match': {
-                    '$or': [
-                        {'tenant_info.name': regex_pattern},
-                        {'house_info.house_number': regex_pattern}
-                    ]
-                }},
-                {'$sort': {'due_date': 1}},
-                {'$skip': (page - 1) * per_page},
-                {'$limit': per_page}
-            ]
-            
-            # Count pipeline for total
-            count_pipeline = [
-                {'$match': query},
-                {'$lookup': {
-                    'from': 'tenants',
-                    'localField': 'tenant_id',
-                    'foreignField': '_id',
-                    'as': 'tenant_info'
-                }},
-                {'$lookup': {
-                    'from': 'houses',
-                    'localField': 'house_id',
-                    'foreignField': '_id',
-                    'as': 'house_info'
-                }},
-                {'$match': {
-                    '$or': [
-                        {'tenant_info.name': regex_pattern},
-                        {'house_info.house_number': regex_pattern}
-                    ]
-                }},
-                {'$count': 'total'}
-            ]
-            
-            bills = list(mongo.db.payments.aggregate(pipeline))
-            count_result = list(mongo.db.payments.aggregate(count_pipeline))
-            total_count = count_result[0]['total'] if count_result else 0
-            
-        else:
-            # Calculate skip value based on page and per_page
-            skip = (page - 1) * per_page
-            
-            # Get total count for pagination
-            total_count = mongo.db.payments.count_documents(query)
-            
-            # Get paginated results
-            bills = list(mongo.db.payments.find(query)
-                        .sort('due_date', 1)
-                        .skip(skip)
-                        .limit(per_page))
-        
-        # Calculate total pages
-        total_pages = (total_count + per_page - 1) // per_page  # Ceiling division
-        
-        return {
-            'bills': bills,
-            'page': page,
-            'per_page': per_page,
-            'total_count': total_count,
-            'total_pages': total_pages
-        }
+            query.update(search_keys.search_filter(search_term, search_keys.BILL_SEARCH_FIELDS))
+
+        # Keyset page on (due_date, _id); the total comes from the cached count
+        page_result = paging.paginate(mongo.db.payments, query, BILL_PAGE_SORT, per_page, after=after, before=before, page=page)
+
+        return dict(
+            page_result,
+            bills=page_result['items'],
+            total_count=page_result['total'],
+            total_pages=page_result['pages']
+        )
     except Exception as e:
         app.logger.error(f"Error fetching paginated bills: {str(e)}")
-        return {'bills': [], 'page': 1, 'per_page': per_page, 'total_count': 0, 'total_pages': 0}
+        return {'bills': [], 'items': [], 'page': 1, 'per_page': per_page, 'total': 0, 'total_count': 0, 'pages': 0, 'total_pages': 0,
+                'has_prev': False, 'has_next': False}
 
 def get_unpaid_bills_with_aggregation(admin_id, tenant_id=None):
     """Get unpaid bills with outstanding amounts calculated in MongoDB"""
@@ -3874,36 +3613,19 @@ def update_payment_status(payment_id, amount_paid, payment_method, notes="", adm
             if current_property_id:
                 query['property_id'] = ObjectId(current_property_id)
 
-        payment = mongo.db.payments.find_one(query)
+        now = datetime.now()
+        payment = balances.apply_payment(mongo.db, query, float(amount_paid), {
+            'last_payment_date': now,
+            'last_payment_method': payment_method,
+            'notes': notes,
+            'updated_at': now
+        })
         if not payment:
             app.logger.warning(f"Payment {payment_id} not found or access denied for admin {admin_id}, property {property_id}")
             return False
-            
-        new_total_paid = payment.get('amount_paid', 0) + float(amount_paid)
-        bill_amount = payment['bill_amount']
-        
-        if new_total_paid >= bill_amount:
-            status = 'paid'
-        elif new_total_paid > 0:
-            status = 'partial'
-        else:
-            status = 'unpaid'
-            
-        update_data = {
-            'amount_paid': new_total_paid,
-            'payment_status': status,
-            'last_payment_date': datetime.now(),
-            'last_payment_method': payment_method,
-            'notes': notes,
-            'updated_at': datetime.now()
-        }
-        
-        result = mongo.db.payments.update_one(
-            query,  # Use the admin-validated query instead of just payment_id
-            {'$set': update_data}
-        )
-        
-        return result.modified_count > 0
+
+        rollups.record_collection(mongo.db, payment, float(amount_paid))
+        return True
     except Exception as e:
         app.logger.error(f"Error updating payment: {str(e)}")
         return False
@@ -3916,121 +3638,17 @@ def calculate_total_arrears(admin_id, tenant_id, bill_type=None, exclude_current
             admin_id = ObjectId(admin_id)
         if not isinstance(tenant_id, ObjectId):
             tenant_id = ObjectId(tenant_id)
-            
-        # Build query to exclude fully paid bills
-        query = {
-            'admin_id': admin_id,
-            'tenant_id': tenant_id,
-            'payment_status': {'$in': ['unpaid', 'partial']}
-        }
-        
-        # Add bill_type filter if specified
-        if bill_type:
-            query['bill_type'] = bill_type
-            
-        # Exclude current month's bill from arrears calculation
-        if exclude_current_month:
-            # Ensure the format is YYYY-MM
-            if isinstance(exclude_current_month, datetime):
-                exclude_current_month = exclude_current_month.strftime('%Y-%m')
-            query['month_year'] = {'$ne': exclude_current_month}
-            
-            # Log for debugging
-            app.logger.info(f"Calculating arrears excluding month: {exclude_current_month}")
-        
-        # Get unpaid/partial bills (excluding current month)
-        unpaid_bills = list(mongo.db.payments.find(query))
-        total_arrears = 0.0
-        
-        # Log for debugging
-        app.logger.info(f"Found {len(unpaid_bills)} unpaid bills for tenant {tenant_id} (excluding current month: {exclude_current_month})")
-        
-        # Calculate outstanding amounts with improved precision
-        for bill in unpaid_bills:
-            bill_amount = float(bill.get('bill_amount', 0))
-            amount_paid = float(bill.get('amount_paid', 0))
-            outstanding = bill_amount - amount_paid
-            
-            # Only count positive outstanding amounts with precision threshold
-            if outstanding > 0.01:
-                total_arrears += outstanding
-                # Log each bill being counted
-                app.logger.debug(f"Bill {bill['_id']} - Month: {bill.get('month_year')} - Outstanding: {outstanding}")
-        
-        # Round to 2 decimal places for currency precision
-        return round(total_arrears, 2)
-        
+
+        # Single indexed read of the tenant's running balances
+        return balances.arrears(mongo.db, admin_id, tenant_id, bill_type, exclude_current_month)
+
     except Exception as e:
         app.logger.error(f"Error calculating arrears for tenant {tenant_id}: {str(e)}")
         return 0.0
 
 def calculate_late_payment_fine(bill, property_settings):
     """Calculate late payment fine for a bill based on property settings"""
-    try:
-        # Check if late payment fines are enabled
-        billing_settings = property_settings.get('billing', {})
-        if not billing_settings.get('enable_late_payment_fines', False):
-            return 0.0
-
-        # Get current date and bill due date
-        current_date = datetime.now()
-        due_date = bill.get('due_date')
-
-        if not due_date:
-            return 0.0
-
-        # Convert due_date if it's a string
-        if isinstance(due_date, str):
-            try:
-                due_date = datetime.strptime(due_date, '%Y-%m-%d')
-            except ValueError:
-                return 0.0
-
-        # Calculate days overdue
-        days_overdue = (current_date - due_date).days
-        grace_period = billing_settings.get('grace_period_days', 7)
-
-        # No fine if within grace period or bill is fully paid
-        if days_overdue <= grace_period or bill.get('payment_status') == 'paid':
-            return 0.0
-
-        # Calculate outstanding amount
-        bill_amount = float(bill.get('bill_amount', 0))
-        amount_paid = float(bill.get('amount_paid', 0))
-        outstanding_amount = bill_amount - amount_paid
-
-        if outstanding_amount <= 0:
-            return 0.0
-
-        # Get fine configuration
-        fine_type = billing_settings.get('fine_type', 'percentage')
-        fine_rate = float(billing_settings.get('fine_rate', 5))
-        fine_frequency = billing_settings.get('fine_frequency', 'one_time')
-        max_fine_amount = float(billing_settings.get('max_fine_amount', 0))
-
-        # Calculate base fine
-        if fine_type == 'fixed':
-            base_fine = fine_rate
-        else:  # percentage
-            base_fine = outstanding_amount * (fine_rate / 100)
-
-        # Apply frequency multiplier for compound fines
-        final_fine = base_fine
-        if fine_frequency == 'monthly':
-            # Calculate how many months overdue (after grace period)
-            effective_overdue_days = max(0, days_overdue - grace_period)
-            months_overdue = max(1, (effective_overdue_days // 30) + 1)
-            final_fine = base_fine * months_overdue
-
-        # Apply maximum fine limit if set
-        if max_fine_amount > 0:
-            final_fine = min(final_fine, max_fine_amount)
-
-        return round(final_fine, 2)
-
-    except Exception as e:
-        app.logger.error(f"Error calculating fine for bill {bill.get('_id', 'unknown')}: {str(e)}")
-        return 0.0
+    return late_fines.calculate_fine(bill, property_settings)
 
 def get_property_billing_settings(property_id, admin_id):
     """Get billing settings for a property, with fallback to admin defaults"""
@@ -4105,28 +3723,11 @@ def build_tenant_search_query(admin_id, search_query="", search_type="all", prop
     
     if not search_query:
         return base_query
-    
-    escaped_query = re.escape(search_query.strip())
-    regex_pattern = {"$regex": escaped_query, "$options": "i"}
-    
-    search_fields = {
-        'name': {"name": regex_pattern},
-        'house': {"house_number": regex_pattern},
-        'phone': {"phone": regex_pattern},
-        'all': {
-            "$or": [
-                {"name": regex_pattern},
-                {"house_number": regex_pattern},
-                {"phone": regex_pattern}
-            ]
-        }
-    }
-    
-    if search_type in search_fields and search_type != 'all':
-        base_query.update(search_fields[search_type])
-    else:
-        base_query.update(search_fields['all'])
-    
+
+    # Prefix search on the indexed search_keys of each tenant
+    fields = (search_type,) if search_type in search_keys.SEARCH_FIELDS else search_keys.SEARCH_FIELDS
+    base_query.update(search_keys.search_filter(search_query, fields))
+
     return base_query
 
 @app.after_request
@@ -4134,6 +3735,15 @@ def add_security_headers(response):
     # CSP-compliant headers with external resources and unsafe-inline for styles
     response.headers['Content-Security-Policy'] = "default-src 'self'; script-src 'self' 'unsafe-inline' https://cdn.jsdelivr.net https://cdnjs.cloudflare.com https://pagead2.googlesyndication.com; img-src 'self' data: https://via.placeholder.com; style-src 'self' 'unsafe-inline' https://cdn.jsdelivr.net https://cdnjs.cloudflare.com; font-src 'self' https://cdn.jsdelivr.net https://cdnjs.cloudflare.com data:;"
     return response
+
+@app.after_request
+def add_context_cache_headers(response):
+    """Report the Mongo lookups the request-scoped context saved"""
+    if app.debug or CONTEXT_CACHE_DEBUG:
+        stats = request_context.stats()
+        response.headers['X-Context-Lookups-Saved'] = str(stats['saved'])
+        response.headers['X-Context-Lookups-Loaded'] = str(stats['loads'])
+    return response
     
 # Routes
 # Add a route to trigger migration (remove after running once)
@@ -4280,6 +3890,7 @@ def signup():
             # Insert the new admin
             result = mongo.db.admins.insert_one(new_admin)
             admin_id = result.inserted_id
+            matching_index.invalidate_shortcodes()
 
             if not admin_id:
                 flash('Failed to create account. Please try again.', 'danger')
@@ -4381,45 +3992,23 @@ def manage_tenants():
 
     # Build query and get tenants with proper property isolation
     query = build_tenant_search_query(admin_id, search_query, search_type, current_property_id)
-    skip = (page - 1) * per_page
-    
-    # Use aggregation pipeline for better performance
-    pipeline = [
-        {"$match": query},
-        {"$facet": {
-            "tenants": [
-                {"$sort": {"name": 1}},
-                {"$skip": skip},
-                {"$limit": per_page}
-            ],
-            "total": [{"$count": "count"}]
-        }}
-    ]
-    
-    result = list(mongo.db.tenants.aggregate(pipeline))[0]
-    tenants = result['tenants']
-    total_count = result['total'][0]['count'] if result['total'] else 0
+
+    # Keyset page on (name, _id); the total comes from the cached count
+    pagination = paging.paginate(
+        mongo.db.tenants, query, TENANT_PAGE_SORT, per_page,
+        after=request.args.get('after'), before=request.args.get('before'), page=page
+    )
+    tenants = pagination['items']
+    total_count = pagination['total']
     
     # Add string ID for template compatibility
     for tenant in tenants:
         tenant['id'] = str(tenant['_id'])
-    
-    # Create pagination object
-    total_pages = (total_count + per_page - 1) // per_page
-    pagination = {
-        'page': page,
-        'per_page': per_page,
-        'total': total_count,
-        'pages': total_pages,
-        'has_prev': page > 1,
-        'has_next': page < total_pages,
-        'items': tenants
-    }
         # Get rate per unit for current property
     property_id = get_current_property_id()
     rate_per_unit = get_rate_per_unit(admin_id, property_id)
     # Add subscription info
-    admin = mongo.db.admins.find_one({"_id": admin_id})
+    admin = get_current_admin(admin_id)
     tier = admin.get('subscription_tier', 'starter')
     tier_config = SUBSCRIPTION_TIERS.get(tier, SUBSCRIPTION_TIERS['starter'])
     return render_template(
@@ -4465,41 +4054,19 @@ def dashboard():
 
     # Build query and get tenants with single database call (with property filtering)
     query = build_tenant_search_query(admin_id, search_query, search_type, current_property_id)
-    skip = (page - 1) * per_page
-    
-    # Use aggregation pipeline for better performance
-    pipeline = [
-        {"$match": query},
-        {"$facet": {
-            "tenants": [
-                {"$sort": {"name": 1}},
-                {"$skip": skip},
-                {"$limit": per_page}
-            ],
-            "total": [{"$count": "count"}]
-        }}
-    ]
-    
-    result = list(mongo.db.tenants.aggregate(pipeline))[0]
-    tenants = result['tenants']
-    total_count = result['total'][0]['count'] if result['total'] else 0
+
+    # Keyset page on (name, _id); the total comes from the cached count
+    pagination = paging.paginate(
+        mongo.db.tenants, query, TENANT_PAGE_SORT, per_page,
+        after=request.args.get('after'), before=request.args.get('before'), page=page
+    )
+    tenants = pagination['items']
+    total_count = pagination['total']
     
     # Add string ID for template compatibility
     for tenant in tenants:
         tenant['id'] = str(tenant['_id'])
     
-    # Create pagination object
-    total_pages = (total_count + per_page - 1) // per_page
-    pagination = {
-        'page': page,
-        'per_page': per_page,
-        'total': total_count,
-        'pages': total_pages,
-        'has_prev': page > 1,
-        'has_next': page < total_pages,
-        'items': tenants
-    }
-    
     # Get recent readings with optimized aggregation (filtered by current property)
     readings_match = {"admin_id": admin_id}
     if current_property_id:
@@ -4546,7 +4113,7 @@ def dashboard():
     # Get rate per unit
     rate_per_unit = get_rate_per_unit(admin_id)
     # Add subscription info
-    admin = mongo.db.admins.find_one({"_id": admin_id})
+    admin = get_current_admin(admin_id)
     tier = admin.get('subscription_tier', 'starter')
     tier_config = SUBSCRIPTION_TIERS.get(tier, SUBSCRIPTION_TIERS['starter'])
 
@@ -4601,44 +4168,27 @@ def tenant_details(tenant_id):
         return redirect(url_for('dashboard'))
 
     page = request.args.get('page', 1, type=int)
-    per_page = request.args.get('per_page', DEFAULT_PER_PAGE, type=int)
-    skip = (page - 1) * per_page
+    per_page = min(request.args.get('per_page', DEFAULT_PER_PAGE, type=int), 100)
 
     # Use the validated property_id from query
     tenant_property_id = tenant.get('property_id')
 
-    # Build query filter - handle both old readings (without property_id) and new ones (with property_id)
+    # Build query filter - old readings without property_id are included until the backfill has run
     if tenant_property_id:
         query_filter = {
-            "$and": [
-                {"tenant_id": tenant_id_obj},
-                {"admin_id": admin_id},
-                {
-                    "$or": [
-                        {"property_id": tenant_property_id},
-                        {"property_id": {"$exists": False}}  # Include old readings without property_id
-                    ]
-                }
-            ]
+            "tenant_id": tenant_id_obj,
+            "admin_id": admin_id,
+            **property_backfill.property_filter(mongo.db, tenant_property_id)
         }
     else:
         query_filter = {"tenant_id": tenant_id_obj, "admin_id": admin_id}
 
-    # For table display, use descending order
-    readings_count = mongo.db.meter_readings.count_documents(query_filter)
-    readings = list(mongo.db.meter_readings.find(query_filter).sort("date_recorded", -1).skip(skip).limit(per_page))
-    
-    # Create pagination object
-    total_pages = (readings_count + per_page - 1) // per_page
-    pagination = {
-        'page': page,
-        'per_page': per_page,
-        'total': readings_count,
-        'pages': total_pages,
-        'has_prev': page > 1,
-        'has_next': page < total_pages,
-        'items': readings
-    }
+    # For table display, newest first as a keyset page on (date_recorded, _id)
+    pagination = paging.paginate(
+        mongo.db.meter_readings, query_filter, READING_PAGE_SORT, per_page,
+        after=request.args.get('after'), before=request.args.get('before'), page=page
+    )
+    readings = pagination['items']
 
     # For chart data, fetch readings in chronological order
     chart_readings = list(mongo.db.meter_readings.find(query_filter).sort("date_recorded", 1))
@@ -4693,19 +4243,12 @@ def tenant_readings_data(tenant_id):
 
         # Get all readings for this tenant with property isolation
         # Sort by date_recorded descending (newest first)
-        # Build query - handle both old readings (without property_id) and new ones (with property_id)
+        # Build query - old readings without property_id are included until the backfill has run
         if current_property_id:
             query = {
-                "$and": [
-                    {"tenant_id": tenant_id_obj},
-                    {"admin_id": admin_id},
-                    {
-                        "$or": [
-                            {"property_id": current_property_id},
-                            {"property_id": {"$exists": False}}  # Include old readings without property_id
-                        ]
-                    }
-                ]
+                "tenant_id": tenant_id_obj,
+                "admin_id": admin_id,
+                **property_backfill.property_filter(mongo.db, current_property_id)
             }
         else:
             query = {
@@ -4719,16 +4262,9 @@ def tenant_readings_data(tenant_id):
         if not tenant_readings and house_number:
             if current_property_id:
                 house_query = {
-                    "$and": [
-                        {"house_number": house_number},
-                        {"admin_id": admin_id},
-                        {
-                            "$or": [
-                                {"property_id": current_property_id},
-                                {"property_id": {"$exists": False}}
-                            ]
-                        }
-                    ]
+                    "house_number": house_number,
+                    "admin_id": admin_id,
+                    **property_backfill.property_filter(mongo.db, current_property_id)
                 }
             else:
                 house_query = {
@@ -4824,6 +4360,7 @@ def maintenance_request():
 
         # Insert maintenance request
         result = mongo.db.maintenance_requests.insert_one(maintenance_request)
+        paging.invalidate_counts('maintenance_requests', tenant['admin_id'])
 
         if result.inserted_id:
             # Send SMS notification to landlord if configured
@@ -4831,7 +4368,7 @@ def maintenance_request():
                 admin = mongo.db.admins.find_one({'_id': tenant['admin_id']})
                 if admin and admin.get('phone'):
                     message = f"New maintenance request from {tenant['name']} at {property_doc['name']} - {data['type']}: {data['description'][:50]}{'...' if len(data['description']) > 50 else ''}"
-                    send_message(admin['phone'], message)
+                    queue_message(admin['phone'], message)
             except Exception as e:
                 app.logger.error(f"Failed to send maintenance request SMS: {str(e)}")
 
@@ -4929,6 +4466,7 @@ def add_tenant():
             new_tenant["house_id"] = house["_id"]
         
         # Insert tenant
+        new_tenant["search_keys"] = search_keys.tenant_keys(new_tenant)
         mongo.db.tenants.insert_one(new_tenant)
         
         # Create or update house
@@ -4960,9 +4498,10 @@ def add_tenant():
             # Update tenant with house_id
             mongo.db.tenants.update_one(
                 {"_id": tenant_id},
-                {"$set": {"house_id": house_id}}
+                {"$set": {"house_id": house_id, "updated_at": datetime.now()}}
             )
         
+        invalidate_matching_index(admin_id)
         flash('Tenant added successfully', 'success')
         
     except ValueError as e:
@@ -5001,41 +4540,18 @@ def water_utility():
     
     # Build query and get tenants with single database call
     query = build_tenant_search_query(admin_id, search_query, search_type)
-    skip = (page - 1) * per_page
-    
-    # Use aggregation pipeline for better performance
-    pipeline = [
-        {"$match": query},
-        {"$facet": {
-            "tenants": [
-                {"$sort": {"name": 1}},
-                {"$skip": skip},
-                {"$limit": per_page}
-            ],
-            "total": [{"$count": "count"}]
-        }}
-    ]
-    
-    result = list(mongo.db.tenants.aggregate(pipeline))[0]
-    tenants = result['tenants']
-    total_count = result['total'][0]['count'] if result['total'] else 0
+
+    # Keyset page on (name, _id); the total comes from the cached count
+    pagination = paging.paginate(
+        mongo.db.tenants, query, TENANT_PAGE_SORT, per_page,
+        after=request.args.get('after'), before=request.args.get('before'), page=page
+    )
+    tenants = pagination['items']
     
     # Add string ID for template compatibility
     for tenant in tenants:
         tenant['id'] = str(tenant['_id'])
     
-    # Create pagination object
-    total_pages = (total_count + per_page - 1) // per_page
-    pagination = {
-        'page': page,
-        'per_page': per_page,
-        'total': total_count,
-        'pages': total_pages,
-        'has_prev': page > 1,
-        'has_next': page < total_pages,
-        'items': tenants
-    }
-    
     # Get recent readings with optimized aggregation (filtered by current property)
     readings_match = {"admin_id": admin_id}
     if current_property_id:
@@ -5108,7 +4624,7 @@ def garbage_utility():
         return redirect(url_for('properties'))
 
     # Get property settings
-    property_doc = mongo.db.properties.find_one({"_id": current_property_id})
+    property_doc = get_property_doc(current_property_id)
     if not property_doc:
         flash('Property not found.', 'danger')
         return redirect(url_for('properties'))
@@ -5263,7 +4779,7 @@ def generate_garbage_bills():
         return redirect(url_for('garbage_utility'))
 
     # Get property settings
-    property_doc = mongo.db.properties.find_one({"_id": current_property_id})
+    property_doc = get_property_doc(current_property_id)
     if not property_doc:
         flash('Property not found.', 'danger')
         return redirect(url_for('garbage_utility'))
@@ -5379,26 +4895,30 @@ def record_garbage_payment():
         "recorded_by": admin_id
     }
 
-    try:
-        # Insert payment record
-        mongo.db.payments.insert_one(payment_record)
-
-        # Update bill status
-        update_data = {
-            "status": "paid",
-            "payment_date": payment_date,
-            "updated_at": datetime.now(timezone.utc)
-        }
-
-        if amount >= bill['outstanding_amount']:
-            update_data["outstanding_amount"] = 0
-        else:
-            update_data["outstanding_amount"] = bill['outstanding_amount'] - amount
+    new_outstanding = {'$max': [{'$subtract': ['$outstanding_amount', amount]}, 0]}
 
-        mongo.db.bills.update_one(
-            {"_id": ObjectId(bill_id)},
-            {"$set": update_data}
+    def write(session):
+        # Reduce the outstanding amount on the server so concurrent payments both count
+        updated = mongo.db.bills.find_one_and_update(
+            {"_id": ObjectId(bill_id), "admin_id": admin_id, "status": {"$ne": "paid"}},
+            [{'$set': {
+                "outstanding_amount": new_outstanding,
+                "status": {'$cond': [{'$lte': [new_outstanding, 0]}, 'paid', '$status']},
+                "payment_date": payment_date,
+                "updated_at": datetime.now(timezone.utc)
+            }}],
+            projection={'_id': 1},
+            session=session
         )
+        if updated:
+            # Insert payment record
+            mongo.db.payments.insert_one(payment_record, session=session)
+        return updated
+
+    try:
+        if not balances.run_in_transaction(mongo.db, write):
+            flash('This bill has already been paid.', 'warning')
+            return redirect(url_for('garbage_utility'))
 
         flash(f'Payment of KES {amount:.2f} recorded successfully for {bill["tenant_name"]}.', 'success')
 
@@ -5538,22 +5058,12 @@ def houses():
     elif status == 'vacant':
         query["is_occupied"] = False
     
-    # Use aggregation pipeline for better performance
-    pipeline = [
-        {"$match": query},
-        {"$facet": {
-            "houses": [
-                {"$sort": {"house_number": 1}},
-                {"$skip": (page - 1) * per_page},
-                {"$limit": per_page}
-            ],
-            "total": [{"$count": "count"}]
-        }}
-    ]
-    
-    result = list(mongo.db.houses.aggregate(pipeline))[0]
-    houses = result['houses']
-    total_count = result['total'][0]['count'] if result['total'] else 0
+    # Keyset page on (house_number, _id); the total comes from the cached count
+    pagination = paging.paginate(
+        mongo.db.houses, query, HOUSE_PAGE_SORT, per_page,
+        after=request.args.get('after'), before=request.args.get('before'), page=page
+    )
+    houses = pagination['items']
     
     # Add string ID for template compatibility
     for house in houses:
@@ -5572,18 +5082,6 @@ def houses():
                 house['tenant_name'] = house.get('current_tenant_name', 'Unknown')
                 house['tenant_id'] = None
     
-    # Create pagination object
-    total_pages = (total_count + per_page - 1) // per_page
-    pagination = {
-        'page': page,
-        'per_page': per_page,
-        'total': total_count,
-        'pages': total_pages,
-        'has_prev': page > 1,
-        'has_next': page < total_pages,
-        'items': houses
-    }
-    
     return render_template(
         'houses.html',
         houses=houses,
@@ -5650,6 +5148,7 @@ def add_house():
         # Insert house
         mongo.db.houses.insert_one(new_house)
         
+        invalidate_matching_index(admin_id)
         flash('House added successfully', 'success')
         
     except ValueError as e:
@@ -5720,7 +5219,7 @@ def edit_house(house_id):
                         "admin_id": admin_id,
                         "property_id": property_id
                     },
-                    {"$set": {"house_number": house_number}}
+                    {"$set": {"house_number": house_number, "updated_at": datetime.now()}}
                 )
         
         # Update house
@@ -5731,7 +5230,12 @@ def edit_house(house_id):
                 "rent": rent
             }}
         )
-        
+
+        if house_number != old_house_number:
+            search_keys.refresh_tenants(mongo.db, admin_id, [house.get('current_tenant_id')] if house.get('is_occupied') else [])
+            search_keys.refresh_house(mongo.db, house_id_obj)
+
+        invalidate_matching_index(admin_id)
         flash('House updated successfully', 'success')
         
     except ValueError as e:
@@ -5777,6 +5281,7 @@ def delete_house(house_id):
             "property_id": property_id
         })
         
+        invalidate_matching_index(admin_id)
         flash('House deleted successfully', 'success')
         
     except Exception as e:
@@ -5866,10 +5371,13 @@ def assign_tenant(house_id):
             {"_id": tenant_id_obj},
             {"$set": {
                 "house_number": house["house_number"],
-                "house_id": house_id_obj
+                "house_id": house_id_obj,
+                "updated_at": datetime.now()
             }}
         )
-        
+        search_keys.refresh_tenants(mongo.db, admin_id, [tenant_id_obj])
+
+        invalidate_matching_index(admin_id)
         flash(f'Tenant {tenant["name"]} assigned to house {house["house_number"]} successfully', 'success')
         
     except Exception as e:
@@ -5997,7 +5505,12 @@ def transfer_tenant(tenant_id):
                         if current_house_doc:
                             house_reading["house_id"] = current_house_doc["_id"]
 
-                        mongo.db.meter_readings.insert_one(house_reading)
+                        result = mongo.db.meter_readings.insert_one(house_reading)
+                        rollups.record_readings(mongo.db, [house_reading])
+
+                        # The tenant's own readings are deleted below, so point the old house at its copy
+                        if current_house_doc:
+                            last_readings.advance(mongo.db, current_house_doc["_id"], result.inserted_id, house_reading['current_reading'], house_reading['date_recorded'])
 
                 # Update old house to mark as unoccupied
                 if current_house_doc:
@@ -6042,13 +5555,18 @@ def transfer_tenant(tenant_id):
                     {"_id": tenant_id_obj},
                     {"$set": {
                         "house_number": new_house,
-                        "house_id": new_house_id
+                        "house_id": new_house_id,
+                        "updated_at": datetime.now()
                     }}
                 )
+                search_keys.refresh_tenants(mongo.db, admin_id, [tenant_id_obj])
                 
                 # Clear the tenant's readings since they're now in a new house
+                rollups.record_readings(mongo.db, mongo.db.meter_readings.find({"tenant_id": tenant_id_obj}), sign=-1)
                 mongo.db.meter_readings.delete_many({"tenant_id": tenant_id_obj})
+                tenant_statements.bump([tenant_id_obj])
                 
+                invalidate_matching_index(admin_id)
                 flash(f'Tenant "{tenant_name}" has been transferred from house {current_house} to house {new_house}. Reading history for both houses has been preserved.', 'success')
                 return redirect(url_for('dashboard'))
                 
@@ -6082,6 +5600,16 @@ def get_last_house_reading(house_number, admin_id, property_id=None):
     
     return last_reading
 
+def get_house_last_reading(house_number, house, admin_id, property_id=None):
+    """Get a house's last_reading pointer, falling back to meter_readings for houses without one."""
+    if house and house.get('last_reading'):
+        return house['last_reading']
+
+    last_reading = get_last_house_reading(house_number, admin_id, property_id)
+    if not last_reading:
+        return None
+    return last_readings.pointer(last_reading['_id'], last_reading.get('current_reading', 0), last_reading.get('date_recorded'))
+
 #replace with a function to handle bulk reading uploads
 @app.route('/record_reading', methods=['POST'])
 @login_required
@@ -6150,11 +5678,11 @@ def record_reading():
         house_id = house.get('_id') if house else None
         
         # Get the latest reading for this house number (regardless of tenant)
-        latest_house_reading = get_last_house_reading(house_number, admin_id)
+        latest_house_reading = get_house_last_reading(house_number, house, admin_id)
         
         # If we have a previous reading for this house, use it
         if latest_house_reading:
-            previous_reading = latest_house_reading.get('current_reading', 0)
+            previous_reading = latest_house_reading.get('value', 0)
         
         # Validate that current reading is greater than previous
         if current_reading <= previous_reading:
@@ -6170,8 +5698,18 @@ def record_reading():
         # Create reading records
         current_time = datetime.now()  # This includes full datetime with microseconds
         
+        # Claim the house's meter before writing so a concurrent reading cannot bill the same usage
+        reading_id = ObjectId()
+        expected_reading_id = house.get('last_reading', {}).get('reading_id') if house else None
+        if house_id and not last_readings.advance(
+            mongo.db, house_id, reading_id, current_reading, current_time, expected_reading_id=expected_reading_id
+        ):
+            flash(f'A newer reading was just recorded for house {house_number}. Please refresh and try again.', 'warning')
+            return redirect(url_for('dashboard'))
+
         # Create tenant reading record (for billing purposes)
         reading_data = {
+            "_id": reading_id,
             "tenant_id": tenant_id_obj,
             "house_number": house_number,
             "house_id": house_id,
@@ -6182,6 +5720,7 @@ def record_reading():
             "date_recorded": current_time,
             "sms_status": "pending",
             "admin_id": admin_id,
+            "property_id": current_property_id,
             "tenant_name": tenant['name'],
             "current_tenant_id": tenant_id_obj,
             "reading_type": "standard_billing",
@@ -6189,8 +5728,15 @@ def record_reading():
         }
     
         # Single insert to meter_readings
-        result = mongo.db.meter_readings.insert_one(reading_data)
-        reading_id = result.inserted_id
+        try:
+            mongo.db.meter_readings.insert_one(reading_data)
+        except Exception:
+            if house_id:
+                last_readings.release(mongo.db, house_id, reading_id, house.get('last_reading'))
+            raise
+        rollups.record_readings(mongo.db, [reading_data])
+        tenant_statements.bump([reading_data.get('tenant_id')])
+        paging.invalidate_counts('meter_readings', admin_id)
     
         
         # Create payment record for this bill - FIXED
@@ -6201,7 +5747,8 @@ def record_reading():
             house_id=house_id,  # Fixed: use house_id instead of house_data['_id']
             bill_amount=bill_amount,
             reading_id=reading_id,  # Fixed: use reading_id instead of reading_result.inserted_id
-            month_year=month_year
+            month_year=month_year,
+            property_id=current_property_id
         )
 
         if payment_id:
@@ -6213,7 +5760,7 @@ def record_reading():
 
         
         # Prepare and send SMS with arrears information - ENHANCED
-        admin = mongo.db.admins.find_one({"_id": admin_id})
+        admin = get_current_admin(admin_id)
         admin_name = admin.get('name', 'Your Landlord') if admin else 'Your Landlord'
         admin_phone = admin.get('phone', 'N/A') if admin else 'N/A'
         
@@ -6242,10 +5789,10 @@ def record_reading():
                 'amount_paid': 0,
                 'due_date': datetime.now() + timedelta(days=30),  # Assuming 30 day payment period
                 'payment_status': 'unpaid',
+                'admin_id': admin_id,
                 'property_id': tenant.get('property_id')  # Get property from tenant if available
             }
-            property_settings = get_property_billing_settings(current_bill.get('property_id'), admin_id)
-            late_fine = calculate_late_payment_fine(current_bill, property_settings)
+            late_fine = late_fines.fines_for_bills(mongo.db, [current_bill])[0]
 
             # Generate secure access token for tenant portal
             access_token = generate_tenant_access_token(tenant_id_obj, admin_id, expires_in_hours=24)
@@ -6294,9 +5841,13 @@ def record_reading():
                         f"From {admin_name} - {admin_phone}"
                     )
         
-        # Send SMS (assuming send_message function exists)
+        # Queue SMS; the dispatcher writes the delivery result to sms_status
         try:
-            response = send_message(tenant['phone'], message)
+            response = queue_message(tenant['phone'], message, writeback=sms_writeback(
+                'meter_readings',
+                {"_id": reading_id, "admin_id": admin_id},  # Validate admin ownership
+                status_field='sms_status'
+            ))
             
             if "error" in response:
                 mongo.db.meter_readings.update_one(
@@ -6308,14 +5859,7 @@ def record_reading():
                 )
                 flash(f"Reading recorded but SMS failed: {response['error']}", "warning")
             else:
-                mongo.db.meter_readings.update_one(
-                    {
-                        "_id": reading_id,
-                        "admin_id": admin_id  # Validate admin ownership
-                    },
-                    {"$set": {"sms_status": "sent"}}
-                )
-                flash("Reading recorded and SMS sent successfully!", "success")
+                flash("Reading recorded and SMS queued for delivery!", "success")
                 
         except Exception as sms_error:
             app.logger.error(f"SMS error: {sms_error}")
@@ -6410,12 +5954,20 @@ def record_tenant_reading(tenant_id):
             "tenant_name": tenant['name'],
             "current_tenant_id": tenant_id_obj,
             "reading_type": "tenant_specific",
-            "source_collection": "meter_readings"
+            "source_collection": "meter_readings",
+            "sms_status": "pending"
         }
     
         # Single insert to meter_readings
         result = mongo.db.meter_readings.insert_one(reading_data)
         reading_id = result.inserted_id
+        rollups.record_readings(mongo.db, [reading_data])
+        tenant_statements.bump([reading_data.get('tenant_id')])
+        paging.invalidate_counts('meter_readings', admin_id)
+
+        # Backdated readings below the meter's current value stay in history without moving the pointer
+        if house_id:
+            last_readings.advance(mongo.db, house_id, reading_id, current_reading, reading_date)
     
         # Create payment record for this bill - FIXED
         month_year = reading_date.strftime('%Y-%m')
@@ -6426,7 +5978,8 @@ def record_tenant_reading(tenant_id):
             bill_amount=bill_amount,
             reading_id=reading_id,  # Fixed: use reading_id
             month_year=month_year,
-            bill_type='water'  # Explicitly set bill_type
+            bill_type='water',  # Explicitly set bill_type
+            property_id=property_id
         )
         
         if payment_id:
@@ -6438,7 +5991,7 @@ def record_tenant_reading(tenant_id):
         
 
 
-        admin = mongo.db.admins.find_one({"_id": admin_id})
+        admin = get_current_admin(admin_id)
         admin_name = admin.get('name', 'Your Landlord') if admin else 'Your Landlord'
         admin_phone = admin.get('phone', 'N/A') if admin else 'N/A'
         
@@ -6480,9 +6033,13 @@ def record_tenant_reading(tenant_id):
                     f"{payment_info} View history: {portal_link} From {admin_name} - {admin_phone}"
                 )
         
-        # Send SMS notification
+        # Queue SMS; the dispatcher writes the delivery result to sms_status
         try:
-            response = send_message(tenant['phone'], message)
+            response = queue_message(tenant['phone'], message, writeback=sms_writeback(
+                'meter_readings',
+                {"_id": reading_id, "admin_id": admin_id},  # Validate admin ownership
+                status_field='sms_status'
+            ))
             
             if "error" in response:
                 mongo.db.meter_readings.update_one(
@@ -6494,14 +6051,7 @@ def record_tenant_reading(tenant_id):
                 )
                 flash(f"Reading recorded but SMS failed: {response['error']}", "warning")
             else:
-                mongo.db.meter_readings.update_one(
-                    {
-                        "_id": reading_id,
-                        "admin_id": admin_id  # Validate admin ownership
-                    },
-                    {"$set": {"sms_status": "sent"}}
-                )
-                flash("Reading recorded and SMS sent successfully!", "success")
+                flash("Reading recorded and SMS queued for delivery!", "success")
                 
         except Exception as sms_error:
             app.logger.error(f"SMS error: {sms_error}")
@@ -6523,154 +6073,267 @@ def record_tenant_reading(tenant_id):
     
     return redirect(url_for('tenant_details', tenant_id=tenant_id))
 
+# Rent billing runs execute off the request thread
+billing_executor = ThreadPoolExecutor(max_workers=BILLING_RUN_THREADS, thread_name_prefix='billing-run')
+
+def get_rent_amount(house, tenant, admin):
+    """Resolve a tenant's rent: house rent, then tenant rent_amount, then the admin default"""
+    # Priority 1: Rent from houses collection
+    if house.get("rent") and house["rent"] > 0:
+        return float(house["rent"])
+    # Priority 2: Rent from tenant record
+    if tenant.get("rent_amount") and tenant["rent_amount"] > 0:
+        return float(tenant["rent_amount"])
+    # Priority 3: Default rent from admin settings
+    if admin and admin.get("default_rent") and admin["default_rent"] > 0:
+        return float(admin["default_rent"])
+    return None
+
+def update_billing_run(run_id, **fields):
+    """Record progress on a billing run"""
+    fields['updated_at'] = datetime.now()
+    mongo.db.billing_runs.update_one({"_id": run_id}, {"$set": fields})
+
+def create_rent_bills(run_id, admin, property_id, month_year):
+    """Create every missing rent bill for a property in one insert; returns the bills and tenants billed"""
+    admin_id = admin["_id"]
+    tenants = list(mongo.db.tenants.find({"admin_id": admin_id, "property_id": property_id}))
+
+    house_numbers = [tenant["house_number"] for tenant in tenants if tenant.get("house_number")]
+    houses = {}
+    for house in mongo.db.houses.aggregate([
+        {"$match": {"admin_id": admin_id, "property_id": property_id, "house_number": {"$in": house_numbers}}},
+        {"$project": {"_id": 1, "rent": 1, "house_number": 1}}
+    ]):
+        houses.setdefault(house["house_number"], house)
+
+    # Tenants already billed this month are skipped, so a failed run can simply be started again
+    already_billed = set(mongo.db.payments.distinct("tenant_id", {
+        "admin_id": admin_id,
+        "property_id": property_id,
+        "month_year": month_year,
+        "bill_type": "rent"
+    }))
+
+    skipped = {"no_house_number": 0, "no_house": 0, "no_rent": 0, "already_billed": 0}
+    bills = []
+    billed_tenants = []
+    for tenant in tenants:
+        house_number = tenant.get("house_number")
+        if not house_number:
+            app.logger.warning(f"Tenant {tenant.get('name')} has no house number")
+            skipped["no_house_number"] += 1
+            continue
+
+        house = houses.get(house_number)
+        if not house:
+            app.logger.warning(f"House {house_number} not found for tenant {tenant.get('name')}")
+            skipped["no_house"] += 1
+            continue
+
+        if tenant["_id"] in already_billed:
+            skipped["already_billed"] += 1
+            continue
+
+        rent_amount = get_rent_amount(house, tenant, admin)
+        if not rent_amount:
+            app.logger.warning(f"No valid rent amount found for tenant {tenant.get('name')}, house {house_number}")
+            skipped["no_rent"] += 1
+            continue
+
+        bill = build_payment_record(admin_id, tenant["_id"], house["_id"], rent_amount, None, month_year, "rent", property_id)
+        bill["_id"] = ObjectId()
+        bill["billing_run_id"] = run_id
+        bills.append(bill)
+        billed_tenants.append(tenant)
+
+    if bills:
+        balances.insert_bills(mongo.db, bills)
+        rollups.record_bills(mongo.db, bills)
+        cache.delete_memoized(get_billing_summary, admin_id)
+        cache.delete_memoized(get_billing_summary, str(admin_id))
+
+    update_billing_run(run_id, tenant_count=len(tenants), bills_generated=len(bills), skipped=skipped)
+    return bills, billed_tenants
+
+def queue_rent_bill_notifications(run_id, admin, property_id, month_year, bills, tenants, url_root):
+    """Build rent bill SMS with arrears and portal links and queue them in one outbox write"""
+    admin_id = admin["_id"]
+    admin_name = admin.get('name', 'Your Landlord')
+    admin_phone = admin.get('phone', 'N/A')
+    payment_text = get_property_payment_info(admin, property_id)
+
+    # Arrears for every billed tenant in one aggregation (excluding this month's bill)
+    arrears = calculate_total_arrears_bulk(admin_id, [tenant["_id"] for tenant in tenants], bill_type='rent', exclude_current_month=month_year)
+
+    outbox = []
+    notified = 0
+    # Portal links for the whole run, minted in one write
+    month_stamp = datetime.now().strftime('%Y%m')
+    portal_links = dict(zip(
+        [tenant["_id"] for tenant in tenants if tenant.get('phone')],
+        shorten_urls([
+            (f"{url_root}tenant_portal/{generate_tenant_access_token(tenant['_id'], admin_id, expires_in_hours=24)}",
+             f"tenant_{tenant['_id']}_{month_stamp}")
+            for tenant in tenants if tenant.get('phone')
+        ], base_url=url_root)
+    ))
+
+    for bill, tenant in zip(bills, tenants):
+        if not tenant.get('phone'):
+            app.logger.warning(f"No phone number for tenant {tenant['name']}")
+            continue
+
+        try:
+            rent_amount = bill["bill_amount"]
+            total_arrears = arrears.get(tenant["_id"], 0)
+            portal_link = portal_links[tenant["_id"]]
+
+            if total_arrears > 1:  # Use smaller threshold for precision
+                message = (
+                    f"Rent Bill Alert: {tenant['name']}, House {tenant['house_number']}. "
+                    f"Current bill: KES {rent_amount:.2f}. "
+                    f"Outstanding arrears: KES {total_arrears:.2f}. "
+                    f"Total amount due: KES {rent_amount + total_arrears:.2f}. "
+                    f"{payment_text} View history: {portal_link} From {admin_name} - {admin_phone}"
+                )
+            else:
+                message = (
+                    f"Rent Bill Alert: {tenant['name']}, House {tenant['house_number']}. "
+                    f"Current bill: KES {rent_amount:.2f}. "
+                    f"{payment_text} View history: {portal_link} From {admin_name} - {admin_phone}"
+                )
+
+            outbox.append(build_outbox_message(
+                tenant['phone'], message,
+                context={'type': 'rent_bill', 'payment_id': bill['_id'], 'billing_run_id': run_id}
+            ))
+        except Exception as e:
+            app.logger.error(f"Error preparing rent SMS for tenant {tenant['name']}: {e}")
+
+        notified += 1
+        if notified % 50 == 0:
+            update_billing_run(run_id, notifications_prepared=notified)
+
+    enqueue_sms_many(mongo.db, outbox)
+    update_billing_run(run_id, notifications_prepared=notified, sms_queued=len(outbox))
+
+def run_rent_billing(run_id, admin_id, property_id, month_year, url_root):
+    """Execute a billing run: bulk-create the month's rent bills, then queue their notifications"""
+    started = time.monotonic()
+    update_billing_run(run_id, status='billing', started_at=datetime.now())
+    try:
+        admin = mongo.db.admins.find_one({"_id": admin_id})
+        if not admin:
+            raise ValueError("Admin not found")
+
+        bills, tenants = create_rent_bills(run_id, admin, property_id, month_year)
+        update_billing_run(run_id, status='notifying', billing_ms=round((time.monotonic() - started) * 1000))
+
+        if bills:
+            queue_rent_bill_notifications(run_id, admin, property_id, month_year, bills, tenants, url_root)
+
+        update_billing_run(run_id, status='completed', completed_at=datetime.now(),
+                           duration_ms=round((time.monotonic() - started) * 1000))
+        app.logger.info(f"Billing run {run_id} generated {len(bills)} rent bills for {month_year}")
+    except Exception as e:
+        app.logger.error(f"Error in billing run {run_id}: {str(e)}")
+        update_billing_run(run_id, status='failed', error=str(e), completed_at=datetime.now(),
+                           duration_ms=round((time.monotonic() - started) * 1000))
+    finally:
+        # Releases the one-active-run-per-property-and-month guard
+        mongo.db.billing_runs.update_one({"_id": run_id}, {"$unset": {"active_key": ""}})
+
 @app.route('/generate_rent_bills', methods=['GET'])
 @login_required
 def generate_rent_bills():
-    """Generate rent bills for all tenants for the current month with proper rent retrieval"""
+    """Start a background rent billing run for the current property and month"""
     try:
         admin_id = get_admin_id()
         current_property_id = get_current_property_id()  # CRITICAL: Get current property
 
-        admin = mongo.db.admins.find_one({"_id": admin_id})
-        admin_name = admin.get('name', 'Your Landlord') if admin else 'Your Landlord'
-        admin_phone = admin.get('phone', 'N/A') if admin else 'N/A'
-
-        # Get property-specific payment info
-        payment_info = get_property_payment_info(admin, current_property_id)
-        payment_text = payment_info.get('payment_text', 'Contact landlord for payment details')
-
-        # Get all active tenants for this admin AND CURRENT PROPERTY ONLY
-        tenant_query = {"admin_id": admin_id, "property_id": current_property_id}
-        tenants = list(mongo.db.tenants.find(tenant_query))
-
-        if not tenants:
+        if not mongo.db.tenants.find_one({"admin_id": admin_id, "property_id": current_property_id}, {"_id": 1}):
             flash("No active tenants found in current property", "warning")
             return redirect(url_for('rent_dashboard'))
 
         current_month_year = get_current_month_year()
 
         # Check if bills already exist for this month FOR CURRENT PROPERTY
-        existing_bills = list(mongo.db.payments.find({
+        if mongo.db.payments.find_one({
             "admin_id": admin_id,
             "property_id": current_property_id,
             "month_year": current_month_year,
             "bill_type": "rent"
-        }))
-        
-        if existing_bills:
+        }, {"_id": 1}):
             flash(f"Rent bills for {current_month_year} have already been generated", "warning")
             return redirect(url_for('rent_dashboard'))
-        
-        bills_generated = 0
-        sms_sent = 0
-        
-        for tenant in tenants:
-            tenant_id = tenant["_id"]
-            house_number = tenant.get("house_number")
-            
-            if not house_number:
-                app.logger.warning(f"Tenant {tenant.get('name')} has no house number")
-                continue
-            
-            # Find house document with explicit rent field projection AND property_id
-            house = mongo.db.houses.find_one(
-                {"house_number": house_number, "admin_id": admin_id, "property_id": current_property_id},
-                {"_id": 1, "rent": 1, "house_number": 1}  # Explicit projection
-            )
-            
-            if not house:
-                app.logger.warning(f"House {house_number} not found for tenant {tenant.get('name')}")
-                continue
-            
-            house_id = house["_id"]
-            
-            # Get rent amount with multiple fallback options
-            rent_amount = None
-            
-            # Priority 1: Rent from houses collection
-            if house.get("rent") and house["rent"] > 0:
-                rent_amount = float(house["rent"])
-            # Priority 2: Rent from tenant record
-            elif tenant.get("rent_amount") and tenant["rent_amount"] > 0:
-                rent_amount = float(tenant["rent_amount"])
-            # Priority 3: Default rent from admin settings
-            elif admin.get("default_rent") and admin["default_rent"] > 0:
-                rent_amount = float(admin["default_rent"])
-            
-            if not rent_amount or rent_amount <= 0:
-                app.logger.warning(f"No valid rent amount found for tenant {tenant.get('name')}, house {house_number}")
-                continue
-            
-            # Create payment record for rent with property_id
-            payment_id = create_payment_record(
-                admin_id=admin_id,
-                tenant_id=tenant_id,
-                house_id=house_id,
-                bill_amount=rent_amount,
-                month_year=current_month_year,
-                bill_type="rent",
-                property_id=current_property_id
-            )
-            
-            if payment_id:
-                bills_generated += 1
 
-                tenant_id_obj = ObjectId(tenant_id)
-                tenant = mongo.db.tenants.find_one({"_id": tenant_id, "admin_id": admin_id, "property_id": current_property_id})
-                # Calculate arrears (excluding current bill)
-                total_arrears = calculate_total_arrears(admin_id, tenant_id_obj, bill_type='rent', exclude_current_month=current_month_year)
+        run = {
+            "admin_id": admin_id,
+            "property_id": current_property_id,
+            "month_year": current_month_year,
+            "bill_type": "rent",
+            "status": "queued",
+            "active_key": f"{admin_id}:{current_property_id}:{current_month_year}:rent",
+            "bills_generated": 0,
+            "sms_queued": 0,
+            "created_at": datetime.now(),
+            "updated_at": datetime.now()
+        }
+        try:
+            run_id = mongo.db.billing_runs.insert_one(run).inserted_id
+        except DuplicateKeyError:
+            # A run whose worker died stops blocking new ones once it has gone quiet
+            released = mongo.db.billing_runs.update_one(
+                {"active_key": run["active_key"], "updated_at": {"$lt": datetime.now() - timedelta(minutes=BILLING_RUN_STALE_MINUTES)}},
+                {"$set": {"status": "abandoned"}, "$unset": {"active_key": ""}}
+            )
+            if not released.modified_count:
+                flash(f"Rent bills for {current_month_year} are already being generated", "info")
+                return redirect(url_for('rent_dashboard'))
+            run.pop("_id", None)
+            run_id = mongo.db.billing_runs.insert_one(run).inserted_id
 
-                # Generate secure access token for tenant portal
-                access_token = generate_tenant_access_token(tenant_id_obj, admin_id, expires_in_hours=24)
-                long_portal_link = f"{request.url_root}tenant_portal/{access_token}"
-                portal_link = shorten_url(long_portal_link, f"tenant_{tenant_id_obj}_{datetime.now().strftime('%Y%m')}")
+        billing_executor.submit(run_rent_billing, run_id, admin_id, current_property_id, current_month_year, request.url_root)
+        flash("Generating rent bills in the background. SMS notifications will be queued when they are ready.", "info")
+        return redirect(url_for('rent_dashboard', billing_run=str(run_id)))
 
-                # Create SMS message with arrears info
-            if total_arrears > 1:  # Use smaller threshold for precision
-                message = (
-                    f"Rent Bill Alert: {tenant['name']}, House {house_number}. "
-                    f"Current bill: KES {rent_amount:.2f}. "
-                    f"Outstanding arrears: KES {total_arrears:.2f}. "
-                    f"Total amount due: KES {rent_amount + total_arrears:.2f}. "
-                    f"{payment_text} View history: {portal_link} From {admin_name} - {admin_phone}"
-                )
-            else:
-                    message = (
-                        f"Rent Bill Alert: {tenant['name']}, House {house_number}. "
-                        f"Current bill: KES {rent_amount:.2f}. "
-                        f"{payment_text} View history: {portal_link} From {admin_name} - {admin_phone}"
-                    )
-                
-                # Send SMS
-            try:
-                if tenant.get('phone'):
-                    response = send_message(tenant['phone'], message)
-                        
-                    if "error" not in response:
-                        sms_sent += 1
-                    else:
-                        app.logger.error(f"SMS error for tenant {tenant['name']}: {response.get('error')}")
-                else:
-                    app.logger.warning(f"No phone number for tenant {tenant['name']}")
-                        
-            except Exception as sms_error:
-                    app.logger.error(f"SMS error for tenant {tenant['name']}: {sms_error}")
-        
-        # Invalidate billing summary cache
-        cache.delete_memoized(get_billing_summary, admin_id)
-        cache.delete_memoized(get_billing_summary, str(admin_id))
-        
-        if bills_generated > 0:
-            flash(f"Generated {bills_generated} rent bills. {sms_sent} SMS notifications sent.", "success")
-        else:
-            flash("No rent bills were generated. Please check tenant and house configurations.", "warning")
-        
     except Exception as e:
         app.logger.error(f"Error generating rent bills: {str(e)}")
         flash(f"Error generating rent bills: {str(e)}", "danger")
-    
+
     return redirect(url_for('rent_dashboard'))
 
+@app.route('/billing_runs/<run_id>', methods=['GET'])
+@login_required
+def billing_run_status(run_id):
+    """Report the progress of a billing run"""
+    try:
+        admin_id = get_admin_id()
+        run = mongo.db.billing_runs.find_one({"_id": ObjectId(run_id), "admin_id": admin_id}, {"active_key": 0})
+        if not run:
+            return jsonify({'error': 'Billing run not found'}), 404
+
+        return jsonify({
+            'run_id': str(run['_id']),
+            'status': run.get('status'),
+            'month_year': run.get('month_year'),
+            'tenant_count': run.get('tenant_count'),
+            'bills_generated': run.get('bills_generated', 0),
+            'skipped': run.get('skipped', {}),
+            'notifications_prepared': run.get('notifications_prepared', 0),
+            'sms_queued': run.get('sms_queued', 0),
+            'billing_ms': run.get('billing_ms'),
+            'duration_ms': run.get('duration_ms'),
+            'error': run.get('error'),
+            'created_at': run['created_at'].isoformat() if run.get('created_at') else None,
+            'completed_at': run['completed_at'].isoformat() if run.get('completed_at') else None
+        })
+
+    except Exception as e:
+        app.logger.error(f"Error getting billing run {run_id}: {e}")
+        return jsonify({'error': 'Failed to load billing run'}), 500
+
 @app.route('/rent_dashboard', methods=['GET', 'POST'])
 @login_required
 def rent_dashboard():
@@ -6689,7 +6352,7 @@ def rent_dashboard():
         pagination = get_unpaid_bills_paginated(
             admin_id, page=page, per_page=10, 
             filter_status=filter_status, search_term=search_term,
-            bill_type='rent'
+            bill_type='rent', after=request.args.get('after'), before=request.args.get('before')
         )
         
         # Enrich with tenant and house information if not already done in aggregation
@@ -6712,6 +6375,7 @@ def rent_dashboard():
                                total_ever_collected=billing_summary['total_ever_collected'],
                                total_outstanding=billing_summary['total_outstanding'],
                                pagination=pagination,
+                               billing_run_id=request.args.get('billing_run'),
                                now=datetime.now().timestamp(),
                                now_date=datetime.now())
         
@@ -6725,36 +6389,22 @@ def rent_dashboard():
 
 @cache.memoize(timeout=3)  # Cache for 1 hour
 def get_billing_summary(admin_id, bill_type=None):
-    """Get billing summary using MongoDB aggregation pipeline"""
+    """Get billing summary from the monthly rollups"""
     try:
         # Ensure admin_id is an ObjectId
         if isinstance(admin_id, str):
             admin_id = ObjectId(admin_id)
 
-        # Start with basic match criteria
-        match_criteria = {'admin_id': admin_id}
-
-        # Add bill_type filter if specified
-        if bill_type:
-            match_criteria['bill_type'] = bill_type
-
-        pipeline = [
-            {'$match': match_criteria},
-            {'$group': {
-                '_id': None,
-                'total_ever_billed': {'$sum': '$bill_amount'},
-                'total_ever_collected': {'$sum': {'$ifNull': ['$amount_paid', 0]}},
-                'count': {'$sum': 1}
-            }},
-            {'$addFields': {
-                'total_outstanding': {'$subtract': ['$total_ever_billed', '$total_ever_collected']}
-            }}
-        ]
+        totals = rollups.sum_rollups(mongo.db, rollups.rollup_query(
+            admin_id, bill_types=[bill_type] if bill_type else None
+        ))
 
-        result = list(mongo.db.payments.aggregate(pipeline))
-        if result:
-            return result[0]
-        return {'total_ever_billed': 0, 'total_ever_collected': 0, 'total_outstanding': 0, 'count': 0}
+        return {
+            'total_ever_billed': totals['billed'],
+            'total_ever_collected': totals['collected'],
+            'total_outstanding': totals['billed'] - totals['collected'],
+            'count': totals['bill_count']
+        }
     except Exception as e:
         app.logger.error(f"Error in billing summary aggregation: {str(e)}")
         return {'total_ever_billed': 0, 'total_ever_collected': 0, 'total_outstanding': 0, 'count': 0}
@@ -6778,10 +6428,12 @@ def payments_dashboard():
         pagination = get_unpaid_bills_paginated(
             admin_id, page=page, per_page=10, 
             filter_status=filter_status, search_term=search_term,
-            bill_type='water'
-
+            bill_type='water', after=request.args.get('after'), before=request.args.get('before')
         )
-        
+
+        # Fines come from the nightly materialization; bills it has not reached are computed in one batch
+        late_fines.attach_fines(mongo.db, pagination['bills'])
+
         # Enrich with tenant and house information if not already done in aggregation
         enriched_bills = []
         for bill in pagination['bills']:
@@ -6794,12 +6446,7 @@ def payments_dashboard():
                 bill['house_number'] = house['house_number'] if house else 'Unknown'
             
             bill['outstanding_amount'] = bill['bill_amount'] - bill.get('amount_paid', 0)
-
-            # Calculate late payment fine
-            property_settings = get_property_billing_settings(bill.get('property_id'), admin_id)
-            fine_amount = calculate_late_payment_fine(bill, property_settings)
-            bill['late_payment_fine'] = fine_amount
-            bill['total_amount_due'] = bill['outstanding_amount'] + fine_amount
+            bill['total_amount_due'] = bill['outstanding_amount'] + bill['late_payment_fine']
 
             enriched_bills.append(bill)
 
@@ -6821,6 +6468,23 @@ def payments_dashboard():
         flash(f'Error loading payments dashboard: {str(e)}', 'danger')
         return redirect(url_for('dashboard'))
 
+UNALLOCATED_PAGE_SIZE = 10
+UNALLOCATED_CURSOR_FORMAT = '%Y%m%d%H%M%S%f'
+
+def encode_receipt_cursor(payment):
+    """Keyset position of an unallocated payment: its payment_date and _id"""
+    return f"{payment['payment_date'].strftime(UNALLOCATED_CURSOR_FORMAT)}_{payment['_id']}"
+
+def receipt_keyset_filter(cursor, direction):
+    """Match receipts after (older than) or before (newer than) a cursor in newest-first order"""
+    stamp, receipt_id = cursor.split('_', 1)
+    payment_date = datetime.strptime(stamp, UNALLOCATED_CURSOR_FORMAT)
+    op = '$lt' if direction == 'after' else '$gt'
+    return {'$or': [
+        {'payment_date': {op: payment_date}},
+        {'payment_date': payment_date, '_id': {op: ObjectId(receipt_id)}}
+    ]}
+
 @app.route('/unallocated_payments', methods=['GET'])
 @login_required
 def unallocated_payments():
@@ -6829,9 +6493,18 @@ def unallocated_payments():
         # Get admin_id from session
         admin_id = get_admin_id()
 
-        # Get pagination parameters
+        # Keyset pagination: ?after=<cursor> for older receipts, ?before=<cursor> for newer ones
         page = request.args.get('page', 1, type=int)
-        per_page = 10
+        per_page = UNALLOCATED_PAGE_SIZE
+        after = request.args.get('after')
+        before = request.args.get('before')
+        direction = 'before' if before else 'after'
+        try:
+            keyset = receipt_keyset_filter(before or after, direction) if (before or after) else {}
+        except (ValueError, InvalidId):
+            keyset, direction, page = {}, 'after', 1
+        # Newer receipts are fetched oldest-first and flipped back below
+        page_sort = -1 if direction == 'after' else 1
 
         # Build query for unallocated payments
         query = {
@@ -6839,54 +6512,82 @@ def unallocated_payments():
             'allocation_status': {'$in': ['pending', 'partial']}
         }
 
-        # Get total count for pagination
-        total_count = mongo.db.unallocated_payments.count_documents(query)
-
-        # Get paginated unallocated payments
-        unallocated_payments_list = list(mongo.db.unallocated_payments.find(query)
-                                       .sort('payment_date', -1)
-                                       .skip((page - 1) * per_page)
-                                       .limit(per_page))
-
-        # Enrich each payment with outstanding bills for that house
-        enriched_payments = []
-        for payment in unallocated_payments_list:
-            # Get outstanding bills for this house (both water and rent)
-            outstanding_bills = list(mongo.db.payments.find({
-                'admin_id': admin_id,
-                'house_id': payment['house_id'],
-                'payment_status': {'$in': ['unpaid', 'partial']}
-            }).sort('due_date', 1))
-
-            # Add outstanding amounts to bills
-            for bill in outstanding_bills:
-                bill['outstanding_amount'] = bill['bill_amount'] - bill.get('amount_paid', 0)
+        result = next(mongo.db.unallocated_payments.aggregate([
+            {'$match': query},
+            {'$sort': {'payment_date': -1, '_id': -1}},
+            {'$facet': {
+                # Summary statistics over every unallocated receipt, not just this page
+                'summary': [{'$group': {
+                    '_id': None,
+                    'total': {'$sum': 1},
+                    'total_unallocated': {'$sum': '$amount_remaining'},
+                    'pending_count': {'$sum': {'$cond': [{'$eq': ['$allocation_status', 'pending']}, 1, 0]}},
+                    'partial_count': {'$sum': {'$cond': [{'$eq': ['$allocation_status', 'partial']}, 1, 0]}}
+                }}],
+                'page': [
+                    {'$match': keyset},
+                    {'$sort': {'payment_date': page_sort, '_id': page_sort}},
+                    # One extra receipt tells whether there is another page in this direction
+                    {'$limit': per_page + 1},
+                    # Outstanding bills (both water and rent) for each receipt's house
+                    {'$lookup': {
+                        'from': 'payments',
+                        'localField': 'house_id',
+                        'foreignField': 'house_id',
+                        'pipeline': [
+                            {'$match': {
+                                'admin_id': admin_id,
+                                'house_id': {'$ne': None},
+                                'payment_status': {'$in': ['unpaid', 'partial']}
+                            }},
+                            {'$sort': {'due_date': 1}},
+                            {'$set': {'outstanding_amount': {
+                                '$subtract': ['$bill_amount', {'$ifNull': ['$amount_paid', 0]}]
+                            }}}
+                        ],
+                        'as': 'outstanding_bills'
+                    }},
+                    {'$set': {'total_outstanding': {'$sum': '$outstanding_bills.outstanding_amount'}}}
+                ]
+            }}
+        ]))
 
-            payment['outstanding_bills'] = outstanding_bills
-            payment['total_outstanding'] = sum(bill['outstanding_amount'] for bill in outstanding_bills)
-            enriched_payments.append(payment)
+        summary = result['summary'][0] if result['summary'] else {}
+        enriched_payments = result['page']
+        has_more = len(enriched_payments) > per_page
+        enriched_payments = enriched_payments[:per_page]
+        if direction == 'before':
+            enriched_payments.reverse()
 
         # Calculate pagination info
-        has_prev = page > 1
-        has_next = (page * per_page) < total_count
-        prev_num = page - 1 if has_prev else None
-        next_num = page + 1 if has_next else None
+        total_count = summary.get('total', 0)
+        has_prev = bool(keyset) and (direction == 'after' or has_more)
+        has_next = (direction == 'before') or has_more
 
         pagination = {
             'page': page,
             'per_page': per_page,
             'total': total_count,
-            'has_prev': has_prev,
-            'has_next': has_next,
-            'prev_num': prev_num,
-            'next_num': next_num,
+            'has_prev': has_prev and bool(enriched_payments),
+            'has_next': has_next and bool(enriched_payments),
+            'prev_num': page - 1 if page > 1 else 1,
+            'next_num': page + 1,
+            'prev_cursor': encode_receipt_cursor(enriched_payments[0]) if enriched_payments else None,
+            'next_cursor': encode_receipt_cursor(enriched_payments[-1]) if enriched_payments else None,
             'pages': (total_count + per_page - 1) // per_page
         }
 
         # Calculate summary statistics
-        total_unallocated = sum(payment['amount_remaining'] for payment in enriched_payments)
-        pending_count = len([p for p in enriched_payments if p['allocation_status'] == 'pending'])
-        partial_count = len([p for p in enriched_payments if p['allocation_status'] == 'partial'])
+        total_unallocated = summary.get('total_unallocated', 0)
+        pending_count = summary.get('pending_count', 0)
+        partial_count = summary.get('partial_count', 0)
+
+        # Callbacks received but not yet turned into unallocated payments
+        try:
+            inbox = payment_inbox.inbox_status(mongo.db, admin_id)
+        except Exception as e:
+            app.logger.error(f"Error loading payment inbox status: {e}")
+            inbox = None
 
         return render_template('unallocated_payments.html',
                              payments=enriched_payments,
@@ -6894,6 +6595,7 @@ def unallocated_payments():
                              total_unallocated=total_unallocated,
                              pending_count=pending_count,
                              partial_count=partial_count,
+                             inbox=inbox,
                              now=datetime.now().timestamp())
 
     except KeyError:
@@ -6904,6 +6606,90 @@ def unallocated_payments():
         flash(f'Error loading unallocated payments: {str(e)}', 'danger')
         return redirect(url_for('dashboard'))
 
+@app.route('/payment_inbox/status')
+@login_required
+def payment_inbox_status():
+    """Backlog, lag and stuck entries of the admin's payment callback inbox"""
+    try:
+        admin_id = get_admin_id()
+        status = payment_inbox.inbox_status(mongo.db, admin_id)
+        return jsonify({
+            'counts': status['counts'],
+            'backlog': status['backlog'],
+            'lag_seconds': status['lag_seconds'],
+            'stuck': [{
+                'id': str(entry['_id']),
+                'transaction_id': entry['transaction_id'],
+                'status': entry['status'],
+                'attempts': entry.get('attempts', 0),
+                'last_error': entry.get('last_error'),
+                'received_at': entry['received_at'].isoformat()
+            } for entry in status['stuck']]
+        })
+    except Exception as e:
+        app.logger.error(f"Error loading payment inbox status: {e}")
+        return jsonify({'error': 'Failed to load payment inbox status'}), 500
+
+@app.route('/payment_inbox/<entry_id>/retry', methods=['POST'])
+@login_required
+def retry_payment_inbox_entry(entry_id):
+    """Requeue a payment callback that failed every processing attempt"""
+    try:
+        admin_id = get_admin_id()
+        if payment_inbox.retry_entry(mongo.db, ObjectId(entry_id), admin_id):
+            flash('Payment callback queued for processing again', 'success')
+        else:
+            flash('Payment callback not found or not failed', 'warning')
+    except Exception as e:
+        app.logger.error(f"Error retrying payment inbox entry {entry_id}: {e}")
+        flash('Error retrying payment callback', 'danger')
+    return redirect(url_for('unallocated_payments'))
+
+@app.route('/auto_allocate_payments', methods=['GET', 'POST'])
+@login_required
+def auto_allocate_payments():
+    """Allocate high-confidence M-Pesa receipts FIFO to the oldest bills; GET returns the dry-run plan"""
+    try:
+        admin_id = get_admin_id()
+        dry_run = request.method == 'GET'
+        run = auto_allocation.run_auto_allocation(mongo.db, admin_id, dry_run=dry_run)
+
+        if dry_run:
+            return jsonify({
+                'status': run['status'],
+                'receipts_allocated': run.get('receipts_allocated', 0),
+                'bills_paid': run.get('bills_paid', 0),
+                'amount_allocated': run.get('amount_allocated', 0),
+                'plan_ms': run['plan_ms'],
+                'error': run.get('error'),
+                'plan': [{
+                    'receipt_id': str(receipt['receipt_id']),
+                    'mpesa_trans_id': receipt['mpesa_trans_id'],
+                    'tenant_name': receipt['tenant_name'],
+                    'house_number': receipt['house_number'],
+                    'amount': receipt['amount'],
+                    'allocations': [dict(allocation, bill_id=str(allocation['bill_id'])) for allocation in receipt['allocations']]
+                } for receipt in run['plan']]
+            })
+
+        if run['status'] == 'failed':
+            flash(f"Auto-allocation failed: {run.get('error')}", 'danger')
+        elif run.get('receipts_allocated'):
+            # Invalidate cached billing summary
+            cache.delete_memoized(get_billing_summary, admin_id)
+            cache.delete_memoized(get_billing_summary, str(admin_id))
+            flash(f"Auto-allocated KES {run['amount_allocated']:.2f} from {run['receipts_allocated']} payment(s) to {run['bills_paid']} bill(s)", 'success')
+        else:
+            flash('No high-confidence payments could be auto-allocated', 'info')
+
+    except Exception as e:
+        app.logger.error(f"Error auto-allocating payments: {str(e)}")
+        flash(f'Error auto-allocating payments: {str(e)}', 'danger')
+        if request.method == 'GET':
+            return jsonify({'error': 'Failed to plan auto-allocation'}), 500
+
+    return redirect(url_for('unallocated_payments'))
+
 @app.route('/allocate_payment/<unallocated_payment_id>', methods=['POST'])
 @login_required
 def allocate_payment(unallocated_payment_id):
@@ -6937,93 +6723,111 @@ def allocate_payment(unallocated_payment_id):
                 })
                 total_allocated += amount
 
-        # Validate total allocation doesn't exceed remaining amount
-        if total_allocated > unallocated_payment['amount_remaining']:
-            flash(f'Total allocation (KES {total_allocated}) exceeds remaining amount (KES {unallocated_payment["amount_remaining"]})', 'danger')
-            return redirect(url_for('unallocated_payments'))
-
-        # Process each allocation
-        successful_allocations = []
-        for allocation in allocations:
-            # Get the bill being paid
-            bill = mongo.db.payments.find_one({
-                '_id': allocation['bill_id'],
-                'admin_id': admin_id
-            })
+        # Only bills of this admin can be paid; others are dropped before anything is reserved
+        known_bills = {
+            bill['_id'] for bill in mongo.db.payments.find(
+                {'_id': {'$in': [allocation['bill_id'] for allocation in allocations]}, 'admin_id': admin_id},
+                {'_id': 1}
+            )
+        }
+        allocations = [allocation for allocation in allocations if allocation['bill_id'] in known_bills]
+        total_allocated = sum(allocation['amount'] for allocation in allocations)
+
+        def reservation(amount):
+            # Pipeline moving amount between allocated and remaining and deriving the allocation status
+            new_amount_allocated = {'$add': ['$amount_allocated', amount]}
+            new_amount_remaining = {'$subtract': ['$amount_remaining', amount]}
+            return [{'$set': {
+                'amount_allocated': new_amount_allocated,
+                'amount_remaining': new_amount_remaining,
+                # Determine new allocation status
+                'allocation_status': {'$switch': {
+                    'branches': [
+                        {'case': {'$lte': [new_amount_remaining, 0]}, 'then': 'complete'},
+                        {'case': {'$gt': [new_amount_allocated, 0]}, 'then': 'partial'}
+                    ],
+                    'default': 'pending'
+                }},
+                'updated_at': datetime.now()
+            }}]
+
+        applications = [
+            (
+                allocation['bill_id'],
+                allocation['amount'],
+                {'last_payment_method': 'mpesa_auto_allocated', 'updated_at': datetime.now()},
+                {
+                    'amount': allocation['amount'],
+                    'method': 'mpesa_auto_allocated',
+                    'date': datetime.now(),
+                    'mpesa_trans_id': unallocated_payment['mpesa_trans_id'],
+                    'unallocated_payment_id': ObjectId(unallocated_payment_id),
+                    'notes': f'Allocated from M-Pesa payment {unallocated_payment["mpesa_trans_id"]}'
+                }
+            )
+            for allocation in allocations
+        ]
 
-            if bill:
-                # Calculate new payment amount for this bill
-                current_paid = bill.get('amount_paid', 0)
-                new_paid = current_paid + allocation['amount']
-                bill_amount = bill['bill_amount']
-
-                # Determine new payment status
-                if new_paid >= bill_amount:
-                    new_status = 'paid'
-                elif new_paid > 0:
-                    new_status = 'partial'
-                else:
-                    new_status = 'unpaid'
+        def write(db_session):
+            # Reserve the amount on the receipt, so concurrent allocations can never exceed it
+            reserved = mongo.db.unallocated_payments.find_one_and_update(
+                {
+                    '_id': ObjectId(unallocated_payment_id),
+                    'admin_id': admin_id,
+                    'amount_remaining': {'$gte': total_allocated - balances.PRECISION / 2}
+                },
+                reservation(total_allocated),
+                projection={'_id': 1},
+                session=db_session
+            )
+            if not reserved:
+                return None
 
-                # Update the bill
-                mongo.db.payments.update_one(
-                    {'_id': allocation['bill_id']},
+            # Apply every part of the receipt to its bill in one bulk write; a bill that changed or vanished aborts it
+            try:
+                paid_bills = balances.apply_payments(mongo.db, admin_id, applications, session=db_session, guard=True)
+            except balances.PaymentConflict:
+                if db_session is None:
+                    # No transaction to roll back on a standalone server: give the reservation back
+                    mongo.db.unallocated_payments.update_one({'_id': ObjectId(unallocated_payment_id)}, reservation(-total_allocated))
+                raise
+
+            mongo.db.unallocated_payments.update_one(
+                {'_id': ObjectId(unallocated_payment_id)},
+                {'$push': {'allocations': {'$each': [
                     {
-                        '$set': {
-                            'amount_paid': new_paid,
-                            'payment_status': new_status,
-                            'last_payment_method': 'mpesa_auto_allocated',
-                            'updated_at': datetime.now()
-                        },
-                        '$push': {
-                            'payment_history': {
-                                'amount': allocation['amount'],
-                                'method': 'mpesa_auto_allocated',
-                                'date': datetime.now(),
-                                'mpesa_trans_id': unallocated_payment['mpesa_trans_id'],
-                                'unallocated_payment_id': ObjectId(unallocated_payment_id),
-                                'notes': f'Allocated from M-Pesa payment {unallocated_payment["mpesa_trans_id"]}'
-                            }
-                        }
+                        'bill_id': allocation['bill_id'],
+                        'bill_type': paid_bills[allocation['bill_id']].get('bill_type', 'unknown'),
+                        'month_year': paid_bills[allocation['bill_id']].get('month_year', 'unknown'),
+                        'amount': allocation['amount'],
+                        'allocated_at': allocation['allocated_at']
                     }
-                )
-
-                successful_allocations.append({
-                    'bill_id': allocation['bill_id'],
-                    'bill_type': bill.get('bill_type', 'unknown'),
-                    'month_year': bill.get('month_year', 'unknown'),
-                    'amount': allocation['amount'],
-                    'allocated_at': allocation['allocated_at']
-                })
+                    for allocation in allocations
+                ]}}},
+                session=db_session
+            )
+            return paid_bills
 
-        # Update unallocated payment record
-        new_amount_allocated = unallocated_payment['amount_allocated'] + total_allocated
-        new_amount_remaining = unallocated_payment['amount_remaining'] - total_allocated
+        try:
+            paid_bills = balances.run_in_transaction(mongo.db, write)
+        except balances.PaymentConflict as e:
+            app.logger.warning(f"Allocation of payment {unallocated_payment_id} conflicted: {e}")
+            flash('The selected bills changed while allocating. Nothing was allocated; please review and try again.', 'warning')
+            return redirect(url_for('unallocated_payments'))
 
-        # Determine new allocation status
-        if new_amount_remaining <= 0:
-            new_allocation_status = 'complete'
-        elif new_amount_allocated > 0:
-            new_allocation_status = 'partial'
-        else:
-            new_allocation_status = 'pending'
+        if paid_bills is None:
+            remaining = mongo.db.unallocated_payments.find_one({'_id': ObjectId(unallocated_payment_id)}, {'amount_remaining': 1})
+            flash(f'Total allocation (KES {total_allocated}) exceeds remaining amount (KES {remaining["amount_remaining"] if remaining else 0})', 'danger')
+            return redirect(url_for('unallocated_payments'))
 
-        mongo.db.unallocated_payments.update_one(
-            {'_id': ObjectId(unallocated_payment_id)},
-            {
-                '$set': {
-                    'amount_allocated': new_amount_allocated,
-                    'amount_remaining': new_amount_remaining,
-                    'allocation_status': new_allocation_status,
-                    'updated_at': datetime.now()
-                },
-                '$push': {
-                    'allocations': {
-                        '$each': successful_allocations
-                    }
-                }
-            }
-        )
+        successful_allocations = []
+        for allocation in allocations:
+            bill = paid_bills[allocation['bill_id']]
+            rollups.record_collection(mongo.db, bill, allocation['amount'])
+            successful_allocations.append({
+                'bill_type': bill.get('bill_type', 'unknown'),
+                'amount': allocation['amount']
+            })
 
         # Send confirmation SMS to tenant
         if unallocated_payment.get('tenant_id'):
@@ -7032,7 +6836,7 @@ def allocate_payment(unallocated_payment_id):
                 try:
                     allocation_details = ', '.join([f"{alloc['bill_type']} KES {alloc['amount']}" for alloc in successful_allocations])
                     message = f"Payment allocated: {allocation_details}. House {unallocated_payment['house_number']}. Thank you!"
-                    send_message(tenant['phone'], message)
+                    queue_message(tenant['phone'], message)
                 except Exception as sms_error:
                     app.logger.error(f"SMS error: {sms_error}")
 
@@ -7057,86 +6861,56 @@ def record_payment(payment_id):
             flash('Payment amount must be greater than 0', 'danger')
             return redirect(request.referrer or url_for('payments_dashboard'))
         
-        # Get the current payment record (with admin validation)
         admin_id = get_admin_id()
-        payment = mongo.db.payments.find_one({
-            "_id": ObjectId(payment_id),
-            "admin_id": admin_id  # Validate admin ownership
-        })
-        
-        if not payment:
-            flash('Payment record not found', 'danger')
-            return redirect(request.referrer or url_for('payments_dashboard'))
-        
-        # Verify admin ownership
-        admin_id = ObjectId(session.get('admin_id'))
-        if payment.get('admin_id') != admin_id:
-            flash('Unauthorized access to payment record', 'danger')
-            return redirect(request.referrer or url_for('payments_dashboard'))
-        
-        # Calculate new payment amounts
-        current_amount_paid = payment.get('amount_paid', 0)
-        bill_amount = payment['bill_amount']
-        new_total_paid = current_amount_paid + amount_paid
-        
-        # Prevent overpayment
-        if new_total_paid > bill_amount:
-            overpayment = new_total_paid - bill_amount
-            flash(f'Payment amount exceeds bill amount by KES {overpayment:.2f}. Please enter a smaller amount.', 'warning')
-            return redirect(request.referrer or url_for('payments_dashboard'))
-        
-        # Determine new payment status
-        if new_total_paid >= bill_amount:
-            payment_status = 'paid'
-            new_total_paid = bill_amount  # Ensure exact match
-        elif new_total_paid > 0:
-            payment_status = 'partial'
-        else:
-            payment_status = 'unpaid'
-        
-        # Update payment record with comprehensive tracking
-        update_result = mongo.db.payments.update_one(
-            {"_id": ObjectId(payment_id)},
+        now = datetime.now()
+
+        # Apply the payment in one round trip; the bill only matches if it is this admin's and has room for it
+        payment = balances.apply_payment(
+            mongo.db,
+            {"_id": ObjectId(payment_id), "admin_id": admin_id},  # Validate admin ownership
+            amount_paid,
             {
-                "$set": {
-                    "amount_paid": round(new_total_paid, 2),
-                    "payment_status": payment_status,
-                    "last_payment_date": datetime.now(),
-                    "last_payment_method": payment_method,
-                    "updated_at": datetime.now()
-                },
-                "$push": {
-                    "payment_history": {
-                        "amount": round(amount_paid, 2),
-                        "method": payment_method,
-                        "date": datetime.now(),
-                        "notes": notes,
-                        "recorded_by": admin_id
-                    }
-                },
-                "$inc": {
-                    "payment_count": 1
-                }
-            }
+                "last_payment_date": now,
+                "last_payment_method": payment_method,
+                "updated_at": now
+            },
+            {
+                "amount": round(amount_paid, 2),
+                "method": payment_method,
+                "date": now,
+                "notes": notes,
+                "recorded_by": admin_id
+            },
+            allow_overpayment=False
         )
-        
-        if update_result.modified_count > 0:
-            # Invalidate cached billing summary
-            cache.delete_memoized(get_billing_summary, admin_id)
-            cache.delete_memoized(get_billing_summary, str(admin_id))
-            cache.delete_memoized(get_billing_summary, admin_id, 'water')
-            cache.delete_memoized(get_billing_summary, str(admin_id), 'water')
 
-            # Send SMS notification if bill is fully paid
-            # Create success message based on payment status
-            if payment_status == 'paid':
-                flash(f'Payment of KES {amount_paid:.2f} recorded successfully. Bill is now fully paid.', 'success')
+        if not payment:
+            bill = mongo.db.payments.find_one(
+                {"_id": ObjectId(payment_id), "admin_id": admin_id}, {"bill_amount": 1, "amount_paid": 1}
+            )
+            if not bill:
+                flash('Payment record not found', 'danger')
             else:
-                outstanding = bill_amount - new_total_paid
-                flash(f'Partial payment of KES {amount_paid:.2f} recorded. Outstanding balance: KES {outstanding:.2f}', 'info')
+                # Prevent overpayment
+                overpayment = bill.get('amount_paid', 0) + amount_paid - bill['bill_amount']
+                flash(f'Payment amount exceeds bill amount by KES {overpayment:.2f}. Please enter a smaller amount.', 'warning')
+            return redirect(request.referrer or url_for('payments_dashboard'))
+
+        rollups.record_collection(mongo.db, payment, amount_paid)
+
+        # Invalidate cached billing summary
+        cache.delete_memoized(get_billing_summary, admin_id)
+        cache.delete_memoized(get_billing_summary, str(admin_id))
+        cache.delete_memoized(get_billing_summary, admin_id, 'water')
+        cache.delete_memoized(get_billing_summary, str(admin_id), 'water')
+
+        # Create success message based on payment status
+        if payment['payment_status'] == 'paid':
+            flash(f'Payment of KES {amount_paid:.2f} recorded successfully. Bill is now fully paid.', 'success')
         else:
-            flash('Error updating payment record', 'danger')
-            
+            outstanding = payment['bill_amount'] - payment['amount_paid']
+            flash(f'Partial payment of KES {amount_paid:.2f} recorded. Outstanding balance: KES {outstanding:.2f}', 'info')
+
     except ValueError:
         flash('Invalid payment amount. Please enter a valid number.', 'danger')
     except Exception as e:
@@ -7174,33 +6948,21 @@ def maintenance_requests():
         page = request.args.get('page', 1, type=int)
         per_page = 10
 
-        total_requests = mongo.db.maintenance_requests.count_documents(query)
-        requests_list = list(mongo.db.maintenance_requests.find(query)
-                           .sort('created_at', -1)
-                           .skip((page - 1) * per_page)
-                           .limit(per_page))
+        pagination = paging.paginate(
+            mongo.db.maintenance_requests, query, MAINTENANCE_PAGE_SORT, per_page,
+            after=request.args.get('after'), before=request.args.get('before'), page=page
+        )
+        requests_list = pagination['items']
 
         # Get properties for filter dropdown
         properties = list(mongo.db.properties.find({'admin_id': admin_id}))
 
         # Calculate summary stats
         stats = {
-            'total': mongo.db.maintenance_requests.count_documents({'admin_id': admin_id}),
-            'pending': mongo.db.maintenance_requests.count_documents({'admin_id': admin_id, 'status': 'pending'}),
-            'in_progress': mongo.db.maintenance_requests.count_documents({'admin_id': admin_id, 'status': 'in_progress'}),
-            'completed': mongo.db.maintenance_requests.count_documents({'admin_id': admin_id, 'status': 'completed'}),
-        }
-
-        # Pagination info
-        pagination = {
-            'page': page,
-            'per_page': per_page,
-            'total': total_requests,
-            'has_prev': page > 1,
-            'has_next': (page * per_page) < total_requests,
-            'prev_num': page - 1 if page > 1 else None,
-            'next_num': page + 1 if (page * per_page) < total_requests else None,
-            'pages': (total_requests + per_page - 1) // per_page
+            'total': paging.cached_count(mongo.db.maintenance_requests, {'admin_id': admin_id}),
+            'pending': paging.cached_count(mongo.db.maintenance_requests, {'admin_id': admin_id, 'status': 'pending'}),
+            'in_progress': paging.cached_count(mongo.db.maintenance_requests, {'admin_id': admin_id, 'status': 'in_progress'}),
+            'completed': paging.cached_count(mongo.db.maintenance_requests, {'admin_id': admin_id, 'status': 'completed'}),
         }
 
         return render_template('maintenance_requests.html',
@@ -7266,6 +7028,7 @@ def update_maintenance_request(request_id):
                 '$push': update_data['$push']
             }
         )
+        paging.invalidate_counts('maintenance_requests', admin_id)
 
         if result.modified_count > 0:
             # Send SMS notification to tenant if status changed
@@ -7283,7 +7046,7 @@ def update_maintenance_request(request_id):
                         if note:
                             message += f" Note: {note}"
 
-                        send_message(tenant['phone'], message)
+                        queue_message(tenant['phone'], message)
                 except Exception as e:
                     app.logger.error(f"Failed to send maintenance update SMS: {str(e)}")
 
@@ -7301,7 +7064,7 @@ def update_maintenance_request(request_id):
 @app.route('/export_tenant_data/<tenant_id>')
 @login_required
 def export_tenant_data(tenant_id):
-    """Export individual tenant's reading history to Excel."""
+    """Export individual tenant's reading history to Excel, or to CSV with ?format=csv, as a background report."""
     try:
         admin_id = get_admin_id()
     except ValueError:
@@ -7310,133 +7073,16 @@ def export_tenant_data(tenant_id):
     
     try:
         tenant_id_obj = ObjectId(tenant_id)
-        tenant = mongo.db.tenants.find_one({"_id": tenant_id_obj, "admin_id": admin_id})
+        tenant = mongo.db.tenants.find_one({"_id": tenant_id_obj, "admin_id": admin_id}, {"name": 1})
         
         if not tenant:
             flash('Tenant not found', 'danger')
             return redirect(url_for('dashboard'))
         
-        # Get tenant's reading history
-        readings = list(mongo.db.meter_readings.find({
-            "tenant_id": tenant_id_obj,
-            "admin_id": admin_id
-        }).sort("date_recorded", 1))
-        
-        # Create Excel file in memory
-        output = BytesIO()
-        workbook = xlsxwriter.Workbook(output, {'in_memory': True})
-        
-        # Create worksheet
-        worksheet = workbook.add_worksheet(f"{tenant['name']}_History")
-        
-        # Define formats
-        header_format = workbook.add_format({
-            'bold': True,
-            'bg_color': '#4472C4',
-            'font_color': 'white',
-            'border': 1,
-            'align': 'center'
-        })
-        
-        cell_format = workbook.add_format({
-            'border': 1,
-            'align': 'center'
-        })
-        
-        currency_format = workbook.add_format({
-            'border': 1,
-            'align': 'center',
-            'num_format': '"Ksh "#,##0.00'
-        })
-        
-        date_format = workbook.add_format({
-            'border': 1,
-            'align': 'center',
-            'num_format': 'yyyy-mm-dd'
-        })
-        
-        # Write tenant information
-        worksheet.write('A1', 'Tenant Information', header_format)
-        worksheet.write('A2', 'Name:', cell_format)
-        worksheet.write('B2', tenant['name'], cell_format)
-        worksheet.write('A3', 'Phone:', cell_format)
-        worksheet.write('B3', tenant['phone'], cell_format)
-        worksheet.write('A4', 'House Number:', cell_format)
-        worksheet.write('B4', tenant['house_number'], cell_format)
-        
-        # Write reading history headers
-        headers = ['Date', 'Previous Reading (m³)', 'Current Reading (m³)', 'Usage (m³)', 'Bill Amount', 'Payment Status', 'Amount Paid', 'Outstanding']
-        start_row = 6
-        
-        worksheet.write('A6', 'Reading History', header_format)
-        for col, header in enumerate(headers):
-            worksheet.write(start_row + 1, col, header, header_format)
-        
-        # Write reading data with payment information
-        for row, reading in enumerate(readings, start_row + 2):
-            # Get payment information for this reading
-            reading_month = reading['date_recorded'].strftime('%Y-%m')
-            payment = mongo.db.payments.find_one({
-                'tenant_id': tenant_id_obj,
-                'admin_id': admin_id,
-                'month_year': reading_month
-            })
-
-            # Determine payment status
-            if payment:
-                amount_paid = payment.get('amount_paid', 0)
-                bill_amount = reading['bill_amount']
-                outstanding = max(0, bill_amount - amount_paid)
-
-                if outstanding == 0:
-                    payment_status = 'Paid'
-                elif amount_paid > 0:
-                    payment_status = 'Partial'
-                else:
-                    payment_status = 'Unpaid'
-            else:
-                payment_status = 'Unpaid'
-                amount_paid = 0
-                outstanding = reading['bill_amount']
-
-            worksheet.write(row, 0, reading['date_recorded'], date_format)
-            worksheet.write(row, 1, reading['previous_reading'], cell_format)
-            worksheet.write(row, 2, reading['current_reading'], cell_format)
-            worksheet.write(row, 3, reading['usage'], cell_format)
-            worksheet.write(row, 4, reading['bill_amount'], currency_format)
-            worksheet.write(row, 5, payment_status, cell_format)
-            worksheet.write(row, 6, amount_paid, currency_format)
-            worksheet.write(row, 7, outstanding, currency_format)
-        
-        # Add summary statistics
-        if readings:
-            summary_row = start_row + len(readings) + 3
-            worksheet.write(summary_row, 0, 'Summary Statistics', header_format)
-            worksheet.write(summary_row + 1, 0, 'Total Readings:', cell_format)
-            worksheet.write(summary_row + 1, 1, len(readings), cell_format)
-            worksheet.write(summary_row + 2, 0, 'Total Usage:', cell_format)
-            worksheet.write(summary_row + 2, 1, sum(r['usage'] for r in readings), cell_format)
-            worksheet.write(summary_row + 3, 0, 'Total Amount:', cell_format)
-            worksheet.write(summary_row + 3, 1, sum(r['bill_amount'] for r in readings), currency_format)
-            worksheet.write(summary_row + 4, 0, 'Average Usage:', cell_format)
-            worksheet.write(summary_row + 4, 1, sum(r['usage'] for r in readings) / len(readings), cell_format)
-        
-        # Auto-adjust column widths
-        worksheet.set_column('A:A', 15)
-        worksheet.set_column('B:E', 20)
-        
-        workbook.close()
-        output.seek(0)
-        
-        # Generate filename
-        filename = f"{tenant['name']}_reading_history_{datetime.now().strftime('%Y%m%d')}.xlsx"
-        
-        return send_file(
-            output,
-            mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
-            as_attachment=True,
-            download_name=filename
-        )
+        export_format = 'csv' if request.args.get('format') == 'csv' else 'xlsx'
+        filename = f"{tenant['name']}_reading_history_{datetime.now().strftime('%Y%m%d')}.{export_format}"
+        return start_report('tenant_history', {'tenant_id': str(tenant_id_obj), 'format': export_format}, filename,
+                            'tenant_details', tenant_id=tenant_id)
         
     except Exception as e:
         app.logger.error(f"Error exporting tenant data for {tenant_id}: {e}")
@@ -7450,7 +7096,7 @@ def sms_config():
     admin_id = get_admin_id()
     
     # Get admin information
-    admin = mongo.db.admins.find_one({"_id": admin_id})
+    admin = get_current_admin(admin_id)
     
     # Add admin_id to query
     config = mongo.db.sms_config.find_one({"admin_id": admin_id})
@@ -7484,6 +7130,9 @@ def sms_config():
                 config_data["admin_id"] = admin_id
                 mongo.db.sms_config.insert_one(config_data)
 
+            invalidate_matching_index(admin_id)
+            request_context.invalidate('sms_config', admin_id)
+            request_context.invalidate('rate')
             flash('Configuration updated successfully!', 'success')
         except Exception as e:
             flash(f'Error updating configuration: {str(e)}', 'danger')
@@ -7557,6 +7206,12 @@ def save_mpesa_config():
         else:
             mongo.db.mpesa_config.insert_one(encrypted_credentials)
 
+        # New credentials must not be served from the in-process caches
+        invalidate_mpesa_cache(admin_id)
+        invalidate_access_token(consumer_key)
+        if existing_config:
+            invalidate_access_token(decrypt_mpesa_credentials(existing_config).get('consumer_key'))
+
         flash('M-Pesa configuration saved successfully!', 'success')
         app.logger.info(f"M-Pesa config updated for admin {admin_id}")
 
@@ -7583,96 +7238,17 @@ def tenant_portal(token):
         tenant_id = token_data['tenant_id']
         admin_id = token_data['admin_id']
 
-        # Get tenant information with property validation
-        tenant = mongo.db.tenants.find_one({
-            "_id": tenant_id,
-            "admin_id": admin_id
-        })
+        # Tenant, readings with their payment status and the landlord in one cached aggregation
+        view = tenant_statements.statement(mongo.db, tenant_id, admin_id)
 
-        if not tenant:
+        if not view:
             return render_template('error.html',
                                  error_title="Tenant Not Found",
                                  error_message="Tenant record not found."), 404
 
-        # Get tenant's property_id for data separation (if available)
-        property_id = tenant.get('property_id')
-
-        # Get tenant's reading history with property isolation (if property_id exists)
-        # Build query to handle both old readings (without property_id) and new ones (with property_id)
-        if property_id:
-            readings_query = {
-                "$and": [
-                    {"tenant_id": tenant_id},
-                    {"admin_id": admin_id},
-                    {
-                        "$or": [
-                            {"property_id": property_id},
-                            {"property_id": {"$exists": False}}  # Include old readings without property_id
-                        ]
-                    }
-                ]
-            }
-        else:
-            readings_query = {
-                "tenant_id": tenant_id,
-                "admin_id": admin_id
-            }
-
-        readings = list(mongo.db.meter_readings.find(readings_query).sort("date_recorded", -1).limit(12))  # Last 12 readings
-
-        # Get payment information for each reading
-        readings_with_payments = []
-        for reading in readings:
-            # Skip reading if date_recorded is missing or invalid
-            if 'date_recorded' not in reading or reading['date_recorded'] is None:
-                app.logger.warning(f"Skipping reading with missing date_recorded: {reading.get('_id')}")
-                continue
-
-            reading_month = reading['date_recorded'].strftime('%Y-%m')
-
-            # Build payment query with optional property_id
-            if property_id:
-                payment_query = {
-                    '$and': [
-                        {'tenant_id': tenant_id},
-                        {'admin_id': admin_id},
-                        {'month_year': reading_month},
-                        {
-                            '$or': [
-                                {'property_id': property_id},
-                                {'property_id': {'$exists': False}}
-                            ]
-                        }
-                    ]
-                }
-            else:
-                payment_query = {
-                    'tenant_id': tenant_id,
-                    'admin_id': admin_id,
-                    'month_year': reading_month
-                }
-
-            payment = mongo.db.payments.find_one(payment_query)
-
-            # Add payment information to reading
-            reading_data = dict(reading)
-            if payment:
-                amount_paid = payment.get('amount_paid', 0)
-                outstanding = max(0, reading['bill_amount'] - amount_paid)
-                reading_data['payment_status'] = 'Paid' if outstanding == 0 else ('Partial' if amount_paid > 0 else 'Unpaid')
-                reading_data['amount_paid'] = amount_paid
-                reading_data['outstanding'] = outstanding
-                reading_data['payment_date'] = payment.get('payment_date')
-            else:
-                reading_data['payment_status'] = 'Unpaid'
-                reading_data['amount_paid'] = 0
-                reading_data['outstanding'] = reading['bill_amount']
-                reading_data['payment_date'] = None
-
-            readings_with_payments.append(reading_data)
-
-        # Get admin/landlord information
-        admin = mongo.db.admins.find_one({"_id": admin_id}, {"name": 1, "phone": 1})
+        tenant = view['tenant']
+        readings_with_payments = view['readings']
+        admin = view['admin']
 
         return render_template('tenant_portal.html',
                              tenant=tenant,
@@ -7694,7 +7270,7 @@ def tenant_download_history(token):
     """Allow tenant to download their reading history"""
     try:
         # Verify token
-        token_data = verify_tenant_access_token(token)
+        token_data = verify_tenant_access_token(token, use='download')
         if not token_data:
             return render_template('error.html',
                                  error_title="Access Denied",
@@ -7703,159 +7279,28 @@ def tenant_download_history(token):
         tenant_id = token_data['tenant_id']
         admin_id = token_data['admin_id']
 
-        # Get tenant information with property validation
-        tenant = mongo.db.tenants.find_one({
-            "_id": tenant_id,
-            "admin_id": admin_id
-        })
+        tenant = mongo.db.tenants.find_one({"_id": tenant_id, "admin_id": admin_id})
 
         if not tenant:
             return render_template('error.html',
                                  error_title="Tenant Not Found",
                                  error_message="Tenant record not found."), 404
 
-        # Get tenant's property_id for data separation (if available)
-        property_id = tenant.get('property_id')
-
-        # Get tenant's reading history with property isolation (if property_id exists)
-        if property_id:
-            readings_query = {
-                "$and": [
-                    {"tenant_id": tenant_id},
-                    {"admin_id": admin_id},
-                    {
-                        "$or": [
-                            {"property_id": property_id},
-                            {"property_id": {"$exists": False}}
-                        ]
-                    }
-                ]
-            }
-        else:
-            readings_query = {
-                "tenant_id": tenant_id,
-                "admin_id": admin_id
-            }
-
-        readings = list(mongo.db.meter_readings.find(readings_query).sort("date_recorded", 1))
-
-        # Create Excel file in memory
-        output = BytesIO()
-        workbook = xlsxwriter.Workbook(output, {'in_memory': True})
-
-        # Create worksheet
-        worksheet = workbook.add_worksheet(f"My_Reading_History")
-
-        # Define formats
-        header_format = workbook.add_format({
-            'bold': True,
-            'bg_color': '#4472C4',
-            'font_color': 'white',
-            'border': 1,
-            'align': 'center'
-        })
-
-        cell_format = workbook.add_format({
-            'border': 1,
-            'align': 'center'
-        })
-
-        currency_format = workbook.add_format({
-            'border': 1,
-            'align': 'center',
-            'num_format': '"Ksh "#,##0.00'
-        })
-
-        date_format = workbook.add_format({
-            'border': 1,
-            'align': 'center',
-            'num_format': 'yyyy-mm-dd'
-        })
-
-        # Write tenant information
-        worksheet.write('A1', 'My Water Usage History', header_format)
-        worksheet.write('A2', 'Name:', cell_format)
-        worksheet.write('B2', tenant['name'], cell_format)
-        worksheet.write('A3', 'House Number:', cell_format)
-        worksheet.write('B3', tenant['house_number'], cell_format)
-        worksheet.write('A4', 'Generated:', cell_format)
-        worksheet.write('B4', datetime.now().strftime('%Y-%m-%d %H:%M'), cell_format)
-
-        # Write reading history headers
-        headers = ['Date', 'Previous Reading (m³)', 'Current Reading (m³)', 'Usage (m³)', 'Bill Amount', 'Payment Status', 'Amount Paid', 'Outstanding']
-        start_row = 6
-
-        worksheet.write('A6', 'Reading History', header_format)
-        for col, header in enumerate(headers):
-            worksheet.write(start_row + 1, col, header, header_format)
-
-        # Write reading data with payment information
-        for row, reading in enumerate(readings, start_row + 2):
-            # Get payment information for this reading
-            reading_month = reading['date_recorded'].strftime('%Y-%m')
-            payment = mongo.db.payments.find_one({
-                'tenant_id': tenant_id,
-                'admin_id': admin_id,
-                'month_year': reading_month
-            })
-
-            # Determine payment status
-            if payment:
-                amount_paid = payment.get('amount_paid', 0)
-                bill_amount = reading['bill_amount']
-                outstanding = max(0, bill_amount - amount_paid)
-
-                if outstanding == 0:
-                    payment_status = 'Paid'
-                elif amount_paid > 0:
-                    payment_status = 'Partial'
-                else:
-                    payment_status = 'Unpaid'
-            else:
-                payment_status = 'Unpaid'
-                amount_paid = 0
-                outstanding = reading['bill_amount']
-
-            worksheet.write(row, 0, reading['date_recorded'], date_format)
-            worksheet.write(row, 1, reading['previous_reading'], cell_format)
-            worksheet.write(row, 2, reading['current_reading'], cell_format)
-            worksheet.write(row, 3, reading['usage'], cell_format)
-            worksheet.write(row, 4, reading['bill_amount'], currency_format)
-            worksheet.write(row, 5, payment_status, cell_format)
-            worksheet.write(row, 6, amount_paid, currency_format)
-            worksheet.write(row, 7, outstanding, currency_format)
-
-        # Add summary statistics
-        if readings:
-            summary_row = start_row + len(readings) + 3
-            worksheet.write(summary_row, 0, 'Summary Statistics', header_format)
-            worksheet.write(summary_row + 1, 0, 'Total Readings:', cell_format)
-            worksheet.write(summary_row + 1, 1, len(readings), cell_format)
-            worksheet.write(summary_row + 2, 0, 'Total Usage:', cell_format)
-            worksheet.write(summary_row + 2, 1, sum(r['usage'] for r in readings), cell_format)
-            worksheet.write(summary_row + 3, 0, 'Total Billed:', cell_format)
-            worksheet.write(summary_row + 3, 1, sum(r['bill_amount'] for r in readings), currency_format)
-
-        # Auto-adjust column widths
-        worksheet.set_column('A:A', 15)
-        worksheet.set_column('B:D', 12)
-        worksheet.set_column('E:H', 15)
-
-        workbook.close()
-        output.seek(0)
-
-        # Mark token as used (one-time download)
-        mark_token_as_used(token)
-
-        # Return file
-        filename = f"{tenant['name']}_Water_History_{datetime.now().strftime('%Y%m%d')}.xlsx"
-        return send_file(
-            output,
-            as_attachment=True,
-            download_name=filename,
-            mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+        # Full history, oldest first, streamed with its payment status into a constant-memory workbook
+        readings = tenant_statements.history(mongo.db, tenant, admin_id, batch_size=exports.BATCH_SIZE)
+        response = exports.xlsx_export(
+            f"{tenant['name']}_Water_History_{datetime.now().strftime('%Y%m%d')}.xlsx",
+            reports.reading_history_workbook('My_Reading_History', 'My Water Usage History', [
+                ('Name:', tenant['name']),
+                ('House Number:', tenant['house_number']),
+                ('Generated:', datetime.now().strftime('%Y-%m-%d %H:%M'))
+            ], readings)
         )
 
+        # Mark token as used (one-time download); the portal link itself keeps working
+        mark_token_as_used(token, use='download')
+        return response
+
     except Exception as e:
         app.logger.error(f"Tenant download error: {e}")
         return render_template('error.html',
@@ -7875,7 +7320,7 @@ def update_profile():
         return redirect(url_for('login'))
     
     # Get admin to check payment method
-    admin = mongo.db.admins.find_one({"_id": admin_id})
+    admin = get_current_admin(admin_id)
     if not admin:
         flash('Admin not found', 'danger')
         return redirect(url_for('login'))
@@ -7937,6 +7382,8 @@ def update_profile():
             {"_id": admin_id},
             {"$set": update_data}
         )
+        request_context.invalidate()
+        matching_index.invalidate_shortcodes()
         flash('Profile updated successfully!', 'success')
     except Exception as e:
         app.logger.error(f"Error updating profile: {e}")
@@ -7969,7 +7416,7 @@ def change_password():
         return redirect(url_for('sms_config'))
     
     # Verify current password
-    admin = mongo.db.admins.find_one({"_id": admin_id})
+    admin = get_current_admin(admin_id)
     if not admin or not check_password_hash(admin['password'], current_password):
         flash('Current password is incorrect', 'danger')
         return redirect(url_for('sms_config'))
@@ -7983,6 +7430,7 @@ def change_password():
                 "updated_at": datetime.now()
             }}
         )
+        request_context.invalidate('admin', admin_id)
         flash('Password changed successfully!', 'success')
     except Exception as e:
         app.logger.error(f"Error changing password: {e}")
@@ -8130,7 +7578,8 @@ def edit_tenant(tenant_id):
                         "name": name,
                         "phone": formatted_phone,
                         "house_number": house_number,
-                        "house_id": house_id
+                        "house_id": house_id,
+                        "updated_at": datetime.now()
                     }}
                 )
             else:
@@ -8139,7 +7588,8 @@ def edit_tenant(tenant_id):
                     {"_id": tenant_id_obj},
                     {"$set": {
                         "name": name,
-                        "phone": formatted_phone
+                        "phone": formatted_phone,
+                        "updated_at": datetime.now()
                     }}
                 )
                 
@@ -8154,7 +7604,10 @@ def edit_tenant(tenant_id):
                         {"_id": house["_id"]},
                         {"$set": {"current_tenant_name": name}}
                     )
-            
+
+            search_keys.refresh_tenants(mongo.db, admin_id, [tenant_id_obj])
+
+        invalidate_matching_index(admin_id)
         flash('Tenant updated successfully', 'success')
         
     except ValueError as e:
@@ -8200,6 +7653,8 @@ def delete_tenant(tenant_id):
         "admin_id": admin_id,
         "property_id": property_id
     })
+    # Portal links already sent to the tenant stop working
+    portal_tokens.revoke_tenant(mongo.db, tenant_id_obj, reason='tenant_deleted')
 
     # Update house status if house exists
     if house_number:
@@ -8216,6 +7671,7 @@ def delete_tenant(tenant_id):
             }}
         )
     
+    invalidate_matching_index(admin_id)
     flash('Tenant deleted successfully', 'success')
     return redirect(url_for('dashboard'))
 
@@ -8323,7 +7779,7 @@ def import_tenants():
         flash('Session expired. Please login again.', 'danger')
         return redirect(url_for('login'))
     
-    admin = mongo.db.admins.find_one({"_id": admin_id})
+    admin = get_current_admin(admin_id)
     tier = admin.get('subscription_tier', 'free')
     tier_config = SUBSCRIPTION_TIERS.get(tier, SUBSCRIPTION_TIERS['starter'])
     max_tenants = tier_config['max_tenants']
@@ -8545,6 +8001,7 @@ def import_tenants():
                         month_year = datetime.now().strftime('%Y-%m')
                         payment_data = {
                             'admin_id': admin_id,
+                            'property_id': property_id,
                             'tenant_id': tenant_id,
                             'house_id': house_id,
                             'bill_amount': bill_amount,
@@ -8574,6 +8031,8 @@ def import_tenants():
             
             # Batch insert operations
             if tenants_to_insert:
+                for new_tenant in tenants_to_insert:
+                    new_tenant["search_keys"] = search_keys.tenant_keys(new_tenant)
                 mongo.db.tenants.insert_many(tenants_to_insert)
                 
             if houses_to_create:
@@ -8582,11 +8041,20 @@ def import_tenants():
                 
             if readings_to_insert:
                 mongo.db.meter_readings.insert_many(readings_to_insert)
+                rollups.record_readings(mongo.db, readings_to_insert)
+                tenant_statements.bump(reading.get('tenant_id') for reading in readings_to_insert)
+                last_readings.advance_many(mongo.db, [
+                    (reading['house_id'], reading['_id'], reading['current_reading'], reading['date_recorded'], last_readings.ANY_READING)
+                    for reading in readings_to_insert
+                ])
                 
             # Insert payment records if any
             if 'payments_to_insert' in locals() and payments_to_insert:
-                mongo.db.payments.insert_many(payments_to_insert)
+                balances.insert_bills(mongo.db, payments_to_insert)
+                rollups.record_bills(mongo.db, payments_to_insert)
             
+            invalidate_matching_index(admin_id)
+
             # Show results
             if success_count > 0:
                 flash(f'Successfully imported {success_count} tenants', 'success')
@@ -8609,125 +8077,21 @@ def import_tenants():
 @app.route('/export_data', methods=['GET'])
 @login_required
 def export_data():
-    """Generate Excel template with actual data and improved formatting."""
+    """Generate Excel template with actual data, or CSV with ?format=csv, as a background report."""
     try:
-        admin_id = get_admin_id()
+        get_admin_id()
     except ValueError:
         flash('Session expired. Please login again.', 'danger')
         return redirect(url_for('login'))
-    
-    # Get tenant data with readings using aggregation
-    pipeline = [
-        {"$match": {"admin_id": admin_id}},
-        {"$lookup": {
-            "from": "meter_readings",
-            "let": {"tenant_id": "$_id"},
-            "pipeline": [
-                {"$match": {
-                    "$expr": {"$eq": ["$tenant_id", "$$tenant_id"]},
-                    "admin_id": admin_id
-                }},
-                {"$sort": {"date_recorded": 1}}
-            ],
-            "as": "readings"
-        }},
-        {"$sort": {"name": 1}}
-    ]
-    
-    tenants_with_readings = list(mongo.db.tenants.aggregate(pipeline))
-    
-    if not tenants_with_readings:
-        # Create sample data if no tenants exist
-        sample_date = datetime.now()
-        tenant_data = [{
-            'Name': 'Sample Tenant',
-            'Phone': '+254712345678',
-            'Date 1': sample_date.strftime('%Y-%m-%d'),
-            'Reading 1': 0,
-            'Date 2': (sample_date + timedelta(days=30)).strftime('%Y-%m-%d'),
-            'Reading 2': 25
-        }]
-    else:
-        # Process actual tenant data
-        tenant_data = []
-        max_readings = max(len(t['readings']) for t in tenants_with_readings) or 1
-        
-        for tenant in tenants_with_readings:
-            row = {
-                'Name': tenant['name'],
-                'Phone': tenant['phone']
-            }
-            
-            readings = tenant['readings']
-            for i, reading in enumerate(readings, 1):
-                date_str = reading['date_recorded'].strftime('%Y-%m-%d')
-                row[f'Date {i}'] = date_str
-                row[f'Reading {i}'] = reading['current_reading']
-            
-            # Fill empty reading slots
-            if not readings:
-                row['Date 1'] = datetime.now().strftime('%Y-%m-%d')
-                row['Reading 1'] = 0
-            
-            tenant_data.append(row)
-        
-        # Ensure consistent column structure
-        if tenant_data:
-            max_readings = max(
-                len([k for k in row.keys() if k.startswith('Reading')]) 
-                for row in tenant_data
-            )
-    
-    # Create DataFrame with consistent columns
-    all_columns = ['Name', 'Phone']
-    readings_count = max(
-        len([k for k in row.keys() if k.startswith('Reading')]) 
-        for row in tenant_data
-    ) if tenant_data else 2
-    
-    for i in range(1, readings_count + 1):
-        all_columns.extend([f'Date {i}', f'Reading {i}'])
-    
-    df = pd.DataFrame(tenant_data)
-    
-    # Add missing columns
-    for col in all_columns:
-        if col not in df.columns:
-            df[col] = None
-    
-    df = df[all_columns]
-    
-    # Create Excel file with formatting
-    output = BytesIO()
-    with pd.ExcelWriter(output, engine='openpyxl') as writer:
-        df.to_excel(writer, index=False, sheet_name='Water Readings')
-        
-        # Get worksheet for formatting
-        worksheet = writer.sheets['Water Readings']
-        
-        # Auto-adjust column widths
-        for column in worksheet.columns:
-            max_length = 0
-            column_letter = column[0].column_letter
-            
-            for cell in column:
-                try:
-                    if len(str(cell.value)) > max_length:
-                        max_length = len(str(cell.value))
-                except:
-                    pass
-            
-            adjusted_width = min(max_length + 2, 50)
-            worksheet.column_dimensions[column_letter].width = adjusted_width
-    
-    output.seek(0)
-    
-    return send_file(
-        output,
-        as_attachment=True,
-        download_name=f'water_billing_template_{datetime.now().strftime("%Y%m%d")}.xlsx',
-        mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
-    )
+
+    try:
+        export_format = 'csv' if request.args.get('format') == 'csv' else 'xlsx'
+        filename = f'water_billing_template_{datetime.now().strftime("%Y%m%d")}.{export_format}'
+        return start_report('readings_export', {'format': export_format}, filename, 'dashboard')
+    except Exception as e:
+        app.logger.error(f"Error exporting data: {e}")
+        flash('Error generating export file. Please try again.', 'danger')
+        return redirect(url_for('dashboard'))
 
 @app.route('/bulk_import_readings_excel', methods=['POST'])
 @login_required
@@ -8775,41 +8139,30 @@ def bulk_import_readings_excel():
             'sms_failed': 0
         }
 
-        # Process each row
+        # Parse each row, then process the whole file as one batch
+        parsed_rows = []
         for index, row in df.iterrows():
+            label = f"Row {index + 2}"
             try:
                 house_number = str(row['house_number']).strip().upper()
                 current_reading = float(row['current_reading'])
 
                 if pd.isna(current_reading) or current_reading < 0:
-                    results['errors'].append(f"Row {index + 2}: Invalid reading value")
+                    parsed_rows.append((label, None, None, "Invalid reading value"))
                     continue
 
-                # Process the reading
-                result = process_bulk_reading(admin_id, house_number, current_reading, send_sms)
-                if result['success']:
-                    results['processed'] += 1
-                    if result.get('warning'):
-                        results['warnings'].append(f"Row {index + 2}: {result['warning']}")
-
-                    # Track SMS status
-                    if send_sms:
-                        sms_status = result.get('sms_status', 'not_sent')
-                        if sms_status == 'sent':
-                            results['sms_sent'] += 1
-                        elif 'failed' in sms_status or 'error' in sms_status:
-                            results['sms_failed'] += 1
-                else:
-                    results['errors'].append(f"Row {index + 2}: {result['error']}")
+                parsed_rows.append((label, house_number, current_reading, None))
 
             except Exception as e:
-                results['errors'].append(f"Row {index + 2}: {str(e)}")
+                parsed_rows.append((label, None, None, str(e)))
+
+        tally_bulk_reading_rows(admin_id, parsed_rows, results, send_sms)
 
         # Flash results
         if results['processed'] > 0:
             success_msg = f'Successfully processed {results["processed"]} out of {results["total"]} readings'
             if send_sms:
-                success_msg += f'. SMS sent: {results["sms_sent"]}, Failed: {results["sms_failed"]}'
+                success_msg += f'. SMS queued: {results["sms_sent"]}, Failed: {results["sms_failed"]}'
             flash(success_msg, 'success')
 
         if results['warnings']:
@@ -8871,49 +8224,38 @@ def bulk_import_readings_text():
             'sms_failed': 0
         }
 
-        # Process each line
+        # Parse each line, then process the whole file as one batch
+        parsed_rows = []
         for line_num, line in enumerate(lines, 1):
+            label = f"Line {line_num}"
             try:
                 # Parse line format: "house_number reading"
                 parts = line.split()
                 if len(parts) != 2:
-                    results['errors'].append(f"Line {line_num}: Invalid format. Expected 'house_number reading'")
+                    parsed_rows.append((label, None, None, "Invalid format. Expected 'house_number reading'"))
                     continue
 
                 house_number = parts[0].strip().upper()
                 current_reading = float(parts[1])
 
                 if current_reading < 0:
-                    results['errors'].append(f"Line {line_num}: Reading cannot be negative")
+                    parsed_rows.append((label, None, None, "Reading cannot be negative"))
                     continue
 
-                # Process the reading
-                result = process_bulk_reading(admin_id, house_number, current_reading, send_sms)
-                if result['success']:
-                    results['processed'] += 1
-                    if result.get('warning'):
-                        results['warnings'].append(f"Line {line_num}: {result['warning']}")
-
-                    # Track SMS status
-                    if send_sms:
-                        sms_status = result.get('sms_status', 'not_sent')
-                        if sms_status == 'sent':
-                            results['sms_sent'] += 1
-                        elif 'failed' in sms_status or 'error' in sms_status:
-                            results['sms_failed'] += 1
-                else:
-                    results['errors'].append(f"Line {line_num}: {result['error']}")
+                parsed_rows.append((label, house_number, current_reading, None))
 
             except ValueError:
-                results['errors'].append(f"Line {line_num}: Invalid reading value")
+                parsed_rows.append((label, None, None, "Invalid reading value"))
             except Exception as e:
-                results['errors'].append(f"Line {line_num}: {str(e)}")
+                parsed_rows.append((label, None, None, str(e)))
+
+        tally_bulk_reading_rows(admin_id, parsed_rows, results, send_sms)
 
         # Flash results
         if results['processed'] > 0:
             success_msg = f'Successfully processed {results["processed"]} out of {results["total"]} readings'
             if send_sms:
-                success_msg += f'. SMS sent: {results["sms_sent"]}, Failed: {results["sms_failed"]}'
+                success_msg += f'. SMS queued: {results["sms_sent"]}, Failed: {results["sms_failed"]}'
             flash(success_msg, 'success')
 
         if results['warnings']:
@@ -8934,62 +8276,187 @@ def bulk_import_readings_text():
 
     return redirect(url_for('dashboard'))
 
-def process_bulk_reading(admin_id, house_number, current_reading, send_sms=True):
-    """Process a single bulk reading entry"""
+def get_last_house_readings(house_numbers, admin_id, property_id=None):
+    """Get the last current_reading for many house numbers in one aggregation, keyed by house number."""
+    if not house_numbers:
+        return {}
+
+    match = {"house_number": {"$in": list(house_numbers)}, "admin_id": admin_id}
+
+    # Same property isolation as get_last_house_reading
+    if property_id:
+        match["property_id"] = property_id
+    else:
+        current_property_id = get_current_property_id()
+        if current_property_id:
+            match["property_id"] = current_property_id
+
+    latest = mongo.db.meter_readings.aggregate([
+        {"$match": match},
+        {"$sort": {"date_recorded": -1}},
+        {"$group": {"_id": "$house_number", "current_reading": {"$first": "$current_reading"}}}
+    ])
+
+    return {doc['_id']: doc.get('current_reading') for doc in latest}
+
+def get_rates_per_unit(admin_id, property_ids):
+    """Resolve get_rate_per_unit for several properties with one properties query, keyed by property_id."""
+    property_ids = set(property_ids)
+    object_ids = []
+    for property_id in property_ids:
+        if property_id:
+            object_ids.append(ObjectId(property_id))
+
+    property_docs = {}
+    if object_ids:
+        for property_doc in mongo.db.properties.find({"_id": {"$in": object_ids}, "admin_id": admin_id}, {"settings": 1}):
+            property_docs[property_doc['_id']] = property_doc
+
+    fallback_rate = None
+    rates = {}
+    for property_id in property_ids:
+        rate = None
+        if property_id:
+            property_doc = property_docs.get(ObjectId(property_id))
+            if property_doc and 'settings' in property_doc:
+                rate = property_doc['settings'].get('water_rate_per_unit', RATE_PER_UNIT)
+            else:
+                rate = RATE_PER_UNIT
+
+        if not rate:
+            # Only look up the admin-level rate when some property has none
+            if fallback_rate is None:
+                fallback_rate = get_rate_per_unit(admin_id)
+            rate = fallback_rate
+
+        rates[property_id] = rate
+
+    return rates
+
+def calculate_total_arrears_bulk(admin_id, tenant_ids, bill_type=None, exclude_current_month=None):
+    """Calculate total arrears for many tenants in one ledger query, keyed by tenant_id"""
     try:
-        # Find tenant by house number
-        tenant = mongo.db.tenants.find_one({
-            "house_number": house_number,
-            "admin_id": admin_id
-        })
+        if not tenant_ids:
+            return {}
 
-        if not tenant:
-            return {
-                'success': False,
-                'error': f'No tenant found for house number {house_number}'
-            }
+        return balances.arrears_many(
+            mongo.db, ObjectId(admin_id), [ObjectId(tenant_id) for tenant_id in tenant_ids],
+            bill_type, exclude_current_month
+        )
 
-        tenant_id = tenant['_id']
+    except Exception as e:
+        app.logger.error(f"Error calculating bulk arrears: {str(e)}")
+        return {}
 
-        # Get the house document to retrieve house_id
-        house = mongo.db.houses.find_one({"house_number": house_number, "admin_id": admin_id})
-        house_id = house.get('_id') if house else None
+def process_bulk_readings(admin_id, entries, send_sms=True):
+    """Process a batch of (house_number, current_reading) entries with set-based reads and writes.
+
+    Returns one result dict per entry, in order, shaped like process_bulk_reading's.
+    """
+    if not entries:
+        return []
 
-        # Get the latest reading for this house number
-        latest_house_reading = get_last_house_reading(house_number, admin_id)
+    batch = pd.DataFrame(entries, columns=['house_number', 'current_reading'])
+    batch['current_reading'] = batch['current_reading'].astype(float)
+    house_numbers = batch['house_number'].unique().tolist()
 
-        # Determine previous reading
-        if latest_house_reading:
-            previous_reading = latest_house_reading.get('current_reading', 0)
-            # Check if reading is decreasing
-            if current_reading < previous_reading:
-                return {
-                    'success': False,
-                    'error': f'Current reading ({current_reading}) is less than previous reading ({previous_reading})'
-                }
-        else:
-            previous_reading = 0
+    try:
+        # Prefetch everything the batch needs in a handful of queries
+        tenants = {}
+        for tenant in mongo.db.tenants.find({"house_number": {"$in": house_numbers}, "admin_id": admin_id}):
+            tenants.setdefault(tenant['house_number'], tenant)
 
-        # Calculate usage and bill using property-specific rate
-        usage = max(0, current_reading - previous_reading)
-        # Get property_id from tenant record
-        property_id = tenant.get('property_id')
-        rate_per_unit = get_rate_per_unit(admin_id, property_id)
-        bill_amount = usage * rate_per_unit
+        houses = {}
+        for house in mongo.db.houses.find({"house_number": {"$in": house_numbers}, "admin_id": admin_id}, {"house_number": 1, "last_reading": 1}):
+            houses.setdefault(house['house_number'], house)
+        house_ids = {house_number: house['_id'] for house_number, house in houses.items()}
+
+        # Previous readings come from the house pointers; only houses without one hit meter_readings
+        latest_readings = {
+            house_number: house['last_reading'].get('value')
+            for house_number, house in houses.items() if house.get('last_reading')
+        }
+        unindexed = [house_number for house_number in house_numbers if house_number not in latest_readings]
+        if unindexed:
+            latest_readings.update(get_last_house_readings(unindexed, admin_id))
+        rates = get_rates_per_unit(admin_id, [tenant.get('property_id') for tenant in tenants.values()])
+    except Exception as e:
+        app.logger.error(f"Error prefetching bulk readings for admin {admin_id}: {e}")
+        return [{'success': False, 'error': str(e)} for _ in entries]
+
+    # Vectorized usage and bill computation for the whole batch
+    batch['has_tenant'] = batch['house_number'].isin(list(tenants))
+    batch['has_previous'] = batch['house_number'].isin(list(latest_readings))
+    # Stored readings are kept as-is for documents and messages; the float copy drives the maths
+    batch['previous_stored'] = pd.Series(
+        [latest_readings.get(house_number) or 0 for house_number in batch['house_number']],
+        index=batch.index, dtype=object
+    )
+    batch['previous_reading'] = batch['previous_stored'].astype(float)
+    batch['rejected'] = batch['has_previous'] & (batch['current_reading'] < batch['previous_reading'])
+
+    # A house listed more than once chains off its own earlier accepted row
+    repeated = batch['house_number'].duplicated(keep=False) & batch['has_tenant']
+    if repeated.any():
+        chained = {house_number: reading or 0 for house_number, reading in latest_readings.items()}
+        for index in batch.index[repeated]:
+            house_number = batch.at[index, 'house_number']
+            current_reading = batch.at[index, 'current_reading']
+            previous_stored = chained.get(house_number, 0)
+            rejected = house_number in chained and current_reading < previous_stored
+            batch.at[index, 'previous_stored'] = previous_stored
+            batch.at[index, 'previous_reading'] = float(previous_stored)
+            batch.at[index, 'rejected'] = rejected
+            if not rejected:
+                chained[house_number] = current_reading
+
+    batch['rate'] = [
+        rates.get(tenants[house_number].get('property_id'), 0) if house_number in tenants else 0
+        for house_number in batch['house_number']
+    ]
+    batch['usage'] = np.maximum(0, batch['current_reading'].to_numpy() - batch['previous_reading'].to_numpy())
+    batch['bill_amount'] = batch['usage'].to_numpy() * batch['rate'].to_numpy()
+
+    results = [None] * len(batch)
+    readings_to_insert = []
+    payments_to_insert = []
+    accepted = []
+
+    reading_date = datetime.now()
+    month_year = reading_date.strftime('%Y-%m')
+
+    for position, row in enumerate(batch.itertuples(index=False)):
+        if not row.has_tenant:
+            results[position] = {
+                'success': False,
+                'error': f'No tenant found for house number {row.house_number}'
+            }
+            continue
+
+        if row.rejected:
+            results[position] = {
+                'success': False,
+                'error': f'Current reading ({row.current_reading}) is less than previous reading ({row.previous_stored})'
+            }
+            continue
+
+        tenant = tenants[row.house_number]
+        house_id = house_ids.get(row.house_number)
+        reading_id = ObjectId()
 
-        # Create reading record
-        reading_date = datetime.now()
         reading_data = {
-            "tenant_id": tenant_id,
-            "house_number": house_number,
-            "previous_reading": previous_reading,
-            "current_reading": current_reading,
-            "usage": usage,
-            "bill_amount": bill_amount,
+            "_id": reading_id,
+            "tenant_id": tenant['_id'],
+            "house_number": row.house_number,
+            "previous_reading": row.previous_stored,
+            "current_reading": float(row.current_reading),
+            "usage": float(row.usage),
+            "bill_amount": float(row.bill_amount),
             "date_recorded": reading_date,
             "admin_id": admin_id,
+            "property_id": tenant.get('property_id'),
             "tenant_name": tenant['name'],
-            "current_tenant_id": tenant_id,
+            "current_tenant_id": tenant['_id'],
             "reading_type": "bulk_import",
             "source_collection": "meter_readings"
         }
@@ -8997,168 +8464,248 @@ def process_bulk_reading(admin_id, house_number, current_reading, send_sms=True)
         if house_id:
             reading_data["house_id"] = house_id
 
-        # Insert reading
-        result = mongo.db.meter_readings.insert_one(reading_data)
-        reading_id = result.inserted_id
-
-        # Create payment record
-        month_year = reading_date.strftime('%Y-%m')
-        create_payment_record(admin_id, tenant_id, house_id, bill_amount, reading_id, month_year, 'water')
-
-        warning_msg = None
-        if usage == 0:
-            warning_msg = f'No usage recorded for {house_number} (same reading as previous)'
-
-        # Send SMS notification if enabled
-        sms_status = 'not_sent'
         if send_sms and tenant.get('phone'):
-            try:
-                # Get admin info for SMS
-                admin = mongo.db.admins.find_one({"_id": admin_id})
-                admin_name = admin.get('name', 'Your Landlord') if admin else 'Your Landlord'
-                admin_phone = admin.get('phone', '') if admin else ''
-
-                # Get payment info
-                payment_method = admin.get('payment_method', 'till') if admin else 'till'
-                if payment_method == 'till':
-                    till = admin.get('till', '') if admin else ''
-                    payment_info = f"Pay via Till: {till}" if till else "Contact landlord for payment details"
-                elif payment_method == 'paybill':
-                    business_number = admin.get('business_number', '') if admin else ''
-                    account_name = admin.get('account_name', house_number) if admin else house_number
-                    payment_info = f"Pay via Paybill: {business_number}, Account: {account_name}" if business_number else "Contact landlord for payment details"
-                else:
-                    payment_info = "Contact landlord for payment details"
-
-                # Calculate arrears excluding current month's bill
-                current_month_year = get_current_month_year()
-                total_arrears = calculate_total_arrears(admin_id, tenant_id, bill_type='water', exclude_current_month=current_month_year)
-
-                # Generate secure access token for tenant portal
-                access_token = generate_tenant_access_token(tenant_id, admin_id, expires_in_hours=24)
-                long_portal_link = f"https://{request.host}/tenant_portal/{access_token}"
-                portal_link = shorten_url(long_portal_link, f"tenant_{tenant_id}_{datetime.now().strftime('%Y%m')}")
-
-                # Create message based on arrears
-                if total_arrears > 1:
-                    message = (
-                        f"Water Bill Alert: {tenant['name']}, House {house_number}. "
-                        f"Current bill: KES {bill_amount:.2f}. "
-                        f"Outstanding arrears: KES {total_arrears:.2f}. "
-                        f"{payment_info} "
-                        f"View your usage history: {portal_link} "
-                        f"From {admin_name} - {admin_phone}"
-                    )
-                else:
-                    message = (
-                        f"Water Bill Alert: {tenant['name']}, House {house_number}. "
-                        f"Current bill: KES {bill_amount:.2f}. "
-                        f"{payment_info} "
-                        f"View history: {portal_link} "
-                        f"From {admin_name} - {admin_phone}"
-                    )
+            reading_data["sms_status"] = "pending"
+
+        readings_to_insert.append(reading_data)
+        payments_to_insert.append(build_payment_record(
+            admin_id, tenant['_id'], house_id, row.bill_amount, reading_id, month_year, 'water', tenant.get('property_id')
+        ))
+        accepted.append((position, tenant, row, reading_id))
+
+    if not accepted:
+        return results
+
+    # Claim each house's meter pointer for its last accepted row before writing anything
+    claims = {}
+    previous_pointers = {}
+    for reading_data in readings_to_insert:
+        house_id = reading_data.get('house_id')
+        if house_id:
+            previous_pointers[house_id] = houses[reading_data['house_number']].get('last_reading')
+            expected = (previous_pointers[house_id] or {}).get('reading_id')
+            claims[house_id] = (house_id, reading_data['_id'], reading_data['current_reading'], reading_date, expected)
 
-                # Send SMS
-                response = send_message(tenant['phone'], message)
+    try:
+        claimed = last_readings.advance_many(mongo.db, list(claims.values()))
+    except Exception as e:
+        app.logger.error(f"Error claiming meters for bulk readings for admin {admin_id}: {e}")
+        for position, _, _, _ in accepted:
+            results[position] = {'success': False, 'error': str(e)}
+        return results
+
+    if len(claimed) < len(claims):
+        kept = []
+        for item, reading_data, payment_data in zip(accepted, readings_to_insert, payments_to_insert):
+            house_id = reading_data.get('house_id')
+            if house_id and house_id not in claimed:
+                results[item[0]] = {
+                    'success': False,
+                    'error': f'A newer reading was recorded for house {reading_data["house_number"]} while this upload was processing'
+                }
+            else:
+                kept.append((item, reading_data, payment_data))
+        accepted = [item for item, _, _ in kept]
+        readings_to_insert = [reading_data for _, reading_data, _ in kept]
+        payments_to_insert = [payment_data for _, _, payment_data in kept]
+        if not accepted:
+            return results
 
-                if "error" in response:
-                    sms_status = f"failed: {response['error']}"
-                    warning_msg = f"{warning_msg}, SMS failed" if warning_msg else "SMS sending failed"
-                else:
-                    sms_status = "sent"
+    def write(session):
+        mongo.db.meter_readings.insert_many(readings_to_insert, session=session)
+        balances.insert_bills(mongo.db, payments_to_insert, session=session)
 
-                # Update reading with SMS status
-                mongo.db.meter_readings.update_one(
-                    {"_id": reading_id},
-                    {"$set": {"sms_status": sms_status}}
-                )
+    # Readings and their bills are stored together or not at all, so a retried upload never duplicates readings
+    try:
+        balances.run_in_transaction(mongo.db, write)
+    except Exception as e:
+        app.logger.error(f"Error writing bulk readings for admin {admin_id}: {e}")
+        # Nothing to undo after an aborted transaction; on a standalone server remove what did get written
+        reading_ids = [reading_data['_id'] for reading_data in readings_to_insert]
+        try:
+            mongo.db.payments.delete_many({"reading_id": {"$in": reading_ids}, "admin_id": admin_id})
+            mongo.db.meter_readings.delete_many({"_id": {"$in": reading_ids}})
+        except Exception as cleanup_error:
+            app.logger.error(f"Error removing partially written bulk readings for admin {admin_id}: {cleanup_error}")
+        for house_id in claimed:
+            last_readings.release(mongo.db, house_id, claims[house_id][1], previous_pointers[house_id])
+        for position, _, _, _ in accepted:
+            results[position] = {'success': False, 'error': str(e)}
+        return results
+
+    try:
+        rollups.record_readings(mongo.db, readings_to_insert)
+        rollups.record_bills(mongo.db, payments_to_insert)
+    except Exception as e:
+        # The readings are stored; rollups are derived and `python rollups.py` rebuilds them
+        app.logger.error(f"Error updating rollups for bulk readings of admin {admin_id}: {e}")
+    tenant_statements.bump(reading.get('tenant_id') for reading in readings_to_insert)
+    cache.delete_memoized(get_billing_summary, admin_id)
 
-            except Exception as sms_error:
-                sms_status = f"error: {str(sms_error)}"
-                warning_msg = f"{warning_msg}, SMS error" if warning_msg else "SMS sending error"
-                app.logger.error(f"SMS error for bulk reading {house_number}: {sms_error}")
+    for position, tenant, row, reading_id in accepted:
+        warning_msg = None
+        if row.usage == 0:
+            warning_msg = f'No usage recorded for {row.house_number} (same reading as previous)'
 
-        return {
+        results[position] = {
             'success': True,
             'reading_id': reading_id,
-            'usage': usage,
-            'bill_amount': bill_amount,
+            'usage': float(row.usage),
+            'bill_amount': float(row.bill_amount),
             'warning': warning_msg,
-            'sms_status': sms_status
+            'sms_status': 'not_sent'
         }
 
-    except Exception as e:
-        app.logger.error(f"Error processing bulk reading for {house_number}: {e}")
-        return {
-            'success': False,
-            'error': str(e)
-        }
+    if send_sms:
+        send_bulk_reading_notifications(admin_id, accepted, results)
+
+    return results
+
+def send_bulk_reading_notifications(admin_id, accepted, results):
+    """Queue bill SMS for accepted bulk readings in one outbox write and record each sms_status"""
+    notify = [item for item in accepted if item[1].get('phone')]
+    if not notify:
+        return
 
-@app.route('/download_bulk_readings_template')
-@login_required
-def download_bulk_readings_template():
-    """Download Excel template for bulk readings import"""
     try:
-        # Create a BytesIO object
-        output = BytesIO()
+        admin = get_current_admin(admin_id)
+        admin_name = admin.get('name', 'Your Landlord') if admin else 'Your Landlord'
+        admin_phone = admin.get('phone', '') if admin else ''
+        payment_method = admin.get('payment_method', 'till') if admin else 'till'
 
-        # Create workbook and worksheet
-        workbook = xlsxwriter.Workbook(output, {'in_memory': True})
-        worksheet = workbook.add_worksheet('Bulk Readings Template')
+        # Arrears excluding current month's bill, for every notified tenant at once
+        current_month_year = get_current_month_year()
+        arrears = calculate_total_arrears_bulk(
+            admin_id, [tenant['_id'] for _, tenant, _, _ in notify],
+            bill_type='water', exclude_current_month=current_month_year
+        )
+    except Exception as e:
+        app.logger.error(f"SMS setup error for bulk readings: {e}")
+        for position, _, _, _ in notify:
+            result = results[position]
+            result['sms_status'] = f"error: {str(e)}"
+            result['warning'] = f"{result['warning']}, SMS error" if result['warning'] else "SMS sending error"
+        mongo.db.meter_readings.update_many(
+            {"_id": {"$in": [reading_id for _, _, _, reading_id in notify]}},
+            {"$set": {"sms_status": f"error: {str(e)}"}}
+        )
+        return
 
-        # Create formats
-        header_format = workbook.add_format({
-            'bold': True,
-            'bg_color': '#D7E4BC',
-            'border': 1,
-            'text_wrap': True,
-            'valign': 'top'
-        })
+    outbox_docs = []
+    queued_positions = []
+    for position, tenant, row, reading_id in notify:
+        result = results[position]
+        house_number = row.house_number
+        tenant_id = tenant['_id']
+        bill_amount = float(row.bill_amount)
 
-        cell_format = workbook.add_format({
-            'border': 1,
-            'text_wrap': True,
-            'valign': 'top'
-        })
+        try:
+            if payment_method == 'till':
+                till = admin.get('till', '') if admin else ''
+                payment_info = f"Pay via Till: {till}" if till else "Contact landlord for payment details"
+            elif payment_method == 'paybill':
+                business_number = admin.get('business_number', '') if admin else ''
+                account_name = admin.get('account_name', house_number) if admin else house_number
+                payment_info = f"Pay via Paybill: {business_number}, Account: {account_name}" if business_number else "Contact landlord for payment details"
+            else:
+                payment_info = "Contact landlord for payment details"
 
-        # Write headers
-        headers = ['house_number', 'current_reading']
-        for col, header in enumerate(headers):
-            worksheet.write(0, col, header, header_format)
-
-        # Write sample data
-        sample_data = [
-            ['A08', 30],
-            ['B12', 45.5],
-            ['C05', 25],
-            ['D14', 38]
-        ]
+            total_arrears = arrears.get(tenant_id, 0.0)
 
-        for row, data in enumerate(sample_data, 1):
-            for col, value in enumerate(data):
-                worksheet.write(row, col, value, cell_format)
+            # Generate secure access token for tenant portal
+            access_token = generate_tenant_access_token(tenant_id, admin_id, expires_in_hours=24)
+            long_portal_link = f"https://{request.host}/tenant_portal/{access_token}"
+            portal_link = shorten_url(long_portal_link, f"tenant_{tenant_id}_{datetime.now().strftime('%Y%m')}")
 
-        # Set column widths
-        worksheet.set_column('A:A', 15)
-        worksheet.set_column('B:B', 18)
+            if total_arrears > 1:
+                message = (
+                    f"Water Bill Alert: {tenant['name']}, House {house_number}. "
+                    f"Current bill: KES {bill_amount:.2f}. "
+                    f"Outstanding arrears: KES {total_arrears:.2f}. "
+                    f"{payment_info} "
+                    f"View your usage history: {portal_link} "
+                    f"From {admin_name} - {admin_phone}"
+                )
+            else:
+                message = (
+                    f"Water Bill Alert: {tenant['name']}, House {house_number}. "
+                    f"Current bill: KES {bill_amount:.2f}. "
+                    f"{payment_info} "
+                    f"View history: {portal_link} "
+                    f"From {admin_name} - {admin_phone}"
+                )
+
+            outbox_docs.append(build_outbox_message(tenant['phone'], message, writeback=sms_writeback(
+                'meter_readings', {"_id": reading_id}, status_field='sms_status'
+            )))
+            queued_positions.append((position, reading_id))
 
-        # Add instructions
-        worksheet.write('A7', 'Instructions:', header_format)
-        worksheet.write('A8', '1. Fill in house_number column with exact house numbers', cell_format)
-        worksheet.write('A9', '2. Fill in current_reading column with meter readings', cell_format)
-        worksheet.write('A10', '3. Save the file and upload through the dashboard', cell_format)
-        worksheet.write('A11', '4. System will calculate usage automatically', cell_format)
+        except Exception as sms_error:
+            result['sms_status'] = f"error: {str(sms_error)}"
+            result['warning'] = f"{result['warning']}, SMS error" if result['warning'] else "SMS sending error"
+            app.logger.error(f"SMS error for bulk reading {house_number}: {sms_error}")
+            mongo.db.meter_readings.update_one({"_id": reading_id}, {"$set": {"sms_status": result['sms_status']}})
 
-        workbook.close()
-        output.seek(0)
+    if not outbox_docs:
+        return
 
-        return send_file(
-            output,
-            as_attachment=True,
-            download_name='bulk_readings_template.xlsx',
-            mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+    try:
+        enqueue_sms_many(mongo.db, outbox_docs)
+        sms_status = "queued"
+    except Exception as e:
+        app.logger.error(f"Error queueing bulk reading SMS: {e}")
+        sms_status = f"failed: {str(e)}"
+        mongo.db.meter_readings.update_many(
+            {"_id": {"$in": [reading_id for _, reading_id in queued_positions]}},
+            {"$set": {"sms_status": sms_status}}
         )
 
+    for position, _ in queued_positions:
+        result = results[position]
+        result['sms_status'] = sms_status
+        if sms_status != "queued":
+            result['warning'] = f"{result['warning']}, SMS failed" if result['warning'] else "SMS sending failed"
+
+def process_bulk_reading(admin_id, house_number, current_reading, send_sms=True):
+    """Process a single bulk reading entry"""
+    return process_bulk_readings(admin_id, [(house_number, current_reading)], send_sms)[0]
+
+def tally_bulk_reading_rows(admin_id, parsed_rows, results, send_sms):
+    """Run parsed upload rows through the batch engine and tally outcomes in file order.
+
+    parsed_rows holds (label, house_number, current_reading, error) tuples; rows with an
+    error were rejected while parsing and never reach the engine.
+    """
+    entries = [(house_number, current_reading) for _, house_number, current_reading, error in parsed_rows if error is None]
+    batch_results = iter(process_bulk_readings(admin_id, entries, send_sms))
+
+    for label, _, _, error in parsed_rows:
+        if error is not None:
+            results['errors'].append(f"{label}: {error}")
+            continue
+
+        result = next(batch_results)
+        if result['success']:
+            results['processed'] += 1
+            if result.get('warning'):
+                results['warnings'].append(f"{label}: {result['warning']}")
+
+            # Track SMS status
+            if send_sms:
+                sms_status = result.get('sms_status', 'not_sent')
+                if sms_status in ('sent', 'queued'):
+                    results['sms_sent'] += 1
+                elif 'failed' in sms_status or 'error' in sms_status:
+                    results['sms_failed'] += 1
+        else:
+            results['errors'].append(f"{label}: {result['error']}")
+
+@app.route('/download_bulk_readings_template')
+@login_required
+def download_bulk_readings_template():
+    """Download Excel template for bulk readings import"""
+    try:
+        return start_report('bulk_readings_template', {}, 'bulk_readings_template.xlsx', 'water_utility')
     except Exception as e:
         app.logger.error(f"Error generating bulk readings template: {e}")
         flash('Error generating template file', 'danger')
@@ -9215,146 +8762,103 @@ def download_tenant_template():
         mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
     )
 
-@app.route('/generate_analytics_report')
-@login_required
-def generate_analytics_report():
-    """Generate comprehensive analytics report."""
-    try:
-        admin_id = get_admin_id()
-
-        # Create Excel workbook
-        output = BytesIO()
-        workbook = xlsxwriter.Workbook(output, {'in_memory': True})
-
-        # Create header format
-        header_format = workbook.add_format({
-            'bold': True,
-            'font_color': 'white',
-            'bg_color': '#4472C4',
-            'border': 1
-        })
-
-        # Create data format
-        data_format = workbook.add_format({
-            'border': 1,
-            'align': 'center'
-        })
-
-        # Create currency format
-        currency_format = workbook.add_format({
-            'num_format': 'KES #,##0.00',
-            'border': 1,
-            'align': 'right'
-        })
-
-        # Summary Sheet
-        summary_sheet = workbook.add_worksheet('Analytics Summary')
-        analytics_data = calculate_dashboard_analytics(admin_id)
-
-        summary_sheet.write(0, 0, 'Analytics Summary Report', workbook.add_format({'bold': True, 'font_size': 16}))
-        summary_sheet.write(1, 0, f"Generated on: {datetime.now().strftime('%Y-%m-%d %H:%M')}")
-
-        summary_sheet.write(3, 0, 'Metric', header_format)
-        summary_sheet.write(3, 1, 'Value', header_format)
+def report_job_payload(job):
+    """JSON view of a report job"""
+    payload = {
+        'job_id': str(job['_id']),
+        'report_type': job['report_type'],
+        'status': job['status'],
+        'filename': job['filename'],
+        'size': job.get('size'),
+        'duration_ms': job.get('duration_ms'),
+        'error': job.get('error'),
+        'created_at': job['created_at'].isoformat() if job.get('created_at') else None,
+        'completed_at': job['completed_at'].isoformat() if job.get('completed_at') else None,
+        'status_url': url_for('report_job_status', job_id=str(job['_id'])),
+        'download_url': None
+    }
+    if job['status'] == 'completed':
+        payload['download_url'] = url_for('download_report', job_id=str(job['_id']))
+    return payload
 
-        summary_sheet.write(4, 0, 'Monthly Consumption (m³)', data_format)
-        summary_sheet.write(4, 1, analytics_data['monthly_consumption'], data_format)
+def start_report(report_type, params, filename, return_endpoint, **return_args):
+    """Queue a report job for the current admin and property.
 
-        summary_sheet.write(5, 0, 'Total Revenue (KES)', data_format)
-        summary_sheet.write(5, 1, analytics_data['total_revenue'], currency_format)
+    JSON clients get the job id back at once; a finished report already in
+    the cache is downloaded straight away; otherwise the browser waits on a
+    page that polls the job and downloads the file when it is ready.
+    """
+    admin_id = get_admin_id()
+    job = report_jobs.enqueue(mongo.db, report_type, admin_id, get_current_property_id(), params, filename)
+    payload = report_job_payload(job)
 
-        summary_sheet.write(6, 0, 'Average Usage per Tenant (m³)', data_format)
-        summary_sheet.write(6, 1, analytics_data['avg_usage'], data_format)
+    if request.accept_mimetypes.best == 'application/json' or request.headers.get('X-Requested-With') == 'XMLHttpRequest':
+        return jsonify(payload), 200 if job['status'] == 'completed' else 202
+    if job['status'] == 'completed':
+        return redirect(payload['download_url'])
+    return render_template('report_job.html', job=payload, back_url=url_for(return_endpoint, **return_args))
 
-        tenant_count = mongo.db.tenants.count_documents({"admin_id": admin_id})
-        summary_sheet.write(7, 0, 'Total Tenants', data_format)
-        summary_sheet.write(7, 1, tenant_count, data_format)
+@app.route('/reports/<job_id>', methods=['GET'])
+@login_required
+def report_job_status(job_id):
+    """Report the progress of a report job; unchanged progress is answered with 304"""
+    try:
+        admin_id = get_admin_id()
+        job = mongo.db.report_jobs.find_one({"_id": ObjectId(job_id), "admin_id": admin_id}, {"active_key": 0})
+        if not job:
+            return jsonify({'error': 'Report not found'}), 404
 
-        # Monthly Trends Sheet
-        trends_sheet = workbook.add_worksheet('Monthly Trends')
+        response = jsonify(report_job_payload(job))
+        response.set_etag(f"{job['_id']}-{job['status']}-{job['updated_at'].timestamp()}")
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+        return response.make_conditional(request)
 
-        # Get monthly data for the past 12 months
-        twelve_months_ago = datetime.now() - timedelta(days=365)
-        monthly_trends = list(mongo.db.meter_readings.aggregate([
-            {"$match": {"admin_id": admin_id, "date_recorded": {"$gte": twelve_months_ago}}},
-            {"$group": {
-                "_id": {
-                    "year": {"$year": "$date_recorded"},
-                    "month": {"$month": "$date_recorded"}
-                },
-                "total_usage": {"$sum": "$usage"},
-                "total_revenue": {"$sum": "$bill_amount"},
-                "reading_count": {"$sum": 1}
-            }},
-            {"$sort": {"_id.year": 1, "_id.month": 1}}
-        ]))
+    except Exception as e:
+        app.logger.error(f"Error getting report job {job_id}: {e}")
+        return jsonify({'error': 'Failed to load report'}), 500
 
-        trends_sheet.write(0, 0, 'Month', header_format)
-        trends_sheet.write(0, 1, 'Total Usage (m³)', header_format)
-        trends_sheet.write(0, 2, 'Total Revenue (KES)', header_format)
-        trends_sheet.write(0, 3, 'Number of Readings', header_format)
-
-        for i, trend in enumerate(monthly_trends, 1):
-            month_str = f"{trend['_id']['year']}-{trend['_id']['month']:02d}"
-            trends_sheet.write(i, 0, month_str, data_format)
-            trends_sheet.write(i, 1, trend['total_usage'], data_format)
-            trends_sheet.write(i, 2, trend['total_revenue'], currency_format)
-            trends_sheet.write(i, 3, trend['reading_count'], data_format)
-
-        # Top Consumers Sheet
-        consumers_sheet = workbook.add_worksheet('Top Consumers')
-
-        top_consumers = list(mongo.db.meter_readings.aggregate([
-            {"$match": {"admin_id": admin_id}},
-            {"$lookup": {
-                "from": "tenants",
-                "localField": "tenant_id",
-                "foreignField": "_id",
-                "as": "tenant_info"
-            }},
-            {"$unwind": "$tenant_info"},
-            {"$group": {
-                "_id": "$tenant_id",
-                "name": {"$first": "$tenant_info.name"},
-                "house_number": {"$first": "$tenant_info.house_number"},
-                "total_usage": {"$sum": "$usage"},
-                "total_revenue": {"$sum": "$bill_amount"},
-                "reading_count": {"$sum": 1}
-            }},
-            {"$sort": {"total_usage": -1}},
-            {"$limit": 20}
-        ]))
+@app.route('/reports/<job_id>/download', methods=['GET'])
+@login_required
+def download_report(job_id):
+    """Send a finished report; its content hash is the ETag, so an unchanged report is answered with 304"""
+    try:
+        admin_id = get_admin_id()
+        job = mongo.db.report_jobs.find_one({"_id": ObjectId(job_id), "admin_id": admin_id}, {"active_key": 0})
+        if not job:
+            flash('Report not found or expired. Please request it again.', 'warning')
+            return redirect(url_for('dashboard'))
 
-        consumers_sheet.write(0, 0, 'Rank', header_format)
-        consumers_sheet.write(0, 1, 'Name', header_format)
-        consumers_sheet.write(0, 2, 'House Number', header_format)
-        consumers_sheet.write(0, 3, 'Total Usage (m³)', header_format)
-        consumers_sheet.write(0, 4, 'Total Revenue (KES)', header_format)
-        consumers_sheet.write(0, 5, 'Number of Readings', header_format)
-
-        for i, consumer in enumerate(top_consumers, 1):
-            consumers_sheet.write(i, 0, i, data_format)
-            consumers_sheet.write(i, 1, consumer['name'], data_format)
-            consumers_sheet.write(i, 2, consumer['house_number'], data_format)
-            consumers_sheet.write(i, 3, consumer['total_usage'], data_format)
-            consumers_sheet.write(i, 4, consumer['total_revenue'], currency_format)
-            consumers_sheet.write(i, 5, consumer['reading_count'], data_format)
+        path = report_jobs.artifact_path(job)
+        if job['status'] == 'completed' and not os.path.exists(path):
+            # The file expired or was built on another host: queue the same report again
+            job = report_jobs.enqueue(mongo.db, job['report_type'], admin_id, job.get('property_id'), job['params'], job['filename'])
+        if job['status'] != 'completed':
+            return render_template('report_job.html', job=report_job_payload(job), back_url=url_for('dashboard'))
 
-        # Set column widths
-        for sheet in [summary_sheet, trends_sheet, consumers_sheet]:
-            for col in range(6):
-                sheet.set_column(col, col, 15)
+        response = send_file(
+            report_jobs.artifact_path(job),
+            mimetype=report_jobs.mimetype(job),
+            as_attachment=True,
+            download_name=job['filename'],
+            etag=job['cache_key'],
+            conditional=True
+        )
+        response.cache_control.private = True
+        return response
 
-        workbook.close()
-        output.seek(0)
+    except Exception as e:
+        app.logger.error(f"Error downloading report {job_id}: {e}")
+        flash('Error downloading report. Please try again.', 'danger')
+        return redirect(url_for('dashboard'))
 
+@app.route('/generate_analytics_report')
+@login_required
+def generate_analytics_report():
+    """Generate comprehensive analytics report as a background report."""
+    try:
         filename = f"analytics_report_{datetime.now().strftime('%Y%m%d_%H%M')}.xlsx"
-        return send_file(
-            output,
-            as_attachment=True,
-            download_name=filename,
-            mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
-        )
+        return start_report('analytics', {}, filename, 'dashboard')
 
     except Exception as e:
         app.logger.error(f"Error generating analytics report: {e}")
@@ -9438,7 +8942,8 @@ def health_check():
 
         return jsonify({
             'status': 'healthy',
-            'database': 'connected'
+            'database': 'connected',
+            'outbound_http': http_client.get_metrics()
         }), 200
     except Exception as e:
         app.logger.error(f"Health check failed: {e}")
@@ -9475,5 +8980,8 @@ if __name__ == '__main__':
     except Exception as e:
         app.logger.error(f"Database initialization error: {e}")
         print(f"Database initialization error: {e}")
-    
+
+    # With the reloader only the child process serves requests
+    if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        start_background_workers()
     app.run(debug=True, host='0.0.0.0', port=5000)
@@ -0,0 +1,152 @@
+# http_client.py
+"""
+Shared outbound HTTP client.
+
+Keeps one keep-alive ``requests.Session`` per host, applies connect and read
+timeouts to every call, retries transient failures with jittered backoff and
+records per-host latency and error counters.
+"""
+import logging
+import random
+import threading
+import time
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+# (connect, read) timeouts in seconds
+DEFAULT_TIMEOUT = (3.05, 15)
+DEFAULT_RETRIES = 2
+BACKOFF_BASE_SECONDS = 0.5
+BACKOFF_MAX_SECONDS = 5
+POOL_SIZE = 16
+
+IDEMPOTENT_METHODS = {'GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE'}
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+# Statuses that mean the server refused the call before acting on it
+SAFE_RETRY_STATUSES = {429, 503}
+
+_sessions = {}
+_metrics = {}
+_lock = threading.Lock()
+
+
+def _host(url):
+    return urlsplit(url).netloc.lower()
+
+
+def get_session(url):
+    """Return the pooled keep-alive session for the URL's host"""
+    host = _host(url)
+    session = _sessions.get(host)
+    if session is None:
+        with _lock:
+            session = _sessions.get(host)
+            if session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=POOL_SIZE)
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                _sessions[host] = session
+    return session
+
+
+def _record(host, elapsed, status_code=None, error=None, retried=False):
+    with _lock:
+        stats = _metrics.setdefault(host, {
+            'requests': 0,
+            'errors': 0,
+            'retries': 0,
+            'total_latency': 0.0,
+            'max_latency': 0.0,
+            'status_codes': {},
+            'last_error': None
+        })
+        stats['requests'] += 1
+        stats['total_latency'] += elapsed
+        stats['max_latency'] = max(stats['max_latency'], elapsed)
+        if retried:
+            stats['retries'] += 1
+        if status_code is not None:
+            key = str(status_code)
+            stats['status_codes'][key] = stats['status_codes'].get(key, 0) + 1
+        if error is not None or (status_code is not None and status_code >= 500):
+            stats['errors'] += 1
+            stats['last_error'] = str(error) if error is not None else f"HTTP {status_code}"
+
+
+def get_metrics():
+    """Snapshot of per-host request counts, error counts and latency in milliseconds"""
+    with _lock:
+        snapshot = {}
+        for host, stats in _metrics.items():
+            snapshot[host] = {
+                'requests': stats['requests'],
+                'errors': stats['errors'],
+                'retries': stats['retries'],
+                'avg_latency_ms': round(stats['total_latency'] / stats['requests'] * 1000, 1) if stats['requests'] else 0,
+                'max_latency_ms': round(stats['max_latency'] * 1000, 1),
+                'status_codes': dict(stats['status_codes']),
+                'last_error': stats['last_error']
+            }
+        return snapshot
+
+
+def _should_retry(method, response=None, error=None):
+    if method in IDEMPOTENT_METHODS:
+        if error is not None:
+            return isinstance(error, (requests.exceptions.ConnectionError, requests.exceptions.Timeout))
+        return response.status_code in RETRY_STATUSES
+
+    # Never repeat a payment or SMS the server may already have acted on
+    if error is not None:
+        return isinstance(error, requests.exceptions.ConnectTimeout)
+    return response.status_code in SAFE_RETRY_STATUSES
+
+
+def _backoff(attempt):
+    delay = min(BACKOFF_MAX_SECONDS, BACKOFF_BASE_SECONDS * (2 ** attempt))
+    return random.uniform(0, delay)
+
+
+def request(method, url, timeout=DEFAULT_TIMEOUT, retries=DEFAULT_RETRIES, **kwargs):
+    """Send a request through the host's pooled session; raises requests exceptions like requests.request"""
+    method = method.upper()
+    host = _host(url)
+    session = get_session(url)
+    attempt = 0
+
+    while True:
+        started = time.monotonic()
+        try:
+            response = session.request(method, url, timeout=timeout, **kwargs)
+        except requests.exceptions.RequestException as e:
+            _record(host, time.monotonic() - started, error=e, retried=attempt > 0)
+            if attempt < retries and _should_retry(method, error=e):
+                attempt += 1
+                logger.warning(f"Retrying {method} {host} after error (attempt {attempt}): {e}")
+                time.sleep(_backoff(attempt))
+                continue
+            raise
+
+        _record(host, time.monotonic() - started, status_code=response.status_code, retried=attempt > 0)
+        if attempt < retries and _should_retry(method, response=response):
+            attempt += 1
+            logger.warning(f"Retrying {method} {host} after HTTP {response.status_code} (attempt {attempt})")
+            time.sleep(_backoff(attempt))
+            continue
+
+        return response
+
+
+def get(url, **kwargs):
+    """GET through the shared client"""
+    return request('GET', url, **kwargs)
+
+
+def post(url, **kwargs):
+    """POST through the shared client"""
+    return request('POST', url, **kwargs)
@@ -0,0 +1,136 @@
+# last_readings.py
+"""
+Per-house latest meter reading pointer.
+
+Each house document carries ``last_reading: {value, date, reading_id}`` so the
+previous reading is a primary-key read instead of a sorted scan of
+``meter_readings``. The pointer only moves forward through a conditional
+update, so two clerks recording the same meter at once cannot both succeed.
+
+Run ``python last_readings.py [admin_id]`` to rebuild pointers from history.
+"""
+import logging
+import sys
+
+from bson import ObjectId
+from pymongo import UpdateOne
+
+logger = logging.getLogger(__name__)
+
+# Passed as expected_reading_id to only enforce that readings never go backwards
+ANY_READING = object()
+
+
+def pointer(reading_id, value, date):
+    """Build a last_reading sub-document"""
+    return {'value': value, 'date': date, 'reading_id': reading_id}
+
+
+def advance_filter(house_id, value, expected_reading_id=ANY_READING):
+    """Match a house whose pointer is still expected_reading_id and not above value"""
+    query = {
+        '_id': house_id,
+        '$or': [{'last_reading.value': {'$exists': False}}, {'last_reading.value': {'$lte': value}}]
+    }
+    if expected_reading_id is not ANY_READING:
+        # None also matches houses that have no pointer yet
+        query['last_reading.reading_id'] = expected_reading_id
+    return query
+
+
+def advance(db, house_id, reading_id, value, date, expected_reading_id=ANY_READING):
+    """Move a house's pointer to a new reading; False when another reading got there first"""
+    result = db.houses.update_one(
+        advance_filter(house_id, value, expected_reading_id),
+        {'$set': {'last_reading': pointer(reading_id, value, date)}}
+    )
+    return result.matched_count == 1
+
+
+def advance_many(db, claims):
+    """Advance several houses in one bulk write.
+
+    claims is a list of (house_id, reading_id, value, date, expected_reading_id);
+    returns the set of house ids whose pointer now names the claimed reading.
+    """
+    if not claims:
+        return set()
+
+    operations = [
+        UpdateOne(advance_filter(house_id, value, expected), {'$set': {'last_reading': pointer(reading_id, value, date)}})
+        for house_id, reading_id, value, date, expected in claims
+    ]
+    result = db.houses.bulk_write(operations, ordered=False)
+    if result.matched_count == len(operations):
+        return {claim[0] for claim in claims}
+
+    # Some claims lost a race; read back which pointers are ours
+    wanted = {claim[0]: claim[1] for claim in claims}
+    claimed = set()
+    for house in db.houses.find({'_id': {'$in': list(wanted)}}, {'last_reading.reading_id': 1}):
+        if house.get('last_reading', {}).get('reading_id') == wanted[house['_id']]:
+            claimed.add(house['_id'])
+    return claimed
+
+
+def release(db, house_id, reading_id, previous=None):
+    """Put back the pointer a failed reading insert had claimed"""
+    try:
+        update = {'$set': {'last_reading': previous}} if previous else {'$unset': {'last_reading': ''}}
+        db.houses.update_one({'_id': house_id, 'last_reading.reading_id': reading_id}, update)
+    except Exception as e:
+        logger.error(f"Error releasing last reading for house {house_id}: {e}")
+
+
+def rebuild_last_readings(db, admin_id=None):
+    """Recompute every house's pointer from meter_readings for one admin, or everyone"""
+    scope = {'admin_id': admin_id} if admin_id else {}
+
+    latest = db.meter_readings.aggregate([
+        {'$match': dict(scope, house_number={'$exists': True}, date_recorded={'$type': 'date'})},
+        {'$sort': {'date_recorded': -1}},
+        {'$group': {
+            '_id': {'admin_id': '$admin_id', 'property_id': '$property_id', 'house_number': '$house_number'},
+            'reading_id': {'$first': '$_id'},
+            'value': {'$first': '$current_reading'},
+            'date': {'$first': '$date_recorded'}
+        }}
+    ], allowDiskUse=True)
+
+    by_house = {}
+    for group in latest:
+        key = (group['_id'].get('admin_id'), group['_id'].get('property_id'), group['_id']['house_number'])
+        by_house[key] = group
+
+    operations = []
+    for house in db.houses.find(scope, {'admin_id': 1, 'property_id': 1, 'house_number': 1}):
+        admin, property_id, house_number = house.get('admin_id'), house.get('property_id'), house.get('house_number')
+        # Readings saved before property isolation have no property_id
+        candidates = [by_house.get((admin, property_id, house_number)), by_house.get((admin, None, house_number))]
+        candidates = [group for group in candidates if group]
+        if not candidates:
+            continue
+
+        newest = max(candidates, key=lambda group: group['date'])
+        operations.append(UpdateOne(
+            # Leave pointers alone that a reading recorded during the rebuild has moved past
+            {'_id': house['_id'], '$or': [
+                {'last_reading.date': {'$exists': False}},
+                {'last_reading.date': {'$lte': newest['date']}}
+            ]},
+            {'$set': {'last_reading': pointer(newest['reading_id'], newest['value'], newest['date'])}}
+        ))
+
+    if operations:
+        db.houses.bulk_write(operations, ordered=False)
+    logger.info(f"Rebuilt last reading for {len(operations)} houses{' for admin ' + str(admin_id) if admin_id else ''}")
+    return len(operations)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    from home import mongo
+
+    target = ObjectId(sys.argv[1]) if len(sys.argv) > 1 else None
+    count = rebuild_last_readings(mongo.db, target)
+    print(f"Rebuilt last reading pointers for {count} houses")
@@ -0,0 +1,331 @@
+# late_fines.py
+"""
+Vectorized late-payment fine engine.
+
+``calculate_fine`` is the rule for one bill (grace period, fixed or
+percentage fine, one-off or per 30 days overdue, optional cap).
+``compute_fines`` applies the same rules with NumPy over a whole batch of
+bills, with the billing settings of every property and admin involved loaded
+in two queries. The nightly run stores the result on each overdue bill as
+``late_fine`` with ``fine_computed_at``, so dashboards and reminders read the
+stored value instead of recomputing it per bill per view.
+
+A stored fine is only trusted while it is current: every payment unsets it
+(see ``balances.payment_pipeline``), saving a property's billing settings
+clears it with ``clear_fines``, and one older than ``LATE_FINES_MAX_AGE_HOURS``
+counts as missing. Missing fines are computed on the fly.
+
+Run ``python late_fines.py [admin_id]`` once, or ``python late_fines.py
+--loop`` as a long-running process (the ``fines`` entry in the Procfile) to
+refresh every ``LATE_FINES_INTERVAL_HOURS``. Either opens its own database
+connection from ``MONGO_URI`` / ``DATABASE_NAME`` rather than importing the
+web app, so it runs no startup migrations and starts no background queues.
+"""
+import logging
+import os
+import sys
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+from bson import ObjectId
+from dotenv import load_dotenv
+from pymongo import MongoClient, UpdateOne
+from pymongo.server_api import ServerApi
+
+logger = logging.getLogger(__name__)
+
+OUTSTANDING_STATUSES = ('unpaid', 'partial')
+BATCH_SIZE = 1000
+MAX_AGE_HOURS = int(os.getenv('LATE_FINES_MAX_AGE_HOURS', 36))
+INTERVAL_HOURS = int(os.getenv('LATE_FINES_INTERVAL_HOURS', 24))
+DEFAULT_BILLING_SETTINGS = {
+    'billing': {
+        'enable_late_payment_fines': False,
+        'grace_period_days': 7,
+        'fine_type': 'percentage',
+        'fine_rate': 5,
+        'fine_frequency': 'one_time',
+        'max_fine_amount': 1000
+    }
+}
+BILL_FIELDS = {'admin_id': 1, 'property_id': 1, 'due_date': 1, 'payment_status': 1, 'bill_amount': 1, 'amount_paid': 1}
+
+
+def settings_key(bill):
+    return bill.get('admin_id'), bill.get('property_id')
+
+
+def load_billing_settings(db, bills, loaded=None):
+    """Billing settings for every (admin_id, property_id) in bills, resolved like get_property_billing_settings.
+
+    A property's own billing_settings win, then the admin's defaults, then
+    DEFAULT_BILLING_SETTINGS. Pass the returned dict back as ``loaded`` to only
+    fetch keys not seen yet.
+    """
+    settings = loaded if loaded is not None else {}
+    missing = {settings_key(bill) for bill in bills} - set(settings)
+    if not missing:
+        return settings
+
+    property_ids = set()
+    for _, property_id in missing:
+        if property_id:
+            try:
+                property_ids.add(ObjectId(property_id))
+            except Exception:
+                pass
+    properties = {
+        prop['_id']: prop for prop in db.properties.find(
+            {'_id': {'$in': list(property_ids)}, 'billing_settings': {'$exists': True}},
+            {'admin_id': 1, 'billing_settings': 1}
+        )
+    } if property_ids else {}
+    admins = {
+        admin['_id']: admin['default_billing_settings'] for admin in db.admins.find(
+            {'_id': {'$in': list({admin_id for admin_id, _ in missing})}, 'default_billing_settings': {'$exists': True}},
+            {'default_billing_settings': 1}
+        )
+    }
+
+    for admin_id, property_id in missing:
+        if property_id:
+            try:
+                prop = properties.get(ObjectId(property_id))
+            except Exception:
+                # get_property_billing_settings gives up on an unparseable property id
+                settings[(admin_id, property_id)] = {}
+                continue
+            if prop and prop.get('admin_id') == admin_id:
+                settings[(admin_id, property_id)] = prop['billing_settings']
+                continue
+        settings[(admin_id, property_id)] = admins.get(admin_id, DEFAULT_BILLING_SETTINGS)
+    return settings
+
+
+def calculate_fine(bill, property_settings, now=None):
+    """Late payment fine for one bill under its property settings; the scalar reference for compute_fines"""
+    try:
+        # Check if late payment fines are enabled
+        billing_settings = property_settings.get('billing', {})
+        if not billing_settings.get('enable_late_payment_fines', False):
+            return 0.0
+
+        # Get current date and bill due date
+        current_date = now or datetime.now()
+        due_date = bill.get('due_date')
+
+        if not due_date:
+            return 0.0
+
+        # Convert due_date if it's a string
+        if isinstance(due_date, str):
+            try:
+                due_date = datetime.strptime(due_date, '%Y-%m-%d')
+            except ValueError:
+                return 0.0
+
+        # Calculate days overdue
+        days_overdue = (current_date - due_date).days
+        grace_period = billing_settings.get('grace_period_days', 7)
+
+        # No fine if within grace period or bill is fully paid
+        if days_overdue <= grace_period or bill.get('payment_status') == 'paid':
+            return 0.0
+
+        # Calculate outstanding amount
+        bill_amount = float(bill.get('bill_amount', 0))
+        amount_paid = float(bill.get('amount_paid', 0))
+        outstanding_amount = bill_amount - amount_paid
+
+        if outstanding_amount <= 0:
+            return 0.0
+
+        # Get fine configuration
+        fine_type = billing_settings.get('fine_type', 'percentage')
+        fine_rate = float(billing_settings.get('fine_rate', 5))
+        fine_frequency = billing_settings.get('fine_frequency', 'one_time')
+        max_fine_amount = float(billing_settings.get('max_fine_amount', 0))
+
+        # Calculate base fine
+        if fine_type == 'fixed':
+            base_fine = fine_rate
+        else:  # percentage
+            base_fine = outstanding_amount * (fine_rate / 100)
+
+        # Apply frequency multiplier for compound fines
+        final_fine = base_fine
+        if fine_frequency == 'monthly':
+            # Calculate how many months overdue (after grace period)
+            effective_overdue_days = max(0, days_overdue - grace_period)
+            months_overdue = max(1, (effective_overdue_days // 30) + 1)
+            final_fine = base_fine * months_overdue
+
+        # Apply maximum fine limit if set
+        if max_fine_amount > 0:
+            final_fine = min(final_fine, max_fine_amount)
+
+        return round(final_fine, 2)
+
+    except Exception as e:
+        logger.error(f"Error calculating fine for bill {bill.get('_id', 'unknown')}: {str(e)}")
+        return 0.0
+
+
+def compute_fines(bills, settings, now=None):
+    """Late fines for a list of bills, given settings keyed by settings_key; returns a list of floats"""
+    now = now or datetime.now()
+    count = len(bills)
+    valid = np.zeros(count, dtype=bool)
+    paid = np.zeros(count, dtype=bool)
+    due = np.full(count, np.datetime64(now, 'us'))
+    outstanding = np.zeros(count)
+    grace = np.zeros(count)
+    fixed = np.zeros(count, dtype=bool)
+    monthly = np.zeros(count, dtype=bool)
+    rate = np.zeros(count)
+    cap = np.zeros(count)
+
+    # Pull the inputs out of the documents; anything the scalar rules would choke on is fined 0
+    for i, bill in enumerate(bills):
+        billing = (settings.get(settings_key(bill)) or {}).get('billing', {})
+        if not billing.get('enable_late_payment_fines', False):
+            continue
+        due_date = bill.get('due_date')
+        if isinstance(due_date, str):
+            try:
+                due_date = datetime.strptime(due_date, '%Y-%m-%d')
+            except ValueError:
+                continue
+        if not isinstance(due_date, datetime) or due_date.tzinfo is not None:
+            continue
+        try:
+            outstanding[i] = float(bill.get('bill_amount', 0)) - float(bill.get('amount_paid', 0))
+            grace[i] = float(billing.get('grace_period_days', 7))
+            rate[i] = float(billing.get('fine_rate', 5))
+            cap[i] = float(billing.get('max_fine_amount', 0))
+        except (TypeError, ValueError):
+            continue
+        due[i] = np.datetime64(due_date, 'us')
+        fixed[i] = billing.get('fine_type', 'percentage') == 'fixed'
+        monthly[i] = billing.get('fine_frequency', 'one_time') == 'monthly'
+        paid[i] = bill.get('payment_status') == 'paid'
+        valid[i] = True
+
+    # Whole days overdue, floored like timedelta.days
+    days_overdue = ((np.datetime64(now, 'us') - due) // np.timedelta64(1, 'D')).astype(float)
+    fined = valid & ~paid & (days_overdue > grace) & (outstanding > 0)
+
+    fines = np.where(fixed, rate, outstanding * (rate / 100))
+    months_overdue = np.maximum(1, np.maximum(0, days_overdue - grace) // 30 + 1)
+    fines = np.where(monthly, fines * months_overdue, fines)
+    fines = np.where(cap > 0, np.minimum(fines, cap), fines)
+    fines = np.where(fined, fines, 0.0)
+
+    # Python's round, so stored fines are exactly what the scalar function gives
+    return [round(fine, 2) for fine in fines.tolist()]
+
+
+def fines_for_bills(db, bills, now=None):
+    """Compute fines for a batch of bills, loading their settings in one go"""
+    if not bills:
+        return []
+    return compute_fines(bills, load_billing_settings(db, bills), now)
+
+
+def stored_fine(bill, now=None):
+    """The materialized fine of a bill, or None if it was never computed, was cleared or is out of date"""
+    if bill.get('payment_status') == 'paid':
+        return 0.0
+    computed_at = bill.get('fine_computed_at')
+    if not isinstance(computed_at, datetime) or computed_at < (now or datetime.now()) - timedelta(hours=MAX_AGE_HOURS):
+        return None
+    return float(bill.get('late_fine') or 0)
+
+
+def clear_fines(db, query):
+    """Drop the stored fines of the outstanding bills matching query, e.g. after their settings changed"""
+    return db.payments.update_many(
+        dict(query, payment_status={'$in': list(OUTSTANDING_STATUSES)}, fine_computed_at={'$exists': True}),
+        {'$unset': {'late_fine': '', 'fine_computed_at': ''}}
+    ).modified_count
+
+
+def attach_fines(db, bills, now=None):
+    """Set bill['late_payment_fine'] from the stored fine, computing the missing ones in one batch"""
+    pending = []
+    for bill in bills:
+        fine = stored_fine(bill, now)
+        if fine is None:
+            pending.append(bill)
+        else:
+            bill['late_payment_fine'] = fine
+    for bill, fine in zip(pending, fines_for_bills(db, pending, now)):
+        bill['late_payment_fine'] = fine
+    return bills
+
+
+def _write_batch(db, bills, settings, now, summary):
+    fines = compute_fines(bills, load_billing_settings(db, bills, settings), now)
+    db.payments.bulk_write([
+        UpdateOne({'_id': bill['_id']}, {'$set': {'late_fine': fine, 'fine_computed_at': now}})
+        for bill, fine in zip(bills, fines)
+    ], ordered=False)
+    summary['bills'] += len(fines)
+    summary['fined'] += sum(1 for fine in fines if fine)
+    summary['total_fines'] += sum(fines)
+
+
+def materialize_late_fines(db, admin_id=None, now=None, batch_size=BATCH_SIZE):
+    """Store late_fine and fine_computed_at on every overdue bill; returns a summary of the run"""
+    started = time.monotonic()
+    now = now or datetime.now()
+    scope = {'admin_id': admin_id} if admin_id is not None else {}
+    summary = {'bills': 0, 'fined': 0, 'total_fines': 0.0, 'cleared': 0}
+    settings = {}
+
+    batch = []
+    for bill in db.payments.find(
+        dict(scope, payment_status={'$in': list(OUTSTANDING_STATUSES)}, due_date={'$lt': now}), BILL_FIELDS
+    ).batch_size(batch_size):
+        batch.append(bill)
+        if len(batch) >= batch_size:
+            _write_batch(db, batch, settings, now, summary)
+            batch = []
+    if batch:
+        _write_batch(db, batch, settings, now, summary)
+
+    # Bills settled since the last run no longer carry a fine
+    summary['cleared'] = db.payments.update_many(
+        dict(scope, payment_status='paid', late_fine={'$gt': 0}),
+        {'$set': {'late_fine': 0.0, 'fine_computed_at': now}}
+    ).modified_count
+
+    summary['total_fines'] = round(summary['total_fines'], 2)
+    summary['duration_ms'] = round((time.monotonic() - started) * 1000, 1)
+    logger.info(f"Late fines materialized: {summary}")
+    return summary
+
+
+def _connect():
+    """The database named by the environment, opened without importing the web app"""
+    load_dotenv()
+    client = MongoClient(os.getenv('MONGO_URI'), server_api=ServerApi('1'))
+    return client.get_database(os.getenv('DATABASE_NAME'))
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    db = _connect()
+
+    if sys.argv[1:] == ['--loop']:
+        while True:
+            try:
+                materialize_late_fines(db)
+            except Exception as e:
+                logger.error(f"Late fine run failed: {e}")
+            time.sleep(INTERVAL_HOURS * 3600)
+
+    result = materialize_late_fines(db, ObjectId(sys.argv[1]) if len(sys.argv) > 1 else None)
+    print(f"{result['bills']} overdue bills, {result['fined']} fined (KES {result['total_fines']:.2f}), "
+          f"{result['cleared']} cleared in {result['duration_ms']} ms")
@@ -0,0 +1,149 @@
+# lease_queue.py
+"""
+A MongoDB collection worked as a durable queue with leased claims.
+
+The SMS outbox and the payment inbox are both queues of this shape:
+documents wait in a ready status until ``next_attempt_at``, a worker claims
+one atomically by moving it to an active status under its worker id, and the
+claim is a lease: a document left active longer than the lease belonged to a
+worker that died and can be claimed again. Failed attempts go back to the
+ready status with exponential backoff until ``max_attempts`` is reached.
+
+``LeaseQueue`` holds one queue's settings and the claim, backoff and worker
+loop; the modules using it own the documents' fields and what processing one
+means.
+"""
+import logging
+import os
+import random
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+from pymongo import ASCENDING, ReturnDocument
+
+logger = logging.getLogger(__name__)
+
+
+class LeaseQueue:
+    """Claim, retry and worker loop for one queue collection"""
+
+    def __init__(self, collection, name, ready_status, active_status, max_attempts, threads, batch_size,
+                 poll_interval, base_backoff, max_backoff, lease_seconds):
+        self.collection = collection
+        self.name = name
+        self.ready_status = ready_status
+        self.active_status = active_status
+        self.max_attempts = max_attempts
+        self.threads = threads
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.lease_seconds = lease_seconds
+        self._thread_lock = threading.Lock()
+        self._thread = None
+
+    def backoff_seconds(self, attempts):
+        """Exponential backoff with jitter for the given number of attempts made"""
+        delay = min(self.max_backoff, self.base_backoff * (2 ** max(0, attempts - 1)))
+        return delay * random.uniform(0.5, 1.5)
+
+    def claim(self, db, worker_id, doc_id=None):
+        """Atomically claim the next due document (or a specific one), including ones abandoned by a dead worker"""
+        now = datetime.now()
+        query = {
+            '$or': [
+                {'status': self.ready_status, 'next_attempt_at': {'$lte': now}},
+                {'status': self.active_status, 'claimed_at': {'$lt': now - timedelta(seconds=self.lease_seconds)}}
+            ]
+        }
+        if doc_id is not None:
+            query['_id'] = doc_id
+        return db[self.collection].find_one_and_update(
+            query,
+            {
+                '$set': {'status': self.active_status, 'claimed_by': worker_id, 'claimed_at': now, 'updated_at': now},
+                '$inc': {'attempts': 1}
+            },
+            sort=[('next_attempt_at', ASCENDING)],
+            return_document=ReturnDocument.AFTER
+        )
+
+    def exhausted(self, doc):
+        """Whether a claimed document has used up its attempts"""
+        return doc['attempts'] >= self.max_attempts
+
+    def settle(self, db, doc, status, fields):
+        """Move a claimed document to a final status, unless its lease passed to another worker"""
+        db[self.collection].update_one(
+            {'_id': doc['_id'], 'claimed_by': doc['claimed_by']},
+            {'$set': dict(fields, status=status, updated_at=datetime.now())}
+        )
+
+    def retry(self, db, doc, error):
+        """Return a claimed document to the queue after a failed attempt, with backoff"""
+        now = datetime.now()
+        db[self.collection].update_one(
+            {'_id': doc['_id'], 'claimed_by': doc['claimed_by']},
+            {'$set': {
+                'status': self.ready_status,
+                'next_attempt_at': now + timedelta(seconds=self.backoff_seconds(doc['attempts'])),
+                'updated_at': now,
+                'last_error': error
+            }}
+        )
+
+    def process_pending(self, db, handle, executor, worker_id, batch_size=None):
+        """Claim up to batch_size due documents and handle them concurrently; returns how many were claimed"""
+        batch_size = batch_size or self.batch_size
+        claimed = []
+        while len(claimed) < batch_size:
+            doc = self.claim(db, worker_id)
+            if not doc:
+                break
+            claimed.append(doc)
+
+        if claimed:
+            list(executor.map(handle, claimed))
+
+        return len(claimed)
+
+    def run_worker(self, db, handle, threads=None, stop_event=None):
+        """Poll the queue and handle documents until stop_event is set"""
+        threads = threads or self.threads
+        stop_event = stop_event or threading.Event()
+        worker_id = f"{socket.gethostname()}:{os.getpid()}:{threading.get_ident()}"
+        logger.info(f"{self.name} worker {worker_id} started with {threads} threads")
+
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            while not stop_event.is_set():
+                try:
+                    if self.process_pending(db, handle, executor, worker_id):
+                        continue
+                except Exception as e:
+                    logger.error(f"{self.name} processing error: {e}")
+                stop_event.wait(self.poll_interval)
+
+    def start_background(self, db, handle, threads=None):
+        """Start the worker in a daemon thread, once per process"""
+        with self._thread_lock:
+            if self._thread and self._thread.is_alive():
+                return self._thread
+            self._thread = threading.Thread(
+                target=self.run_worker, args=(db, handle, threads),
+                name=self.collection.replace('_', '-'), daemon=True
+            )
+            self._thread.start()
+            return self._thread
+
+    def run_forever(self, db, handle, threads=None):
+        """Run the worker as a dedicated process, restarting it if it crashes"""
+        while True:
+            try:
+                self.run_worker(db, handle, threads)
+            except Exception as e:
+                logger.error(f"{self.name} worker crashed, restarting: {e}")
+                time.sleep(self.poll_interval)
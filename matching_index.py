@@ -0,0 +1,140 @@
+# matching_index.py
+"""
+In-memory matching index for M-Pesa PayBill/Till callbacks.
+
+For each admin the index maps house number -> (house, first tenant), phone ->
+tenants and normalised name -> tenant, so matching an incoming payment is a
+handful of dict lookups instead of up to eight queries and a scan of every
+tenant. Indexes are built lazily, kept in a bounded LRU across admins and
+dropped whenever the admin's tenants, houses or payment settings change; the
+TTL bounds staleness for writes made by other worker processes.
+"""
+import logging
+import os
+import re
+
+from lru import LRUCache
+
+logger = logging.getLogger(__name__)
+
+MAX_ADMINS = int(os.getenv('MATCHING_INDEX_MAX_ADMINS', 256))
+INDEX_TTL_SECONDS = int(os.getenv('MATCHING_INDEX_TTL', 300))
+
+_indexes = LRUCache(maxsize=MAX_ADMINS, ttl=INDEX_TTL_SECONDS)
+_shortcodes = LRUCache(maxsize=MAX_ADMINS * 2, ttl=INDEX_TTL_SECONDS)
+_NO_ADMIN = object()
+# The callback only needs to know who the admin is, how they are paid and where to notify them
+ADMIN_FIELDS = {'payment_method': 1, 'phone': 1, 'business_number': 1, 'till': 1}
+
+
+def normalize_phone(phone):
+    """Canonical local form of a Kenyan number: +254712..., 254712... and 0712... all become 0712..."""
+    digits = re.sub(r'\D', '', phone or '')
+    if digits.startswith('254'):
+        digits = '0' + digits[3:]
+    return digits
+
+
+def normalize_name(name):
+    """Lowercase a name and collapse its whitespace"""
+    return ' '.join((name or '').lower().split())
+
+
+def build_index(db, admin_id):
+    """Load one admin's houses, tenants and account-reference setting into lookup tables"""
+    config = db.sms_config.find_one({'admin_id': admin_id}, {'use_house_number_as_account': 1})
+    index = {
+        'use_house_number_as_account': bool(config and config.get('use_house_number_as_account')),
+        'houses': {},
+        'tenants_by_house': {},
+        'tenants_by_phone': {},
+        'tenants_by_name': {}
+    }
+
+    # setdefault keeps the first document in natural order, which is what find_one returned
+    for house in db.houses.find({'admin_id': admin_id}, {'last_reading': 0}):
+        index['houses'].setdefault(house.get('house_number'), house)
+
+    for tenant in db.tenants.find({'admin_id': admin_id}):
+        name = normalize_name(tenant.get('name', ''))
+        index['tenants_by_house'].setdefault(tenant.get('house_number'), tenant)
+        index['tenants_by_name'].setdefault(name, tenant)
+        phone = normalize_phone(tenant.get('phone'))
+        if phone:
+            index['tenants_by_phone'].setdefault(phone, []).append((name, tenant))
+
+    return index
+
+
+def get_index(db, admin_id):
+    """The admin's matching index, built on first use"""
+    index = _indexes.get(admin_id)
+    if index is None:
+        index = build_index(db, admin_id)
+        _indexes.set(admin_id, index)
+    return index
+
+
+def invalidate(admin_id):
+    """Drop an admin's index after their tenants, houses or settings change"""
+    _indexes.pop(admin_id)
+
+
+def find_admin_by_shortcode(db, short_code):
+    """Resolve the admin owning a PayBill business number or Till number"""
+    short_code = str(short_code)
+    admin = _shortcodes.get(short_code)
+    if admin is None:
+        admin = db.admins.find_one({'$or': [{'business_number': short_code}, {'till': short_code}]}, ADMIN_FIELDS) or _NO_ADMIN
+        _shortcodes.set(short_code, admin)
+    return None if admin is _NO_ADMIN else admin
+
+
+def invalidate_shortcodes():
+    """Forget every shortcode resolution after an admin's payment details change"""
+    _shortcodes.clear()
+
+
+def match_payment(index, payment_method, bill_ref_number, customer_phone, customer_name):
+    """Apply the multi-reference strategies to an index; returns (tenant, house, matching_method)"""
+    houses = index['houses']
+
+    # Strategy 1: PayBill - House number as account reference (most reliable)
+    if payment_method == 'paybill' and bill_ref_number and index['use_house_number_as_account']:
+        house = houses.get(bill_ref_number)
+        if house:
+            tenant = index['tenants_by_house'].get(bill_ref_number)
+            if tenant:
+                return tenant, house, "house_number_paybill"
+            # House exists but no tenant found - still return house for manual allocation
+            return None, house, "house_found_no_tenant"
+
+    phone_matches = index['tenants_by_phone'].get(normalize_phone(customer_phone), []) if customer_phone else []
+
+    # Strategy 2: Phone number + name matching (works for both PayBill and Till)
+    if phone_matches and customer_name:
+        normalized_customer_name = normalize_name(customer_name)
+        for tenant_name, tenant in phone_matches:
+            # Check if names match (exact or partial)
+            if normalized_customer_name in tenant_name or tenant_name in normalized_customer_name:
+                return tenant, houses.get(tenant.get('house_number')), "phone_and_name_match"
+
+    # Strategy 3: Phone number only (less reliable)
+    if phone_matches:
+        tenant = phone_matches[0][1]
+        return tenant, houses.get(tenant.get('house_number')), "phone_only_match"
+
+    # Strategy 4: Till users - House number as tenant reference (if available)
+    if payment_method == 'till' and bill_ref_number:
+        house = houses.get(bill_ref_number)
+        if house:
+            return index['tenants_by_house'].get(bill_ref_number), house, "house_number_till"
+
+    # Strategy 5: Name matching only (least reliable)
+    if customer_name and len(customer_name.strip()) > 3:
+        tenant = index['tenants_by_name'].get(normalize_name(customer_name))
+        if tenant:
+            return tenant, houses.get(tenant.get('house_number')), "name_only_exact_match"
+
+    # No match found
+    return None, None, "no_match_found"
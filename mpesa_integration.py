@@ -1,10 +1,33 @@
 # mpesa_integration.py
-import requests
+import http_client
 import base64
 from datetime import datetime
 import json
+import threading
+import time
 from flask import current_app
 
+# Refresh tokens this long before Daraja says they expire
+TOKEN_REFRESH_MARGIN_SECONDS = 300
+
+# Process-wide OAuth token cache shared by every MpesaAPI instance,
+# keyed by (base_url, consumer_key): {key: (token, expires_at)}
+_token_cache = {}
+_token_locks = {}
+_token_locks_guard = threading.Lock()
+
+
+def _token_lock(key):
+    with _token_locks_guard:
+        return _token_locks.setdefault(key, threading.Lock())
+
+
+def invalidate_access_token(consumer_key=None):
+    """Drop cached tokens for one consumer key, or all of them"""
+    for key in list(_token_cache):
+        if consumer_key is None or key[1] == consumer_key:
+            _token_cache.pop(key, None)
+
 class MpesaAPI:
     def __init__(self, consumer_key, consumer_secret, shortcode, passkey, env='sandbox'):
         self.consumer_key = consumer_key
@@ -19,7 +42,26 @@ class MpesaAPI:
             self.base_url = 'https://api.safaricom.co.ke'
             
     def get_access_token(self):
-        """Get OAuth access token from M-Pesa"""
+        """Get OAuth access token from M-Pesa, reusing the cached token until shortly before expiry"""
+        cache_key = (self.base_url, self.consumer_key)
+        cached = _token_cache.get(cache_key)
+        if cached and cached[1] > time.monotonic():
+            return cached[0]
+
+        # One refresh per consumer key; other threads wait and reuse its result
+        with _token_lock(cache_key):
+            cached = _token_cache.get(cache_key)
+            if cached and cached[1] > time.monotonic():
+                return cached[0]
+
+            token, expires_in = self._request_access_token()
+            if token:
+                ttl = max(0, expires_in - TOKEN_REFRESH_MARGIN_SECONDS)
+                _token_cache[cache_key] = (token, time.monotonic() + ttl)
+            return token
+
+    def _request_access_token(self):
+        """Fetch a fresh OAuth token; returns (token, expires_in_seconds)"""
         url = f"{self.base_url}/oauth/v1/generate?grant_type=client_credentials"
         
         # Create base64 encoded string
@@ -31,12 +73,13 @@ class MpesaAPI:
         }
         
         try:
-            response = requests.get(url, headers=headers)
+            response = http_client.get(url, headers=headers)
             response.raise_for_status()
-            return response.json()['access_token']
+            data = response.json()
+            return data['access_token'], int(data.get('expires_in', 3599))
         except Exception as e:
             current_app.logger.error(f"Error getting M-Pesa token: {e}")
-            return None
+            return None, 0
             
     def stk_push(self, phone_number, amount, account_reference, callback_url):
         """Initiate STK push for payment"""
@@ -76,7 +119,10 @@ class MpesaAPI:
         }
         
         try:
-            response = requests.post(url, json=payload, headers=headers)
+            response = http_client.post(url, json=payload, headers=headers)
+            if response.status_code == 401:
+                # Token revoked early; drop it so the next push fetches a fresh one
+                invalidate_access_token(self.consumer_key)
             response.raise_for_status()
             return response.json()
         except Exception as e:
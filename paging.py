@@ -0,0 +1,208 @@
+# paging.py
+"""
+Keyset (cursor) pagination with cached counts.
+
+Listings used ``$skip``/``.skip()``, so page N read and threw away every row
+before it, and each page recounted the whole result set. ``paginate`` instead
+seeks past the last row shown: the sort keys of the first and last row on a
+page (always ending in ``_id``, e.g. name+_id, due_date+_id,
+date_recorded+_id) are encoded into opaque ``after``/``before`` tokens, and
+the next page is one indexed range read of ``per_page + 1`` rows.
+
+Totals come from ``cached_count``: a count is computed once per query shape
+and then served from memory, refreshed in a background thread once it is
+older than ``PAGINATION_COUNT_REFRESH`` seconds. Writers that change a
+listing's size can drop its counts with ``invalidate_counts``.
+
+The returned dict keeps the keys the templates already read (``page``,
+``pages``, ``total``, ``has_prev``, ``has_next``, ...) and adds
+``prev_cursor``/``next_cursor``; ``page_args`` turns either style into link
+arguments, so a template can move to cursors one link at a time. A plain
+``?page=N`` link still works through an offset read.
+"""
+import base64
+import hashlib
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from bson import json_util
+from pymongo import ASCENDING
+
+from lru import LRUCache
+
+logger = logging.getLogger(__name__)
+
+COUNT_REFRESH_SECONDS = int(os.getenv('PAGINATION_COUNT_REFRESH', 60))
+# Counts older than this are recomputed in the request instead of served stale
+COUNT_MAX_AGE_SECONDS = int(os.getenv('PAGINATION_COUNT_MAX_AGE', 3600))
+MAX_CACHED_COUNTS = int(os.getenv('PAGINATION_MAX_CACHED_COUNTS', 4096))
+COUNT_REFRESH_THREADS = int(os.getenv('PAGINATION_COUNT_THREADS', 2))
+
+_counts = LRUCache(maxsize=MAX_CACHED_COUNTS, ttl=COUNT_MAX_AGE_SECONDS)
+_refreshing = set()
+_refreshing_lock = threading.Lock()
+_count_executor = ThreadPoolExecutor(max_workers=COUNT_REFRESH_THREADS, thread_name_prefix='count-refresh')
+
+
+def _signature(sort):
+    # Ties a token to the listing order it was made for
+    return hashlib.sha1(repr([(field, order) for field, order in sort]).encode()).hexdigest()[:8]
+
+
+def encode_cursor(sort, document):
+    """Opaque token for the position of document in a listing sorted by sort"""
+    payload = json_util.dumps({'s': _signature(sort), 'v': [document.get(field) for field, _ in sort]})
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip('=')
+
+
+def decode_cursor(sort, token):
+    """Sort key values from a token made by encode_cursor; ValueError if it is not one for this sort"""
+    try:
+        payload = json_util.loads(base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)).decode())
+        values = payload['v']
+        signature = payload['s']
+    except (TypeError, KeyError, ValueError, UnicodeDecodeError) as e:
+        raise ValueError(f"Malformed page token: {e}")
+    if signature != _signature(sort) or len(values) != len(sort):
+        raise ValueError("Page token belongs to a different listing")
+    return values
+
+
+def keyset_filter(sort, values, direction):
+    """Match rows after (direction 'after') or before ('before') the position values in sort order.
+
+    MongoDB orders null and missing fields before everything else, so those
+    are handled explicitly; each field must otherwise hold a single type.
+    """
+    branches = []
+    for position, (field, order) in enumerate(sort):
+        value = values[position]
+        branch = {prior: prior_value for (prior, _), prior_value in zip(sort, values[:position])}
+        if (order == ASCENDING) == (direction == 'after'):
+            branch[field] = {'$ne': None} if value is None else {'$gt': value}
+        elif value is None:
+            # Nothing sorts before null
+            continue
+        else:
+            branch['$or'] = [{field: {'$lt': value}}, {field: None}]
+        branches.append(branch)
+    return {'$or': branches} if branches else {'_id': {'$in': []}}
+
+
+def paginate(collection, query, sort, per_page, after=None, before=None, page=1, projection=None, total=None):
+    """One page of collection matching query in sort order, with links to its neighbours.
+
+    sort is a list of (field, direction) ending with '_id'. after/before are
+    tokens from a previous page; without one, page > 1 is read by offset so
+    old ?page=N links keep working. total overrides the cached count.
+    """
+    if not sort or sort[-1][0] != '_id':
+        raise ValueError("Keyset sort must end with _id")
+    page = max(page or 1, 1)
+    direction = 'before' if before else 'after'
+    keyset = None
+    if after or before:
+        try:
+            keyset = keyset_filter(sort, decode_cursor(sort, before or after), direction)
+        except ValueError as e:
+            logger.debug(f"Ignoring page token: {e}")
+            direction, page = 'after', 1
+
+    match = {'$and': [query, keyset]} if keyset else query
+    # Rows before a position are read in reverse order, nearest first
+    read_sort = sort if direction == 'after' else [(field, -order) for field, order in sort]
+    cursor = collection.find(match, projection).sort(read_sort)
+    offset = (page - 1) * per_page if keyset is None else 0
+    if offset:
+        cursor = cursor.skip(offset)
+    items = list(cursor.limit(per_page + 1))
+
+    # One extra row tells whether there is more in the reading direction
+    more = len(items) > per_page
+    items = items[:per_page]
+    if direction == 'before':
+        items.reverse()
+        has_prev, has_next = more, True
+        if not more:
+            page = 1
+    else:
+        has_prev, has_next = keyset is not None or offset > 0, more
+
+    if total is None:
+        if not has_prev and not has_next:
+            # A single page holds the whole result set
+            total = len(items)
+            _counts.set(_count_key(collection, query), (total, time.monotonic()))
+        else:
+            total = cached_count(collection, query)
+    pages = max((total + per_page - 1) // per_page, page)
+
+    return {
+        'items': items,
+        'page': page,
+        'per_page': per_page,
+        'total': total,
+        'pages': pages,
+        'has_prev': has_prev and bool(items),
+        'has_next': has_next and bool(items),
+        'prev_num': max(page - 1, 1),
+        'next_num': page + 1,
+        'prev_cursor': encode_cursor(sort, items[0]) if items else None,
+        'next_cursor': encode_cursor(sort, items[-1]) if items else None
+    }
+
+
+def page_args(pagination, target):
+    """URL arguments for the 'prev' or 'next' page, or page number target, in whichever style pagination uses"""
+    if target == 'prev':
+        if pagination.get('prev_cursor'):
+            return {'before': pagination['prev_cursor'], 'page': pagination['prev_num']}
+        return {'page': max(pagination['page'] - 1, 1)}
+    if target == 'next':
+        if pagination.get('next_cursor'):
+            return {'after': pagination['next_cursor'], 'page': pagination['next_num']}
+        return {'page': pagination['page'] + 1}
+    return {'page': target}
+
+
+def _count_key(collection, query):
+    return (collection.name, query.get('admin_id'), json_util.dumps(query, sort_keys=True))
+
+
+def _refresh_count(collection, query, key):
+    try:
+        _counts.set(key, (collection.count_documents(query), time.monotonic()))
+    except Exception as e:
+        logger.error(f"Error refreshing {collection.name} count: {e}")
+    finally:
+        with _refreshing_lock:
+            _refreshing.discard(key)
+
+
+def cached_count(collection, query):
+    """count_documents(query), served from memory and refreshed in the background once stale"""
+    key = _count_key(collection, query)
+    entry = _counts.get(key)
+    if entry is None:
+        count = collection.count_documents(query)
+        _counts.set(key, (count, time.monotonic()))
+        return count
+
+    count, computed_at = entry
+    if time.monotonic() - computed_at > COUNT_REFRESH_SECONDS:
+        with _refreshing_lock:
+            start = key not in _refreshing
+            _refreshing.add(key)
+        if start:
+            _count_executor.submit(_refresh_count, collection, query, key)
+    return count
+
+
+def invalidate_counts(collection_name, admin_id=None):
+    """Drop cached counts of a collection, optionally only one admin's"""
+    return _counts.discard_where(
+        lambda key: key[0] == collection_name and (admin_id is None or key[1] == admin_id)
+    )
@@ -0,0 +1,197 @@
+# payment_inbox.py
+"""
+Durable inbox for payment provider callbacks.
+
+Callback routes store the raw payload in ``payment_inbox`` under a unique
+``(provider, transaction_id)`` key and acknowledge the provider at once, so
+matching, database writes and SMS never hold up Safaricom or Paystack and a
+redelivered callback is recognised as a duplicate. Workers claim entries
+atomically and run the handler registered for the entry's kind; delivery is
+at-least-once, so handlers must be idempotent. Failures are retried with
+backoff and entries that keep failing are parked as 'dead' for an admin to
+inspect and retry.
+"""
+import logging
+import os
+from datetime import datetime, timedelta
+
+from pymongo import ASCENDING
+from pymongo.errors import DuplicateKeyError
+
+import db_indexes
+from lease_queue import LeaseQueue
+
+logger = logging.getLogger(__name__)
+
+MAX_ATTEMPTS = int(os.getenv('PAYMENT_INBOX_MAX_ATTEMPTS', 8))
+WORKER_THREADS = int(os.getenv('PAYMENT_INBOX_THREADS', 4))
+BATCH_SIZE = int(os.getenv('PAYMENT_INBOX_BATCH_SIZE', 20))
+POLL_INTERVAL_SECONDS = 1
+BASE_BACKOFF_SECONDS = 10
+MAX_BACKOFF_SECONDS = 1800
+# An entry stuck in 'processing' longer than this belonged to a worker that died
+CLAIM_LEASE_SECONDS = 120
+# Pending entries older than this are reported as stuck
+STUCK_AFTER_SECONDS = 300
+
+queue = LeaseQueue(
+    'payment_inbox', 'Payment inbox', ready_status='pending', active_status='processing',
+    max_attempts=MAX_ATTEMPTS, threads=WORKER_THREADS, batch_size=BATCH_SIZE,
+    poll_interval=POLL_INTERVAL_SECONDS, base_backoff=BASE_BACKOFF_SECONDS,
+    max_backoff=MAX_BACKOFF_SECONDS, lease_seconds=CLAIM_LEASE_SECONDS
+)
+
+
+def ensure_inbox_indexes(db):
+    """Create the dedupe key and claim indexes"""
+    db_indexes.ensure_indexes(db, ['payment_inbox'])
+
+
+def record(db, provider, kind, transaction_id, payload, admin_id=None):
+    """Persist a raw callback; returns (entry_id, is_new) and never duplicates a transaction"""
+    now = datetime.now()
+    entry = {
+        'provider': provider,
+        'kind': kind,
+        'transaction_id': str(transaction_id),
+        'admin_id': admin_id,
+        'payload': payload,
+        'status': 'pending',
+        'attempts': 0,
+        'next_attempt_at': now,
+        'last_error': None,
+        'result': None,
+        'received_at': now,
+        'updated_at': now
+    }
+    try:
+        return db.payment_inbox.insert_one(entry).inserted_id, True
+    except DuplicateKeyError:
+        existing = db.payment_inbox.find_one(
+            {'provider': provider, 'transaction_id': str(transaction_id)}, {'_id': 1}
+        )
+        return (existing['_id'] if existing else None), False
+
+
+def claim_effect(db, collection, doc_id, effect):
+    """Mark a one-off side effect (such as an SMS) of a document as done; true only for the first caller.
+
+    Handlers claim before acting, so a retried entry never repeats the effect;
+    effects that are safe to repeat should be applied first and marked after.
+    """
+    result = db[collection].update_one(
+        {'_id': doc_id, f'effects.{effect}': {'$exists': False}},
+        {'$set': {f'effects.{effect}': datetime.now()}}
+    )
+    return result.modified_count == 1
+
+
+def claim_entry(db, worker_id, entry_id):
+    """Atomically claim one specific entry if it is due, e.g. to process it inline right after recording it"""
+    if entry_id is None:
+        # Without an id the claim would take whichever entry is due next
+        return None
+    return queue.claim(db, worker_id, entry_id)
+
+
+def complete_entry(db, entry, result=None, error=None):
+    """Record the outcome of processing an entry, rescheduling failures with backoff"""
+    if error is None:
+        queue.settle(db, entry, 'done', {'processed_at': datetime.now(), 'result': result, 'last_error': None})
+        return 'done'
+
+    if queue.exhausted(entry):
+        queue.settle(db, entry, 'dead', {'failed_at': datetime.now(), 'last_error': error})
+        logger.error(f"Payment inbox entry {entry['_id']} ({entry['provider']} {entry['transaction_id']}) failed after {entry['attempts']} attempts: {error}")
+        return 'dead'
+
+    queue.retry(db, entry, error)
+    return 'retry'
+
+
+def process_entry(db, handlers, entry):
+    """Run the handler for one claimed entry and record the outcome"""
+    handler = handlers.get(entry['kind'])
+    try:
+        if handler is None:
+            raise LookupError(f"No handler for payment inbox kind '{entry['kind']}'")
+        result, error = handler(entry), None
+    except Exception as e:
+        result, error = None, str(e)
+
+    try:
+        return complete_entry(db, entry, result, error)
+    except Exception as e:
+        # Left in 'processing'; the claim lease makes it eligible again later
+        logger.error(f"Error recording payment inbox outcome for {entry['_id']}: {e}")
+        return 'error'
+
+
+def process_pending(db, handlers, executor, worker_id, batch_size=BATCH_SIZE):
+    """Claim up to batch_size due entries and process them concurrently; returns how many were claimed"""
+    return queue.process_pending(db, lambda entry: process_entry(db, handlers, entry), executor, worker_id, batch_size)
+
+
+def retry_entry(db, entry_id, admin_id=None):
+    """Requeue a dead entry for immediate processing; returns whether one was requeued"""
+    query = {'_id': entry_id, 'status': 'dead'}
+    if admin_id is not None:
+        query['admin_id'] = admin_id
+    result = db.payment_inbox.update_one(query, {
+        '$set': {'status': 'pending', 'attempts': 0, 'next_attempt_at': datetime.now(), 'updated_at': datetime.now()}
+    })
+    return result.modified_count == 1
+
+
+def inbox_status(db, admin_id=None, limit=20):
+    """Backlog size, lag of the oldest unprocessed entry and the entries that look stuck"""
+    scope = {'admin_id': admin_id} if admin_id is not None else {}
+    now = datetime.now()
+
+    counts = dict.fromkeys(('pending', 'processing', 'done', 'dead'), 0)
+    for group in db.payment_inbox.aggregate([
+        {'$match': dict(scope, status={'$in': ['pending', 'processing', 'dead']})},
+        {'$group': {'_id': '$status', 'count': {'$sum': 1}}}
+    ]):
+        counts[group['_id']] = group['count']
+
+    oldest = db.payment_inbox.find_one(
+        dict(scope, status={'$in': ['pending', 'processing']}),
+        {'received_at': 1},
+        sort=[('received_at', ASCENDING)]
+    )
+    lag_seconds = int((now - oldest['received_at']).total_seconds()) if oldest else 0
+
+    stuck = list(db.payment_inbox.find(
+        dict(scope, **{'$or': [
+            {'status': 'dead'},
+            {'status': {'$in': ['pending', 'processing']}, 'received_at': {'$lt': now - timedelta(seconds=STUCK_AFTER_SECONDS)}}
+        ]}),
+        {'payload': 0}
+    ).sort('received_at', ASCENDING).limit(limit))
+
+    return {
+        'counts': counts,
+        'backlog': counts['pending'] + counts['processing'],
+        'lag_seconds': lag_seconds,
+        'stuck': stuck
+    }
+
+
+def run_worker(db, handlers, threads=WORKER_THREADS, stop_event=None):
+    """Poll the inbox and process entries until stop_event is set"""
+    queue.run_worker(db, lambda entry: process_entry(db, handlers, entry), threads, stop_event)
+
+
+def start_background_processor(db, handlers, threads=WORKER_THREADS):
+    """Start the processor in a daemon thread, once per process"""
+    return queue.start_background(db, lambda entry: process_entry(db, handlers, entry), threads)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+
+    from home import mongo, PAYMENT_INBOX_HANDLERS
+
+    ensure_inbox_indexes(mongo.db)
+    queue.run_forever(mongo.db, lambda entry: process_entry(mongo.db, PAYMENT_INBOX_HANDLERS, entry))
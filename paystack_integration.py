@@ -1,5 +1,6 @@
 # paystack_integration.py
 import requests
+import http_client
 import hashlib
 import hmac
 import logging
@@ -71,7 +72,7 @@ class PaystackAPI:
             payload["metadata"] = metadata
 
         try:
-            response = requests.post(url, json=payload, headers=self._get_headers())
+            response = http_client.post(url, json=payload, headers=self._get_headers())
             response.raise_for_status()
             result = response.json()
 
@@ -125,7 +126,7 @@ class PaystackAPI:
         url = f"{self.base_url}/transaction/verify/{reference}"
 
         try:
-            response = requests.get(url, headers=self._get_headers())
+            response = http_client.get(url, headers=self._get_headers())
             response.raise_for_status()
             result = response.json()
 
@@ -208,7 +209,7 @@ class PaystackAPI:
             params['to'] = to_date.strftime('%Y-%m-%d')
 
         try:
-            response = requests.get(url, params=params, headers=self._get_headers())
+            response = http_client.get(url, params=params, headers=self._get_headers())
             response.raise_for_status()
             result = response.json()
 
@@ -254,7 +255,7 @@ class PaystackAPI:
         }
 
         try:
-            response = requests.post(url, json=payload, headers=self._get_headers())
+            response = http_client.post(url, json=payload, headers=self._get_headers())
             response.raise_for_status()
             result = response.json()
 
@@ -305,7 +306,7 @@ class PaystackAPI:
         }
 
         try:
-            response = requests.post(url, json=payload, headers=self._get_headers())
+            response = http_client.post(url, json=payload, headers=self._get_headers())
             response.raise_for_status()
             result = response.json()
 
@@ -343,7 +344,7 @@ class PaystackAPI:
         params = {'country': country}
 
         try:
-            response = requests.get(url, params=params, headers=self._get_headers())
+            response = http_client.get(url, params=params, headers=self._get_headers())
             response.raise_for_status()
             result = response.json()
 
@@ -0,0 +1,175 @@
+# portal_tokens.py
+"""
+Self-verifying tenant portal tokens with a revocation filter.
+
+A portal link used to insert a ``tenant_access_tokens`` row for every SMS
+and look it up again on every visit. Tokens are now signed
+``URLSafeTimedSerializer`` payloads carrying the tenant, admin, a random
+token id and the expiry, so issuing one needs no database write and checking
+the signature proves everything except revocation.
+
+Revoked and used tokens, and tenants whose earlier links were all withdrawn,
+are recorded in ``portal_revocations``; a TTL index drops each entry once the
+tokens it covers have expired, so the collection stays small. Each process
+keeps a Bloom filter of the entry keys, rebuilt every
+``PORTAL_REVOCATION_REFRESH`` seconds. A token whose keys miss the filter is
+accepted without touching the database; on a hit (a revocation or a false
+positive) a single indexed read decides. Revocations made by another process
+take effect here at the next rebuild.
+"""
+import hashlib
+import logging
+import math
+import os
+import secrets
+import threading
+import time
+from datetime import datetime, timedelta
+
+from bson import ObjectId
+from itsdangerous import URLSafeTimedSerializer, SignatureExpired
+
+logger = logging.getLogger(__name__)
+
+# Signature age limit; each token's own expiry is checked as well
+MAX_TOKEN_HOURS = int(os.getenv('PORTAL_TOKEN_MAX_HOURS', 24 * 30))
+REFRESH_SECONDS = int(os.getenv('PORTAL_REVOCATION_REFRESH', 60))
+FILTER_CAPACITY = int(os.getenv('PORTAL_REVOCATION_CAPACITY', 10000))
+FALSE_POSITIVE_RATE = 0.01
+
+
+class BloomFilter:
+    """Fixed-size set membership test with no false negatives"""
+
+    def __init__(self, capacity, error_rate=FALSE_POSITIVE_RATE):
+        self.size = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, key):
+        digest = hashlib.sha256(key.encode()).digest()
+        first = int.from_bytes(digest[:8], 'big')
+        second = int.from_bytes(digest[8:16], 'big') | 1
+        return [(first + i * second) % self.size for i in range(self.hashes)]
+
+    def add(self, key):
+        for position in self._positions(key):
+            self.bits[position // 8] |= 1 << (position % 8)
+
+    def __contains__(self, key):
+        return all(self.bits[position // 8] & (1 << (position % 8)) for position in self._positions(key))
+
+
+_filter = None
+_built_at = 0.0
+_filter_lock = threading.Lock()
+
+
+def _serializer(secret_key):
+    return URLSafeTimedSerializer(secret_key)
+
+
+def issue(secret_key, tenant_id, admin_id, expires_in_hours=24):
+    """Signed portal token for a tenant; nothing is stored"""
+    expires_in_hours = min(expires_in_hours, MAX_TOKEN_HOURS)
+    now = int(time.time())
+    return _serializer(secret_key).dumps({
+        't': str(tenant_id),
+        'a': str(admin_id),
+        'j': secrets.token_urlsafe(9),
+        'i': now,
+        'e': now + int(expires_in_hours * 3600)
+    })
+
+
+def decode(secret_key, token):
+    """Claims of a valid token: tenant_id, admin_id, token_id, issued_at, expires_at.
+
+    Raises itsdangerous' SignatureExpired or BadSignature like loads() does.
+    """
+    payload = _serializer(secret_key).loads(token, max_age=MAX_TOKEN_HOURS * 3600)
+    if 'j' in payload:
+        claims = {
+            'tenant_id': ObjectId(payload['t']),
+            'admin_id': ObjectId(payload['a']),
+            'token_id': payload['j'],
+            'issued_at': datetime.fromtimestamp(payload['i']),
+            'expires_at': datetime.fromtimestamp(payload['e'])
+        }
+    else:
+        # Links sent before tokens carried an id; the signature still vouches for them
+        claims = {
+            'tenant_id': ObjectId(payload['tenant_id']),
+            'admin_id': ObjectId(payload['admin_id']),
+            'token_id': hashlib.sha256(token.encode()).hexdigest()[:16],
+            'issued_at': datetime.fromisoformat(payload['timestamp']),
+            'expires_at': datetime.fromisoformat(payload['expires'])
+        }
+    if claims['expires_at'] <= datetime.now():
+        raise SignatureExpired(f"Portal token expired at {claims['expires_at']}")
+    return claims
+
+
+def _keys(claims, use=None):
+    keys = [f"token:{claims['token_id']}", f"tenant:{claims['tenant_id']}"]
+    if use:
+        keys.append(f"{use}:{claims['token_id']}")
+    return keys
+
+
+def _current_filter(db):
+    global _filter, _built_at
+    if _filter is not None and time.monotonic() - _built_at < REFRESH_SECONDS:
+        return _filter
+    with _filter_lock:
+        if _filter is None or time.monotonic() - _built_at >= REFRESH_SECONDS:
+            keys = [doc['key'] for doc in db.portal_revocations.find({'expires_at': {'$gt': datetime.now()}}, {'key': 1})]
+            bloom = BloomFilter(max(FILTER_CAPACITY, 2 * len(keys)))
+            for key in keys:
+                bloom.add(key)
+            _filter, _built_at = bloom, time.monotonic()
+        return _filter
+
+
+def is_revoked(db, claims, use=None):
+    """Whether a decoded token was revoked, already spent on use, or belongs to a tenant whose links were withdrawn"""
+    candidates = [key for key in _keys(claims, use) if key in _current_filter(db)]
+    if not candidates:
+        return False
+    for entry in db.portal_revocations.find({'key': {'$in': candidates}}, {'key': 1, 'not_before': 1}):
+        not_before = entry.get('not_before')
+        if not_before is None or claims['issued_at'] < not_before:
+            return True
+    return False
+
+
+def _record(db, key, expires_at, fields):
+    db.portal_revocations.update_one(
+        {'key': key},
+        {'$set': dict(fields, expires_at=expires_at), '$setOnInsert': {'created_at': datetime.now()}},
+        upsert=True
+    )
+    # Visible to this process at once; others see it at their next rebuild
+    with _filter_lock:
+        if _filter is not None:
+            _filter.add(key)
+
+
+def revoke(db, claims, reason='revoked', use=None):
+    """Stop one decoded token from being accepted again, or only for one use such as 'download'"""
+    _record(db, _keys(claims, use)[-1] if use else _keys(claims)[0], claims['expires_at'], {
+        'reason': reason,
+        'tenant_id': claims['tenant_id'],
+        'admin_id': claims['admin_id']
+    })
+
+
+def revoke_tenant(db, tenant_id, reason='revoked'):
+    """Withdraw every portal link issued to a tenant so far"""
+    # Token issue times are whole seconds; links issued later in this second stay valid
+    now = datetime.now().replace(microsecond=0)
+    _record(db, f"tenant:{ObjectId(tenant_id)}", now + timedelta(hours=MAX_TOKEN_HOURS), {
+        'reason': reason,
+        'tenant_id': ObjectId(tenant_id),
+        'not_before': now
+    })
@@ -0,0 +1,186 @@
+# property_backfill.py
+"""
+Backfill ``property_id`` on legacy meter readings and payments.
+
+Documents written before multi-property support have no ``property_id``, so
+property-scoped queries had to accept them with
+``$or: [{property_id: X}, {property_id: {$exists: false}}]``. This job assigns
+each one the property of its tenant (or, failing that, its house) in
+``_id``-ordered chunks written with ``bulk_write``. Progress is stored in the
+``migrations`` collection so an interrupted run resumes where it stopped, and
+re-running a finished backfill is a no-op.
+
+Once no document is left without the field, ``is_backfill_complete`` turns
+true and the application switches to plain ``property_id`` equality filters.
+
+Run ``python property_backfill.py [batch_size]``.
+"""
+import logging
+import sys
+import time
+from datetime import datetime
+
+from pymongo import ASCENDING, UpdateOne
+
+import rollups
+
+logger = logging.getLogger(__name__)
+
+MIGRATION_ID = 'property_id_backfill'
+COLLECTIONS = ('meter_readings', 'payments')
+DEFAULT_BATCH_SIZE = 500
+# How long a negative completeness check is trusted before asking the database again
+RECHECK_SECONDS = 60
+
+_complete = False
+_checked_at = 0.0
+
+
+def get_progress(db):
+    """The stored progress document, or an empty one"""
+    return db.migrations.find_one({'_id': MIGRATION_ID}) or {'_id': MIGRATION_ID, 'collections': {}}
+
+
+def _resolve_properties(db, docs):
+    """Map each document _id to the property of its tenant, else its house, else None"""
+    tenant_ids = {doc['tenant_id'] for doc in docs if doc.get('tenant_id')}
+    house_ids = {doc['house_id'] for doc in docs if doc.get('house_id')}
+    house_numbers = {doc['house_number'] for doc in docs if doc.get('house_number')}
+
+    tenant_properties = {}
+    if tenant_ids:
+        for tenant in db.tenants.find({'_id': {'$in': list(tenant_ids)}, 'property_id': {'$ne': None}}, {'property_id': 1}):
+            tenant_properties[tenant['_id']] = tenant['property_id']
+
+    house_properties = {}
+    numbered_properties = {}
+    if house_ids or house_numbers:
+        house_query = {'$or': [{'_id': {'$in': list(house_ids)}}, {'house_number': {'$in': list(house_numbers)}}]}
+        for house in db.houses.find(house_query, {'property_id': 1, 'admin_id': 1, 'house_number': 1}):
+            if not house.get('property_id'):
+                continue
+            house_properties[house['_id']] = house['property_id']
+            numbered_properties.setdefault((house.get('admin_id'), house.get('house_number')), set()).add(house['property_id'])
+
+    resolved = {}
+    for doc in docs:
+        property_id = tenant_properties.get(doc.get('tenant_id')) or house_properties.get(doc.get('house_id'))
+        if not property_id:
+            # A bare house number is only trusted when it names a house in exactly one property
+            candidates = numbered_properties.get((doc.get('admin_id'), doc.get('house_number')), set())
+            if len(candidates) == 1:
+                property_id = next(iter(candidates))
+        resolved[doc['_id']] = property_id
+    return resolved
+
+
+def backfill_collection(db, collection, batch_size=DEFAULT_BATCH_SIZE):
+    """Backfill one collection from its saved position; returns (assigned, unassigned)"""
+    progress = get_progress(db).get('collections', {}).get(collection, {})
+    last_id = progress.get('last_id')
+    assigned = unassigned = 0
+
+    while True:
+        query = {'property_id': {'$exists': False}}
+        if last_id is not None:
+            query['_id'] = {'$gt': last_id}
+        docs = list(db[collection].find(
+            query, {'tenant_id': 1, 'house_id': 1, 'house_number': 1, 'admin_id': 1}
+        ).sort('_id', ASCENDING).limit(batch_size))
+        if not docs:
+            break
+
+        resolved = _resolve_properties(db, docs)
+        # Orphans get an explicit null so they stop matching the legacy filter and are not rescanned
+        operations = [
+            UpdateOne({'_id': doc_id, 'property_id': {'$exists': False}}, {'$set': {'property_id': property_id}})
+            for doc_id, property_id in resolved.items()
+        ]
+        db[collection].bulk_write(operations, ordered=False)
+
+        batch_assigned = sum(1 for property_id in resolved.values() if property_id)
+        assigned += batch_assigned
+        unassigned += len(resolved) - batch_assigned
+        last_id = docs[-1]['_id']
+
+        db.migrations.update_one(
+            {'_id': MIGRATION_ID},
+            {
+                '$set': {f'collections.{collection}.last_id': last_id, 'updated_at': datetime.now()},
+                '$inc': {
+                    f'collections.{collection}.assigned': batch_assigned,
+                    f'collections.{collection}.unassigned': len(resolved) - batch_assigned
+                }
+            },
+            upsert=True
+        )
+        logger.info(f"Backfilled {collection} up to {last_id}: {assigned} assigned, {unassigned} without a property")
+
+    return assigned, unassigned
+
+
+def remaining(db):
+    """Number of legacy documents still missing property_id, per collection"""
+    return {collection: db[collection].count_documents({'property_id': {'$exists': False}}) for collection in COLLECTIONS}
+
+
+def run_backfill(db, batch_size=DEFAULT_BATCH_SIZE):
+    """Backfill every collection and record completion once nothing is left"""
+    changed = 0
+    for collection in COLLECTIONS:
+        assigned, unassigned = backfill_collection(db, collection, batch_size)
+        changed += assigned + unassigned
+
+    left = remaining(db)
+    if any(left.values()):
+        # Documents inserted behind the cursor without a property; the next run starts over for them
+        db.migrations.update_one({'_id': MIGRATION_ID}, {'$unset': {'collections': ''}})
+        logger.warning(f"Property backfill incomplete, still missing: {left}")
+        return False
+
+    if changed:
+        # Rollups were keyed by the documents' old, missing property
+        rollups.rebuild_monthly_rollups(db)
+
+    db.migrations.update_one(
+        {'_id': MIGRATION_ID},
+        {'$set': {'completed_at': datetime.now()}},
+        upsert=True
+    )
+    logger.info("Property backfill complete")
+    return True
+
+
+def is_backfill_complete(db):
+    """Whether property-scoped queries can use plain equality on property_id"""
+    global _complete, _checked_at
+    if _complete:
+        return True
+
+    now = time.monotonic()
+    if now - _checked_at < RECHECK_SECONDS:
+        return False
+    _checked_at = now
+
+    try:
+        _complete = bool(get_progress(db).get('completed_at'))
+    except Exception as e:
+        logger.error(f"Error checking property backfill status: {e}")
+    return _complete
+
+
+def property_filter(db, property_id):
+    """Property isolation clause; legacy documents without property_id match until the backfill is done"""
+    if is_backfill_complete(db):
+        return {'property_id': property_id}
+    return {'$or': [{'property_id': property_id}, {'property_id': {'$exists': False}}]}
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    from home import mongo
+
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_BATCH_SIZE
+    done = run_backfill(mongo.db, size)
+    print("Backfill complete" if done else f"Backfill incomplete: {remaining(mongo.db)}")
+    sys.exit(0 if done else 1)
@@ -0,0 +1,282 @@
+# report_jobs.py
+"""
+Background report jobs with a content-addressed artifact cache.
+
+Report and export routes used to build their files inside the request.
+``enqueue`` now records a ``report_jobs`` document and hands the build to a
+pool of ``REPORT_WORKERS`` worker processes, which run the builders in
+reports.py against their own database connection. The route returns the job
+id at once; clients poll the job and then download the artifact.
+
+Artifacts are files in ``REPORT_DIR`` named by a hash of (report type, admin,
+property, parameters, data version). The data version combines the latest
+write to the admin's monthly rollups, which every reading, bill and payment
+updates, the latest tenant edit (name, phone, house or transfer), the newest
+reading and the tenant count. An identical request inside the validity
+window (``REPORT_CACHE_SECONDS``) reuses the finished artifact, or joins the
+job still building it, instead of computing it again; any change to the
+underlying data changes the key. The hash doubles as the download's ETag.
+
+Artifacts live on the local disk of the host that built them. When the app
+runs on several hosts, point ``REPORT_DIR`` at shared storage; otherwise a
+download that lands on another host queues the report again.
+
+Run ``python report_jobs.py`` to delete expired artifacts.
+"""
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+
+from pymongo import MongoClient, ReturnDocument
+from pymongo.errors import DuplicateKeyError
+from pymongo.server_api import ServerApi
+
+import reports
+
+logger = logging.getLogger(__name__)
+
+WORKERS = int(os.getenv('REPORT_WORKERS', 2))
+CACHE_SECONDS = int(os.getenv('REPORT_CACHE_SECONDS', 3600))
+STALE_MINUTES = int(os.getenv('REPORT_JOB_STALE_MINUTES', 30))
+REPORT_DIR = os.getenv('REPORT_DIR', os.path.join(tempfile.gettempdir(), 'water_billing_reports'))
+
+XLSX_MIMETYPE = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+CSV_MIMETYPE = 'text/csv'
+
+# Report type: builder, and whether the artifact depends on the admin's data
+REPORTS = {
+    'analytics': {'build': reports.analytics_report, 'versioned': True},
+    'readings_export': {'build': reports.readings_export, 'versioned': True},
+    'tenant_history': {'build': reports.tenant_history_export, 'versioned': True},
+    'bulk_readings_template': {'build': reports.bulk_readings_template, 'versioned': False},
+}
+
+_executor = None
+_executor_lock = threading.Lock()
+_worker_db = None
+_last_sweep = 0.0
+
+
+def _latest(db, collection, admin_id, field):
+    document = db[collection].find_one({'admin_id': admin_id}, {field: 1}, sort=[(field, -1)])
+    value = document.get(field) if document else None
+    return value.isoformat() if isinstance(value, datetime) else str(value or '-')
+
+
+def data_version(db, admin_id):
+    """Token that changes whenever the admin's readings, bills, payments or tenants change"""
+    return ':'.join([
+        _latest(db, 'monthly_rollups', admin_id, 'updated_at'),
+        _latest(db, 'tenants', admin_id, 'updated_at'),
+        _latest(db, 'meter_readings', admin_id, '_id'),
+        str(db.tenants.count_documents({'admin_id': admin_id}))
+    ])
+
+
+def cache_key(report_type, admin_id, property_id, params, version):
+    """Content address of an artifact: a hash of everything it is built from"""
+    payload = json.dumps([report_type, str(admin_id), str(property_id), params, version], sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def mimetype(job):
+    return CSV_MIMETYPE if job['filename'].endswith('.csv') else XLSX_MIMETYPE
+
+
+def artifact_path(job):
+    """Where the artifact of a job is (or will be) stored"""
+    return os.path.join(REPORT_DIR, job['cache_key'] + os.path.splitext(job['filename'])[1])
+
+
+def _reusable(job, now):
+    if job['status'] == 'completed':
+        return job['expires_at'] > now and os.path.exists(artifact_path(job))
+    if job['status'] in ('queued', 'running'):
+        return job['updated_at'] > now - timedelta(minutes=STALE_MINUTES)
+    return False
+
+
+def enqueue(db, report_type, admin_id, property_id, params, filename):
+    """Queue a report, or return the job that already has (or is building) the same artifact"""
+    version = data_version(db, admin_id) if REPORTS[report_type]['versioned'] else None
+    key = cache_key(report_type, admin_id, property_id, params, version)
+    now = datetime.now()
+
+    existing = db.report_jobs.find_one({'active_key': key})
+    if existing and _reusable(existing, now):
+        return existing
+    if existing:
+        # Expired, lost its artifact, or its worker died: it stops blocking a new build
+        db.report_jobs.update_one(
+            {'_id': existing['_id'], 'active_key': key},
+            {'$set': {'status': 'expired' if existing['status'] == 'completed' else 'abandoned'}, '$unset': {'active_key': ''}}
+        )
+
+    job = {
+        'report_type': report_type,
+        'admin_id': admin_id,
+        'property_id': property_id,
+        'params': params,
+        'filename': filename,
+        'data_version': version,
+        'cache_key': key,
+        'active_key': key,
+        'status': 'queued',
+        'created_at': now,
+        'updated_at': now,
+        'expires_at': now + timedelta(seconds=CACHE_SECONDS)
+    }
+    try:
+        job['_id'] = db.report_jobs.insert_one(job).inserted_id
+    except DuplicateKeyError:
+        # An identical request queued it first
+        return db.report_jobs.find_one({'active_key': key}) or job
+
+    _sweep_if_due()
+    _submit(db, job)
+    return job
+
+
+def _submit(db, job):
+    if WORKERS <= 0:
+        # No pool configured: build in this process before returning
+        _run(db, job['_id'])
+        return
+    pool = _pool()
+    try:
+        future = pool.submit(run_job, job['_id'])
+    except Exception as e:
+        logger.error(f"Error submitting report job {job['_id']}: {e}")
+        _discard_pool(pool)
+        _fail(db, job['_id'], f"Could not start the report: {e}")
+        return
+
+    def finished(future):
+        # Build errors are recorded by the worker; this only sees a worker process that died
+        error = None if future.cancelled() else future.exception()
+        if error:
+            logger.error(f"Report worker crashed on job {job['_id']}: {error}")
+            _discard_pool(pool)
+            _fail(db, job['_id'], 'The report worker stopped unexpectedly')
+
+    future.add_done_callback(finished)
+
+
+def _pool():
+    """Worker process pool, started on first use; spawned so no web-process threads or sockets are inherited"""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ProcessPoolExecutor(
+                max_workers=WORKERS,
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=_init_worker
+            )
+        return _executor
+
+
+def _discard_pool(pool):
+    """Drop a broken pool so the next job starts a fresh one"""
+    global _executor
+    with _executor_lock:
+        if _executor is pool:
+            _executor = None
+    pool.shutdown(wait=False)
+
+
+def _init_worker():
+    """Open the worker process's own database connection"""
+    global _worker_db
+    logging.basicConfig(level=logging.INFO)
+    client = MongoClient(os.getenv('MONGO_URI'), server_api=ServerApi('1'))
+    _worker_db = client.get_database(os.getenv('DATABASE_NAME'))
+
+
+def run_job(job_id):
+    """Entry point in a worker process"""
+    _run(_worker_db, job_id)
+
+
+def _fail(db, job_id, error):
+    db.report_jobs.update_one(
+        {'_id': job_id},
+        {'$set': {'status': 'failed', 'error': error, 'updated_at': datetime.now()}, '$unset': {'active_key': ''}}
+    )
+
+
+def _run(db, job_id):
+    """Build a queued job's artifact unless a file with the same content address already exists"""
+    started = time.monotonic()
+    job = db.report_jobs.find_one_and_update(
+        {'_id': job_id, 'status': 'queued'},
+        {'$set': {'status': 'running', 'started_at': datetime.now(), 'updated_at': datetime.now()}},
+        return_document=ReturnDocument.AFTER
+    )
+    if not job:
+        return
+
+    path = artifact_path(job)
+    try:
+        if not os.path.exists(path):
+            os.makedirs(REPORT_DIR, exist_ok=True)
+            partial = f"{path}.{os.getpid()}.part"
+            try:
+                REPORTS[job['report_type']]['build'](db, job['admin_id'], job.get('property_id'), job['params'], partial)
+                os.replace(partial, path)
+            finally:
+                if os.path.exists(partial):
+                    os.remove(partial)
+        else:
+            # Same content address: the file on disk is this report; keep it past the next sweep
+            os.utime(path)
+    except Exception as e:
+        logger.error(f"Error building {job['report_type']} report {job_id}: {e}")
+        _fail(db, job_id, str(e))
+        return
+
+    db.report_jobs.update_one({'_id': job_id}, {'$set': {
+        'status': 'completed',
+        'size': os.path.getsize(path),
+        'duration_ms': round((time.monotonic() - started) * 1000),
+        'completed_at': datetime.now(),
+        'updated_at': datetime.now()
+    }})
+
+
+def sweep(max_age_seconds=CACHE_SECONDS):
+    """Delete artifacts older than the validity window; returns how many were removed"""
+    removed = 0
+    cutoff = time.time() - max_age_seconds
+    try:
+        entries = list(os.scandir(REPORT_DIR))
+    except FileNotFoundError:
+        return 0
+    for entry in entries:
+        try:
+            # Partial files belong to builds still running until those count as stale
+            age_limit = cutoff if not entry.name.endswith('.part') else time.time() - STALE_MINUTES * 60
+            if entry.is_file() and entry.stat().st_mtime < age_limit:
+                os.remove(entry.path)
+                removed += 1
+        except OSError as e:
+            logger.warning(f"Could not remove report artifact {entry.path}: {e}")
+    return removed
+
+
+def _sweep_if_due():
+    global _last_sweep
+    if time.monotonic() - _last_sweep >= CACHE_SECONDS:
+        _last_sweep = time.monotonic()
+        sweep()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    print(f"Removed {sweep()} expired report artifacts from {REPORT_DIR}")
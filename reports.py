@@ -0,0 +1,381 @@
+# reports.py
+"""
+Report and export builders.
+
+Each builder writes one artifact to a path from the database handle it is
+given and nothing else (no request, session or app globals), so the same
+code runs in a report worker process (see report_jobs.py) and inside a
+request. Rows are streamed through exports.py, so memory stays bounded
+whatever the size of the history.
+"""
+import itertools
+import logging
+from datetime import datetime, timedelta
+
+from bson import ObjectId
+
+import exports
+import property_backfill
+import rollups
+import tenant_statements
+
+logger = logging.getLogger(__name__)
+
+READING_HISTORY_HEADERS = ['Date', 'Previous Reading (m³)', 'Current Reading (m³)', 'Usage (m³)', 'Bill Amount', 'Payment Status', 'Amount Paid', 'Outstanding']
+TOP_CONSUMERS = 20
+# Water rollups; legacy payments without a bill_type were water bills
+WATER_BILL_TYPES = ['water', None]
+
+
+def reading_history_rows(readings, totals=None):
+    """Export rows for readings carrying payment fields, adding them to totals as they stream past"""
+    for reading in readings:
+        if totals is not None:
+            totals['count'] += 1
+            totals['usage'] += reading.get('usage') or 0
+            totals['billed'] += reading.get('bill_amount') or 0
+        yield [
+            reading['date_recorded'], reading.get('previous_reading'), reading.get('current_reading'), reading.get('usage'),
+            reading.get('bill_amount'), reading['payment_status'], reading['amount_paid'], reading['outstanding']
+        ]
+
+
+def reading_history_workbook(sheet_name, title, details, readings, billed_label='Total Billed:', with_average=False):
+    """Workbook builder for exports.write_xlsx: tenant details, the streamed reading history, then its totals"""
+    def build(workbook):
+        worksheet = workbook.add_worksheet(sheet_name)
+
+        header_format = workbook.add_format({
+            'bold': True,
+            'bg_color': '#4472C4',
+            'font_color': 'white',
+            'border': 1,
+            'align': 'center'
+        })
+        cell_format = workbook.add_format({
+            'border': 1,
+            'align': 'center'
+        })
+        currency_format = workbook.add_format({
+            'border': 1,
+            'align': 'center',
+            'num_format': '"Ksh "#,##0.00'
+        })
+        date_format = workbook.add_format({
+            'border': 1,
+            'align': 'center',
+            'num_format': 'yyyy-mm-dd'
+        })
+
+        # Rows go out in order: the sheet is written in constant_memory mode
+        worksheet.write('A1', title, header_format)
+        for row, (label, value) in enumerate(details, 1):
+            worksheet.write(row, 0, label, cell_format)
+            worksheet.write(row, 1, value, cell_format)
+
+        start_row = 6
+        worksheet.write('A6', 'Reading History', header_format)
+        totals = {'count': 0, 'usage': 0, 'billed': 0}
+        formats = [date_format, cell_format, cell_format, cell_format, currency_format, cell_format, currency_format, currency_format]
+        exports.write_table(worksheet, start_row + 1, READING_HISTORY_HEADERS, reading_history_rows(readings, totals),
+                            header_format, formats)
+
+        if totals['count']:
+            summary_row = start_row + totals['count'] + 3
+            worksheet.write(summary_row, 0, 'Summary Statistics', header_format)
+            worksheet.write(summary_row + 1, 0, 'Total Readings:', cell_format)
+            worksheet.write(summary_row + 1, 1, totals['count'], cell_format)
+            worksheet.write(summary_row + 2, 0, 'Total Usage:', cell_format)
+            worksheet.write(summary_row + 2, 1, totals['usage'], cell_format)
+            worksheet.write(summary_row + 3, 0, billed_label, cell_format)
+            worksheet.write(summary_row + 3, 1, totals['billed'], currency_format)
+            if with_average:
+                worksheet.write(summary_row + 4, 0, 'Average Usage:', cell_format)
+                worksheet.write(summary_row + 4, 1, totals['usage'] / totals['count'], cell_format)
+
+    return build
+
+
+def tenant_history_export(db, admin_id, property_id, params, path):
+    """One tenant's reading history with payment status, as xlsx or csv (params tenant_id, format)"""
+    tenant = db.tenants.find_one({'_id': ObjectId(params['tenant_id']), 'admin_id': admin_id})
+    if not tenant:
+        raise LookupError('Tenant not found')
+
+    readings = tenant_statements.history(db, tenant, admin_id, batch_size=exports.BATCH_SIZE)
+    if params.get('format') == 'csv':
+        exports.write_csv(path, READING_HISTORY_HEADERS, reading_history_rows(readings))
+        return
+    exports.write_xlsx(path, reading_history_workbook(
+        f"{tenant['name']}_History", 'Tenant Information',
+        [('Name:', tenant['name']), ('Phone:', tenant['phone']), ('House Number:', tenant['house_number'])],
+        readings, billed_label='Total Amount:', with_average=True
+    ))
+
+
+def readings_export(db, admin_id, property_id, params, path):
+    """Every tenant's readings as Date/Reading column pairs, the bulk import layout, as xlsx or csv (params format)"""
+    # Widest history decides the number of Date/Reading column pairs
+    longest = next(db.meter_readings.aggregate([
+        {'$match': {'admin_id': admin_id, 'tenant_id': {'$ne': None}}},
+        {'$group': {'_id': '$tenant_id', 'readings': {'$sum': 1}}},
+        {'$group': {'_id': None, 'readings': {'$max': '$readings'}}}
+    ]), None)
+    readings_count = max(longest['readings'] if longest else 1, 1)
+
+    # Tenants with their readings, streamed in batches; each lookup keeps only the two fields exported
+    tenants_with_readings = db.tenants.aggregate([
+        {'$match': {'admin_id': admin_id}},
+        {'$sort': {'name': 1}},
+        {'$project': {'name': 1, 'phone': 1}},
+        {'$lookup': {
+            'from': 'meter_readings',
+            'let': {'tenant_id': '$_id'},
+            'pipeline': [
+                {'$match': {
+                    '$expr': {'$eq': ['$tenant_id', '$$tenant_id']},
+                    'admin_id': admin_id
+                }},
+                {'$sort': {'date_recorded': 1}},
+                {'$project': {'_id': 0, 'date_recorded': 1, 'current_reading': 1}}
+            ],
+            'as': 'readings'
+        }}
+    ], batchSize=exports.BATCH_SIZE)
+
+    def rows():
+        for tenant in tenants_with_readings:
+            row = [tenant['name'], tenant['phone']]
+            for reading in tenant['readings']:
+                date_recorded = reading.get('date_recorded')
+                row += [date_recorded.strftime('%Y-%m-%d') if date_recorded else None, reading.get('current_reading')]
+            # Fill empty reading slots
+            if not tenant['readings']:
+                row += [datetime.now().strftime('%Y-%m-%d'), 0]
+            yield row + [None] * (2 + 2 * readings_count - len(row))
+
+    tenant_rows = rows()
+    first_row = next(tenant_rows, None)
+    if first_row is None:
+        # Create sample data if no tenants exist
+        sample_date = datetime.now()
+        readings_count = 2
+        tenant_rows = iter([[
+            'Sample Tenant', '+254712345678',
+            sample_date.strftime('%Y-%m-%d'), 0,
+            (sample_date + timedelta(days=30)).strftime('%Y-%m-%d'), 25
+        ]])
+    else:
+        tenant_rows = itertools.chain([first_row], tenant_rows)
+
+    headers = ['Name', 'Phone']
+    for i in range(1, readings_count + 1):
+        headers.extend([f'Date {i}', f'Reading {i}'])
+
+    if params.get('format') == 'csv':
+        exports.write_csv(path, headers, tenant_rows)
+        return
+
+    def build(workbook):
+        worksheet = workbook.add_worksheet('Water Readings')
+        header_format = workbook.add_format({'bold': True, 'border': 1, 'align': 'center'})
+        exports.write_table(worksheet, 0, headers, tenant_rows, header_format)
+
+    exports.write_xlsx(path, build)
+
+
+def analytics_summary(db, admin_id, property_id):
+    """This month's consumption, total revenue and average usage per tenant, as the dashboard computes them"""
+    include_legacy = not property_backfill.is_backfill_complete(db)
+    current_month = datetime.now().replace(day=1)
+
+    monthly_consumption = rollups.sum_rollups(db, rollups.rollup_query(
+        admin_id, property_id, since_month=current_month, bill_types=WATER_BILL_TYPES, include_legacy=include_legacy
+    ))['usage']
+    water_revenue = rollups.sum_rollups(db, rollups.rollup_query(
+        admin_id, property_id, bill_types=WATER_BILL_TYPES, include_legacy=include_legacy
+    ))['billed']
+    rent_revenue = rollups.sum_rollups(db, rollups.rollup_query(
+        admin_id, property_id, bill_types=['rent'], include_legacy=include_legacy
+    ))['collected']
+
+    tenant_query = {'admin_id': admin_id}
+    if property_id:
+        tenant_query['property_id'] = property_id
+    tenant_count = db.tenants.count_documents(tenant_query)
+
+    return {
+        'monthly_consumption': round(monthly_consumption, 1),
+        'total_revenue': round(water_revenue + rent_revenue, 2),
+        'avg_usage': round(monthly_consumption / tenant_count, 1) if tenant_count else 0
+    }
+
+
+def top_consumers(db, admin_id, limit=TOP_CONSUMERS):
+    """Tenants with the highest total usage, with their revenue and reading counts"""
+    return list(db.meter_readings.aggregate([
+        {'$match': {'admin_id': admin_id, 'tenant_id': {'$ne': None}}},
+        {'$group': {
+            '_id': '$tenant_id',
+            'total_usage': {'$sum': '$usage'},
+            'total_revenue': {'$sum': '$bill_amount'},
+            'reading_count': {'$sum': 1}
+        }},
+        {'$sort': {'total_usage': -1}},
+        # Tenants are looked up per consumer rather than per reading, and only until the limit is
+        # reached; readings of tenants that no longer exist drop out as they always did
+        {'$lookup': {'from': 'tenants', 'localField': '_id', 'foreignField': '_id', 'as': 'tenant_info'}},
+        {'$unwind': '$tenant_info'},
+        {'$limit': limit},
+        {'$project': {
+            'name': '$tenant_info.name',
+            'house_number': '$tenant_info.house_number',
+            'total_usage': 1,
+            'total_revenue': 1,
+            'reading_count': 1
+        }}
+    ]))
+
+
+def analytics_report(db, admin_id, property_id, params, path):
+    """Analytics workbook: summary, monthly trends for the past 12 months and top consumers"""
+    def build(workbook):
+        # Create header format
+        header_format = workbook.add_format({
+            'bold': True,
+            'font_color': 'white',
+            'bg_color': '#4472C4',
+            'border': 1
+        })
+
+        # Create data format
+        data_format = workbook.add_format({
+            'border': 1,
+            'align': 'center'
+        })
+
+        # Create currency format
+        currency_format = workbook.add_format({
+            'num_format': 'KES #,##0.00',
+            'border': 1,
+            'align': 'right'
+        })
+
+        # Summary Sheet
+        summary_sheet = workbook.add_worksheet('Analytics Summary')
+        analytics_data = analytics_summary(db, admin_id, property_id)
+
+        summary_sheet.write(0, 0, 'Analytics Summary Report', workbook.add_format({'bold': True, 'font_size': 16}))
+        summary_sheet.write(1, 0, f"Generated on: {datetime.now().strftime('%Y-%m-%d %H:%M')}")
+
+        summary_sheet.write(3, 0, 'Metric', header_format)
+        summary_sheet.write(3, 1, 'Value', header_format)
+
+        summary_sheet.write(4, 0, 'Monthly Consumption (m³)', data_format)
+        summary_sheet.write(4, 1, analytics_data['monthly_consumption'], data_format)
+
+        summary_sheet.write(5, 0, 'Total Revenue (KES)', data_format)
+        summary_sheet.write(5, 1, analytics_data['total_revenue'], currency_format)
+
+        summary_sheet.write(6, 0, 'Average Usage per Tenant (m³)', data_format)
+        summary_sheet.write(6, 1, analytics_data['avg_usage'], data_format)
+
+        tenant_count = db.tenants.count_documents({"admin_id": admin_id})
+        summary_sheet.write(7, 0, 'Total Tenants', data_format)
+        summary_sheet.write(7, 1, tenant_count, data_format)
+
+        # Monthly Trends Sheet
+        trends_sheet = workbook.add_worksheet('Monthly Trends')
+
+        # Get monthly data for the past 12 months
+        twelve_months_ago = datetime.now() - timedelta(days=365)
+        monthly_trends = rollups.monthly_totals(db, rollups.rollup_query(
+            admin_id, since_month=twelve_months_ago, bill_types=WATER_BILL_TYPES
+        ))
+
+        trends_sheet.write(0, 0, 'Month', header_format)
+        trends_sheet.write(0, 1, 'Total Usage (m³)', header_format)
+        trends_sheet.write(0, 2, 'Total Revenue (KES)', header_format)
+        trends_sheet.write(0, 3, 'Number of Readings', header_format)
+
+        for i, (month_str, trend) in enumerate(monthly_trends, 1):
+            trends_sheet.write(i, 0, month_str, data_format)
+            trends_sheet.write(i, 1, trend['usage'], data_format)
+            trends_sheet.write(i, 2, trend['billed'], currency_format)
+            trends_sheet.write(i, 3, trend['reading_count'], data_format)
+
+        # Top Consumers Sheet
+        consumers_sheet = workbook.add_worksheet('Top Consumers')
+
+        consumers_sheet.write(0, 0, 'Rank', header_format)
+        consumers_sheet.write(0, 1, 'Name', header_format)
+        consumers_sheet.write(0, 2, 'House Number', header_format)
+        consumers_sheet.write(0, 3, 'Total Usage (m³)', header_format)
+        consumers_sheet.write(0, 4, 'Total Revenue (KES)', header_format)
+        consumers_sheet.write(0, 5, 'Number of Readings', header_format)
+
+        for i, consumer in enumerate(top_consumers(db, admin_id), 1):
+            consumers_sheet.write(i, 0, i, data_format)
+            consumers_sheet.write(i, 1, consumer['name'], data_format)
+            consumers_sheet.write(i, 2, consumer['house_number'], data_format)
+            consumers_sheet.write(i, 3, consumer['total_usage'], data_format)
+            consumers_sheet.write(i, 4, consumer['total_revenue'], currency_format)
+            consumers_sheet.write(i, 5, consumer['reading_count'], data_format)
+
+        # Set column widths
+        for sheet in [summary_sheet, trends_sheet, consumers_sheet]:
+            for col in range(6):
+                sheet.set_column(col, col, 15)
+
+    exports.write_xlsx(path, build)
+
+
+def bulk_readings_template(db, admin_id, property_id, params, path):
+    """Excel template for the bulk readings import"""
+    def build(workbook):
+        worksheet = workbook.add_worksheet('Bulk Readings Template')
+
+        # Create formats
+        header_format = workbook.add_format({
+            'bold': True,
+            'bg_color': '#D7E4BC',
+            'border': 1,
+            'text_wrap': True,
+            'valign': 'top'
+        })
+
+        cell_format = workbook.add_format({
+            'border': 1,
+            'text_wrap': True,
+            'valign': 'top'
+        })
+
+        # Set column widths
+        worksheet.set_column('A:A', 15)
+        worksheet.set_column('B:B', 18)
+
+        # Write headers
+        headers = ['house_number', 'current_reading']
+        for col, header in enumerate(headers):
+            worksheet.write(0, col, header, header_format)
+
+        # Write sample data
+        sample_data = [
+            ['A08', 30],
+            ['B12', 45.5],
+            ['C05', 25],
+            ['D14', 38]
+        ]
+
+        for row, data in enumerate(sample_data, 1):
+            for col, value in enumerate(data):
+                worksheet.write(row, col, value, cell_format)
+
+        # Add instructions
+        worksheet.write('A7', 'Instructions:', header_format)
+        worksheet.write('A8', '1. Fill in house_number column with exact house numbers', cell_format)
+        worksheet.write('A9', '2. Fill in current_reading column with meter readings', cell_format)
+        worksheet.write('A10', '3. Save the file and upload through the dashboard', cell_format)
+        worksheet.write('A11', '4. System will calculate usage automatically', cell_format)
+
+    exports.write_xlsx(path, build)
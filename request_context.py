@@ -0,0 +1,58 @@
+# request_context.py
+"""
+Request-scoped memo for documents looked up repeatedly while serving one request.
+
+The subscription decorator, the route body and helpers such as
+``get_rate_per_unit`` or ``get_property_payment_info`` each used to fetch the
+same admin, property and settings documents. Lookups routed through
+``memoize`` run once per request and are kept on ``flask.g``, so nothing
+outlives the request; code that changes one of these documents mid-request
+calls ``invalidate`` so later lookups see the write. Outside a request
+(background workers, CLI jobs) every lookup goes straight to the loader.
+
+Values are shared between callers, so treat them as read-only.
+"""
+from flask import g, has_request_context
+
+_ANY = object()
+
+
+def _store():
+    store = g.get('_request_context')
+    if store is None:
+        store = g._request_context = {'values': {}, 'loads': 0, 'saved': 0}
+    return store
+
+
+def memoize(kind, key, loader):
+    """Return the value cached for (kind, key) in this request, calling loader() the first time"""
+    if not has_request_context():
+        return loader()
+    store = _store()
+    if (kind, key) in store['values']:
+        store['saved'] += 1
+        return store['values'][(kind, key)]
+    store['loads'] += 1
+    value = store['values'][(kind, key)] = loader()
+    return value
+
+
+def invalidate(kind=None, key=_ANY):
+    """Forget cached lookups: everything, one kind, or one (kind, key)"""
+    if not has_request_context():
+        return
+    values = _store()['values']
+    for cached_kind, cached_key in list(values):
+        if kind is not None and cached_kind != kind:
+            continue
+        if key is not _ANY and cached_key != key:
+            continue
+        del values[(cached_kind, cached_key)]
+
+
+def stats():
+    """Lookups loaded and lookups answered from the cache in this request"""
+    if not has_request_context():
+        return {'loads': 0, 'saved': 0}
+    store = _store()
+    return {'loads': store['loads'], 'saved': store['saved']}
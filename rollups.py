@@ -0,0 +1,200 @@
+# rollups.py
+"""
+Monthly usage and revenue rollups.
+
+``monthly_rollups`` holds one document per (admin_id, property_id, month,
+bill_type) with running totals that are kept current with ``$inc`` on every
+reading insert and payment change, so dashboards read O(months) documents
+instead of scanning every reading.
+
+Run ``python rollups.py [admin_id]`` to rebuild totals from history.
+"""
+import logging
+import sys
+from collections import defaultdict
+from datetime import datetime
+
+from bson import ObjectId
+from pymongo import UpdateOne
+
+import db_indexes
+
+logger = logging.getLogger(__name__)
+
+ROLLUP_FIELDS = ('usage', 'reading_count', 'billed', 'collected', 'bill_count')
+
+
+def month_key(value):
+    """Normalise a datetime or 'YYYY-MM' string to the rollup month key"""
+    if isinstance(value, datetime):
+        return value.strftime('%Y-%m')
+    return value
+
+
+def ensure_rollup_indexes(db):
+    """Create the unique rollup key index"""
+    db_indexes.ensure_indexes(db, ['monthly_rollups'])
+
+
+def _reading_key(reading):
+    return (reading.get('admin_id'), reading.get('property_id'), month_key(reading.get('date_recorded')), 'water')
+
+
+def _payment_key(payment):
+    return (payment.get('admin_id'), payment.get('property_id'), month_key(payment.get('month_year')), payment.get('bill_type'))
+
+
+def _apply(db, increments):
+    """Upsert accumulated {key: {field: delta}} increments in one bulk write"""
+    operations = []
+    now = datetime.now()
+    for (admin_id, property_id, month, bill_type), deltas in increments.items():
+        deltas = {field: value for field, value in deltas.items() if value}
+        if not deltas or not admin_id or not month:
+            continue
+        operations.append(UpdateOne(
+            {'admin_id': admin_id, 'property_id': property_id, 'month': month, 'bill_type': bill_type},
+            {'$inc': deltas, '$set': {'updated_at': now}},
+            upsert=True
+        ))
+
+    if operations:
+        db.monthly_rollups.bulk_write(operations, ordered=False)
+
+
+def record_readings(db, readings, sign=1):
+    """Add (or with sign=-1 remove) readings' usage to the rollups"""
+    try:
+        increments = defaultdict(lambda: defaultdict(int))
+        for reading in readings:
+            deltas = increments[_reading_key(reading)]
+            deltas['usage'] += sign * float(reading.get('usage') or 0)
+            deltas['reading_count'] += sign
+        _apply(db, increments)
+    except Exception as e:
+        logger.error(f"Error updating reading rollups: {e}")
+
+
+def record_bills(db, payments, sign=1):
+    """Add (or with sign=-1 remove) new payment documents' billed and collected amounts"""
+    try:
+        increments = defaultdict(lambda: defaultdict(int))
+        for payment in payments:
+            deltas = increments[_payment_key(payment)]
+            deltas['billed'] += sign * float(payment.get('bill_amount') or 0)
+            deltas['collected'] += sign * float(payment.get('amount_paid') or 0)
+            deltas['bill_count'] += sign
+        _apply(db, increments)
+    except Exception as e:
+        logger.error(f"Error updating bill rollups: {e}")
+
+
+def record_collection(db, payment, amount):
+    """Add an amount collected against an existing payment document"""
+    try:
+        _apply(db, {_payment_key(payment): {'collected': float(amount)}})
+    except Exception as e:
+        logger.error(f"Error updating collection rollups: {e}")
+
+
+def rollup_query(admin_id, property_id=None, since_month=None, bill_types=None, include_legacy=True):
+    """Build a monthly_rollups filter; with include_legacy a property also matches data without one"""
+    query = {'admin_id': admin_id}
+    if property_id:
+        query['property_id'] = {'$in': [property_id, None]} if include_legacy else property_id
+    if since_month:
+        query['month'] = {'$gte': month_key(since_month)}
+    if bill_types is not None:
+        query['bill_type'] = {'$in': list(bill_types)}
+    return query
+
+
+def sum_rollups(db, query):
+    """Total every rollup field over the documents matching query"""
+    totals = dict.fromkeys(ROLLUP_FIELDS, 0)
+    for doc in db.monthly_rollups.find(query, {field: 1 for field in ROLLUP_FIELDS}):
+        for field in ROLLUP_FIELDS:
+            totals[field] += doc.get(field, 0)
+    return totals
+
+
+def monthly_totals(db, query):
+    """Rollup totals per month, oldest first: [(month, totals), ...]"""
+    by_month = defaultdict(lambda: dict.fromkeys(ROLLUP_FIELDS, 0))
+    for doc in db.monthly_rollups.find(query):
+        totals = by_month[doc['month']]
+        for field in ROLLUP_FIELDS:
+            totals[field] += doc.get(field, 0)
+    return sorted(by_month.items())
+
+
+def rebuild_monthly_rollups(db, admin_id=None):
+    """Recompute rollups from meter_readings and payments for one admin, or everyone"""
+    scope = {'admin_id': admin_id} if admin_id else {}
+
+    readings = db.meter_readings.aggregate([
+        {'$match': dict(scope, date_recorded={'$type': 'date'})},
+        {'$group': {
+            '_id': {
+                'admin_id': '$admin_id',
+                'property_id': '$property_id',
+                'month': {'$dateToString': {'format': '%Y-%m', 'date': '$date_recorded'}}
+            },
+            'usage': {'$sum': '$usage'},
+            'reading_count': {'$sum': 1}
+        }}
+    ], allowDiskUse=True)
+
+    payments = db.payments.aggregate([
+        {'$match': dict(scope, month_year={'$type': 'string'})},
+        {'$group': {
+            '_id': {
+                'admin_id': '$admin_id',
+                'property_id': '$property_id',
+                'month': '$month_year',
+                'bill_type': '$bill_type'
+            },
+            'billed': {'$sum': '$bill_amount'},
+            'collected': {'$sum': {'$ifNull': ['$amount_paid', 0]}},
+            'bill_count': {'$sum': 1}
+        }}
+    ], allowDiskUse=True)
+
+    increments = defaultdict(lambda: defaultdict(int))
+    for group in readings:
+        key = (group['_id'].get('admin_id'), group['_id'].get('property_id'), group['_id']['month'], 'water')
+        increments[key]['usage'] += group['usage'] or 0
+        increments[key]['reading_count'] += group['reading_count']
+    for group in payments:
+        key = (group['_id'].get('admin_id'), group['_id'].get('property_id'), group['_id']['month'], group['_id'].get('bill_type'))
+        increments[key]['billed'] += group['billed'] or 0
+        increments[key]['collected'] += group['collected'] or 0
+        increments[key]['bill_count'] += group['bill_count']
+
+    # Writes that land between the delete and the upserts are not double counted,
+    # but ones racing the aggregations above can be missed; run it off-peak.
+    db.monthly_rollups.delete_many(scope)
+    _apply(db, increments)
+    logger.info(f"Rebuilt {len(increments)} monthly rollups{' for admin ' + str(admin_id) if admin_id else ''}")
+    return len(increments)
+
+
+def backfill_if_empty(db):
+    """Build rollups from history the first time the collection is used"""
+    try:
+        if db.monthly_rollups.find_one({}, {'_id': 1}) is None and (
+            db.meter_readings.find_one({}, {'_id': 1}) or db.payments.find_one({}, {'_id': 1})
+        ):
+            rebuild_monthly_rollups(db)
+    except Exception as e:
+        logger.error(f"Error backfilling monthly rollups: {e}")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    from home import mongo
+
+    ensure_rollup_indexes(mongo.db)
+    target = ObjectId(sys.argv[1]) if len(sys.argv) > 1 else None
+    count = rebuild_monthly_rollups(mongo.db, target)
+    print(f"Rebuilt {count} monthly rollup documents")
@@ -131,7 +131,10 @@ def main():
 
     # Import and run the application
     try:
-        from home import app
+        from home import app, start_background_workers
+        # With the reloader only the child process serves requests
+        if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+            start_background_workers()
         print("🌐 Starting Flask development server...")
         print("💡 Access the application at: http://localhost:5000")
         print("🛑 Press Ctrl+C to stop the server")
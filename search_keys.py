@@ -0,0 +1,221 @@
+# search_keys.py
+"""
+Indexed prefix search for tenants and bills.
+
+Tenant and bill searches used unanchored case-insensitive regexes, which no
+index can serve, and the bill search ``$lookup``ed every bill's tenant and
+house before filtering. Instead, each tenant and bill carries a multikey
+``search_keys`` array written alongside the document:
+
+- ``n:<prefix>`` for every prefix of every lowercased name token
+- ``h:<prefix>`` for every prefix of the canonical house number (lowercase,
+  letters and digits only) and of each tail of it starting at a new part
+- ``p:<prefix>`` (tenants only) for every prefix of the phone number's
+  digits in international (2547...), local (07...) and bare (7...) form
+
+Bills also carry ``tenant_name`` and ``house_number`` so result pages need
+no joins. A search term matches when each of its tokens is one of the keys,
+i.e. a prefix of a name token, of the house number or of the phone number;
+that is one index lookup per term.
+
+Run ``python search_keys.py [batch_size]`` once to backfill existing
+documents; it only touches documents without keys, so it can be re-run.
+"""
+import logging
+import re
+import sys
+
+from pymongo import ASCENDING, UpdateOne
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BATCH_SIZE = 500
+SEARCH_FIELDS = ('name', 'house', 'phone')
+BILL_SEARCH_FIELDS = ('name', 'house')
+_TOKEN = re.compile(r'[0-9a-z]+')
+# Matches nothing, for terms with no searchable characters
+NO_MATCH = {'search_keys': {'$in': []}}
+
+
+def _prefixes(value):
+    return [value[:end] for end in range(1, len(value) + 1)]
+
+
+def name_tokens(name):
+    """Lowercase alphanumeric tokens of a name"""
+    return _TOKEN.findall((name or '').lower())
+
+
+def canonical_house_number(house_number):
+    """Lowercase a house number and drop everything but letters and digits: 'A-1 ' becomes 'a1'"""
+    return ''.join(name_tokens(str(house_number or '')))
+
+
+def phone_forms(phone):
+    """Digits of a Kenyan number in international, local and bare form"""
+    digits = re.sub(r'\D', '', str(phone or ''))
+    if not digits:
+        return []
+    if digits.startswith('254'):
+        national = digits[3:]
+    elif digits.startswith('0'):
+        national = digits[1:]
+    else:
+        national = digits
+    return list(dict.fromkeys(form for form in (digits, '0' + national, '254' + national, national) if form))
+
+
+def _name_keys(name):
+    return {f'n:{prefix}' for token in name_tokens(name) for prefix in _prefixes(token)}
+
+
+def _house_keys(house_number):
+    # The canonical number and every tail of it that starts at a part boundary: 'Block B-12' gives blockb12, b12 and 12
+    tokens = name_tokens(str(house_number or ''))
+    return {f'h:{prefix}' for start in range(len(tokens)) for prefix in _prefixes(''.join(tokens[start:]))}
+
+
+def _phone_keys(phone):
+    return {f'p:{prefix}' for form in phone_forms(phone) for prefix in _prefixes(form)}
+
+
+def tenant_keys(tenant):
+    """Search keys of a tenant document"""
+    return sorted(_name_keys(tenant.get('name')) | _house_keys(tenant.get('house_number')) | _phone_keys(tenant.get('phone')))
+
+
+def bill_keys(tenant_name, house_number):
+    """Search keys of a bill for its tenant's name and its house's number"""
+    return sorted(_name_keys(tenant_name) | _house_keys(house_number))
+
+
+def term_keys(term, field):
+    """The keys a document must all have to match term on field, or None if the term cannot match it"""
+    if field == 'name':
+        keys = [f'n:{token}' for token in name_tokens(term)]
+    elif field == 'house':
+        house = canonical_house_number(term)
+        keys = [f'h:{house}'] if house else []
+    elif field == 'phone':
+        digits = re.sub(r'\D', '', term or '')
+        # Only digits and phone punctuation make a phone search
+        keys = [f'p:{digits}'] if digits and not re.search(r'[^\d\s+()-]', term) else []
+    else:
+        raise ValueError(f"Unknown search field '{field}'")
+    return list(dict.fromkeys(keys)) or None
+
+
+def search_filter(term, fields=SEARCH_FIELDS):
+    """Query fragment matching documents whose keys match term on any of fields"""
+    branches = []
+    for field in fields:
+        keys = term_keys(term, field)
+        if keys:
+            branches.append({'search_keys': keys[0]} if len(keys) == 1 else {'search_keys': {'$all': keys}})
+    if not branches:
+        return dict(NO_MATCH)
+    return branches[0] if len(branches) == 1 else {'$or': branches}
+
+
+def annotate_bills(db, bills):
+    """Fill tenant_name, house_number and search_keys on new bill documents before insert"""
+    tenant_ids = {bill['tenant_id'] for bill in bills if bill.get('tenant_id')}
+    house_ids = {bill['house_id'] for bill in bills if bill.get('house_id')}
+    tenants = {
+        tenant['_id']: tenant.get('name')
+        for tenant in db.tenants.find({'_id': {'$in': list(tenant_ids)}}, {'name': 1})
+    } if tenant_ids else {}
+    houses = {
+        house['_id']: house.get('house_number')
+        for house in db.houses.find({'_id': {'$in': list(house_ids)}}, {'house_number': 1})
+    } if house_ids else {}
+
+    for bill in bills:
+        tenant_name = tenants.get(bill.get('tenant_id'), bill.get('tenant_name'))
+        house_number = houses.get(bill.get('house_id'), bill.get('house_number'))
+        if tenant_name is not None:
+            bill['tenant_name'] = tenant_name
+        if house_number is not None:
+            bill['house_number'] = house_number
+        bill['search_keys'] = bill_keys(tenant_name, house_number)
+    return bills
+
+
+def refresh_bills(db, query, batch_size=DEFAULT_BATCH_SIZE):
+    """Recompute tenant_name, house_number and search_keys of the bills matching query; returns how many changed"""
+    changed = 0
+    batch = []
+    for bill in db.payments.find(query, {'tenant_id': 1, 'house_id': 1, 'tenant_name': 1, 'house_number': 1, 'search_keys': 1}):
+        batch.append(bill)
+        if len(batch) >= batch_size:
+            changed += _write_bill_keys(db, batch)
+            batch = []
+    if batch:
+        changed += _write_bill_keys(db, batch)
+    return changed
+
+
+def _write_bill_keys(db, bills):
+    current = {bill['_id']: (bill.get('tenant_name'), bill.get('house_number'), bill.get('search_keys')) for bill in bills}
+    operations = []
+    for bill in annotate_bills(db, [dict(bill) for bill in bills]):
+        fields = {field: bill[field] for field in ('tenant_name', 'house_number', 'search_keys') if field in bill}
+        if current[bill['_id']] != (fields.get('tenant_name'), fields.get('house_number'), fields['search_keys']):
+            operations.append(UpdateOne({'_id': bill['_id']}, {'$set': fields}))
+    if operations:
+        db.payments.bulk_write(operations, ordered=False)
+    return len(operations)
+
+
+def refresh_tenants(db, admin_id, tenant_ids):
+    """Recompute the keys of tenants after their name, phone or house changed, and of their bills"""
+    tenant_ids = [tenant_id for tenant_id in tenant_ids if tenant_id]
+    if not tenant_ids:
+        return
+    operations = [
+        UpdateOne({'_id': tenant['_id']}, {'$set': {'search_keys': tenant_keys(tenant)}})
+        for tenant in db.tenants.find({'_id': {'$in': tenant_ids}}, {'name': 1, 'house_number': 1, 'phone': 1})
+    ]
+    if operations:
+        db.tenants.bulk_write(operations, ordered=False)
+    refresh_bills(db, {'admin_id': admin_id, 'tenant_id': {'$in': tenant_ids}})
+
+
+def refresh_house(db, house_id):
+    """Recompute the keys of a house's bills after its number changed"""
+    refresh_bills(db, {'house_id': house_id})
+
+
+def backfill(db, batch_size=DEFAULT_BATCH_SIZE):
+    """Add keys to every tenant and bill that has none; returns {'tenants': n, 'payments': n}"""
+    report = {'tenants': 0, 'payments': 0}
+    missing = {'search_keys': {'$exists': False}}
+
+    while True:
+        tenants = list(db.tenants.find(missing, {'name': 1, 'house_number': 1, 'phone': 1})
+                       .sort('_id', ASCENDING).limit(batch_size))
+        if not tenants:
+            break
+        db.tenants.bulk_write([
+            UpdateOne({'_id': tenant['_id']}, {'$set': {'search_keys': tenant_keys(tenant)}}) for tenant in tenants
+        ], ordered=False)
+        report['tenants'] += len(tenants)
+
+    while True:
+        bills = list(db.payments.find(missing, {'tenant_id': 1, 'house_id': 1, 'tenant_name': 1, 'house_number': 1})
+                     .sort('_id', ASCENDING).limit(batch_size))
+        if not bills:
+            break
+        _write_bill_keys(db, bills)
+        report['payments'] += len(bills)
+
+    logger.info(f"Search keys backfilled: {report}")
+    return report
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    from home import mongo
+
+    result = backfill(mongo.db, int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_BATCH_SIZE)
+    print(f"Backfilled search keys on {result['tenants']} tenants and {result['payments']} bills")
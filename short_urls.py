@@ -0,0 +1,163 @@
+# short_urls.py
+"""
+Short links for SMS: bulk minting, cached redirects and buffered click counts.
+
+Codes are the first 8 hex digits of the md5 of an identifier (or of the long
+URL), so minting the same identifier twice yields the same link and the
+first long URL stored for a code keeps it. ``mint_many`` stores a whole
+billing run's links with one ``insert_many``; codes that already exist are
+left as they are.
+
+Redirects are answered from an in-process LRU and fall back to one read on
+the unique ``short_code`` index. Clicks are counted in memory and written by
+a background thread every ``SHORT_URL_FLUSH_SECONDS`` (sooner once
+``SHORT_URL_FLUSH_THRESHOLD`` codes are pending) as one ``bulk_write`` of
+``$inc`` updates, so a burst of tenants opening their links costs one write
+per flush, not one per click. Counts still buffered when a process is killed
+are lost; a clean exit flushes them.
+"""
+import atexit
+import hashlib
+import logging
+import os
+import threading
+from datetime import datetime
+
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+
+from lru import LRUCache
+
+logger = logging.getLogger(__name__)
+
+CACHE_SIZE = int(os.getenv('SHORT_URL_CACHE_SIZE', 10000))
+CACHE_TTL_SECONDS = int(os.getenv('SHORT_URL_CACHE_TTL', 3600))
+# Unknown codes are remembered briefly so probing them does not reach the database
+MISSING_TTL_SECONDS = 60
+FLUSH_SECONDS = int(os.getenv('SHORT_URL_FLUSH_SECONDS', 10))
+FLUSH_THRESHOLD = int(os.getenv('SHORT_URL_FLUSH_THRESHOLD', 500))
+DUPLICATE_KEY = 11000
+
+_links = LRUCache(maxsize=CACHE_SIZE, ttl=CACHE_TTL_SECONDS)
+_MISSING = object()
+
+_clicks = {}
+_last_clicked = {}
+_clicks_lock = threading.Lock()
+_flush_requested = threading.Event()
+_flusher_lock = threading.Lock()
+_flusher_thread = None
+
+
+def code_for(long_url, identifier=None):
+    """Short code of a link: from the identifier when given, else from the URL"""
+    return hashlib.md5((identifier or long_url).encode()).hexdigest()[:8]
+
+
+def mint_many(db, links):
+    """Store short codes for [(long_url, identifier), ...] in one insert; returns the codes in order"""
+    now = datetime.now()
+    codes = [code_for(long_url, identifier) for long_url, identifier in links]
+    documents = {}
+    for code, (long_url, identifier) in zip(codes, links):
+        documents.setdefault(code, {
+            'short_code': code,
+            'long_url': long_url,
+            'created_at': now,
+            'click_count': 0,
+            'identifier': identifier
+        })
+    if not documents:
+        return codes
+
+    documents = list(documents.values())
+    existing = set()
+    try:
+        db.short_urls.insert_many(documents, ordered=False)
+    except BulkWriteError as e:
+        errors = e.details.get('writeErrors', [])
+        if any(error.get('code') != DUPLICATE_KEY for error in errors):
+            raise
+        # Codes minted before keep their first long URL
+        existing = {documents[error['index']]['short_code'] for error in errors}
+
+    for document in documents:
+        if document['short_code'] in existing:
+            _links.pop(document['short_code'])
+        else:
+            _links.set(document['short_code'], document['long_url'])
+    return codes
+
+
+def mint(db, long_url, identifier=None):
+    """Store one short code; returns it"""
+    return mint_many(db, [(long_url, identifier)])[0]
+
+
+def resolve(db, short_code):
+    """The long URL behind a code, or None"""
+    long_url = _links.get(short_code)
+    if long_url is None:
+        document = db.short_urls.find_one({'short_code': short_code}, {'long_url': 1})
+        if document:
+            long_url = document['long_url']
+            _links.set(short_code, long_url)
+        else:
+            long_url = _MISSING
+            _links.set(short_code, _MISSING, ttl=MISSING_TTL_SECONDS)
+    return None if long_url is _MISSING else long_url
+
+
+def record_click(db, short_code):
+    """Count a click; it reaches the database at the next flush"""
+    with _clicks_lock:
+        _clicks[short_code] = _clicks.get(short_code, 0) + 1
+        _last_clicked[short_code] = datetime.now()
+        pending = len(_clicks)
+    _start_flusher(db)
+    if pending >= FLUSH_THRESHOLD:
+        _flush_requested.set()
+
+
+def flush_clicks(db):
+    """Write buffered click counts in one bulk_write; returns how many codes were updated"""
+    global _clicks, _last_clicked
+    with _clicks_lock:
+        clicks, last_clicked = _clicks, _last_clicked
+        _clicks, _last_clicked = {}, {}
+    if not clicks:
+        return 0
+
+    try:
+        db.short_urls.bulk_write([
+            UpdateOne({'short_code': code}, {'$inc': {'click_count': count}, '$max': {'last_accessed': last_clicked[code]}})
+            for code, count in clicks.items()
+        ], ordered=False)
+    except Exception as e:
+        logger.error(f"Error flushing short URL clicks, keeping them for the next flush: {e}")
+        with _clicks_lock:
+            for code, count in clicks.items():
+                _clicks[code] = _clicks.get(code, 0) + count
+                _last_clicked[code] = max(last_clicked[code], _last_clicked.get(code, last_clicked[code]))
+        return 0
+    return len(clicks)
+
+
+def _run_flusher(db):
+    while True:
+        _flush_requested.wait(FLUSH_SECONDS)
+        _flush_requested.clear()
+        flush_clicks(db)
+
+
+def _start_flusher(db):
+    """Start the click flusher in a daemon thread, once per process"""
+    global _flusher_thread
+    if _flusher_thread is not None:
+        return
+    with _flusher_lock:
+        if _flusher_thread is not None:
+            return
+        _flusher_thread = threading.Thread(target=_run_flusher, args=(db,), name='short-url-clicks', daemon=True)
+        _flusher_thread.start()
+        atexit.register(flush_clicks, db)
@@ -0,0 +1,156 @@
+# sms_outbox.py
+"""
+Durable SMS outbox.
+
+Request paths enqueue messages into the ``sms_outbox`` collection and return
+immediately; dispatch workers claim them atomically, send them concurrently
+and write the delivery status back to the originating document.
+"""
+import logging
+import os
+from datetime import datetime
+
+import db_indexes
+from lease_queue import LeaseQueue
+
+logger = logging.getLogger(__name__)
+
+MAX_ATTEMPTS = int(os.getenv('SMS_OUTBOX_MAX_ATTEMPTS', 5))
+WORKER_THREADS = int(os.getenv('SMS_OUTBOX_THREADS', 8))
+BATCH_SIZE = int(os.getenv('SMS_OUTBOX_BATCH_SIZE', 50))
+POLL_INTERVAL_SECONDS = 2
+BASE_BACKOFF_SECONDS = 30
+MAX_BACKOFF_SECONDS = 3600
+# A message stuck in 'sending' longer than this belonged to a worker that died
+CLAIM_LEASE_SECONDS = 300
+
+queue = LeaseQueue(
+    'sms_outbox', 'SMS outbox', ready_status='queued', active_status='sending',
+    max_attempts=MAX_ATTEMPTS, threads=WORKER_THREADS, batch_size=BATCH_SIZE,
+    poll_interval=POLL_INTERVAL_SECONDS, base_backoff=BASE_BACKOFF_SECONDS,
+    max_backoff=MAX_BACKOFF_SECONDS, lease_seconds=CLAIM_LEASE_SECONDS
+)
+
+
+def sms_writeback(collection, filter, status_field=None, on_sent=None):
+    """Describe where a message's final delivery status should be written"""
+    writeback = {'collection': collection, 'filter': filter}
+    if status_field:
+        writeback['status_field'] = status_field
+    if on_sent:
+        writeback['on_sent'] = on_sent
+    return writeback
+
+
+def build_outbox_message(recipient, message, sender=None, writeback=None, context=None):
+    """Build an outbox document ready to insert"""
+    now = datetime.now()
+    return {
+        'recipient': recipient,
+        'message': message,
+        'sender': sender,
+        'status': 'queued',
+        'attempts': 0,
+        'next_attempt_at': now,
+        'writeback': writeback,
+        'context': context or {},
+        'last_error': None,
+        'created_at': now,
+        'updated_at': now
+    }
+
+
+def enqueue_sms(db, recipient, message, sender=None, writeback=None, context=None):
+    """Queue a single SMS and return its outbox id"""
+    doc = build_outbox_message(recipient, message, sender, writeback, context)
+    return db.sms_outbox.insert_one(doc).inserted_id
+
+
+def enqueue_sms_many(db, docs):
+    """Queue several prepared outbox documents in one write and return their ids"""
+    if not docs:
+        return []
+    return db.sms_outbox.insert_many(docs, ordered=False).inserted_ids
+
+
+def ensure_outbox_indexes(db):
+    """Create the indexes the claim query relies on"""
+    db_indexes.ensure_indexes(db, ['sms_outbox'])
+
+
+def claim_message(db, worker_id):
+    """Atomically claim the next due message, including ones abandoned by a dead worker"""
+    return queue.claim(db, worker_id)
+
+
+def apply_writeback(db, writeback, status):
+    """Write the final delivery status back to the originating document"""
+    if not writeback:
+        return
+
+    update = {}
+    if writeback.get('status_field'):
+        update[writeback['status_field']] = status
+    if status == 'sent' and writeback.get('on_sent'):
+        update.update(writeback['on_sent'])
+
+    if update:
+        db[writeback['collection']].update_one(writeback['filter'], {'$set': update})
+
+
+def complete_message(db, doc, response):
+    """Record the outcome of a delivery attempt, rescheduling failures with backoff"""
+    if 'error' not in response:
+        queue.settle(db, doc, 'sent', {'sent_at': datetime.now(), 'last_error': None})
+        apply_writeback(db, doc.get('writeback'), 'sent')
+        return 'sent'
+
+    error = str(response['error'])
+    if queue.exhausted(doc):
+        queue.settle(db, doc, 'failed', {'failed_at': datetime.now(), 'last_error': error})
+        apply_writeback(db, doc.get('writeback'), f"failed: {error}")
+        logger.error(f"SMS {doc['_id']} to {doc['recipient']} failed after {doc['attempts']} attempts: {error}")
+        return 'failed'
+
+    queue.retry(db, doc, error)
+    return 'retry'
+
+
+def deliver(db, send_func, doc):
+    """Send one claimed message and record the outcome"""
+    try:
+        # The outbox owns retries, so the sender makes a single attempt
+        response = send_func(doc['recipient'], doc['message'], sender=doc.get('sender'), retries=1)
+    except Exception as e:
+        response = {'error': str(e)}
+
+    try:
+        return complete_message(db, doc, response or {'error': 'Empty response'})
+    except Exception as e:
+        # Left in 'sending'; the claim lease makes it eligible again later
+        logger.error(f"Error recording SMS outcome for {doc['_id']}: {e}")
+        return 'error'
+
+
+def dispatch_pending(db, send_func, executor, worker_id, batch_size=BATCH_SIZE):
+    """Claim up to batch_size due messages and send them concurrently; returns how many were claimed"""
+    return queue.process_pending(db, lambda doc: deliver(db, send_func, doc), executor, worker_id, batch_size)
+
+
+def run_worker(db, send_func, threads=WORKER_THREADS, stop_event=None):
+    """Poll the outbox and dispatch messages until stop_event is set"""
+    queue.run_worker(db, lambda doc: deliver(db, send_func, doc), threads, stop_event)
+
+
+def start_background_dispatcher(db, send_func, threads=WORKER_THREADS):
+    """Start the dispatcher in a daemon thread, once per process"""
+    return queue.start_background(db, lambda doc: deliver(db, send_func, doc), threads)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+
+    from home import mongo, send_message
+
+    ensure_outbox_indexes(mongo.db)
+    queue.run_forever(mongo.db, lambda doc: deliver(mongo.db, send_message, doc))
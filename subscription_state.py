@@ -0,0 +1,122 @@
+# subscription_state.py
+"""
+Cached subscription state for the enforcement decorator.
+
+``enforce_subscription_payment`` runs on nearly every authenticated route.
+Instead of reading the whole admin document each time it reads a compact
+snapshot of the subscription fields, cached per admin for a short TTL and
+dropped whenever a payment or an admin action changes the subscription; the
+TTL bounds staleness for changes made by other processes.
+
+Suspension is a compare-and-set on ``subscription_status``: only the request
+(or job) that actually moves an admin into 'suspended' writes, and it records
+exactly one ``subscription_suspensions`` event. A suspended admin refreshing
+a page costs no writes.
+"""
+import logging
+import os
+from datetime import datetime, timedelta
+
+from lru import LRUCache
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_TTL_SECONDS = int(os.getenv('SUBSCRIPTION_STATE_TTL', 60))
+MAX_ADMINS = int(os.getenv('SUBSCRIPTION_STATE_MAX_ADMINS', 1024))
+GRACE_PERIOD_DAYS = 7
+PAYMENT_OVERDUE_DAYS = 30
+SNAPSHOT_FIELDS = {
+    'subscription_tier': 1,
+    'subscription_status': 1,
+    'subscription_type': 1,
+    'subscription_end_date': 1,
+    'last_payment_date': 1,
+    'auto_renew': 1,
+    'suspended_at': 1,
+    'suspension_reason': 1
+}
+
+_snapshots = LRUCache(maxsize=MAX_ADMINS, ttl=SNAPSHOT_TTL_SECONDS)
+_NO_ADMIN = object()
+
+
+def get_snapshot(db, admin_id):
+    """The admin's subscription fields, or None if there is no such admin"""
+    snapshot = _snapshots.get(admin_id)
+    if snapshot is None:
+        snapshot = db.admins.find_one({'_id': admin_id}, SNAPSHOT_FIELDS) or _NO_ADMIN
+        _snapshots.set(admin_id, snapshot)
+    return None if snapshot is _NO_ADMIN else snapshot
+
+
+def invalidate(admin_id):
+    """Drop an admin's snapshot after their subscription changes"""
+    _snapshots.pop(admin_id)
+
+
+def evaluate(snapshot, now=None):
+    """Apply the enforcement rules; returns (halt_reasons, warnings)"""
+    now = now or datetime.now()
+    tier = snapshot.get('subscription_tier', 'starter')
+    subscription_status = snapshot.get('subscription_status', 'active')
+    subscription_end_date = snapshot.get('subscription_end_date')
+    last_payment_date = snapshot.get('last_payment_date')
+
+    subscription_expired = bool(subscription_end_date and subscription_end_date < now)
+    grace_period_expired = subscription_expired and now > subscription_end_date + timedelta(days=GRACE_PERIOD_DAYS)
+    # No payment record at all counts as overdue
+    payment_overdue = not last_payment_date or (now - last_payment_date).days > PAYMENT_OVERDUE_DAYS
+
+    halt_reasons = []
+    if subscription_status != 'active':
+        halt_reasons.append(f"Your {tier} subscription is {subscription_status}")
+    if grace_period_expired:
+        halt_reasons.append("Your subscription grace period has expired")
+    if payment_overdue:
+        halt_reasons.append("Your subscription payment is overdue")
+    if not last_payment_date:
+        halt_reasons.append("No payment record found for your subscription")
+
+    warnings = []
+    if subscription_end_date and not subscription_expired:
+        days_until_expiry = (subscription_end_date - now).days
+        if days_until_expiry <= 3:
+            warnings.append(f"⚠️ Your subscription expires in {days_until_expiry} days")
+    if subscription_expired and not grace_period_expired:
+        days_in_grace = (now - subscription_end_date).days
+        warnings.append(f"⚠️ Subscription expired {days_in_grace} days ago - Grace period ends soon")
+    if snapshot.get('auto_renew', False) and subscription_expired:
+        warnings.append("⚠️ Auto-renewal failed - Please update payment method")
+
+    return halt_reasons, warnings
+
+
+def suspend(db, admin_id, reasons, fields=None, event=None):
+    """Move an admin into 'suspended' unless already there; true only for the caller that made the change.
+
+    fields are extra admin fields to set with the transition and event extra
+    fields for the one subscription_suspensions record written.
+    """
+    now = datetime.now()
+    before = db.admins.find_one_and_update(
+        {'_id': admin_id, 'subscription_status': {'$ne': 'suspended'}},
+        {'$set': dict(fields or {}, subscription_status='suspended', suspended_at=now, suspension_reason='; '.join(reasons))},
+        projection=SNAPSHOT_FIELDS
+    )
+    # Either way the cached snapshot no longer says what the document does
+    invalidate(admin_id)
+    if before is None:
+        return False
+
+    db.subscription_suspensions.insert_one(dict(
+        event or {},
+        admin_id=admin_id,
+        suspended_at=now,
+        reasons=reasons,
+        previous_status=before.get('subscription_status'),
+        tier_at_suspension=before.get('subscription_tier', 'unknown'),
+        last_payment_date=before.get('last_payment_date'),
+        subscription_end_date=before.get('subscription_end_date')
+    ))
+    logger.critical(f"SUBSCRIPTION SUSPENDED - Admin {admin_id}: {'; '.join(reasons)}")
+    return True
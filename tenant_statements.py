@@ -0,0 +1,167 @@
+# tenant_statements.py
+"""
+Tenant portal statements: readings joined to their bills in one aggregation.
+
+The portal and the history download used to read a tenant's readings and
+then run one ``payments.find_one`` per reading. ``statement`` builds the
+whole view (tenant, readings with payment status, paid and outstanding
+amounts, and the landlord's contact) with a single aggregation on
+``tenants``: readings are ``$lookup``ed by tenant and each reading's bill is
+``$lookup``ed by (tenant, month_year).
+
+Every SMS carries a portal link, so opens spike after each billing run.
+Views are cached per tenant under a data version that ``bump`` advances
+whenever one of the tenant's readings or bills is written, so a repeat open
+costs no database work and a write is never hidden by a view built before
+it. Versions live in this process; views also expire after
+``PORTAL_CACHE_TTL`` seconds, which bounds how long a write made by another
+process can go unseen.
+
+``history`` returns the same fields for a tenant's whole history as a cursor,
+for exports that stream it instead of caching it.
+"""
+import logging
+import os
+import threading
+
+from lru import LRUCache
+import property_backfill
+
+logger = logging.getLogger(__name__)
+
+PORTAL_READINGS = 12
+CACHE_SIZE = int(os.getenv('PORTAL_CACHE_SIZE', 2048))
+CACHE_TTL_SECONDS = int(os.getenv('PORTAL_CACHE_TTL', 300))
+# Bills a reading can be paid through: water bills, and bills from before bill_type existed
+READING_BILL_TYPES = ['water', None]
+
+_views = LRUCache(maxsize=CACHE_SIZE, ttl=CACHE_TTL_SECONDS)
+_versions = {}
+_versions_lock = threading.Lock()
+
+
+def version(tenant_id):
+    """Current data version of a tenant in this process"""
+    return _versions.get(tenant_id, 0)
+
+
+def bump(tenant_ids):
+    """Advance the data version of tenants whose readings or bills were just written"""
+    with _versions_lock:
+        for tenant_id in {tenant_id for tenant_id in tenant_ids if tenant_id}:
+            _versions[tenant_id] = _versions.get(tenant_id, 0) + 1
+
+
+def _property_expr(db, field, property_id='$$property_id'):
+    # Tenants without a property see all their documents; legacy documents without property_id match until the backfill is done
+    clauses = [{'$eq': [property_id, None]}, {'$eq': [field, property_id]}]
+    if not property_backfill.is_backfill_complete(db):
+        clauses.append({'$eq': [{'$type': field}, 'missing']})
+    return {'$or': clauses}
+
+
+def _payment_stages(db, tenant_id, admin_id, property_id):
+    """Stages adding amount_paid, outstanding, payment_status and payment_date to readings from their bills"""
+    return [
+        {'$lookup': {
+            'from': 'payments',
+            'let': {
+                'month': {'$dateToString': {'format': '%Y-%m', 'date': '$date_recorded'}},
+                'property_id': property_id
+            },
+            'pipeline': [
+                {'$match': {
+                    'tenant_id': tenant_id,
+                    'admin_id': admin_id,
+                    'bill_type': {'$in': READING_BILL_TYPES},
+                    '$expr': {'$and': [{'$eq': ['$month_year', '$$month']}, _property_expr(db, '$property_id')]}
+                }},
+                {'$limit': 1},
+                {'$project': {'amount_paid': 1, 'payment_date': 1}}
+            ],
+            'as': 'bill'
+        }},
+        {'$set': {'bill': {'$arrayElemAt': ['$bill', 0]}}},
+        {'$set': {'amount_paid': {'$ifNull': ['$bill.amount_paid', 0]}}},
+        {'$set': {
+            'outstanding': {'$max': [0, {'$subtract': ['$bill_amount', '$amount_paid']}]},
+            'payment_date': {'$ifNull': ['$bill.payment_date', None]}
+        }},
+        {'$set': {'payment_status': {'$switch': {
+            'branches': [
+                {'case': {'$eq': [{'$type': '$bill'}, 'missing']}, 'then': 'Unpaid'},
+                {'case': {'$eq': ['$outstanding', 0]}, 'then': 'Paid'},
+                {'case': {'$gt': ['$amount_paid', 0]}, 'then': 'Partial'}
+            ],
+            'default': 'Unpaid'
+        }}}},
+        {'$unset': 'bill'}
+    ]
+
+
+def statement_pipeline(db, tenant_id, admin_id, limit=PORTAL_READINGS, newest_first=True):
+    """Aggregation on tenants producing one document: the tenant with 'readings' and 'landlord'"""
+    order = -1 if newest_first else 1
+    readings_pipeline = [
+        {'$match': {
+            'tenant_id': tenant_id,
+            'admin_id': admin_id,
+            'date_recorded': {'$ne': None},
+            '$expr': _property_expr(db, '$property_id')
+        }},
+        {'$sort': {'date_recorded': order, '_id': order}},
+    ]
+    if limit:
+        readings_pipeline.append({'$limit': limit})
+    readings_pipeline += _payment_stages(db, tenant_id, admin_id, '$$property_id')
+
+    return [
+        {'$match': {'_id': tenant_id, 'admin_id': admin_id}},
+        {'$lookup': {
+            'from': 'meter_readings',
+            'let': {'property_id': {'$ifNull': ['$property_id', None]}},
+            'pipeline': readings_pipeline,
+            'as': 'readings'
+        }},
+        {'$lookup': {
+            'from': 'admins',
+            'pipeline': [{'$match': {'_id': admin_id}}, {'$project': {'name': 1, 'phone': 1}}],
+            'as': 'landlord'
+        }}
+    ]
+
+
+def history(db, tenant, admin_id, batch_size=None):
+    """Cursor over all of a tenant's readings, oldest first, with the same payment fields as statement.
+
+    Not cached: exports read it in batches so a long history never sits in memory.
+    """
+    query = {'tenant_id': tenant['_id'], 'admin_id': admin_id, 'date_recorded': {'$ne': None}}
+    if tenant.get('property_id'):
+        query.update(property_backfill.property_filter(db, tenant['property_id']))
+    pipeline = [{'$match': query}, {'$sort': {'date_recorded': 1, '_id': 1}}]
+    pipeline += _payment_stages(db, tenant['_id'], admin_id, {'$literal': tenant.get('property_id')})
+    if batch_size:
+        return db.meter_readings.aggregate(pipeline, batchSize=batch_size)
+    return db.meter_readings.aggregate(pipeline)
+
+
+def statement(db, tenant_id, admin_id, limit=PORTAL_READINGS, newest_first=True):
+    """{'tenant', 'readings', 'admin'} for a tenant, or None if the tenant does not belong to admin_id.
+
+    Cached per tenant and data version; treat the result as read-only.
+    """
+    key = (tenant_id, admin_id, limit, newest_first, version(tenant_id))
+    view = _views.get(key)
+    if view is None:
+        document = next(db.tenants.aggregate(statement_pipeline(db, tenant_id, admin_id, limit, newest_first)), None)
+        if document is None:
+            return None
+        landlord = document.pop('landlord')
+        view = {
+            'readings': document.pop('readings'),
+            'admin': landlord[0] if landlord else None,
+            'tenant': document
+        }
+        _views.set(key, view)
+    return view
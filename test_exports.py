@@ -0,0 +1,139 @@
+import csv
+import io
+import os
+import re
+import tempfile
+import time
+import tracemalloc
+import unittest
+import zipfile
+from datetime import datetime, timedelta
+
+import xlsxwriter
+
+import exports
+
+SMALL = 2000
+LARGE = 20000
+HEADERS = ['Date', 'Previous Reading (m³)', 'Current Reading (m³)', 'Usage (m³)', 'Bill Amount', 'Payment Status', 'Amount Paid', 'Outstanding']
+
+
+def history(rows):
+    """Synthetic reading history rows, generated lazily like a cursor"""
+    started = datetime(2015, 1, 1)
+    reading = 0.0
+    for i in range(rows):
+        usage = float(i % 37)
+        bill = usage * 150.0
+        paid = bill if i % 3 else bill / 2
+        yield [started + timedelta(days=i), reading, reading + usage, usage, bill,
+               'Paid' if paid >= bill else 'Partial', paid, bill - paid]
+        reading += usage
+
+
+def peak_bytes(work):
+    """Peak Python heap allocated while work runs"""
+    tracemalloc.start()
+    try:
+        work()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def sheet_xml(path):
+    with zipfile.ZipFile(path) as archive:
+        return archive.read('xl/worksheets/sheet1.xml').decode()
+
+
+class TestColumnWidths(unittest.TestCase):
+
+    def test_widths_fit_headers_and_sample(self):
+        widths = exports.estimate_widths(['Name', 'Phone'], [['Wanjiru Kamau', '+254712345678'], ['Jo', None]])
+        self.assertEqual(widths, [len('Wanjiru Kamau') + 2, len('+254712345678') + 2])
+
+    def test_widths_are_clamped(self):
+        widths = exports.estimate_widths(['A', 'B'], [['x' * 200, 1]])
+        self.assertEqual(widths, [exports.MAX_WIDTH, exports.MIN_WIDTH])
+
+    def test_rows_wider_than_headers(self):
+        self.assertEqual(len(exports.estimate_widths(['Name'], [['Jane', '2025-01-01', 12.5]])), 3)
+
+
+class TestStreamingExports(unittest.TestCase):
+
+    def setUp(self):
+        handle, self.path = tempfile.mkstemp(suffix='.xlsx')
+        os.close(handle)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def write(self, rows):
+        def build(workbook):
+            worksheet = workbook.add_worksheet('History')
+            worksheet.write(0, 0, 'My Water Usage History')
+            self.written = exports.write_table(worksheet, 2, HEADERS, history(rows))
+            worksheet.write(self.written + 4, 0, 'Total Readings:')
+        exports.write_xlsx(self.path, build)
+
+    def csv_bytes(self, rows):
+        return sum(len(chunk) for chunk in exports.csv_chunks(HEADERS, history(rows)))
+
+    def test_xlsx_keeps_every_row_in_order(self):
+        self.write(SMALL)
+        self.assertEqual(self.written, SMALL)
+        xml = sheet_xml(self.path)
+        rows = [int(number) for number in re.findall(r'<row r="(\d+)"', xml)]
+        self.assertEqual(rows, sorted(rows))
+        self.assertEqual(len(rows), SMALL + 3)
+        # Widths estimated from the sample are applied although the rows were flushed first
+        self.assertIn('<cols>', xml)
+
+    def test_csv_round_trips(self):
+        text = b''.join(exports.csv_chunks(HEADERS, history(5))).decode('utf-8-sig')
+        rows = list(csv.reader(io.StringIO(text)))
+        self.assertEqual(rows[0], HEADERS)
+        self.assertEqual(len(rows), 6)
+        self.assertEqual(rows[1][0], '2015-01-01')
+        self.assertEqual(rows[2][4], '150')
+
+    def test_csv_is_chunked_by_batch(self):
+        chunks = list(exports.csv_chunks(HEADERS, history(exports.BATCH_SIZE * 3)))
+        self.assertEqual(len(chunks), 4)
+
+    def test_peak_memory_does_not_grow_with_history(self):
+        xlsx_small = peak_bytes(lambda: self.write(SMALL))
+        xlsx_large = peak_bytes(lambda: self.write(LARGE))
+        csv_small = peak_bytes(lambda: self.csv_bytes(SMALL))
+        csv_large = peak_bytes(lambda: self.csv_bytes(LARGE))
+
+        # Ten times the rows may not cost more than a fraction more memory
+        self.assertLess(xlsx_large, xlsx_small * 1.5, (xlsx_small, xlsx_large))
+        self.assertLess(csv_large, csv_small * 1.5, (csv_small, csv_large))
+
+    def test_benchmark(self):
+        def in_memory():
+            output = io.BytesIO()
+            workbook = xlsxwriter.Workbook(output, {'in_memory': True})
+            worksheet = workbook.add_worksheet('History')
+            rows = list(history(LARGE))
+            for row, values in enumerate(rows, 1):
+                for col, value in enumerate(values):
+                    worksheet.write(row, col, value)
+            workbook.close()
+
+        started = time.perf_counter()
+        streamed = peak_bytes(lambda: self.write(LARGE))
+        streamed_s = time.perf_counter() - started
+        started = time.perf_counter()
+        buffered = peak_bytes(in_memory)
+        buffered_s = time.perf_counter() - started
+
+        print(f"\n{LARGE} rows: in-memory workbook peak {buffered / 2 ** 20:.1f} MiB in {buffered_s:.1f} s, "
+              f"streamed peak {streamed / 2 ** 20:.1f} MiB in {streamed_s:.1f} s")
+        self.assertLess(streamed, buffered)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,122 @@
+import random
+import unittest
+from datetime import datetime, timedelta
+
+from bson import ObjectId
+
+import late_fines
+
+
+def billing_settings(enabled=True, grace=7, fine_type='percentage', rate=5, frequency='one_time', cap=0):
+    return {'billing': {
+        'enable_late_payment_fines': enabled,
+        'grace_period_days': grace,
+        'fine_type': fine_type,
+        'fine_rate': rate,
+        'fine_frequency': frequency,
+        'max_fine_amount': cap
+    }}
+
+
+class TestLateFines(unittest.TestCase):
+
+    def setUp(self):
+        self.admin_id = ObjectId()
+        self.random = random.Random(16)
+
+    def bill(self, property_id, days_overdue, bill_amount=1000.0, amount_paid=0.0, payment_status='unpaid'):
+        # Half a day off the boundary, so the scalar rule's own datetime.now() sees the same whole days
+        return {
+            '_id': ObjectId(),
+            'admin_id': self.admin_id,
+            'property_id': property_id,
+            'due_date': datetime.now() - timedelta(days=days_overdue, hours=12),
+            'bill_amount': bill_amount,
+            'amount_paid': amount_paid,
+            'payment_status': payment_status
+        }
+
+    def assert_matches_scalar(self, bills, settings):
+        fines = late_fines.compute_fines(bills, settings)
+        self.assertEqual(len(fines), len(bills))
+        for bill, fine in zip(bills, fines):
+            expected = late_fines.calculate_fine(bill, settings[late_fines.settings_key(bill)])
+            self.assertEqual(fine, expected, f"bill {bill}")
+
+    def test_rules(self):
+        settings = {
+            (self.admin_id, 'one_time'): billing_settings(),
+            (self.admin_id, 'monthly'): billing_settings(frequency='monthly'),
+            (self.admin_id, 'fixed_capped'): billing_settings(fine_type='fixed', rate=300, frequency='monthly', cap=500),
+            (self.admin_id, 'disabled'): billing_settings(enabled=False),
+            (self.admin_id, 'empty'): {}
+        }
+        bills = [
+            self.bill('one_time', 3),
+            self.bill('one_time', 7),
+            self.bill('one_time', 8),
+            self.bill('one_time', 90, amount_paid=400.0, payment_status='partial'),
+            self.bill('one_time', 90, amount_paid=1000.0, payment_status='partial'),
+            self.bill('one_time', 90, payment_status='paid'),
+            self.bill('monthly', 8),
+            self.bill('monthly', 36),
+            self.bill('monthly', 37),
+            self.bill('monthly', 400),
+            self.bill('fixed_capped', 20),
+            self.bill('fixed_capped', 60),
+            self.bill('disabled', 60),
+            self.bill('empty', 60),
+            self.bill('one_time', -10),
+        ]
+        self.assert_matches_scalar(bills, settings)
+
+        fines = late_fines.compute_fines(bills, settings)
+        self.assertEqual(fines[:4], [0.0, 0.0, 50.0, 30.0])
+        self.assertEqual(fines[6:10], [50.0, 50.0, 100.0, 700.0])
+        self.assertEqual(fines[10:12], [300.0, 500.0])
+
+    def test_odd_documents(self):
+        settings = {(self.admin_id, None): billing_settings(grace=0)}
+        bills = [
+            dict(self.bill(None, 10), due_date=None),
+            dict(self.bill(None, 10), due_date='2020-01-15'),
+            dict(self.bill(None, 10), due_date='15/01/2020'),
+            dict(self.bill(None, 10), amount_paid=None),
+            {'admin_id': self.admin_id, 'property_id': None, 'due_date': datetime.now() - timedelta(days=40, hours=12)},
+        ]
+        self.assert_matches_scalar(bills, settings)
+
+    def test_matches_scalar_bill_for_bill(self):
+        settings = {}
+        for property_number in range(20):
+            settings[(self.admin_id, property_number)] = billing_settings(
+                enabled=self.random.random() < 0.8,
+                grace=self.random.choice([0, 3, 7, 14, 30]),
+                fine_type=self.random.choice(['percentage', 'fixed']),
+                rate=self.random.choice([2, 5, 7.5, 10, 150, 250]),
+                frequency=self.random.choice(['one_time', 'monthly']),
+                cap=self.random.choice([0, 0, 200, 1000])
+            )
+        bills = []
+        for _ in range(5000):
+            bill_amount = round(self.random.uniform(50, 20000), 2)
+            amount_paid = self.random.choice([0.0, round(self.random.uniform(0, bill_amount), 2), bill_amount])
+            status = 'paid' if amount_paid >= bill_amount else ('partial' if amount_paid else 'unpaid')
+            bills.append(self.bill(
+                self.random.randrange(20), self.random.randint(-30, 400),
+                bill_amount=bill_amount, amount_paid=amount_paid, payment_status=status
+            ))
+        self.assert_matches_scalar(bills, settings)
+
+    def test_stored_fine(self):
+        self.assertIsNone(late_fines.stored_fine({'payment_status': 'unpaid'}))
+        self.assertEqual(late_fines.stored_fine({'payment_status': 'unpaid', 'late_fine': 75.5, 'fine_computed_at': datetime.now()}), 75.5)
+        self.assertEqual(late_fines.stored_fine({'payment_status': 'paid', 'late_fine': 75.5, 'fine_computed_at': datetime.now()}), 0.0)
+
+    def test_stale_stored_fine_is_recomputed(self):
+        computed_at = datetime.now() - timedelta(hours=late_fines.MAX_AGE_HOURS + 1)
+        self.assertIsNone(late_fines.stored_fine({'payment_status': 'partial', 'late_fine': 75.5, 'fine_computed_at': computed_at}))
+
+
+if __name__ == '__main__':
+    unittest.main()
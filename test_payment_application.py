@@ -0,0 +1,157 @@
+import os
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from bson import ObjectId
+from pymongo import MongoClient
+from pymongo.errors import PyMongoError
+
+import balances
+
+# Pipeline updates need a real MongoDB (4.2+); the suite uses a throwaway database on it
+TEST_MONGO_URI = os.getenv('TEST_MONGO_URI', 'mongodb://localhost:27017')
+THREADS = 32
+
+
+class TestPaymentApplication(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.client = MongoClient(TEST_MONGO_URI, serverSelectionTimeoutMS=2000)
+        try:
+            cls.client.admin.command('ping')
+        except PyMongoError as e:
+            raise unittest.SkipTest(f"MongoDB not available at {TEST_MONGO_URI}: {e}")
+        cls.db = cls.client[f"test_payment_application_{os.getpid()}"]
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.client.drop_database(cls.db.name)
+        cls.client.close()
+
+    def setUp(self):
+        self.db.payments.delete_many({})
+        self.db.tenant_balances.delete_many({})
+        self.admin_id = ObjectId()
+        self.tenant_id = ObjectId()
+
+    def insert_bill(self, bill_amount, month_year='2025-01'):
+        bill = {
+            '_id': ObjectId(),
+            'admin_id': self.admin_id,
+            'tenant_id': self.tenant_id,
+            'bill_type': 'water',
+            'month_year': month_year,
+            'bill_amount': bill_amount,
+            'amount_paid': 0.0,
+            'payment_status': 'unpaid',
+            'created_at': datetime.now()
+        }
+        balances.insert_bills(self.db, [bill])
+        return bill['_id']
+
+    def ledger_total(self):
+        return balances.arrears(self.db, self.admin_id, self.tenant_id)
+
+    def test_concurrent_payments_are_all_counted(self):
+        """Hammering one bill from many threads loses no update"""
+        bill_id = self.insert_bill(5000.0)
+
+        def pay(i):
+            return balances.apply_payment(
+                self.db, {'_id': bill_id, 'admin_id': self.admin_id}, 25.0,
+                {'last_payment_method': 'cash'}, {'amount': 25.0, 'method': 'cash', 'notes': f'$payment {i}'}
+            )
+
+        with ThreadPoolExecutor(max_workers=THREADS) as executor:
+            results = list(executor.map(pay, range(200)))
+
+        self.assertTrue(all(results))
+        bill = self.db.payments.find_one({'_id': bill_id})
+        self.assertEqual(bill['amount_paid'], 5000.0)
+        self.assertEqual(bill['payment_status'], 'paid')
+        self.assertEqual(bill['payment_count'], 200)
+        self.assertEqual(len(bill['payment_history']), 200)
+        self.assertEqual(self.ledger_total(), 0)
+
+    def test_overpayment_guard_under_contention(self):
+        """Only the payments that fit in the bill are applied when overpayment is refused"""
+        bill_id = self.insert_bill(1000.0)
+
+        def pay(_):
+            return balances.apply_payment(
+                self.db, {'_id': bill_id}, 100.0, allow_overpayment=False
+            )
+
+        with ThreadPoolExecutor(max_workers=THREADS) as executor:
+            results = list(executor.map(pay, range(50)))
+
+        self.assertEqual(sum(1 for result in results if result), 10)
+        bill = self.db.payments.find_one({'_id': bill_id})
+        self.assertEqual(bill['amount_paid'], 1000.0)
+        self.assertEqual(bill['payment_status'], 'paid')
+        self.assertEqual(self.ledger_total(), 0)
+
+    def test_refused_overpayment_is_rounded_and_capped(self):
+        """A payment inside the rounding tolerance settles the bill without storing more than its amount"""
+        bill_id = self.insert_bill(100.0)
+
+        balances.apply_payment(self.db, {'_id': bill_id}, 60.0, allow_overpayment=False)
+        after = balances.apply_payment(self.db, {'_id': bill_id}, 40.004, allow_overpayment=False)
+
+        self.assertEqual(after['amount_paid'], 100.0)
+        self.assertEqual(after['payment_status'], 'paid')
+        stored = self.db.payments.find_one({'_id': bill_id})
+        self.assertEqual(stored['amount_paid'], 100.0)
+        self.assertEqual(self.ledger_total(), 0)
+
+    def test_partial_payment_status_and_post_image(self):
+        bill_id = self.insert_bill(300.0)
+
+        after = balances.apply_payment(self.db, {'_id': bill_id}, 120.0)
+
+        self.assertEqual(after['amount_paid'], 120.0)
+        self.assertEqual(after['payment_status'], 'partial')
+        stored = self.db.payments.find_one({'_id': bill_id})
+        self.assertEqual(stored['payment_status'], 'partial')
+        self.assertEqual(self.ledger_total(), 180.0)
+
+    def test_missing_bill_returns_none(self):
+        self.assertIsNone(balances.apply_payment(self.db, {'_id': ObjectId()}, 10.0))
+
+    def test_split_receipt_across_bills(self):
+        """One receipt split over several bills is applied in one bulk write"""
+        bill_ids = [self.insert_bill(200.0, f'2025-0{month}') for month in range(1, 4)]
+
+        afters = balances.apply_payments(self.db, self.admin_id, [
+            (bill_ids[0], 200.0, {'last_payment_method': 'mpesa'}, {'amount': 200.0}),
+            (bill_ids[1], 50.0, {'last_payment_method': 'mpesa'}, {'amount': 50.0}),
+            (ObjectId(), 10.0, None, None),
+        ])
+
+        self.assertEqual(set(afters), set(bill_ids[:2]))
+        self.assertEqual(afters[bill_ids[0]]['payment_status'], 'paid')
+        self.assertEqual(afters[bill_ids[1]]['payment_status'], 'partial')
+        statuses = {bill['_id']: bill['payment_status'] for bill in self.db.payments.find()}
+        self.assertEqual(statuses, {bill_ids[0]: 'paid', bill_ids[1]: 'partial', bill_ids[2]: 'unpaid'})
+        self.assertEqual(self.ledger_total(), 350.0)
+
+    def test_concurrent_split_receipts_are_all_counted(self):
+        bill_ids = [self.insert_bill(1000.0, f'2025-0{month}') for month in range(1, 3)]
+
+        def pay(_):
+            return balances.apply_payments(self.db, self.admin_id, [
+                (bill_ids[0], 10.0, None, None),
+                (bill_ids[1], 5.0, None, None),
+            ])
+
+        with ThreadPoolExecutor(max_workers=THREADS) as executor:
+            list(executor.map(pay, range(100)))
+
+        paid = {bill['_id']: bill['amount_paid'] for bill in self.db.payments.find()}
+        self.assertEqual(paid, {bill_ids[0]: 1000.0, bill_ids[1]: 500.0})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,199 @@
+import os
+import random
+import re
+import time
+import unittest
+
+from bson import ObjectId
+from pymongo import MongoClient
+from pymongo.errors import PyMongoError
+
+import db_indexes
+import search_keys
+
+# Index use can only be checked against a real MongoDB; the suite uses a throwaway database on it
+TEST_MONGO_URI = os.getenv('TEST_MONGO_URI', 'mongodb://localhost:27017')
+TENANTS = 10000
+FIRST_NAMES = ['Jane', 'John', 'Wanjiru', 'Kamau', 'Achieng', 'Otieno', 'Mary', 'Peter', 'Njeri', 'Mwangi', 'Akinyi', 'Brian']
+LAST_NAMES = ['Wanjau', 'Odhiambo', 'Kariuki', 'Mutua', 'Chebet', 'Kiprop', 'Njoroge', 'Omondi', 'Wafula', 'Maina']
+
+
+def legacy_regex(term):
+    return {'$regex': re.escape(term.strip()), '$options': 'i'}
+
+
+def at_token_start(term, value):
+    """Whether term occurs in value where a name token starts, i.e. a legacy match the prefix search keeps"""
+    return re.search(r'(?<![0-9a-z])' + re.escape(term.lower()), (value or '').lower()) is not None
+
+
+class TestSearchKeyGeneration(unittest.TestCase):
+
+    def test_name_prefixes(self):
+        keys = search_keys.tenant_keys({'name': "Mary-Anne O'Brien"})
+        for key in ('n:m', 'n:mary', 'n:anne', 'n:o', 'n:brien', 'n:bri'):
+            self.assertIn(key, keys)
+        self.assertNotIn('n:ary', keys)
+
+    def test_house_numbers(self):
+        keys = search_keys.tenant_keys({'house_number': 'Block B-12'})
+        for key in ('h:blockb12', 'h:block', 'h:b12', 'h:12', 'h:1'):
+            self.assertIn(key, keys)
+        self.assertEqual(search_keys.term_keys(' b-12 ', 'house'), ['h:b12'])
+
+    def test_phone_forms(self):
+        keys = search_keys.tenant_keys({'phone': '+254712345678'})
+        for key in ('p:2547123', 'p:07123', 'p:71234', 'p:254712345678', 'p:0712345678'):
+            self.assertIn(key, keys)
+        self.assertEqual(search_keys.term_keys('0712 345', 'phone'), ['p:0712345'])
+        self.assertIsNone(search_keys.term_keys('jane', 'phone'))
+
+    def test_filters(self):
+        self.assertEqual(search_keys.search_filter('Jan', ('name',)), {'search_keys': 'n:jan'})
+        self.assertEqual(search_keys.search_filter('jane wan', ('name',)), {'search_keys': {'$all': ['n:jane', 'n:wan']}})
+        self.assertEqual(search_keys.search_filter('A1'), {'$or': [{'search_keys': 'n:a1'}, {'search_keys': 'h:a1'}]})
+        self.assertEqual(search_keys.search_filter('!!', ('name',)), search_keys.NO_MATCH)
+
+    def test_bill_annotation_keeps_existing_names(self):
+        class Empty:
+            def find(self, *args, **kwargs):
+                return []
+
+        db = type('Db', (), {'tenants': Empty(), 'houses': Empty()})()
+        bill = {'tenant_id': ObjectId(), 'house_id': ObjectId(), 'tenant_name': 'Jane Doe', 'house_number': 'A1'}
+        search_keys.annotate_bills(db, [bill])
+        self.assertIn('n:doe', bill['search_keys'])
+        self.assertIn('h:a1', bill['search_keys'])
+
+
+class TestIndexedSearch(unittest.TestCase):
+    """Indexed search returns the legacy results anchored at token starts, at 10k tenants"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.client = MongoClient(TEST_MONGO_URI, serverSelectionTimeoutMS=2000)
+        try:
+            cls.client.admin.command('ping')
+        except PyMongoError as e:
+            raise unittest.SkipTest(f"MongoDB not available at {TEST_MONGO_URI}: {e}")
+        cls.db = cls.client[f"test_search_keys_{os.getpid()}"]
+        db_indexes.ensure_indexes(cls.db, ['tenants', 'payments'])
+
+        rng = random.Random(19)
+        cls.admin_id = ObjectId()
+        cls.property_id = ObjectId()
+        houses, tenants, bills = [], [], []
+        for i in range(TENANTS):
+            house = {'_id': ObjectId(), 'admin_id': cls.admin_id, 'property_id': cls.property_id,
+                     'house_number': f"{rng.choice('ABCDEFGH')}{i}"}
+            tenant = {
+                '_id': ObjectId(), 'admin_id': cls.admin_id, 'property_id': cls.property_id,
+                'name': f"{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)}",
+                'phone': f"07{rng.randrange(10 ** 8):08d}",
+                'house_number': house['house_number'], 'house_id': house['_id']
+            }
+            tenant['search_keys'] = search_keys.tenant_keys(tenant)
+            houses.append(house)
+            tenants.append(tenant)
+            bills.append({
+                'admin_id': cls.admin_id, 'property_id': cls.property_id, 'tenant_id': tenant['_id'],
+                'house_id': house['_id'], 'bill_type': 'water', 'payment_status': rng.choice(['unpaid', 'partial', 'paid']),
+                'bill_amount': 500.0, 'amount_paid': 0.0, 'due_date': None, 'month_year': '2025-01'
+            })
+        cls.db.houses.insert_many(houses)
+        cls.db.tenants.insert_many(tenants)
+        for start in range(0, len(bills), 1000):
+            cls.db.payments.insert_many(search_keys.annotate_bills(cls.db, bills[start:start + 1000]))
+        cls.tenants = tenants
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.client.drop_database(cls.db.name)
+        cls.client.close()
+
+    def scope(self):
+        return {'admin_id': self.admin_id, 'property_id': self.property_id}
+
+    def ids(self, collection, query):
+        return {doc['_id'] for doc in self.db[collection].find(query, {'_id': 1})}
+
+    def terms(self):
+        names = ['jan', 'Jane', 'wanj', 'KAM', 'o', 'mutua', 'an', 'iru', 'zzz']
+        houses = ['A1', 'b12', 'H999', 'C']
+        phones = [tenant['phone'][:5] for tenant in self.tenants[:3]] + ['345']
+        return names, houses, phones
+
+    def test_tenant_search_matches_legacy_at_token_start(self):
+        names, houses, phones = self.terms()
+        for field, attribute, terms in (('name', 'name', names), ('house', 'house_number', houses), ('phone', 'phone', phones)):
+            for term in terms:
+                # Names match at any token start; house and phone numbers from their first character
+                kept = at_token_start if field == 'name' else lambda term, value: value.lower().startswith(term.lower())
+                legacy = {
+                    tenant['_id'] for tenant in self.db.tenants.find(dict(self.scope(), **{attribute: legacy_regex(term)}))
+                    if kept(term, tenant[attribute])
+                }
+                indexed = self.ids('tenants', dict(self.scope(), **search_keys.search_filter(term, (field,))))
+                self.assertEqual(indexed, legacy, f"{field} search for {term!r}")
+
+    def test_multi_word_names(self):
+        indexed = self.ids('tenants', dict(self.scope(), **search_keys.search_filter('jane wanj', ('name',))))
+        expected = {
+            tenant['_id'] for tenant in self.tenants
+            if at_token_start('jane', tenant['name']) and at_token_start('wanj', tenant['name'])
+        }
+        self.assertEqual(indexed, expected)
+        self.assertTrue(expected)
+
+    def test_bill_search_matches_legacy_lookup(self):
+        names, houses, _ = self.terms()
+        for term in names + houses:
+            legacy = set()
+            for bill in self.db.payments.aggregate([
+                {'$match': self.scope()},
+                {'$lookup': {'from': 'tenants', 'localField': 'tenant_id', 'foreignField': '_id', 'as': 'tenant_info'}},
+                {'$lookup': {'from': 'houses', 'localField': 'house_id', 'foreignField': '_id', 'as': 'house_info'}},
+                {'$match': {'$or': [{'tenant_info.name': legacy_regex(term)}, {'house_info.house_number': legacy_regex(term)}]}}
+            ]):
+                name = bill['tenant_info'][0]['name']
+                house_number = bill['house_info'][0]['house_number']
+                if at_token_start(term, name) or house_number.lower().startswith(term.lower()):
+                    legacy.add(bill['_id'])
+            indexed = self.ids('payments', dict(self.scope(), **search_keys.search_filter(term, search_keys.BILL_SEARCH_FIELDS)))
+            self.assertEqual(indexed, legacy, f"bill search for {term!r}")
+
+    def test_searches_use_the_index(self):
+        for collection, fields, exact in (
+            ('tenants', ('name',), True),
+            ('payments', ('name',), True),
+            ('tenants', search_keys.SEARCH_FIELDS, False),
+            ('payments', search_keys.BILL_SEARCH_FIELDS, False),
+        ):
+            explain = self.db[collection].find(dict(self.scope(), **search_keys.search_filter('wanj', fields))).explain()
+            self.assertNotIn('COLLSCAN', str(explain['queryPlanner']['winningPlan']), collection)
+            if exact:
+                # A single key is read straight off the index: every document fetched is a result
+                stats = explain['executionStats']
+                self.assertEqual(stats['totalDocsExamined'], stats['nReturned'], collection)
+
+    def test_benchmark(self):
+        names, houses, phones = self.terms()
+        terms = names + houses + phones
+
+        started = time.perf_counter()
+        for term in terms:
+            list(self.db.tenants.find(dict(self.scope(), **{'$or': [
+                {'name': legacy_regex(term)}, {'house_number': legacy_regex(term)}, {'phone': legacy_regex(term)}
+            ]}), {'_id': 1}))
+        legacy_ms = (time.perf_counter() - started) * 1000
+
+        started = time.perf_counter()
+        for term in terms:
+            list(self.db.tenants.find(dict(self.scope(), **search_keys.search_filter(term)), {'_id': 1}))
+        indexed_ms = (time.perf_counter() - started) * 1000
+
+        print(f"\n{len(terms)} tenant searches over {TENANTS} tenants: regex {legacy_ms:.1f} ms, indexed {indexed_ms:.1f} ms")
+
+
+if __name__ == '__main__':
+    unittest.main()
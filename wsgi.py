@@ -0,0 +1,13 @@
+# wsgi.py
+"""
+Web server entry point: ``gunicorn wsgi:app``.
+
+Importing home only builds the app; the background queues (SMS outbox,
+payment inbox) are started here, so only processes that serve requests run
+them and one-off commands that import home do not.
+"""
+from home import app, start_background_workers
+
+start_background_workers()
+
+__all__ = ['app']